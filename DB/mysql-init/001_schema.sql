@@ -29,7 +29,8 @@ CREATE TABLE IF NOT EXISTS weight_data (
   device_id  VARCHAR(50)  NOT NULL,
   weight     FLOAT        NOT NULL,
   `timestamp` DATETIME    NOT NULL,
-  PRIMARY KEY (id),
+  -- timestamp is part of every unique key so analysis-service can range-partition the table
+  PRIMARY KEY (id, `timestamp`),
   -- אינדקסים לשאילתות בזמן
   UNIQUE KEY uniq_device_time (device_id, `timestamp`),
   KEY idx_weight_device_time (device_id, `timestamp`)
@@ -37,6 +38,41 @@ CREATE TABLE IF NOT EXISTS weight_data (
   DEFAULT CHARSET=utf8mb4
   COLLATE=utf8mb4_unicode_ci;
 
+-- === weight_daily_rollup (first/last/min/max per device and day) ========
+-- Maintained by analysis-service on every flush; daily analytics read this
+-- table instead of grouping raw weight_data.
+CREATE TABLE IF NOT EXISTS weight_daily_rollup (
+  device_id     VARCHAR(128) NOT NULL,
+  `day`         DATE         NOT NULL,
+  first_ts      DATETIME     NOT NULL,
+  first_weight  FLOAT        NOT NULL,
+  last_ts       DATETIME     NOT NULL,
+  last_weight   FLOAT        NOT NULL,
+  min_weight    FLOAT        NOT NULL,
+  max_weight    FLOAT        NOT NULL,
+  reading_count INT UNSIGNED NOT NULL,
+  drop_sum_g    FLOAT        NOT NULL DEFAULT 0,  -- sum of positive drops between consecutive readings
+  PRIMARY KEY (device_id, `day`)
+) ENGINE=InnoDB
+  DEFAULT CHARSET=utf8mb4
+  COLLATE=utf8mb4_unicode_ci;
+
+-- === weight_hourly_history (readings older than the retention period) ====
+-- Written by analysis-service just before it drops an expired weight_data partition.
+CREATE TABLE IF NOT EXISTS weight_hourly_history (
+  device_id     VARCHAR(128) NOT NULL,
+  `hour`        DATETIME     NOT NULL,
+  first_weight  FLOAT        NOT NULL,
+  last_weight   FLOAT        NOT NULL,
+  min_weight    FLOAT        NOT NULL,
+  max_weight    FLOAT        NOT NULL,
+  avg_weight    FLOAT        NOT NULL,
+  reading_count INT UNSIGNED NOT NULL,
+  PRIMARY KEY (device_id, `hour`)
+) ENGINE=InnoDB
+  DEFAULT CHARSET=utf8mb4
+  COLLATE=utf8mb4_unicode_ci;
+
 -- === client_stats -> user_stats (סטטיסטיקות פר משתמש) ===================
 -- === user_stats (per-user live stats for Smart Milk) ===================
 CREATE TABLE IF NOT EXISTS user_stats (
@@ -46,12 +82,24 @@ CREATE TABLE IF NOT EXISTS user_stats (
   cups_left                   FLOAT        NULL,  -- current_amount_g / avg_cup_grams
   percent_full                FLOAT        NULL,  -- 0..100
   expected_empty_date         DATE         NULL,  -- projected run-out date
+  expected_empty_at           DATETIME     NULL,  -- projected run-out time (hourly forecast)
   expiration_date             DATE         NULL,  -- expiration date
   PRIMARY KEY (container_id) 
 ) ENGINE=InnoDB
   DEFAULT CHARSET=utf8mb4
   COLLATE=utf8mb4_unicode_ci;
 
+-- === alert_state (alerts already sent, claimed by updates-service replicas) ===
+CREATE TABLE IF NOT EXISTS alert_state (
+  user_id    INT UNSIGNED NOT NULL,
+  alert_type VARCHAR(16)  NOT NULL,  -- 'warning' | 'critical' | 'over'
+  sent_at    DATETIME     NOT NULL,  -- UTC
+  replica    VARCHAR(64)  NOT NULL,  -- replica that sent it
+  PRIMARY KEY (user_id, alert_type)
+) ENGINE=InnoDB
+  DEFAULT CHARSET=utf8mb4
+  COLLATE=utf8mb4_unicode_ci;
+
 -- (אופציונלי) Seed לדוגמה – בטל/י אם לא צריך
 -- INSERT IGNORE INTO users (username,password,full_name,email,phone,device_id)
 -- VALUES ('demo','demo','Demo User','demo@example.com','050-0000000','device1');
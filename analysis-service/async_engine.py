@@ -0,0 +1,526 @@
+# analysis-service/async_engine.py
+"""
+MODE=async: the analysis pipeline on one asyncio event loop.
+
+The threaded engine (main.py) receives on the paho network thread and hands
+every reading to a worker thread that blocks on mysql-connector. Here the
+MQTT client (aiomqtt) and MySQL (aiomysql) share a single event loop, so no
+thread ever sits blocked on a socket:
+
+- a reading is parsed, run through the carton-removal tracker and folded
+  into AnalyticsState inline. None of that awaits, so each device's readings
+  are handled strictly in arrival order without per-device locks.
+- carton grace periods are loop.call_later() timers, one handle per device.
+- readings are buffered and flushed as multi-row weight_data inserts plus
+  rollup upserts, one explicit transaction per batch (the pool runs with
+  autocommit on), like WeightWriteBuffer does; only rows the INSERT IGNORE
+  actually stored are folded into the rollup.
+  Up to `max_inflight` batches are written concurrently, each on its own
+  pooled connection; the rollup upsert is order-independent, so batches may
+  commit in any order. A batch that fails is requeued at the head of the
+  buffer and retried with backoff, up to `max_retries` times.
+- user_stats is refreshed by a single writer task for the devices stored
+  since its last pass. Stats are computed right before they are written, and
+  only one upsert runs at a time, so older stats never overwrite newer ones.
+- when the buffer holds `max_pending` readings the MQTT consumer stops
+  reading until a flush makes room, pushing back on the broker connection.
+
+Table setup, the snapshot restore / warm-up and the retention job stay on
+the threaded connection pool in main.py; none of them is on the per-reading
+path.
+"""
+from __future__ import annotations
+import time
+import signal
+import asyncio
+from datetime import datetime
+
+import aiomqtt
+import aiomysql
+
+import carton
+import payload_codec
+from device_analytics import user_stats_row
+from ingest_buffer import (BufferedReading, INSERT_WEIGHTS_SQL, existing_weights_sql, new_rows,
+                           stored_key, weight_params)
+from mqtt_topics import content_type, parse_topic
+from rollup import UPSERT_ROLLUP_SQL, aggregate_batch
+
+PROTOCOLS = {"3.1": aiomqtt.ProtocolVersion.V31, "3.1.1": aiomqtt.ProtocolVersion.V311,
+             "5": aiomqtt.ProtocolVersion.V5}
+
+STATS_CHUNK = 500   # user_stats rows per multi-row upsert
+
+
+def aiomysql_config(mysql_config: dict) -> dict:
+    """mysql-connector connect() arguments -> aiomysql ones."""
+    cfg = dict(mysql_config)
+    if "database" in cfg:
+        cfg["db"] = cfg.pop("database")
+    return cfg
+
+
+class AsyncAnalysisEngine:
+    """
+    filters     -> MQTT subscription filters (see mqtt_topics.subscription_filters)
+    base_topic  -> topic whose `<base>/<device_id>` children name the device
+    parse       -> callable(payload bytes, topic_device, binary) returning a
+                   list of payload_codec.Reading, e.g. main.parse_payload
+    dedup       -> dedup.DuplicateFilter; QoS 1 redeliveries are dropped right after parsing
+    deadband    -> deadband.DeadbandFilter applied to every reading before it is stored
+    stats_sql   -> the user_stats upsert (executemany -> one multi-row upsert)
+    metrics     -> Metrics; stages are timed under the threaded engine's names
+    """
+
+    def __init__(self, *, mqtt_host: str, mqtt_port: int, filters, base_topic: str, protocol: str,
+                 mysql_config: dict, analytics, tracker, deadband, parse, stats_sql: str, metrics, dedup,
+                 client_id: str = "", batch_size: int = 200, max_latency_s: float = 0.5,
+                 pool_size: int = 10, max_inflight: int = 4, max_pending: int = 0,
+                 pool_recycle_s: float = 1800, stats_log_interval_s: float = 60.0,
+                 max_retries: int = 5, retry_backoff_s: float = 0.5, retry_backoff_max_s: float = 30.0):
+        if protocol not in PROTOCOLS:
+            raise ValueError(f"MQTT protocol must be one of {sorted(PROTOCOLS)}, got {protocol!r}")
+        self.mqtt_host = mqtt_host
+        self.mqtt_port = mqtt_port
+        self.filters = list(filters)
+        self.base_topic = base_topic
+        self.protocol = protocol
+        self.client_id = client_id
+        self.mysql_config = aiomysql_config(mysql_config)
+        self.pool_size = max(2, int(pool_size))
+        self.pool_recycle_s = pool_recycle_s
+        self.batch_size = max(1, int(batch_size))
+        self.max_latency_s = max(0.001, float(max_latency_s))
+        # One connection stays free for the user_stats writer
+        self.max_inflight = max(1, min(int(max_inflight), self.pool_size - 1))
+        self.max_pending = int(max_pending) or self.batch_size * (self.max_inflight + 1) * 4
+        self.stats_log_interval_s = stats_log_interval_s
+        self.max_retries = max(0, int(max_retries))
+        self.retry_backoff_s = float(retry_backoff_s)
+        self.retry_backoff_max_s = float(retry_backoff_max_s)
+        self._analytics = analytics
+        self._tracker = tracker
+        self._deadband = deadband
+        self._parse = parse
+        self._stats_sql = stats_sql
+        self._metrics = metrics
+        self._dedup = dedup
+
+        self._loop = None
+        self._pool = None
+        self._rows = []             # buffered BufferedReading, oldest first
+        self._oldest = None         # monotonic time of the oldest buffered row
+        self._failures = 0          # failed batch writes in a row
+        self._retry_at = 0.0        # monotonic time before which a requeued batch is not retried
+        self._timers = {}           # device_id -> asyncio.TimerHandle of its grace period
+        self._dirty = {}            # device_id -> msg_num of its latest stored reading (user_stats due)
+        self._writes = set()        # batch writes in flight
+        self._wake = None           # flusher: first row buffered / batch full / closing
+        self._room = None           # consumer: buffer below max_pending again
+        self._stats_due = None      # user_stats writer: devices became dirty
+        self._inflight = None       # limits concurrent batch writes
+        self._stop = None
+        self._closing = False
+
+        # Counters (read via stats())
+        self.received = 0
+        self.rows_flushed = 0
+        self.rows_failed = 0
+        self.rows_skipped = 0        # already in weight_data (INSERT IGNORE)
+        self.batches_flushed = 0
+        self.flush_errors = 0
+        self.flush_retries = 0
+        self.flushes_by_size = 0
+        self.flushes_by_deadline = 0
+        self.consumer_pauses = 0
+        self.flush_latency_total_s = 0.0
+        self.flush_latency_max_s = 0.0
+
+    # ---------- lifecycle ----------
+    async def run(self):
+        """Serve until SIGTERM/SIGINT (or stop()), then flush everything buffered and close the pool."""
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        self._room = asyncio.Event()
+        self._room.set()
+        self._stats_due = asyncio.Event()
+        self._inflight = asyncio.Semaphore(self.max_inflight)
+        self._stop = asyncio.Event()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                self._loop.add_signal_handler(sig, self._stop.set)
+            except (NotImplementedError, RuntimeError):
+                pass   # not on the main thread / not supported by this loop
+
+        await self._open_pool()
+        now = datetime.now()
+        for device_id, zero_start in self._tracker.pending():   # restored from a snapshot
+            self._arm(device_id, (zero_start + self._tracker.grace - now).total_seconds(), zero_start)
+
+        flusher = asyncio.ensure_future(self._flusher())
+        stats_writer = asyncio.ensure_future(self._stats_writer())
+        stats_logger = asyncio.ensure_future(self._stats_logger())
+        consumer = asyncio.ensure_future(self._consume())
+        print(f"[analysis] ⚡ Async engine running (batch {self.batch_size}, max latency "
+              f"{self.max_latency_s * 1000:.0f}ms, {self.max_inflight} batches in flight, "
+              f"{self.pool_size} MySQL connections)")
+        await self._stop.wait()
+
+        print("[analysis] ⚡ Async engine stopping - flushing buffered readings")
+        for task in (consumer, stats_logger, flusher):
+            task.cancel()
+        await asyncio.gather(consumer, stats_logger, flusher, return_exceptions=True)
+        for handle in self._timers.values():
+            handle.cancel()
+        if self._writes:
+            await asyncio.gather(*self._writes, return_exceptions=True)
+        while self._rows:   # including batches those writes requeued
+            await self._write(self._take(self.batch_size), requeue=False)
+        self._closing = True
+        self._stats_due.set()   # one last user_stats pass for everything stored
+        await stats_writer
+        self._pool.close()
+        await self._pool.wait_closed()
+        self._log_stats()
+
+    def stop(self):
+        if self._stop is not None:
+            self._loop.call_soon_threadsafe(self._stop.set)
+
+    async def _open_pool(self):
+        while True:
+            try:
+                self._pool = await aiomysql.create_pool(minsize=1, maxsize=self.pool_size,
+                                                        pool_recycle=self.pool_recycle_s, **self.mysql_config)
+                return
+            except Exception as e:
+                print(f"[analysis] Error connecting to MySQL: {e}; retrying in 5s…")
+                await asyncio.sleep(5)
+
+    # ---------- MQTT ----------
+    async def _consume(self):
+        while True:
+            try:
+                async with aiomqtt.Client(self.mqtt_host, self.mqtt_port, identifier=self.client_id or None,
+                                          protocol=PROTOCOLS[self.protocol]) as client:
+                    for f in self.filters:
+                        await client.subscribe(f)
+                    print(f"[analysis] Connected to MQTT and subscribed to {', '.join(self.filters)}")
+                    async for message in client.messages:
+                        if len(self._rows) >= self.max_pending:
+                            self.consumer_pauses += 1
+                            self._room.clear()
+                            await self._room.wait()
+                        self.handle(message.topic.value, message.payload, content_type(message))
+            except aiomqtt.MqttError as e:
+                print(f"[analysis] Error: {e}; retrying in 5s…")
+                await asyncio.sleep(5)
+
+    def handle(self, topic: str, payload: bytes, ctype: str | None = None):
+        """One MQTT message (a reading or a batch), start to buffer; runs on the loop and never awaits."""
+        self.received += 1
+        msg_num = self.received
+        try:
+            with self._metrics.time("parse"):
+                readings = self._parse(payload, *parse_topic(topic, self.base_topic, ctype))
+                reading = readings[-1]
+                device_id, weight = reading.device_id, reading.weight
+        except Exception as e:
+            print(f"[analysis] Message #{msg_num}: ERROR - {e}")
+            return
+        if self._dedup.seen(device_id, reading.message_id, reading.timestamp):
+            print(f"[analysis] Message #{msg_num}: ♻️ Duplicate msg_id {reading.message_id} from device {device_id} suppressed")
+            return
+        if len(readings) > 1:
+            print(f"[analysis] Message #{msg_num}: Received batch of {len(readings)} buffered readings "
+                  f"from device {device_id}, latest weight {weight}g")
+        elif reading.format == payload_codec.LEGACY:
+            print(f"[analysis] Message #{msg_num}: Received legacy format from device {device_id}, weight {weight}g")
+        else:
+            print(f"[analysis] Message #{msg_num}: Received from device {device_id}, weight {weight}g, msg_id: {reading.message_id}")
+        self._metrics.device_seen(device_id)
+        if len(readings) > 1:
+            self.handle_batch(device_id, readings, msg_num)
+            return
+
+        now = datetime.now()
+        with self._metrics.time("carton"):
+            outcome = self._tracker.observe(device_id, weight, now)
+        if outcome == carton.RETURNED:
+            print(f"[analysis] 🥛 Carton returned after removal! Current: {weight}g - canceling 0g timer")
+            handle = self._timers.pop(device_id, None)
+            if handle is not None:
+                handle.cancel()
+        if outcome in (carton.SAVE, carton.RETURNED):
+            self.save(device_id, weight, now, msg_num)
+            return
+        if outcome == carton.STARTED:
+            self._arm(device_id, self._tracker.grace.total_seconds(), now)
+            print(f"[analysis] 🥛 Carton removal detected for device {device_id} - starting 1 minute grace period")
+        else:
+            handle = self._timers.get(device_id)
+            remaining = max(0.0, handle.when() - self._loop.time()) if handle is not None else 0
+            print(f"[analysis] ⏳ Carton removal grace period active for device {device_id}, {remaining:.0f} seconds remaining")
+        self._metrics.inc("readings_held_total", description="0g readings held back by the carton-removal grace period")
+        print(f"[analysis] Message #{msg_num}: Weight {weight}g - carton removal grace period active, not saving yet")
+
+    def handle_batch(self, device_id: str, readings, msg_num: int):
+        """A store-and-forward backlog, like main.process_batch: own timestamps, buffered as one unit."""
+        now = datetime.now()
+        last = self._analytics.last_timestamp(device_id)
+        backlog = sorted(((r.weight, min(r.timestamp or now, now)) for r in readings), key=lambda r: r[1])
+        fresh = [r for r in backlog if last is None or r[1] > last]
+        with self._metrics.time("carton"):
+            stored = self._tracker.observe_backlog(device_id, fresh, now)
+            zero_start = self._tracker.zero_since(device_id)
+            if zero_start is None:
+                handle = self._timers.pop(device_id, None)
+                if handle is not None:
+                    handle.cancel()
+            else:
+                self._arm(device_id, (zero_start + self._tracker.grace - now).total_seconds(), zero_start)
+        queued = sum(self.save(device_id, weight, ts, msg_num, quiet=True) for weight, ts in stored)
+        self._metrics.inc("batched_readings_total", len(readings), description="Readings received in store-and-forward batches")
+        print(f"[analysis] Message #{msg_num}: 📦 Batch from device {device_id}: stored {queued} of "
+              f"{len(readings)} readings ({len(backlog) - len(fresh)} already seen)")
+
+    # ---------- carton grace periods ----------
+    def _arm(self, device_id: str, delay_s: float, zero_start: datetime):
+        old = self._timers.pop(device_id, None)
+        if old is not None:
+            old.cancel()
+        self._timers[device_id] = self._loop.call_later(max(0.0, delay_s), self._grace_expired, device_id, zero_start)
+
+    def _grace_expired(self, device_id: str, zero_start: datetime):
+        self._timers.pop(device_id, None)
+        if not self._tracker.expire(device_id, zero_start):
+            return  # carton came back (or a newer removal started)
+        print(f"[analysis] ⏰ Grace period expired for device {device_id} - carton appears to be empty, saving 0g")
+        self.save(device_id, 0.0, datetime.now(), 0)
+
+    # ---------- ingest buffer ----------
+    def save(self, device_id: str, weight: float, now: datetime, msg_num: int, quiet: bool = False) -> bool:
+        """
+        Fold the reading into the analytics state and buffer it for the next
+        batch, unless it is inside the write deadband. Returns True if buffered.
+        """
+        try:
+            stored = self._deadband.filter(device_id, float(weight), now)
+            if stored is None:
+                self._metrics.inc("readings_deadbanded_total", description="Steady readings not stored (write deadband)")
+                if not quiet:
+                    print(f"[analysis] Message #{msg_num}: Weight {weight}g within {self._deadband.deadband_g:g}g "
+                          f"of the last stored reading - not stored")
+                return False
+            drop_g = self._analytics.add_reading(device_id, stored, now)
+        except Exception as e:
+            print(f"[analysis] Message #{msg_num}: ERROR buffering weight - {e}")
+            return False
+        if not self._rows:
+            self._oldest = time.monotonic()
+            self._wake.set()   # start the latency deadline
+        self._rows.append(BufferedReading(device_id, stored, now, msg_num, drop_g))
+        if len(self._rows) >= self.batch_size:
+            self._wake.set()
+        return True
+
+    def _take(self, n: int):
+        rows = self._rows[:n]
+        del self._rows[:n]
+        self._oldest = time.monotonic() if self._rows else None
+        if len(self._rows) < self.max_pending:
+            self._room.set()
+        return rows
+
+    async def _sleep_until_woken(self, timeout):
+        self._wake.clear()
+        try:
+            await asyncio.wait_for(self._wake.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _flusher(self):
+        while True:
+            if not self._rows:
+                await self._sleep_until_woken(None)
+                continue
+            backoff = self._retry_at - time.monotonic()
+            if backoff > 0:   # a failed batch is waiting for its retry
+                await self._sleep_until_woken(backoff)
+                continue
+            by_size = len(self._rows) >= self.batch_size
+            if not by_size:
+                wait = self._oldest + self.max_latency_s - time.monotonic()
+                if wait > 0:
+                    await self._sleep_until_woken(wait)
+                    continue
+            await self._inflight.acquire()   # at most max_inflight batches being written
+            rows = self._take(self.batch_size)
+            if not rows:
+                self._inflight.release()
+                continue
+            if by_size:
+                self.flushes_by_size += 1
+            else:
+                self.flushes_by_deadline += 1
+            task = asyncio.ensure_future(self._write(rows, acquired=True))
+            self._writes.add(task)
+            task.add_done_callback(self._writes.discard)
+
+    async def _write(self, rows, acquired: bool = False, requeue: bool = True):
+        """Insert one batch and fold it into weight_daily_rollup; its devices then get fresh user_stats."""
+        started = time.monotonic()
+        written = False
+        try:
+            async with self._pool.acquire() as conn:
+                await conn.begin()
+                try:
+                    inserted = await self._insert(conn, rows)
+                    if inserted:
+                        async with conn.cursor() as cur:
+                            with self._metrics.time("rollup"):
+                                # Same transaction as the insert, so the rollup gets each stored row exactly once.
+                                # Same row order in every batch, so concurrent upserts lock rows in one order
+                                await cur.executemany(UPSERT_ROLLUP_SQL, sorted(aggregate_batch(inserted)))
+                    await conn.commit()
+                except Exception:
+                    try:
+                        await conn.rollback()
+                    except Exception:
+                        pass   # the connection is gone; the server drops the transaction
+                    raise
+                written = True
+                elapsed = time.monotonic() - started
+                self._record_flush(len(rows), len(rows) - len(inserted), elapsed)
+                self._metrics.observe("insert", elapsed)
+        except Exception as e:
+            if not written:
+                self._write_failed(rows, e, requeue)
+                return
+            # The rows are stored; only returning the connection failed
+            print(f"[analysis] ERROR releasing connection after flush - {e}")
+        finally:
+            if acquired:
+                self._inflight.release()
+        for r in rows:
+            self._dirty[r.device_id] = r.msg_num
+        self._stats_due.set()
+
+    @staticmethod
+    async def _insert(conn, rows) -> list:
+        """ingest_buffer.insert_rows on an aiomysql connection: returns the rows actually inserted."""
+        async with conn.cursor() as cur:
+            # executemany rewrites the INSERT into one multi-row statement
+            await cur.executemany(INSERT_WEIGHTS_SQL, weight_params(rows))
+            if cur.rowcount >= len(rows):
+                return rows
+        await conn.rollback()
+        await conn.begin()
+        keys = sorted({stored_key(r.device_id, r.timestamp) for r in rows})
+        async with conn.cursor() as cur:
+            await cur.execute(existing_weights_sql(len(keys)), [v for key in keys for v in key])
+            fresh = new_rows(rows, await cur.fetchall())
+            if fresh:
+                await cur.executemany(INSERT_WEIGHTS_SQL, weight_params(fresh))
+        return fresh
+
+    def _write_failed(self, rows, e: Exception, requeue: bool):
+        self.flush_errors += 1
+        self._failures += 1
+        if not requeue or self._failures > self.max_retries:
+            self._failures = 0
+            self.rows_failed += len(rows)
+            print(f"[analysis] ERROR flushing {len(rows)} buffered readings, dropping them - {e}")
+            return
+        delay = min(self.retry_backoff_max_s, self.retry_backoff_s * 2 ** (self._failures - 1))
+        self._rows[:0] = rows                 # back to the head of the buffer
+        self._oldest = time.monotonic() - self.max_latency_s
+        self._retry_at = time.monotonic() + delay
+        self.flush_retries += 1
+        self._wake.set()
+        print(f"[analysis] ERROR flushing {len(rows)} buffered readings (attempt {self._failures}/"
+              f"{self.max_retries + 1}), retrying in {delay:.1f}s - {e}")
+
+    def _record_flush(self, n: int, skipped: int, elapsed: float):
+        self._failures = 0
+        self._retry_at = 0.0
+        self.rows_flushed += n
+        self.rows_skipped += skipped
+        self.batches_flushed += 1
+        self.flush_latency_total_s += elapsed
+        self.flush_latency_max_s = max(self.flush_latency_max_s, elapsed)
+
+    # ---------- user_stats ----------
+    async def _stats_writer(self):
+        while True:
+            await self._stats_due.wait()
+            self._stats_due.clear()
+            await self._write_stats()
+            if self._closing and not self._dirty:
+                return
+
+    async def _write_stats(self):
+        dirty, self._dirty = self._dirty, {}
+        if not dirty:
+            return
+        now = datetime.now()
+        stats_rows = []
+        for device_id, msg_num in dirty.items():
+            try:
+                with self._metrics.time("analytics"):
+                    stats_rows.append(user_stats_row(self._analytics, device_id, now))
+            except Exception as e:
+                print(f"[analysis] Message #{msg_num}: ERROR computing analytics - {e}")
+        for i in range(0, len(stats_rows), STATS_CHUNK):
+            chunk = stats_rows[i:i + STATS_CHUNK]
+            try:
+                with self._metrics.time("upsert_user_stats"):
+                    async with self._pool.acquire() as conn:
+                        async with conn.cursor() as cur:
+                            await cur.executemany(self._stats_sql, chunk)
+                        await conn.commit()
+            except Exception as e:
+                print(f"[analysis] ERROR saving analytics for {len(chunk)} device(s) to MySQL - {e}")
+                continue
+            for row in chunk:
+                empty = f", empty around {row[6]:%Y-%m-%d %H:%M}" if row[6] else ""
+                print(f"[analysis] Message #{dirty[row[0]]}: Analytics saved to MySQL - {row[3]} cups left, {row[4]:.1f}% full{empty}")
+
+    # ---------- metrics ----------
+    def stats(self) -> dict:
+        batches = self.batches_flushed
+        return {
+            "received": self.received,
+            "pending": len(self._rows),
+            "in_flight": len(self._writes),
+            "rows_flushed": self.rows_flushed,
+            "rows_failed": self.rows_failed,
+            "rows_skipped": self.rows_skipped,
+            "batches_flushed": batches,
+            "flush_errors": self.flush_errors,
+            "flush_retries": self.flush_retries,
+            "flushes_by_size": self.flushes_by_size,
+            "flushes_by_deadline": self.flushes_by_deadline,
+            "batch_size_avg": (self.rows_flushed / batches) if batches else 0.0,
+            "flush_latency_avg_ms": (self.flush_latency_total_s / batches * 1000) if batches else 0.0,
+            "flush_latency_max_ms": self.flush_latency_max_s * 1000,
+            "grace_timers": len(self._timers),
+            "stats_due": len(self._dirty),
+            "consumer_pauses": self.consumer_pauses,
+        }
+
+    async def _stats_logger(self):
+        while True:
+            await asyncio.sleep(self.stats_log_interval_s)
+            self._log_stats()
+
+    def _log_stats(self):
+        s = self.stats()
+        print(
+            f"[analysis] ⚡ Async engine: {s['received']} received, {s['rows_flushed']} rows in "
+            f"{s['batches_flushed']} batches (avg {s['batch_size_avg']:.1f}), "
+            f"flush avg {s['flush_latency_avg_ms']:.1f}ms / max {s['flush_latency_max_ms']:.1f}ms, "
+            f"size/deadline flushes {s['flushes_by_size']}/{s['flushes_by_deadline']}, errors {s['flush_errors']} "
+            f"(retried {s['flush_retries']}, rows dropped {s['rows_failed']}), already stored {s['rows_skipped']}, pending {s['pending']}, in flight {s['in_flight']}, grace timers {s['grace_timers']}, "
+            f"consumer pauses {s['consumer_pauses']}, duplicates suppressed {self._dedup.suppressed}"
+        )
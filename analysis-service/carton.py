@@ -0,0 +1,114 @@
+# analysis-service/carton.py
+"""
+Carton-removal state machine, shared by the live path and the replay CLI.
+
+A 0g reading means the carton was lifted off the scale. It is only stored
+once the scale has read 0g for a whole grace period; a positive reading
+inside the grace period cancels it. The tracker holds no timers and never
+reads the clock - callers pass `now` - so the live path can arm a deadline
+for it and the replay can run it against historical timestamps.
+"""
+from __future__ import annotations
+from datetime import datetime, timedelta
+
+from device_state import DeviceStateStore, StateRecord
+
+# observe() outcomes
+SAVE = "save"          # positive reading, store it
+RETURNED = "returned"  # positive reading that cancelled a pending removal, store it
+STARTED = "started"    # first 0g reading, grace period begins
+PENDING = "pending"    # 0g again while the grace period is running
+
+
+class PendingRemoval(StateRecord):
+    __slots__ = ("zero_start",)
+
+    def __init__(self):
+        self.zero_start = None   # datetime of the first 0g reading
+
+
+class CartonRemovalTracker:
+    """
+    Only devices with a pending removal have a record, so the store stays as
+    small as the number of cartons currently off their scale.
+    """
+
+    def __init__(self, grace_s: float, stripes: int = 64):
+        self.grace = timedelta(seconds=grace_s)
+        self._pending = DeviceStateStore(PendingRemoval, stripes=stripes)
+
+    def __contains__(self, device_id: str) -> bool:
+        return device_id in self._pending
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def observe(self, device_id: str, weight: float, now: datetime) -> str:
+        if weight > 0:
+            return RETURNED if self._pending.pop(device_id) is not None else SAVE
+        with self._pending.locked(device_id) as rec:
+            if rec.zero_start is None:
+                rec.zero_start = now
+                return STARTED
+            return PENDING
+
+    def zero_since(self, device_id: str):
+        """Start of the running grace period, or None."""
+        rec = self._pending.get(device_id)
+        return None if rec is None else rec.zero_start
+
+    def deadline(self, device_id: str):
+        start = self.zero_since(device_id)
+        return None if start is None else start + self.grace
+
+    def expire(self, device_id: str, zero_start: datetime) -> bool:
+        """
+        End the grace period that began at zero_start. Returns False if the
+        carton came back or a newer removal started in the meantime.
+        """
+        with self._pending.locked(device_id, create=False) as rec:
+            if rec is None or rec.zero_start != zero_start:
+                return False
+            self._pending.pop(device_id)
+            return True
+
+    def observe_backlog(self, device_id: str, readings, now: datetime) -> list:
+        """
+        Run readings a device buffered while offline [(weight, ts)], oldest
+        first, through the state machine with their own timestamps as the
+        clock. Returns the readings to store [(weight, ts)]; a removal whose
+        grace period ended inside the backlog (or before now) is stored as 0g at
+        its deadline. A removal still running afterwards stays pending - the
+        caller arms its deadline.
+        """
+        stored = []
+        for weight, ts in readings:
+            self._expire_due(device_id, ts, stored)
+            if self.observe(device_id, weight, ts) in (SAVE, RETURNED):
+                stored.append((weight, ts))
+        self._expire_due(device_id, now, stored)
+        return stored
+
+    def _expire_due(self, device_id: str, now: datetime, stored: list):
+        start = self.zero_since(device_id)
+        if start is not None and start + self.grace <= now and self.expire(device_id, start):
+            stored.append((0.0, start + self.grace))
+
+    def forget(self, device_id: str):
+        self._pending.pop(device_id)
+
+    def pending(self):
+        """[(device_id, zero_start)] for every removal still in its grace period."""
+        out = []
+        for device_id in self._pending.keys():
+            start = self.zero_since(device_id)
+            if start is not None:   # skip ones that expired since keys() was taken
+                out.append((device_id, start))
+        return out
+
+    # ---------- snapshots ----------
+    def dump(self) -> dict:
+        return self._pending.dump()
+
+    def load(self, data: dict) -> int:
+        return self._pending.load(data)
@@ -0,0 +1,241 @@
+# analysis-service/db_pool.py
+"""
+Small managed MySQL connection pool for the analysis hot paths.
+
+- `size` connections are kept open; up to `max_overflow` extra ones are opened
+  under load and closed again when returned.
+- A connection that sat idle longer than `pre_ping_idle_s` is pinged on
+  checkout and replaced if the ping fails.
+- Connections older than `recycle_s` are closed and reopened on checkout.
+- A connection returned with a transaction still open is rolled back first
+  (and discarded if that fails), so the next user never inherits it.
+- Fixed single-row queries can use `conn.prepared(sql)`, a server-side
+  prepared cursor cached per connection, so the statement is parsed once per
+  connection. Batched writes keep plain cursors: mysql-connector rewrites
+  executemany(INSERT) into one multi-row statement only for those.
+- A checkout that finds the pool exhausted waits (up to `timeout_s`) for a
+  connection to be returned or for a slot to free up, whichever comes first.
+"""
+from __future__ import annotations
+import time
+import threading
+from contextlib import contextmanager
+
+import mysql.connector
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection could be checked out within the pool timeout."""
+
+
+class PooledConnection:
+    """A raw mysql-connector connection plus its pool bookkeeping and prepared-cursor cache."""
+
+    __slots__ = ("raw", "created_at", "last_used", "_prepared")
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self._prepared = {}
+
+    def prepared(self, sql: str):
+        """Return the cached prepared cursor for `sql` (created on first use; callers don't close it)."""
+        cur = self._prepared.get(sql)
+        if cur is None:
+            cur = self.raw.cursor(prepared=True)
+            self._prepared[sql] = cur
+        return cur
+
+    def cursor(self, *args, **kwargs):
+        return self.raw.cursor(*args, **kwargs)
+
+    def start_transaction(self):
+        self.raw.start_transaction()
+
+    @property
+    def in_transaction(self) -> bool:
+        return self.raw.in_transaction
+
+    def commit(self):
+        self.raw.commit()
+
+    def rollback(self):
+        self.raw.rollback()
+
+    def close(self):
+        for cur in self._prepared.values():
+            try:
+                cur.close()
+            except Exception:
+                pass
+        self._prepared.clear()
+        try:
+            self.raw.close()
+        except Exception:
+            pass
+
+
+class ConnectionPool:
+    def __init__(self, config: dict, size: int = 5, max_overflow: int = 5,
+                 recycle_s: float = 1800, timeout_s: float = 10,
+                 pre_ping_idle_s: float = 30):
+        self._config = dict(config)
+        self.size = max(1, int(size))
+        self.max_overflow = max(0, int(max_overflow))
+        self.recycle_s = recycle_s
+        self.timeout_s = timeout_s
+        self.pre_ping_idle_s = pre_ping_idle_s
+
+        self._idle = []       # idle connections, most recently returned last (LIFO)
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)   # a connection came back or a slot freed up
+        self._open = 0        # connections currently open (idle + checked out)
+
+        # Counters (read via stats())
+        self.checkouts = 0
+        self.checkouts_waited = 0
+        self.wait_time_total_s = 0.0
+        self.wait_time_max_s = 0.0
+        self.timeouts = 0
+        self.created = 0
+        self.recycled = 0
+        self.health_check_failures = 0
+        self.discarded = 0
+        self.rolled_back = 0
+
+    # ---------- checkout / checkin ----------
+    @contextmanager
+    def connection(self):
+        """
+        Check out a connection for the duration of the with-block.
+        A connection whose block raised is discarded instead of being reused.
+        """
+        conn = self._checkout()
+        try:
+            yield conn
+        except Exception:
+            self._discard(conn)
+            raise
+        else:
+            self._checkin(conn)
+
+    def _checkout(self) -> PooledConnection:
+        started = time.monotonic()
+        deadline = started + self.timeout_s
+        conn = None
+        with self._available:
+            while True:
+                if self._idle:
+                    conn = self._idle.pop()
+                    break
+                if self._open < self.size + self.max_overflow:
+                    self._open += 1   # reserve the slot; the connection is opened outside the lock
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise PoolTimeout(f"no MySQL connection available within {self.timeout_s}s")
+                self._available.wait(remaining)
+
+            waited = time.monotonic() - started
+            self.checkouts += 1
+            self.wait_time_total_s += waited
+            if waited > 0.001:
+                self.checkouts_waited += 1
+            self.wait_time_max_s = max(self.wait_time_max_s, waited)
+
+        if conn is None:
+            conn = self._open_in_slot()
+        return self._validate(conn)
+
+    def _validate(self, conn: PooledConnection) -> PooledConnection:
+        now = time.monotonic()
+        if self.recycle_s and now - conn.created_at >= self.recycle_s:
+            conn.close()
+            with self._lock:
+                self.recycled += 1
+            return self._open_in_slot()
+        if self.pre_ping_idle_s is not None and now - conn.last_used >= self.pre_ping_idle_s:
+            try:
+                healthy = conn.raw.is_connected()
+            except Exception:
+                healthy = False
+            if not healthy:
+                conn.close()
+                with self._lock:
+                    self.health_check_failures += 1
+                return self._open_in_slot()
+        return conn
+
+    def _open_in_slot(self) -> PooledConnection:
+        """Open a connection for an already reserved slot; give the slot back on failure."""
+        try:
+            return self._new_connection()
+        except Exception:
+            with self._available:
+                self._open -= 1
+                self._available.notify()
+            raise
+
+    def _new_connection(self) -> PooledConnection:
+        raw = mysql.connector.connect(**self._config)
+        with self._lock:
+            self.created += 1
+        return PooledConnection(raw)
+
+    def _checkin(self, conn: PooledConnection):
+        try:
+            if conn.in_transaction:   # left open by the caller: don't hand it to the next one
+                conn.rollback()
+                with self._lock:
+                    self.rolled_back += 1
+        except Exception:
+            self._discard(conn)
+            return
+        conn.last_used = time.monotonic()
+        with self._available:
+            overflow = self._open > self.size
+            if overflow:
+                self._open -= 1
+            else:
+                self._idle.append(conn)
+            self._available.notify()
+        if overflow:
+            conn.close()
+
+    def _discard(self, conn: PooledConnection):
+        conn.close()
+        with self._available:
+            self._open -= 1
+            self.discarded += 1
+            self._available.notify()
+
+    # ---------- metrics ----------
+    def stats(self) -> dict:
+        with self._lock:
+            checkouts = self.checkouts
+            return {
+                "size": self.size,
+                "max_overflow": self.max_overflow,
+                "open": self._open,
+                "idle": len(self._idle),
+                "checkouts": checkouts,
+                "checkouts_waited": self.checkouts_waited,
+                "wait_time_avg_ms": (self.wait_time_total_s / checkouts * 1000) if checkouts else 0.0,
+                "wait_time_max_ms": self.wait_time_max_s * 1000,
+                "timeouts": self.timeouts,
+                "created": self.created,
+                "recycled": self.recycled,
+                "health_check_failures": self.health_check_failures,
+                "discarded": self.discarded,
+                "rolled_back": self.rolled_back,
+            }
+
+    def close(self):
+        with self._available:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+            self._available.notify_all()
+        for conn in idle:
+            conn.close()
@@ -0,0 +1,87 @@
+# analysis-service/deadband.py
+"""
+Change-based write compression for steady readings.
+
+A carton sitting in the fridge reports the same weight (give or take sensor
+noise) for hours. Positive readings are first smoothed with a running median
+over the device's last `median_window` readings, which drops single-sample
+spikes (a real step shows up median_window // 2 readings later). The
+smoothed weight is then stored only if it moved more than `deadband_g` from
+the last stored value, or if `heartbeat_s` has passed since that was stored,
+so an idle device still shows up in weight_data now and then.
+
+0g readings bypass both: by the time one gets here the carton-removal grace
+period has already confirmed it, so it is stored as-is and clears the median
+window, and a carton put back after a removal is stored immediately.
+
+Like the carton tracker this never reads the clock - callers pass `now` - so
+store-and-forward backlogs are filtered on their own timestamps.
+"""
+from __future__ import annotations
+from datetime import datetime, timedelta
+
+from device_state import DeviceStateStore, StateRecord
+
+
+class DeadbandState(StateRecord):
+    __slots__ = ("window", "stored_g", "stored_at")
+
+    def __init__(self):
+        self.window = []       # last raw positive readings, oldest first
+        self.stored_g = None   # last weight stored for the device
+        self.stored_at = None  # and when
+
+
+class DeadbandFilter:
+    """
+    deadband_g    -> store a reading only if it moved more than this from the last stored one
+                     (0 stores every change, negative disables the filter)
+    heartbeat_s   -> ...or if the last stored reading is at least this old (0 = no heartbeat)
+    median_window -> readings in the running median (1 = no smoothing)
+    max_devices / ttl_s -> DeviceStateStore bounds (0 = none); an evicted device's
+                     next reading is simply stored
+    """
+
+    def __init__(self, deadband_g: float = 3.0, heartbeat_s: float = 600, median_window: int = 3,
+                 stripes: int = 64, max_devices: int = 0, ttl_s: float = 0):
+        self.deadband_g = float(deadband_g)
+        self.heartbeat = timedelta(seconds=heartbeat_s) if heartbeat_s > 0 else None
+        self.median_window = max(1, int(median_window))
+        self._devices = DeviceStateStore(DeadbandState, stripes=stripes, max_records=max_devices, ttl_s=ttl_s)
+        self.passed = 0
+        self.suppressed = 0
+
+    def __len__(self) -> int:
+        return len(self._devices)
+
+    def filter(self, device_id: str, weight: float, now: datetime):
+        """The weight to store for this reading (median-smoothed), or None to skip it."""
+        if self.deadband_g < 0:
+            return weight
+        with self._devices.locked(device_id) as st:
+            if weight <= 0:
+                st.window = []
+                value = 0.0
+            else:
+                st.window.append(float(weight))
+                if len(st.window) > self.median_window:
+                    del st.window[0]
+                value = sorted(st.window)[(len(st.window) - 1) // 2]   # lower median: always a real reading
+                if (st.stored_g is not None and abs(value - st.stored_g) <= self.deadband_g
+                        and (self.heartbeat is None or now - st.stored_at < self.heartbeat)):
+                    self.suppressed += 1
+                    return None
+            st.stored_g = value
+            st.stored_at = now
+        self.passed += 1
+        return value
+
+    def forget(self, device_id: str):
+        self._devices.pop(device_id)
+
+    def sweep(self) -> int:
+        """Drop idle devices (see DeviceStateStore.sweep); returns how many."""
+        return self._devices.sweep()
+
+    def stats(self) -> dict:
+        return {"devices": len(self._devices), "passed": self.passed, "suppressed": self.suppressed}
@@ -0,0 +1,106 @@
+# deadline_scheduler.py (shared by analysis-service and updates-service; keep both copies identical)
+"""
+Keyed deadline scheduler.
+
+Timers live in a min-heap ordered by expiry time. A single thread sleeps until
+the earliest deadline and fires exactly that timer; with nothing pending it
+sleeps until something is scheduled, so idle cost is zero. Scheduling a key
+that already has a timer replaces it, and cancel(key) is O(1) (the stale heap
+entry is skipped when it reaches the top).
+"""
+from __future__ import annotations
+import time
+import heapq
+import itertools
+import threading
+
+
+class DeadlineScheduler:
+    def __init__(self, name: str = "deadline-scheduler", log_prefix: str = "[scheduler]"):
+        self.name = name
+        self.log_prefix = log_prefix
+        self._heap = []                  # (deadline, seq, key)
+        self._timers = {}                # key -> (deadline, seq, callback, args)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+        self.fired = 0
+        self.cancelled = 0
+
+    # ---------- API ----------
+    def schedule(self, key, delay_s: float, callback, *args):
+        """Fire callback(*args) after delay_s seconds; replaces any timer already set for key."""
+        deadline = time.monotonic() + max(0.0, delay_s)
+        with self._cond:
+            seq = next(self._seq)
+            self._timers[key] = (deadline, seq, callback, args)
+            heapq.heappush(self._heap, (deadline, seq, key))
+            if self._heap[0][1] == seq:
+                self._cond.notify()      # new earliest deadline: wake the timer thread
+        return deadline
+
+    def cancel(self, key) -> bool:
+        """Drop the timer for key; returns False if none was pending."""
+        with self._cond:
+            if self._timers.pop(key, None) is None:
+                return False
+            self.cancelled += 1
+            # Keep the heap from filling up with dead entries under heavy churn
+            if len(self._heap) > 2 * len(self._timers) + 64:
+                self._heap = [e for e in self._heap if self._is_live(e)]
+                heapq.heapify(self._heap)
+            return True
+
+    def remaining(self, key):
+        """Seconds until key fires, or None if nothing is scheduled for it."""
+        with self._cond:
+            timer = self._timers.get(key)
+            return None if timer is None else max(0.0, timer[0] - time.monotonic())
+
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._timers)
+
+    # ---------- lifecycle ----------
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    # ---------- timer thread ----------
+    def _is_live(self, entry) -> bool:
+        timer = self._timers.get(entry[2])
+        return timer is not None and timer[1] == entry[1]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopped:
+                        return
+                    while self._heap and not self._is_live(self._heap[0]):
+                        heapq.heappop(self._heap)
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    wait = self._heap[0][0] - time.monotonic()
+                    if wait <= 0:
+                        break
+                    self._cond.wait(wait)
+                _, _, key = heapq.heappop(self._heap)
+                _, _, callback, args = self._timers.pop(key)
+                self.fired += 1
+            try:
+                callback(*args)
+            except Exception as e:
+                print(f"{self.log_prefix} ❌ Error in scheduled callback for {key}: {e}")
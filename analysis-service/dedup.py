@@ -0,0 +1,74 @@
+# dedup.py (shared by analysis-service and updates-service; keep both copies identical)
+"""
+Duplicate suppression for QoS 1 redeliveries.
+
+Publishers send with qos=1, so the broker may deliver a reading more than
+once (e.g. after a reconnect). A reading is identified by (device_id,
+message_id, timestamp); the timestamp keeps a device whose sequence numbers
+restarted after a reboot from colliding with its older readings.
+
+Seen keys are kept as the tuples themselves (not their hashes, so two
+different readings are never mistaken for each other) in two generations of
+sets. The current generation takes new keys; every window_s it becomes the
+previous one and the old previous generation is dropped, so a key is
+remembered for between window_s and 2 * window_s. A generation that reaches
+max_keys / 2 rotates early, which bounds memory at the cost of a shorter
+window under heavy load. Unlike a Bloom filter or a set of hashes this
+never drops a reading it has not seen.
+"""
+from __future__ import annotations
+import time
+import threading
+
+
+class DuplicateFilter:
+    def __init__(self, window_s: float = 600, max_keys: int = 200000):
+        self.window_s = float(window_s)
+        self.generation_max = max(1, int(max_keys) // 2)
+        self._lock = threading.Lock()
+        self._current = set()
+        self._previous = set()
+        self._rotated_at = time.monotonic()
+
+        # Counters (read via stats())
+        self.checked = 0
+        self.suppressed = 0
+        self.rotations = 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._current) + len(self._previous)
+
+    def seen(self, device_id: str, message_id, timestamp=None) -> bool:
+        """
+        Record a reading; True if the same reading was recorded within the
+        window (drop it). Readings without a message_id are never suppressed.
+        Disabled (always False) when window_s <= 0.
+        """
+        if self.window_s <= 0 or message_id is None or message_id == "unknown":
+            return False
+        key = (device_id, message_id, timestamp)
+        now = time.monotonic()
+        with self._lock:
+            self.checked += 1
+            if now - self._rotated_at >= self.window_s:
+                self._rotate(now)
+            if key in self._current or key in self._previous:
+                self.suppressed += 1
+                return True
+            if len(self._current) >= self.generation_max:
+                self._rotate(now)
+            self._current.add(key)
+            return False
+
+    def _rotate(self, now: float):
+        # After a whole window without rotating, the current generation is stale as well
+        self._previous = self._current if now - self._rotated_at < 2 * self.window_s else set()
+        self._current = set()
+        self._rotated_at = now
+        self.rotations += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            keys = len(self._current) + len(self._previous)
+        return {"keys": keys, "checked": self.checked, "suppressed": self.suppressed, "rotations": self.rotations}
@@ -0,0 +1,374 @@
+# analysis-service/device_analytics.py
+"""
+Incremental per-device analytics state.
+
+Instead of re-reading WINDOW_DAYS of weight_data for every reading, each
+device keeps:
+  - a running window of cup-sized drops between consecutive readings
+    (deque + running sum, old drops evicted from the left),
+  - per-day min/max/count for the days still inside the window,
+  - the full-weight baseline (all-time max, or max over the lookback days),
+  - an hour-of-day usage forecast (forecast.py) for the expected empty time.
+
+Every update and every stats read is O(1) amortised; the per-day part is
+bounded by the number of days kept, not by the number of readings.
+The state is warmed once at startup (per-day aggregates and baselines from
+weight_daily_rollup, raw readings only for the cup-size window), or restored
+from a snapshot (export/restore) and caught up on the readings stored since.
+"""
+from __future__ import annotations
+import math
+import time
+import threading
+from collections import deque
+from datetime import datetime, timedelta, date
+
+from forecast import UsageForecast
+
+# Warm-up / reload: per-day aggregates and the baseline come from weight_daily_rollup,
+# raw readings are only read for the cup-size window (drops and the hourly forecast).
+ROLLUP_DAYS_SQL = ("SELECT device_id, `day`, min_weight, max_weight, reading_count FROM weight_daily_rollup "
+                   "WHERE `day` >= %s")
+ROLLUP_MAX_SQL = "SELECT device_id, MAX(max_weight) FROM weight_daily_rollup GROUP BY device_id"
+READINGS_SQL = ("SELECT device_id, weight, timestamp FROM weight_data WHERE timestamp >= %s "
+                "ORDER BY device_id, timestamp")
+DEVICE_ROLLUP_DAYS_SQL = ("SELECT `day`, min_weight, max_weight, reading_count FROM weight_daily_rollup "
+                          "WHERE device_id = %s AND `day` >= %s")
+DEVICE_ROLLUP_MAX_SQL = "SELECT MAX(max_weight) FROM weight_daily_rollup WHERE device_id = %s"
+DEVICE_READINGS_SQL = ("SELECT weight, timestamp FROM weight_data WHERE device_id = %s AND timestamp >= %s "
+                       "ORDER BY timestamp")
+
+class DeviceAnalytics:
+    __slots__ = ("last_weight", "last_ts", "drops", "drop_sum", "days", "baseline_g", "forecast", "touched")
+
+    def __init__(self):
+        self.last_weight = None    # float | None
+        self.last_ts = None        # datetime | None
+        self.drops = deque()       # (ts_of_previous_reading, drop_g) for cup-sized drops
+        self.drop_sum = 0.0
+        self.days = {}             # date -> [min_g, max_g, count]
+        self.baseline_g = None     # all-time max seen (used when no lookback is configured)
+        self.forecast = UsageForecast()
+        self.touched = time.monotonic()   # last reading folded in (idle eviction)
+
+
+class AnalyticsState:
+    """
+    window_days      -> lookback for cup size and daily consumption
+    cup_min/max_g    -> drops outside this range are ignored (noise / refills)
+    baseline_days    -> 0 for all-time max baseline, otherwise max over N days
+    forecast_alpha   -> weight of the newest day in the smoothed daily rate and hourly profile
+    forecast_horizon_days -> no empty time is forecast further out than this
+    idle_ttl_s       -> sweep() drops devices without a reading for this long (0 = never);
+                        the caller reloads an evicted device (reload_device) when it reports again
+    """
+
+    def __init__(self, window_days: int, cup_min_g: float, cup_max_g: float,
+                 cup_default_g: float, daily_default_g: float, baseline_days: int = 0,
+                 forecast_alpha: float = 0.3, forecast_horizon_days: int = 60, idle_ttl_s: float = 0):
+        self.window_days = window_days
+        self.cup_min_g = cup_min_g
+        self.cup_max_g = cup_max_g
+        self.cup_default_g = cup_default_g
+        self.daily_default_g = daily_default_g
+        self.baseline_days = baseline_days
+        self.forecast_alpha = forecast_alpha
+        self.forecast_horizon_days = forecast_horizon_days
+        self.keep_days = max(window_days, baseline_days)
+        self.idle_ttl_s = idle_ttl_s
+        self.evicted = 0
+        self._devices = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._devices)
+
+    def __contains__(self, device_id: str) -> bool:
+        with self._lock:
+            return device_id in self._devices
+
+    def _get(self, device_id: str) -> DeviceAnalytics:
+        st = self._devices.get(device_id)
+        if st is None:
+            st = self._devices[device_id] = DeviceAnalytics()
+        return st
+
+    # ---------- updates ----------
+    def add_reading(self, device_id: str, weight: float, ts: datetime) -> float:
+        """
+        Fold one stored reading into the device state.
+        Returns the positive drop versus the previous reading (0.0 if none).
+        """
+        with self._lock:
+            st = self._get(device_id)
+            st.touched = time.monotonic()
+            return self._add(st, float(weight), ts)
+
+    def _add(self, st: DeviceAnalytics, weight: float, ts: datetime, days: bool = True) -> float:
+        """days=False leaves the per-day aggregates alone (warm-up takes them from the rollup)."""
+        drop = consumed = 0.0
+        if st.last_weight is not None:
+            drop = st.last_weight - weight
+            if self.cup_min_g <= drop <= self.cup_max_g:
+                st.drops.append((st.last_ts, drop))
+                st.drop_sum += drop
+                consumed = drop
+        st.forecast.observe(ts, consumed, self.forecast_alpha)
+        st.last_weight = weight
+        st.last_ts = ts
+        if st.baseline_g is None or weight > st.baseline_g:
+            st.baseline_g = weight
+        if not days:
+            return drop if drop > 0 else 0.0
+
+        day = ts.date()
+        agg = st.days.get(day)
+        if agg is None:
+            st.days[day] = [weight, weight, 1]
+            self._evict_days(st, day)
+        else:
+            if weight < agg[0]:
+                agg[0] = weight
+            if weight > agg[1]:
+                agg[1] = weight
+            agg[2] += 1
+        return drop if drop > 0 else 0.0
+
+    def _evict_days(self, st: DeviceAnalytics, today: date):
+        oldest = today - timedelta(days=self.keep_days)
+        if len(st.days) > self.keep_days + 1:
+            for d in [d for d in st.days if d < oldest]:
+                del st.days[d]
+
+    def _evict_drops(self, st: DeviceAnalytics, cutoff: datetime):
+        drops = st.drops
+        while drops and drops[0][0] < cutoff:
+            _, drop = drops.popleft()
+            st.drop_sum -= drop
+        if not drops:
+            st.drop_sum = 0.0   # clear accumulated float error
+
+    def apply_rollup(self, device_id: str, days, max_g: float | None = None):
+        """
+        Take the device's per-day aggregates from weight_daily_rollup rows
+        (day, min_weight, max_weight, reading_count) inside the kept window,
+        and raise the all-time baseline to max_g (the rollup's MAX(max_weight)).
+        """
+        with self._lock:
+            self._apply_rollup(self._get(device_id), days, max_g)
+
+    @staticmethod
+    def _apply_rollup(st: DeviceAnalytics, days, max_g):
+        st.days = {d: [float(lo), float(hi), int(count)] for d, lo, hi, count in days}
+        if max_g is not None and (st.baseline_g is None or float(max_g) > st.baseline_g):
+            st.baseline_g = float(max_g)
+
+    def forget(self, device_id: str):
+        with self._lock:
+            self._devices.pop(device_id, None)
+
+    def sweep(self) -> int:
+        """Drop devices idle longer than idle_ttl_s; returns how many."""
+        if self.idle_ttl_s <= 0:
+            return 0
+        cutoff = time.monotonic() - self.idle_ttl_s
+        with self._lock:
+            idle = [d for d, st in self._devices.items() if st.touched < cutoff]
+            for device_id in idle:
+                del self._devices[device_id]
+            self.evicted += len(idle)
+        return len(idle)
+
+    # ---------- reads ----------
+    def last_timestamp(self, device_id: str):
+        """Timestamp of the device's newest folded-in reading, or None."""
+        with self._lock:
+            st = self._devices.get(device_id)
+            return None if st is None else st.last_ts
+
+    def snapshot(self, device_id: str, now: datetime | None = None):
+        """
+        Return (current_g, cup_g, daily_g, baseline_g) for the device.
+        Daily consumption counts whole calendar days from the first day of the
+        window, which matches the SQL version except for the partial oldest day.
+        """
+        now = now or datetime.now()
+        with self._lock:
+            st = self._devices.get(device_id)
+            if st is None:
+                return None, self.cup_default_g, self.daily_default_g, None
+            cutoff = now - timedelta(days=self.window_days)
+            self._evict_drops(st, cutoff)
+            cup = (st.drop_sum / len(st.drops)) if st.drops else self.cup_default_g
+
+            first_day = cutoff.date()
+            total, n = 0.0, 0
+            for d, (lo, hi, count) in st.days.items():
+                if d >= first_day and count > 1 and hi - lo > 0:
+                    total += hi - lo
+                    n += 1
+            daily = (total / n) if n else self.daily_default_g
+
+            if self.baseline_days > 0:
+                first_baseline_day = (now - timedelta(days=self.baseline_days)).date()
+                maxes = [hi for d, (_, hi, _) in st.days.items() if d >= first_baseline_day]
+                baseline = max(maxes) if maxes else None
+            else:
+                baseline = st.baseline_g
+            return st.last_weight, cup, daily, baseline
+
+    def empty_at(self, device_id: str, daily_g: float, now: datetime | None = None):
+        """
+        Expected empty time from the device's forecast (cached until its next
+        reading); daily_g stands in until a whole day of usage was learned.
+        """
+        now = now or datetime.now()
+        with self._lock:
+            st = self._devices.get(device_id)
+            if st is None or not st.last_weight:
+                return None
+            return st.forecast.forecast(st.last_weight, daily_g, now, self.forecast_horizon_days)
+
+    # ---------- warm-up ----------
+    def warm(self, conn, now: datetime | None = None) -> int:
+        """
+        Load state for every device: per-day aggregates (and the all-time
+        baseline) from weight_daily_rollup, one row per device-day, plus the
+        raw readings inside the cup-size window for the drops and the hourly
+        forecast. Returns the number of readings read.
+        """
+        now = now or datetime.now()
+        cur = conn.cursor()
+        cur.execute(ROLLUP_DAYS_SQL, ((now - timedelta(days=self.keep_days)).date(),))
+        days = {}
+        for device_id, d, lo, hi, count in cur:
+            days.setdefault(device_id, []).append((d, lo, hi, count))
+        max_w = {}
+        if self.baseline_days <= 0:   # a lookback baseline is read from the days themselves
+            cur.execute(ROLLUP_MAX_SQL)
+            max_w = dict(cur.fetchall())
+        cur.execute(READINGS_SQL, (now - timedelta(days=self.window_days),))
+        rows = 0
+        with self._lock:
+            self._devices.clear()
+            for device_id, weight, ts in cur:
+                self._add(self._get(device_id), float(weight), ts, days=False)
+                rows += 1
+            for device_id in days.keys() | max_w.keys():
+                self._apply_rollup(self._get(device_id), days.get(device_id, ()), max_w.get(device_id))
+        cur.close()
+        return rows
+
+    def reload_device(self, conn, device_id: str, now: datetime | None = None) -> int:
+        """
+        Rebuild one device's state from MySQL, like warm() does for all of
+        them (used when the device's readings were processed elsewhere).
+        Returns the number of readings read.
+        """
+        now = now or datetime.now()
+        # Prepared cursors (conn is pooled): a device is reloaded on every takeover
+        cur = conn.prepared(DEVICE_ROLLUP_DAYS_SQL)
+        cur.execute(DEVICE_ROLLUP_DAYS_SQL, (device_id, (now - timedelta(days=self.keep_days)).date()))
+        days = cur.fetchall()
+        max_w = None
+        if self.baseline_days <= 0:
+            cur = conn.prepared(DEVICE_ROLLUP_MAX_SQL)
+            cur.execute(DEVICE_ROLLUP_MAX_SQL, (device_id,))
+            rows = cur.fetchall()
+            max_w = rows[0][0] if rows else None
+        cur = conn.prepared(DEVICE_READINGS_SQL)
+        cur.execute(DEVICE_READINGS_SQL, (device_id, now - timedelta(days=self.window_days)))
+        readings = cur.fetchall()
+
+        st = DeviceAnalytics()
+        for weight, ts in readings:
+            self._add(st, float(weight), ts, days=False)
+        self._apply_rollup(st, days, max_w)
+        with self._lock:
+            self._devices[device_id] = st
+        return len(readings)
+
+    # ---------- snapshots ----------
+    def config(self) -> list:
+        """Settings the state was built with; a snapshot taken under other settings is not reused."""
+        return [self.window_days, self.cup_min_g, self.cup_max_g, self.baseline_days, self.forecast_alpha]
+
+    def export(self) -> dict:
+        """device_id -> [last_weight, last_ts, drops, drop_sum, days, baseline_g, forecast], copied under the lock."""
+        with self._lock:
+            return {
+                device_id: [st.last_weight, st.last_ts, list(st.drops), st.drop_sum,
+                            {d: list(agg) for d, agg in st.days.items()}, st.baseline_g, st.forecast.export()]
+                for device_id, st in self._devices.items()
+            }
+
+    def restore(self, devices: dict) -> int:
+        """Replace the state with an export(); returns the number of devices."""
+        with self._lock:
+            self._devices.clear()
+            for device_id, (last_weight, last_ts, drops, drop_sum, days, baseline_g, forecast) in devices.items():
+                st = self._devices[device_id] = DeviceAnalytics()
+                st.last_weight = last_weight
+                st.last_ts = last_ts
+                st.drops = deque(tuple(d) for d in drops)
+                st.drop_sum = drop_sum
+                st.days = days
+                st.baseline_g = baseline_g
+                st.forecast = UsageForecast.restore(forecast)
+            return len(self._devices)
+
+    def catch_up(self, conn, since: datetime) -> int:
+        """
+        Fold in weight_data rows stored after `since` that are newer than what
+        each device already holds (written after the snapshot, possibly by
+        another replica). Returns the number of rows folded in.
+        """
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT device_id, weight, timestamp FROM weight_data
+            WHERE timestamp > %s
+            ORDER BY device_id, timestamp
+        """, (since,))
+        rows = 0
+        with self._lock:
+            for device_id, weight, ts in cur:
+                st = self._get(device_id)
+                if st.last_ts is None or ts > st.last_ts:
+                    self._add(st, float(weight), ts)
+                    rows += 1
+        cur.close()
+        return rows
+
+
+def derive_stats(current_g: float, cup_g: float, daily_g: float, baseline_g: float | None,
+                 today: date, assumed_full_g: float = 1000.0):
+    """
+    Turn the learned inputs into the user_stats columns:
+    (cups_left, percent_full, expected_empty_date).
+    percent_full is relative to the learned full baseline when one is known.
+    """
+    full_g = baseline_g if baseline_g and baseline_g > 0 else assumed_full_g
+    percent_full = min(100.0, (current_g / full_g) * 100)
+    cups_left = math.floor(current_g / cup_g) if cup_g > 0 else 0
+
+    expected_empty_date = None
+    if daily_g > 0 and current_g > 0:
+        days_left = current_g / daily_g
+        if days_left > 0:
+            expected_empty_date = today + timedelta(days=int(days_left))
+    return cups_left, percent_full, expected_empty_date
+
+
+def user_stats_row(state: AnalyticsState, device_id: str, now: datetime):
+    """
+    One user_stats row from the analytics state: (device_id, current_g,
+    avg_daily_g, cups_left, percent_full, expected_empty_date, expected_empty_at).
+    The empty date comes from the hourly forecast when it has one.
+    """
+    current_g, cup_g, daily_g, baseline_g = state.snapshot(device_id, now)
+    current_g = float(current_g or 0.0)
+    cups_left, percent_full, expected_empty_date = derive_stats(current_g, cup_g, daily_g, baseline_g, now.date())
+    expected_empty_at = state.empty_at(device_id, daily_g, now)
+    if expected_empty_at is not None:
+        expected_empty_date = expected_empty_at.date()
+    return device_id, current_g, daily_g, cups_left, percent_full, expected_empty_date, expected_empty_at
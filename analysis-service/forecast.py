@@ -0,0 +1,118 @@
+# analysis-service/forecast.py
+"""
+Per-device empty-time forecast.
+
+Each device keeps a fixed-size model, updated in O(1) per stored reading:
+  - `today`: grams consumed in each hour of the current day (24 slots),
+  - `profile`: exponentially smoothed grams consumed per hour of day,
+  - `daily_g`: exponentially smoothed grams consumed per day.
+When a reading arrives on a later day, the finished day is folded into
+`profile` and `daily_g` (24 multiply-adds, once a day). The first day a
+device is seen is usually partial and is not folded in; days without any
+reading are skipped rather than counted as zero consumption.
+
+The forecast lays the current weight out along the hour-of-day profile,
+scaled to `daily_g`, starting from now: whole days are skipped in one step
+and the hour it runs out in is found by bisecting the cumulative profile.
+The result is cached and only recomputed after the model changed.
+"""
+from __future__ import annotations
+import math
+from array import array
+from bisect import bisect_left
+from itertools import accumulate
+from datetime import datetime, timedelta
+
+HOURS = 24
+
+
+class UsageForecast:
+    __slots__ = ("daily_g", "profile", "today", "day", "partial", "cached_for", "empty_at")
+
+    def __init__(self):
+        self.daily_g = None                       # smoothed g/day (None until a whole day was folded in)
+        self.profile = array("d", [0.0] * HOURS)  # smoothed g consumed per hour of day
+        self.today = array("d", [0.0] * HOURS)    # g consumed per hour of `day`
+        self.day = None                           # date `today` belongs to
+        self.partial = True                       # `day` is the first (incomplete) day seen
+        self.cached_for = None                    # current_g the cached forecast was made for
+        self.empty_at = None                      # cached forecast (datetime or None)
+
+    def observe(self, ts: datetime, consumed_g: float, alpha: float):
+        """Fold one stored reading in; consumed_g is the cup-sized drop it completed (0 if none)."""
+        day = ts.date()
+        if self.day is None:
+            self.day = day
+        elif day > self.day:
+            self._close_day(alpha)
+            self.day = day
+        elif day < self.day:
+            return   # older than the day being counted (out-of-order backlog): already folded
+        if consumed_g > 0:
+            self.today[ts.hour] += consumed_g
+        self.cached_for = None
+
+    def _close_day(self, alpha: float):
+        if self.partial:
+            self.partial = False
+        elif self.daily_g is None:
+            self.daily_g = sum(self.today)
+            self.profile = array("d", self.today)
+        else:
+            keep = 1.0 - alpha
+            self.daily_g = keep * self.daily_g + alpha * sum(self.today)
+            for h in range(HOURS):
+                self.profile[h] = keep * self.profile[h] + alpha * self.today[h]
+        self.today = array("d", [0.0] * HOURS)
+
+    def forecast(self, current_g: float, fallback_daily_g: float, now: datetime, horizon_days: int):
+        """
+        When the carton is expected to be empty (to the minute), or None.
+        fallback_daily_g is used until a whole day has been learned.
+        """
+        if self.cached_for is not None and self.cached_for == current_g:
+            return self.empty_at
+        self.empty_at = predict_empty_at(self.profile, self.daily_g or fallback_daily_g,
+                                         current_g, now, horizon_days)
+        self.cached_for = current_g
+        return self.empty_at
+
+    def export(self) -> list:
+        return [self.daily_g, list(self.profile), list(self.today), self.day, self.partial]
+
+    @classmethod
+    def restore(cls, data) -> "UsageForecast":
+        fc = cls()
+        daily_g, profile, today, day, partial = data
+        fc.daily_g = daily_g
+        fc.profile = array("d", profile)
+        fc.today = array("d", today)
+        fc.day = day
+        fc.partial = partial
+        return fc
+
+
+def predict_empty_at(profile, daily_g: float, current_g: float, now: datetime, horizon_days: int):
+    """Where on the hourly profile (scaled to daily_g g/day) current_g is used up, counting from now."""
+    if not daily_g or daily_g <= 0 or current_g <= 0:
+        return None
+    total = sum(profile)
+    scale = daily_g / total if total > 0 else 0.0
+    hourly = [p * scale for p in profile] if total > 0 else [daily_g / HOURS] * HOURS
+    cum = list(accumulate(hourly, initial=0.0))   # cum[h] = g consumed from midnight to h:00
+
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    into_hour = (now - midnight).total_seconds() / 3600.0 - now.hour
+    # grams of a daily cycle used up by now, plus what is left in the carton
+    target = cum[now.hour] + hourly[now.hour] * into_hour + current_g
+    days = max(0, math.ceil(target / daily_g) - 1)   # leaves 0 < rest <= daily_g
+    if days >= horizon_days:
+        return None
+    rest = min(target - days * daily_g, daily_g)
+    h = max(0, bisect_left(cum, rest) - 1)           # cum[h] < rest <= cum[h + 1], so hourly[h] > 0
+    hours = h + (rest - cum[h]) / hourly[h]
+    return _round_minute(midnight + timedelta(days=days, hours=hours))
+
+
+def _round_minute(t: datetime) -> datetime:
+    return (t + timedelta(seconds=30)).replace(second=0, microsecond=0)
@@ -0,0 +1,370 @@
+# analysis-service/ingest_buffer.py
+"""
+Buffered, batched writer for weight_data.
+
+Readings handed over by the MQTT path are collected in memory and written
+with one multi-row INSERT per batch. A batch is flushed as soon as it holds
+`batch_size` readings, or when its oldest reading has waited `max_latency_s`,
+whichever comes first.
+
+Each batch is written in an explicit transaction (the connections run with
+autocommit on, so without one every statement would commit on its own): the
+INSERT and whatever `in_transaction` adds (the daily rollup) commit or roll
+back together. INSERT IGNORE skips readings whose (device_id, timestamp) is
+already stored; when the affected-row count shows that happened, the batch is
+rolled back and written again with only the new readings, so `in_transaction`
+is only ever handed rows that were actually inserted.
+
+A batch whose write fails goes back to the head of the buffer and is retried
+after an exponential backoff (retry_backoff_s, doubled per failure up to
+retry_backoff_max_s); only after max_retries failures in a row is it dropped.
+The readings are already folded into AnalyticsState, so dropping them on the
+first hiccup would leave user_stats describing rows weight_data never got.
+"""
+from __future__ import annotations
+import time
+import threading
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+BufferedReading = namedtuple("BufferedReading", "device_id weight timestamp msg_num drop_g")
+
+INSERT_WEIGHTS_SQL = (
+    "INSERT IGNORE INTO weight_data (device_id, weight, timestamp) VALUES (%s, %s, %s)"
+)
+
+
+def stored_key(device_id: str, ts: datetime):
+    """(device_id, timestamp) as weight_data stores it: DATETIME rounds to the nearest second."""
+    return device_id, (ts + timedelta(microseconds=500000)).replace(microsecond=0)
+
+
+def existing_weights_sql(n: int) -> str:
+    """Lock and list which of n (device_id, timestamp) keys weight_data already holds."""
+    keys = ", ".join(["(%s, %s)"] * n)
+    return f"SELECT device_id, timestamp FROM weight_data WHERE (device_id, timestamp) IN ({keys}) FOR UPDATE"
+
+
+def weight_params(rows) -> list:
+    return [(r.device_id, r.weight, r.timestamp) for r in rows]
+
+
+def new_rows(rows, existing) -> list:
+    """
+    The rows INSERT IGNORE would store: not already in `existing` (keys as
+    returned by existing_weights_sql), and not repeating an earlier row of
+    the batch.
+    """
+    seen = {(d, ts) for d, ts in existing}
+    out = []
+    for r in rows:
+        key = stored_key(r.device_id, r.timestamp)
+        if key not in seen:
+            seen.add(key)
+            out.append(r)
+    return out
+
+
+def insert_rows(conn, rows) -> list:
+    """
+    INSERT IGNORE the batch inside the transaction the caller started on
+    conn; returns the rows that were inserted. If some were skipped as
+    already stored, the transaction is rolled back and restarted, the
+    existing keys are locked and read, and only the new rows are inserted.
+    """
+    cur = conn.cursor()
+    try:
+        # executemany on a plain (non-prepared) cursor is rewritten into one multi-row INSERT
+        cur.executemany(INSERT_WEIGHTS_SQL, weight_params(rows))
+        if cur.rowcount >= len(rows):
+            return rows
+        conn.rollback()
+        conn.start_transaction()
+        keys = sorted({stored_key(r.device_id, r.timestamp) for r in rows})
+        cur.execute(existing_weights_sql(len(keys)), [v for key in keys for v in key])
+        fresh = new_rows(rows, cur.fetchall())
+        if fresh:
+            cur.executemany(INSERT_WEIGHTS_SQL, weight_params(fresh))
+        return fresh
+    finally:
+        cur.close()
+
+
+class WeightWriteBuffer:
+    """
+    Collects readings and flushes them from a background thread.
+
+    connection -> callable returning a context manager that yields a DB
+                  connection for one flush (e.g. ConnectionPool.connection)
+    in_transaction -> optional callable(conn, rows) run after the INSERT and
+                  before its commit with the rows actually inserted; its writes
+                  commit or roll back with the batch (used for the daily rollup)
+    on_flush   -> optional callable(conn, rows) run after a successful insert,
+                  on the same connection (used to refresh user_stats)
+    on_stats   -> optional callable run whenever the buffer logs its counters,
+                  so related components can log theirs alongside
+    observe    -> optional callable(stage, seconds) timing each INSERT+commit
+                  (stage "insert"), e.g. Metrics.observe
+    max_retries -> failed flushes of a batch before it is dropped (0 = drop at once)
+    """
+
+    def __init__(self, connection, batch_size: int = 200, max_latency_s: float = 0.5,
+                 on_flush=None, stats_log_interval_s: float = 60.0, on_stats=None, observe=None,
+                 in_transaction=None, max_retries: int = 5, retry_backoff_s: float = 0.5,
+                 retry_backoff_max_s: float = 30.0):
+        self._connection = connection
+        self._in_transaction = in_transaction
+        self._observe = observe
+        self._on_stats = on_stats
+        self._on_flush = on_flush
+        self.batch_size = max(1, int(batch_size))
+        self.max_latency_s = max(0.001, float(max_latency_s))
+        self.stats_log_interval_s = stats_log_interval_s
+        self.max_retries = max(0, int(max_retries))
+        self.retry_backoff_s = float(retry_backoff_s)
+        self.retry_backoff_max_s = float(retry_backoff_max_s)
+
+        self._rows = []
+        self._oldest = None          # monotonic time of the oldest buffered row
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = None
+        self._flushing = 0           # batches taken by the flusher thread and not yet written
+        self._failures = 0           # failed flushes in a row (of the batch at the head)
+        self._retry_at = 0.0         # monotonic time before which a requeued batch is not retried
+
+        # Tuning counters (read via stats())
+        self.rows_flushed = 0
+        self.rows_failed = 0
+        self.rows_skipped = 0        # already in weight_data (INSERT IGNORE)
+        self.batches_flushed = 0
+        self.flush_errors = 0
+        self.flush_retries = 0
+        self.flushes_by_size = 0
+        self.flushes_by_deadline = 0
+        self.batch_size_max = 0
+        self.flush_latency_total_s = 0.0
+        self.flush_latency_max_s = 0.0
+        self.flush_latency_last_s = 0.0
+        self._last_stats_log = time.monotonic()
+
+    # ---------- producer side ----------
+    def add(self, device_id: str, weight: float, ts, msg_num: int = 0, drop_g: float = 0.0):
+        """Queue one reading (drop_g = positive drop vs. the previous reading); never touches the DB."""
+        with self._cond:
+            if not self._rows:
+                self._oldest = time.monotonic()
+                self._cond.notify()   # start the latency deadline
+            self._rows.append(BufferedReading(device_id, float(weight), ts, msg_num, drop_g))
+            if len(self._rows) >= self.batch_size:
+                self._cond.notify()
+
+    def add_many(self, readings):
+        """
+        Queue a device's store-and-forward backlog [BufferedReading] in one go,
+        so it is inserted together (in batch_size chunks if it is larger).
+        """
+        if not readings:
+            return
+        with self._cond:
+            if not self._rows:
+                self._oldest = time.monotonic()
+                self._cond.notify()   # start the latency deadline
+            self._rows.extend(readings)
+            if len(self._rows) >= self.batch_size:
+                self._cond.notify()
+
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._rows)
+
+    # ---------- lifecycle ----------
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="weight-flusher", daemon=True)
+            self._thread.start()
+        return self
+
+    def close(self):
+        """Stop the flusher and write whatever is still buffered."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+        rows = self._take(len(self._rows))
+        if rows:
+            self._flush(rows, requeue=False)   # nobody is left to retry it
+
+    def flush(self):
+        """
+        Write everything buffered right now on the calling thread, and wait
+        for a batch the flusher thread may be writing at the same time. If the
+        write fails the rows are requeued for the flusher thread to retry.
+        """
+        rows = self._take(len(self._rows))
+        if rows:
+            self._flush(rows)
+        with self._cond:
+            while self._flushing:
+                self._cond.wait()
+
+    # ---------- flusher ----------
+    def _take(self, n: int):
+        with self._cond:
+            rows = self._rows[:n]
+            del self._rows[:n]
+            self._oldest = time.monotonic() if self._rows else None
+            return rows
+
+    def _run(self):
+        while True:
+            with self._cond:
+                by_size = None
+                while not self._closed:
+                    now = time.monotonic()
+                    if self._rows and now < self._retry_at:
+                        wait = self._retry_at - now          # backing off after a failed flush
+                    elif len(self._rows) >= self.batch_size:
+                        by_size = True
+                        break
+                    elif self._rows:
+                        wait = self._oldest + self.max_latency_s - now
+                        if wait <= 0:
+                            by_size = False
+                            break
+                    else:
+                        wait = self.stats_log_interval_s
+                    stats_due = self._last_stats_log + self.stats_log_interval_s - now
+                    if stats_due <= 0:
+                        break                                # log even while nothing is flushed
+                    self._cond.wait(min(wait, stats_due))
+                if self._closed:
+                    return
+                rows = []
+                if by_size is not None:
+                    rows = self._rows[:self.batch_size]
+                    del self._rows[:self.batch_size]
+                    self._oldest = time.monotonic() if self._rows else None
+                    self._flushing += 1
+                    if by_size:
+                        self.flushes_by_size += 1
+                    else:
+                        self.flushes_by_deadline += 1
+
+            if rows:
+                try:
+                    self._flush(rows)
+                finally:
+                    with self._cond:
+                        self._flushing -= 1
+                        self._cond.notify_all()
+            self._maybe_log_stats()
+
+    def _flush(self, rows, requeue: bool = True):
+        started = time.monotonic()
+        written = False
+        try:
+            with self._connection() as conn:
+                conn.start_transaction()
+                try:
+                    inserted = insert_rows(conn, rows)
+                    if self._in_transaction is not None and inserted:
+                        self._in_transaction(conn, inserted)
+                    conn.commit()
+                except Exception:
+                    try:
+                        conn.rollback()
+                    except Exception:
+                        pass   # the connection is gone; the server drops the transaction
+                    raise
+                written = True
+                elapsed = time.monotonic() - started
+                self._record_flush(len(rows), len(rows) - len(inserted), elapsed)
+                if self._observe is not None:
+                    self._observe("insert", elapsed)
+
+                if self._on_flush is not None:
+                    try:
+                        self._on_flush(conn, rows)
+                    except Exception as e:
+                        print(f"[analysis] ERROR in post-flush processing - {e}")
+        except Exception as e:
+            if written:
+                # The rows are stored; only returning the connection failed
+                print(f"[analysis] ERROR releasing connection after flush - {e}")
+                return
+            self._flush_failed(rows, e, requeue)
+
+    def _flush_failed(self, rows, e: Exception, requeue: bool):
+        with self._cond:
+            self.flush_errors += 1
+            self._failures += 1
+            if requeue and self._failures <= self.max_retries:
+                delay = min(self.retry_backoff_max_s, self.retry_backoff_s * 2 ** (self._failures - 1))
+                self._rows[:0] = rows                      # back to the head: order is kept
+                self._oldest = time.monotonic() - self.max_latency_s
+                self._retry_at = time.monotonic() + delay
+                self.flush_retries += 1
+                attempt = self._failures
+            else:
+                self._failures = 0
+                self.rows_failed += len(rows)
+                attempt = None
+        if attempt is not None:
+            print(f"[analysis] ERROR flushing {len(rows)} buffered readings (attempt {attempt}/"
+                  f"{self.max_retries + 1}), retrying in {delay:.1f}s - {e}")
+        else:
+            print(f"[analysis] ERROR flushing {len(rows)} buffered readings, dropping them - {e}")
+
+    def _record_flush(self, n: int, skipped: int, elapsed: float):
+        with self._cond:
+            self._failures = 0
+            self._retry_at = 0.0
+            self.rows_flushed += n
+            self.rows_skipped += skipped
+            self.batches_flushed += 1
+            self.batch_size_max = max(self.batch_size_max, n)
+            self.flush_latency_last_s = elapsed
+            self.flush_latency_total_s += elapsed
+            self.flush_latency_max_s = max(self.flush_latency_max_s, elapsed)
+
+    # ---------- metrics ----------
+    def stats(self) -> dict:
+        with self._cond:
+            batches = self.batches_flushed
+            return {
+                "pending": len(self._rows),
+                "rows_flushed": self.rows_flushed,
+                "rows_failed": self.rows_failed,
+                "rows_skipped": self.rows_skipped,
+                "batches_flushed": batches,
+                "flush_errors": self.flush_errors,
+                "flush_retries": self.flush_retries,
+                "flushes_by_size": self.flushes_by_size,
+                "flushes_by_deadline": self.flushes_by_deadline,
+                "batch_size_avg": (self.rows_flushed / batches) if batches else 0.0,
+                "batch_size_max": self.batch_size_max,
+                "flush_latency_avg_ms": (self.flush_latency_total_s / batches * 1000) if batches else 0.0,
+                "flush_latency_max_ms": self.flush_latency_max_s * 1000,
+                "flush_latency_last_ms": self.flush_latency_last_s * 1000,
+            }
+
+    def _maybe_log_stats(self):
+        now = time.monotonic()
+        if now - self._last_stats_log < self.stats_log_interval_s:
+            return
+        self._last_stats_log = now
+        s = self.stats()
+        print(
+            f"[analysis] 📦 Ingest buffer: {s['rows_flushed']} rows in {s['batches_flushed']} batches "
+            f"(avg {s['batch_size_avg']:.1f}, max {s['batch_size_max']}), "
+            f"flush avg {s['flush_latency_avg_ms']:.1f}ms / max {s['flush_latency_max_ms']:.1f}ms, "
+            f"size/deadline flushes {s['flushes_by_size']}/{s['flushes_by_deadline']}, "
+            f"errors {s['flush_errors']} (retried {s['flush_retries']}, rows dropped {s['rows_failed']}), "
+            f"already stored {s['rows_skipped']}, pending {s['pending']}"
+        )
+        if self._on_stats is not None:
+            self._on_stats()
+
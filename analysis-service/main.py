@@ -1,14 +1,30 @@
 # analysis-service/main.py
 from __future__ import annotations
 import os
+import sys
 import time
-import math
-import json
+import atexit
+import signal
 import threading
-from datetime import datetime, timedelta, date
-
-import mysql.connector
-import paho.mqtt.client as mqtt
+from datetime import datetime, timedelta
+
+import carton
+import ownership
+import payload_codec
+from db_pool import ConnectionPool
+from deadband import DeadbandFilter
+from dedup import DuplicateFilter
+from deadline_scheduler import DeadlineScheduler
+from device_analytics import AnalyticsState, user_stats_row
+from ingest_buffer import BufferedReading, WeightWriteBuffer
+from metrics import Metrics
+from mqtt_topics import content_type, make_client, parse_topic, subscribe_all, subscription_filters
+from ownership import DeviceOwnership
+from payload_codec import binary_topic
+from retention import HOURLY_HISTORY_DDL, run_retention
+from rollup import ROLLUP_DDL, update_daily_rollup, rollup_is_empty, backfill as backfill_rollup
+from snapshot import Snapshotter, read_snapshot
+from workers import ShardedWorkerPool
 
 # ======= ENV (compatible with your compose) =======
 MQTT_HOST   = os.getenv("MQTT_HOST", "mqtt")
@@ -26,6 +42,17 @@ MYSQL_CONFIG = {
 # schema maps device_id → users(device_id)
 DEVICE_ID = os.getenv("DEVICE_ID", "device1")
 
+# Scale-out: per-device topics (<MQTT_TOPIC>/<device_id>) and MQTT v5 shared subscriptions
+MQTT_PER_DEVICE_TOPICS = os.getenv("MQTT_PER_DEVICE_TOPICS", "true").lower() == "true"  # also subscribe to <MQTT_TOPIC>/+
+MQTT_SHARED_GROUP = os.getenv("MQTT_SHARED_GROUP", "")       # e.g. "analysis"; empty = every replica gets every reading
+MQTT_PROTOCOL = os.getenv("MQTT_PROTOCOL", "5" if MQTT_SHARED_GROUP else "3.1.1")   # 3.1.1 | 5
+REPLICA_ID = os.getenv("REPLICA_ID", os.getenv("HOSTNAME", "analysis-0"))          # stable pod name (StatefulSet)
+OWNERSHIP_LEASE_SEC = int(os.getenv("OWNERSHIP_LEASE_SEC", "30"))            # a dead replica's devices move after this long
+FORWARDED_CLAIM_WAIT_SEC = float(os.getenv("FORWARDED_CLAIM_WAIT_SEC", "2"))  # wait for a handoff before processing anyway
+
+# Readings forwarded to this replica by the others (shared-subscription mode only)
+INBOX_TOPIC = f"{MQTT_TOPIC}/_replica/{REPLICA_ID}"
+
 # ======= Tunables =======
 # Lookback window for both daily consumption and cup-size estimation (complete days, excludes today)
 WINDOW_DAYS = int(os.getenv("ANALYSIS_WINDOW_DAYS", "7"))
@@ -37,8 +64,12 @@ CUP_MAX_DROP_G = float(os.getenv("CUP_MAX_DROP_G", "350"))   # ignore large refi
 # Fallback cup size if we can't infer from data
 CUP_DEFAULT_G = float(os.getenv("CUP_DEFAULT_G", "60"))      # ~60 ml ≈ a small coffee
 
-# Require at least this many complete days to trust avg consumption
-MIN_DAYS_FOR_AVG = int(os.getenv("MIN_DAYS_FOR_AVG", "2"))
+# Fallback daily consumption if we can't infer from data
+DAILY_DEFAULT_G = float(os.getenv("DAILY_DEFAULT_G", "200"))
+
+# Empty-time forecast: smoothed daily rate and hour-of-day profile per device (forecast.py)
+FORECAST_ALPHA = float(os.getenv("FORECAST_ALPHA", "0.3"))                 # weight of the newest day (0..1)
+FORECAST_HORIZON_DAYS = int(os.getenv("FORECAST_HORIZON_DAYS", "60"))      # no forecast further out than this
 
 # Baseline "full" calculation:
 # 0 → use all-time max; otherwise: use max over last N days
@@ -46,9 +77,69 @@ FULL_BASELINE_LOOKBACK_DAYS = int(os.getenv("FULL_BASELINE_LOOKBACK_DAYS", "0"))
 
 # Carton removal detection
 CARTON_REMOVAL_GRACE_PERIOD_MIN = int(os.getenv("CARTON_REMOVAL_GRACE_PERIOD_MIN", "1"))  # Wait 1 minute before saving 0g
-
-# Carton removal tracking per device
-_device_carton_removal_tracking = {}  # {device_id: {"zero_start_time": datetime}}
+GRACE_RESUBMIT_DELAY_SEC = 1.0   # retry a grace expiry the worker pool did not accept
+
+# Ingest buffer: readings are written to weight_data in multi-row batches
+WEIGHT_BATCH_SIZE = int(os.getenv("WEIGHT_BATCH_SIZE", "200"))                       # flush when this many readings are buffered
+WEIGHT_BATCH_MAX_LATENCY_MS = int(os.getenv("WEIGHT_BATCH_MAX_LATENCY_MS", "500"))   # ...or when the oldest one waited this long
+INGEST_STATS_LOG_SEC = float(os.getenv("INGEST_STATS_LOG_SEC", "60"))                # how often to log buffer counters
+WEIGHT_FLUSH_MAX_RETRIES = int(os.getenv("WEIGHT_FLUSH_MAX_RETRIES", "5"))           # failed inserts of a batch before it is dropped
+WEIGHT_FLUSH_RETRY_BACKOFF_MS = int(os.getenv("WEIGHT_FLUSH_RETRY_BACKOFF_MS", "500"))  # first retry delay, doubled per failure (max 30s)
+
+# MySQL connection pool shared by the insert and analytics paths
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))                        # connections kept open
+DB_POOL_MAX_OVERFLOW = int(os.getenv("DB_POOL_MAX_OVERFLOW", "5"))        # extra connections allowed under load
+DB_POOL_TIMEOUT_SEC = float(os.getenv("DB_POOL_TIMEOUT_SEC", "10"))       # max wait for a free connection
+DB_POOL_RECYCLE_SEC = float(os.getenv("DB_POOL_RECYCLE_SEC", "1800"))     # reopen connections older than this
+DB_POOL_PRE_PING_IDLE_SEC = float(os.getenv("DB_POOL_PRE_PING_IDLE_SEC", "30"))  # ping on checkout if idle this long
+
+# Worker pool: on_message only parses and hands the reading to the worker owning the device
+WORKER_THREADS = int(os.getenv("WORKER_THREADS", "4"))                  # parallel shards (one thread each)
+WORK_QUEUE_DEPTH = int(os.getenv("WORK_QUEUE_DEPTH", "1000"))           # max queued readings per shard
+OVERLOAD_POLICY = os.getenv("OVERLOAD_POLICY", "drop-oldest").lower()   # block | drop-oldest | shed
+OVERLOAD_BLOCK_TIMEOUT_MS = float(os.getenv("OVERLOAD_BLOCK_TIMEOUT_MS", "50"))  # "block": shed after waiting this long
+
+# Engine: "sync" = paho thread + worker threads (above); "async" = one asyncio loop (async_engine.py)
+MODE = os.getenv("MODE", "sync").lower()                                # sync | async
+ASYNC_MAX_INFLIGHT_BATCHES = int(os.getenv("ASYNC_MAX_INFLIGHT_BATCHES", "4"))   # batches written concurrently
+ASYNC_MAX_PENDING = int(os.getenv("ASYNC_MAX_PENDING", "0"))            # stop reading MQTT at this many buffered readings (0 = auto)
+
+# Write compression: steady readings are median-smoothed and only stored when they move (0g always is)
+WRITE_DEADBAND_G = float(os.getenv("WRITE_DEADBAND_G", "3"))           # store when the weight moved more than this (-1 stores everything)
+WRITE_HEARTBEAT_SEC = float(os.getenv("WRITE_HEARTBEAT_SEC", "600"))    # ...or when the last stored reading is this old (0 = never)
+WRITE_MEDIAN_WINDOW = int(os.getenv("WRITE_MEDIAN_WINDOW", "3"))        # readings in the noise-smoothing median (1 = off)
+
+# Per-device state (deadband, analytics): idle devices are evicted so memory stays flat
+DEVICE_STATE_TTL_HOURS = float(os.getenv("DEVICE_STATE_TTL_HOURS", "168"))   # drop devices idle this long (0 = never)
+DEVICE_STATE_MAX = int(os.getenv("DEVICE_STATE_MAX", "200000"))              # LRU cap for the deadband store
+DEVICE_STATE_SWEEP_MIN = float(os.getenv("DEVICE_STATE_SWEEP_MIN", "15"))    # how often idle devices are swept
+
+# QoS 1 redeliveries are dropped by (device_id, message_id) before any DB work
+DEDUP_WINDOW_SEC = float(os.getenv("DEDUP_WINDOW_SEC", "600"))   # remember message ids this long (0 disables)
+DEDUP_MAX_KEYS = int(os.getenv("DEDUP_MAX_KEYS", "200000"))      # memory bound; the window shrinks when it is hit
+
+# Prometheus text metrics served on http://<pod>:METRICS_PORT/metrics (0 disables the endpoint)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+
+# weight_data retention: raw readings are kept in time partitions and downsampled to hourly history when dropped
+# (never shorter than what the live analytics read back from weight_data)
+RETENTION_DAYS = max(int(os.getenv("RETENTION_DAYS", "90")), WINDOW_DAYS + 1, FULL_BASELINE_LOOKBACK_DAYS + 1)
+RETENTION_PARTITION = os.getenv("RETENTION_PARTITION", "month").lower()          # month | day
+RETENTION_PARTITIONS_AHEAD = int(os.getenv("RETENTION_PARTITIONS_AHEAD", "2"))   # future partitions kept ready
+RETENTION_INTERVAL_HOURS = float(os.getenv("RETENTION_INTERVAL_HOURS", "24"))   # 0 disables the background job
+
+# Warm restarts: analytics and pending carton removals are snapshotted to a local file and restored on startup
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", "/var/lib/smart-milk/analysis-state.snap")   # empty disables snapshots
+SNAPSHOT_INTERVAL_SEC = float(os.getenv("SNAPSHOT_INTERVAL_SEC", "30"))                # periodic snapshot (plus one on shutdown)
+SNAPSHOT_MAX_AGE_MIN = float(os.getenv("SNAPSHOT_MAX_AGE_MIN", "1440"))                # older snapshots -> full warm-up from MySQL
+SNAPSHOT_CATCH_UP_MARGIN_SEC = float(os.getenv("SNAPSHOT_CATCH_UP_MARGIN_SEC", "60"))  # re-read readings this far before the snapshot
+
+# Carton removal tracking per device (first 0g reading of each pending removal)
+_carton_tracker = carton.CartonRemovalTracker(CARTON_REMOVAL_GRACE_PERIOD_MIN * 60)
+
+# Per-device median window and last stored weight for the write deadband
+_deadband = DeadbandFilter(WRITE_DEADBAND_G, WRITE_HEARTBEAT_SEC, WRITE_MEDIAN_WINDOW,
+                           max_devices=DEVICE_STATE_MAX, ttl_s=DEVICE_STATE_TTL_HOURS * 3600)
 
 # ======= DB Helpers =======
 def get_user_id_by_device(conn, device_id: str):
@@ -60,18 +151,20 @@ def get_user_id_by_device(conn, device_id: str):
 
 def init_tables(conn):
     """
-    Ensure weight_data exists and user_stats matches the NEW schema (container_id as primary key).
+    Ensure weight_data exists, user_stats matches the NEW schema (container_id as primary key)
+    and the weight_daily_rollup / weight_hourly_history tables exist.
     """
     cur = conn.cursor()
 
-    # 1) Raw readings table
+    # 1) Raw readings table (timestamp is part of every unique key so it can be range-partitioned)
     cur.execute("""
         CREATE TABLE IF NOT EXISTS weight_data (
-          id        BIGINT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
+          id        BIGINT UNSIGNED AUTO_INCREMENT,
           device_id VARCHAR(128) NOT NULL,
           weight    FLOAT NOT NULL,
           timestamp DATETIME NOT NULL,
-          INDEX(device_id, timestamp)
+          PRIMARY KEY (id, timestamp),
+          UNIQUE KEY uniq_device_time (device_id, timestamp)
         ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
     """)
 
@@ -84,9 +177,22 @@ def init_tables(conn):
           cups_left                   FLOAT        NULL,      -- current_amount_g / avg_cup_grams
           percent_full                FLOAT        NULL,      -- 0..100
           expected_empty_date         DATE         NULL,      -- projected run-out date
+          expected_empty_at           DATETIME     NULL,      -- projected run-out time (hourly forecast)
           PRIMARY KEY (container_id)                          -- device_id is the primary key
         ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
     """)
+    cur.execute("""
+        SELECT COUNT(*) FROM INFORMATION_SCHEMA.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'user_stats' AND COLUMN_NAME = 'expected_empty_at'
+    """)
+    if cur.fetchone()[0] == 0:   # created before the hourly forecast
+        cur.execute("ALTER TABLE user_stats ADD COLUMN expected_empty_at DATETIME NULL AFTER expected_empty_date")
+
+    # 3) Per-device daily rollup, maintained on every flush
+    cur.execute(ROLLUP_DDL)
+
+    # 4) Hourly history of readings whose partitions were dropped by retention
+    cur.execute(HOURLY_HISTORY_DDL)
 
     conn.commit()
     cur.close()
@@ -105,386 +211,621 @@ def handle_carton_removal_logic(device_id: str, weight: float) -> tuple[bool, fl
     """
     Handle carton removal detection and return whether to save and what weight to save.
     Returns (should_save, weight_to_save)
+    The 0g save itself happens when the grace-period deadline fires (see on_grace_deadline).
     """
     now = datetime.now()
-    
-    # If weight is not 0g, reset carton removal tracking
-    if weight > 0:
-        if device_id in _device_carton_removal_tracking:
-            print(f"[analysis] 🥛 Carton returned after removal! Current: {weight}g - canceling 0g timer")
-            del _device_carton_removal_tracking[device_id]
+    outcome = _carton_tracker.observe(device_id, weight, now)
+
+    if outcome == carton.RETURNED:
+        print(f"[analysis] 🥛 Carton returned after removal! Current: {weight}g - canceling 0g timer")
+        _grace_scheduler.cancel(device_id)
+    if outcome in (carton.SAVE, carton.RETURNED):
         return True, weight  # Save immediately
-    
-    # Weight is 0g - handle carton removal
-    if device_id not in _device_carton_removal_tracking:
-        # First time seeing 0g, start tracking
-        _device_carton_removal_tracking[device_id] = {
-            "zero_start_time": now
-        }
+
+    if outcome == carton.STARTED:
+        # First time seeing 0g: arm the grace-period deadline
+        _grace_scheduler.schedule(device_id, CARTON_REMOVAL_GRACE_PERIOD_MIN * 60,
+                                  on_grace_deadline, device_id, now)
         print(f"[analysis] 🥛 Carton removal detected for device {device_id} - starting 1 minute grace period")
         return False, None  # Don't save yet, wait for grace period
-    
-    tracking = _device_carton_removal_tracking[device_id]
-    
-    # Check if grace period expired
-    grace_period_expired = now >= tracking["zero_start_time"] + timedelta(minutes=CARTON_REMOVAL_GRACE_PERIOD_MIN)
-    
-    if grace_period_expired:
-        print(f"[analysis] ⏰ Grace period expired for device {device_id} - carton appears to be empty, saving 0g")
-        del _device_carton_removal_tracking[device_id]
-        return True, 0.0  # Now save 0g as the carton is truly empty
-    else:
-        remaining_time = (tracking["zero_start_time"] + timedelta(minutes=CARTON_REMOVAL_GRACE_PERIOD_MIN) - now).total_seconds()
-        print(f"[analysis] ⏳ Carton removal grace period active for device {device_id}, {remaining_time:.0f} seconds remaining")
-        return False, None  # Don't save yet, still in grace period
 
-def check_expired_grace_periods():
-    """Check if any grace periods have expired and save 0g weights"""
-    now = datetime.now()
-    expired_devices = []
-    
-    for device_id, tracking in _device_carton_removal_tracking.items():
-        grace_period_expired = now >= tracking["zero_start_time"] + timedelta(minutes=CARTON_REMOVAL_GRACE_PERIOD_MIN)
-        
-        if grace_period_expired:
-            expired_devices.append(device_id)
-            print(f"[analysis] ⏰ Grace period expired for device {device_id} - saving 0g weight")
-    
-    # Save 0g weights for expired devices
-    for device_id in expired_devices:
-        del _device_carton_removal_tracking[device_id]
-        save_weight(device_id, 0.0, 0)  # Save 0g weight
+    remaining_time = _grace_scheduler.remaining(device_id) or 0
+    print(f"[analysis] ⏳ Carton removal grace period active for device {device_id}, {remaining_time:.0f} seconds remaining")
+    return False, None  # Don't save yet, still in grace period
 
-# ======= Analytics =======
-def fetch_day_first_last_by_device(conn, device_id: str, start_day: date, end_day_exclusive: date):
+def on_grace_deadline(device_id: str, zero_start_time: datetime):
     """
-    Return rows [(day_date, first_weight, last_weight)] for days in [start_day, end_day_exclusive),
-    where each day is COMPLETE. Use GROUP BY date(timestamp) and join to first/last timestamps.
+    Fired by the deadline scheduler exactly when a grace period ends.
+    The save is handed to the device's worker so the 0g lands in order with that device's readings;
+    it is pinned, so a full shard never sheds or evicts it. Re-armed if the pool is stopping.
     """
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT d.d,
-               w1.weight AS first_w,
-               w2.weight AS last_w
-        FROM (
-            SELECT DATE(timestamp) AS d,
-                   MIN(timestamp) AS t_min,
-                   MAX(timestamp) AS t_max
-            FROM weight_data
-            WHERE device_id=%s
-              AND timestamp >= %s
-              AND timestamp <  %s
-            GROUP BY DATE(timestamp)
-        ) d
-        LEFT JOIN weight_data w1
-          ON w1.device_id=%s AND w1.timestamp = d.t_min
-        LEFT JOIN weight_data w2
-          ON w2.device_id=%s AND w2.timestamp = d.t_max
-        ORDER BY d.d ASC
-    """, (
-        device_id,
-        datetime.combine(start_day, datetime.min.time()),
-        datetime.combine(end_day_exclusive, datetime.min.time()),
-        device_id, device_id
-    ))
-    rows = cur.fetchall()
-    cur.close()
-
-    out = []
-    for d, first_w, last_w in rows:
-        if first_w is not None and last_w is not None:
-            out.append((d, float(first_w), float(last_w)))
-    return out
-
-def robust_average_daily_consumption(conn, device_id: str) -> float | None:
-    """
-    Average of (start_of_day - end_of_day) across the last WINDOW_DAYS complete days, excluding today.
-    Only positive deltas are counted (ignores refills/noise).
-    """
-    today = date.today()
-    start_day = today - timedelta(days=WINDOW_DAYS)
-    # consider full days: from start_day .. yesterday
-    day_rows = fetch_day_first_last_by_device(conn, device_id, start_day, today)
-    daily_uses = []
-    for _, first_w, last_w in day_rows:
-        delta = first_w - last_w
-        if delta > 0:
-            daily_uses.append(delta)
-    if len(daily_uses) < MIN_DAYS_FOR_AVG:
-        return None
-    return sum(daily_uses) / len(daily_uses)
-
-def median(values):
-    if not values:
-        return None
-    s = sorted(values)
-    n = len(s)
-    m = n // 2
-    return s[m] if n % 2 == 1 else 0.5 * (s[m-1] + s[m])
-
-def estimate_avg_cup_grams(conn, device_id: str) -> float:
-    """
-    Estimate average 'cup' usage from recent drops between consecutive readings
-    within [CUP_MIN_DROP_G, CUP_MAX_DROP_G] over the last WINDOW_DAYS.
-    Uses the median for robustness; falls back to CUP_DEFAULT_G.
-    """
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT weight
-        FROM weight_data
-        WHERE device_id=%s
-          AND timestamp >= (NOW() - INTERVAL %s DAY)
-        ORDER BY timestamp ASC
-    """, (device_id, WINDOW_DAYS))
-    weights = [float(w) for (w,) in cur.fetchall()]
-    cur.close()
-
-    drops = []
-    for i in range(1, len(weights)):
-        drop = weights[i-1] - weights[i]
-        if CUP_MIN_DROP_G <= drop <= CUP_MAX_DROP_G:
-            drops.append(drop)
+    if not _workers.submit_pinned(device_id, expire_grace_period, device_id, zero_start_time):
+        _grace_scheduler.schedule(device_id, GRACE_RESUBMIT_DELAY_SEC, on_grace_deadline, device_id, zero_start_time)
+
+def expire_grace_period(device_id: str, zero_start_time: datetime):
+    """Runs on the device's worker: save 0g if this grace period is still the pending one."""
+    if _ownership is not None and not _ownership.owns(device_id):
+        _carton_tracker.forget(device_id)
+        return  # the device moved to another replica, which tracks its removals now
+    if not _carton_tracker.expire(device_id, zero_start_time):
+        return  # carton came back (or a newer removal started) while this was queued
+    print(f"[analysis] ⏰ Grace period expired for device {device_id} - carton appears to be empty, saving 0g")
+    save_weight(device_id, 0.0, 0)  # Save 0g weight
 
-    cup = median(drops)
-    if cup is None or cup <= 0:
-        cup = CUP_DEFAULT_G
-    return cup
-
-def compute_full_baseline_g(conn, device_id: str) -> float | None:
-    """
-    Baseline "full" weight. By default, uses ALL-TIME MAX. If FULL_BASELINE_LOOKBACK_DAYS > 0,
-    uses the max over that rolling window to adapt quicker to new containers.
-    """
+# ======= Analytics =======
+UPSERT_USER_STATS_SQL = """
+    INSERT INTO user_stats (
+        container_id, current_amount_g, avg_daily_consumption_g,
+        cups_left, percent_full, expected_empty_date, expected_empty_at
+    ) VALUES (%s, %s, %s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+        current_amount_g=VALUES(current_amount_g),
+        avg_daily_consumption_g=VALUES(avg_daily_consumption_g),
+        cups_left=VALUES(cups_left),
+        percent_full=VALUES(percent_full),
+        expected_empty_date=VALUES(expected_empty_date),
+        expected_empty_at=VALUES(expected_empty_at)
+"""
+
+def upsert_user_stats_many(conn, rows):
+    """Write several user_stats rows at once (executemany -> one multi-row upsert)."""
     cur = conn.cursor()
-    if FULL_BASELINE_LOOKBACK_DAYS > 0:
-        cur.execute("""
-            SELECT MAX(weight)
-            FROM weight_data
-            WHERE device_id=%s
-              AND timestamp >= (NOW() - INTERVAL %s DAY)
-        """, (device_id, FULL_BASELINE_LOOKBACK_DAYS))
-    else:
-        cur.execute("""
-            SELECT MAX(weight)
-            FROM weight_data
-            WHERE device_id=%s
-        """, (device_id,))
-    row = cur.fetchone()
+    cur.executemany(UPSERT_USER_STATS_SQL, rows)
     cur.close()
-    return float(row[0]) if row and row[0] is not None else None
-
-def upsert_user_stats(conn, device_id: str,
-                      current_amount_g: float,
-                      avg_daily_g: float | None,
-                      cups_left: float | None,
-                      percent_full: float | None,
-                      expected_empty_date):
-    """
-    Write stats using container_id (device_id) as primary key
-    """
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO user_stats (
-            container_id, current_amount_g, avg_daily_consumption_g,
-            cups_left, percent_full, expected_empty_date
-        ) VALUES (%s, %s, %s, %s, %s, %s)
-        ON DUPLICATE KEY UPDATE
-            current_amount_g=VALUES(current_amount_g),
-            avg_daily_consumption_g=VALUES(avg_daily_consumption_g),
-            cups_left=VALUES(cups_left),
-            percent_full=VALUES(percent_full),
-            expected_empty_date=VALUES(expected_empty_date)
-    """, (
-        device_id, current_amount_g, avg_daily_g,
-        cups_left, percent_full, expected_empty_date
-    ))
     conn.commit()
-    cur.close()
 
 # Add global message counter at the top level
 message_counter = 0
 
 # ======= MQTT callbacks =======
 def on_connect(client, userdata, flags, rc, properties=None):
-    client.subscribe(MQTT_TOPIC)
-    print(f"[analysis] Connected to MQTT and subscribed to {MQTT_TOPIC}")
+    global _mqtt_client
+    _mqtt_client = client
+    filters = subscription_filters(MQTT_TOPIC, MQTT_PER_DEVICE_TOPICS, MQTT_SHARED_GROUP)
+    if _ownership is not None:
+        # readings other replicas forward to the owner (never shared)
+        filters += [f"{INBOX_TOPIC}/+", binary_topic(INBOX_TOPIC, "+")]
+    subscribe_all(client, filters)
+    print(f"[analysis] Connected to MQTT and subscribed to {', '.join(filters)}")
+
+def parse_payload(payload: bytes, topic_device: str | None = None, binary: bool = False):
+    """
+    JSON, legacy plain number or (when the topic or content type says so) the
+    packed binary layout; see payload_codec.py. Returns a list of
+    payload_codec.Reading: one, or a publisher's store-and-forward batch.
+    A per-device topic names the device when the payload does not.
+    """
+    return payload_codec.decode_readings(payload, topic_device, binary, default_device=DEVICE_ID)
 
 def on_message(client, userdata, msg, properties=None):
     global message_counter
     message_counter += 1
     
     try:
-        payload = msg.payload.decode().strip()
-        
-        # Try to parse as JSON first
-        try:
-            data = json.loads(payload)
-            device_id = data.get("device_id", DEVICE_ID)
-            weight = float(data.get("weight"))
-            message_id = data.get("message_id", "unknown")
-            
-            print(f"[analysis] Message #{message_counter}: Received from device {device_id}, weight {weight}g, msg_id: {message_id}")
-            
-        except (json.JSONDecodeError, KeyError, TypeError):
-            # Fallback to old format (plain number)
-            weight = float(payload)
-            device_id = DEVICE_ID
-            
+        with _metrics.time("parse"):
+            topic = msg.topic
+            forwarded = _ownership is not None and topic.startswith(INBOX_TOPIC + "/")
+            topic_device, binary = parse_topic(topic, INBOX_TOPIC if forwarded else MQTT_TOPIC, content_type(msg))
+            readings = parse_payload(msg.payload, topic_device, binary)
+            reading = readings[-1]
+            device_id, weight = reading.device_id, reading.weight
+
+        if _dedup.seen(device_id, reading.message_id, reading.timestamp):
+            print(f"[analysis] Message #{message_counter}: ♻️ Duplicate msg_id {reading.message_id} from device {device_id} suppressed")
+            return
+        if len(readings) > 1:
+            print(f"[analysis] Message #{message_counter}: Received batch of {len(readings)} buffered readings "
+                  f"from device {device_id}, latest weight {weight}g")
+        elif reading.format == payload_codec.LEGACY:
             print(f"[analysis] Message #{message_counter}: Received legacy format from device {device_id}, weight {weight}g")
-        
-        # Handle carton removal logic
-        should_save, weight_to_save = handle_carton_removal_logic(device_id, weight)
-        
-        if should_save:
-            save_weight(device_id, weight_to_save, message_counter)
         else:
-            print(f"[analysis] Message #{message_counter}: Weight {weight}g - carton removal grace period active, not saving yet")
+            print(f"[analysis] Message #{message_counter}: Received from device {device_id}, weight {weight}g, msg_id: {reading.message_id}")
+        _metrics.device_seen(device_id)
+
+        # Everything past parsing runs on the device's worker thread
+        if len(readings) > 1:
+            submitted = _workers.submit(device_id, process_batch, device_id, readings, message_counter, msg.payload, forwarded)
+        else:
+            submitted = _workers.submit(device_id, process_reading, device_id, weight, message_counter, msg.payload, forwarded)
+        if not submitted:
+            print(f"[analysis] Message #{message_counter}: Work queue full - reading shed for device {device_id}")
         
     except Exception as e:
         print(f"[analysis] Message #{message_counter}: ERROR - {e}")
 
+def process_reading(device_id: str, weight: float, msg_num: int, raw: bytes = b"", forwarded: bool = False):
+    """Carton-removal logic and save; always runs on the worker owning device_id."""
+    if _ownership is not None and not claim_device(device_id, raw, forwarded, msg_num):
+        return  # forwarded to the replica that owns the device
+    ensure_analytics(device_id)
+
+    # Handle carton removal logic
+    with _metrics.time("carton"):
+        should_save, weight_to_save = handle_carton_removal_logic(device_id, weight)
+
+    if should_save:
+        save_weight(device_id, weight_to_save, msg_num)
+    else:
+        _metrics.inc("readings_held_total", description="0g readings held back by the carton-removal grace period")
+        print(f"[analysis] Message #{msg_num}: Weight {weight}g - carton removal grace period active, not saving yet")
+
+def process_batch(device_id: str, readings, msg_num: int, raw: bytes = b"", forwarded: bool = False):
+    """
+    A publisher's store-and-forward backlog, on the worker owning device_id.
+    The carton logic runs on the readings' own timestamps, and everything that
+    is stored is queued as one unit: one multi-row insert, one stats refresh.
+    Readings not newer than the device's last one are skipped, so a batch the
+    publisher re-sends after a lost acknowledgement is not counted twice.
+    """
+    if _ownership is not None and not claim_device(device_id, raw, forwarded, msg_num):
+        return
+    ensure_analytics(device_id)
+
+    now = datetime.now()
+    last = _analytics.last_timestamp(device_id)
+    backlog = sorted(((r.weight, min(r.timestamp or now, now)) for r in readings), key=lambda r: r[1])
+    fresh = [r for r in backlog if last is None or r[1] > last]
+    with _metrics.time("carton"):
+        stored = _carton_tracker.observe_backlog(device_id, fresh, now)
+        zero_start = _carton_tracker.zero_since(device_id)
+        if zero_start is None:
+            _grace_scheduler.cancel(device_id)
+        else:
+            _grace_scheduler.schedule(device_id, (zero_start + _carton_tracker.grace - now).total_seconds(),
+                                      on_grace_deadline, device_id, zero_start)
+    queued = save_weights(device_id, stored, msg_num)
+    _metrics.inc("batched_readings_total", len(readings), description="Readings received in store-and-forward batches")
+    print(f"[analysis] Message #{msg_num}: 📦 Batch from device {device_id}: stored {queued} of "
+          f"{len(readings)} readings ({len(backlog) - len(fresh)} already seen)")
+
+# ======= Scale-out =======
+def claim_device(device_id: str, raw: bytes, forwarded: bool, msg_num: int) -> bool:
+    """
+    Shared-subscription mode: True if this replica processes the reading.
+    Readings of devices owned elsewhere are forwarded to the owner's inbox;
+    a reading that was already forwarded here waits briefly for an
+    in-progress handoff instead of bouncing back.
+    """
+    deadline = time.monotonic() + (FORWARDED_CLAIM_WAIT_SEC if forwarded else 0)
+    while True:
+        try:
+            with _metrics.time("ownership"):
+                owner = _ownership.claim(device_id, refresh=forwarded)
+        except Exception as e:
+            print(f"[analysis] Message #{msg_num}: ERROR checking ownership of {device_id} - {e}; processing here")
+            return True
+        if owner == ownership.OWNED:
+            return True
+        if owner == ownership.ACQUIRED:
+            take_over_device(device_id)
+            return True
+        if not forwarded:
+            forward_reading(owner, device_id, raw, msg_num)
+            return False
+        if time.monotonic() >= deadline:
+            print(f"[analysis] Message #{msg_num}: {device_id} is still owned by {owner} - processing forwarded reading here")
+            return True
+        time.sleep(0.1)
+
+def forward_reading(owner: str, device_id: str, raw: bytes, msg_num: int):
+    inbox = f"{MQTT_TOPIC}/_replica/{owner}"
+    # Binary readings keep their topic announcement (their magic bytes can't start a JSON payload)
+    topic = binary_topic(inbox, device_id) if raw.startswith(payload_codec.MAGIC) else f"{inbox}/{device_id}"
+    _mqtt_client.publish(topic, raw, qos=1)
+    _metrics.inc("readings_forwarded_total", description="Readings forwarded to the replica owning the device")
+    print(f"[analysis] Message #{msg_num}: Device {device_id} is owned by {owner} - forwarded")
+
+def take_over_device(device_id: str):
+    """This replica just became the device's owner: forget local leftovers and reload it from MySQL."""
+    _grace_scheduler.cancel(device_id)
+    _carton_tracker.forget(device_id)
+    _deadband.forget(device_id)
+    with _db_pool.connection() as conn:
+        rows = _analytics.reload_device(conn, device_id)
+    print(f"[analysis] 🔀 Took over device {device_id} ({rows} readings reloaded from MySQL)")
+
+def hand_off_devices(devices):
+    """Give up devices that now hash to another replica, after everything they produced is stored."""
+    _ownership.start_handoff(devices)   # their readings are forwarded from here on...
+    _workers.barrier()                  # ...once the ones already queued are processed
+    _weight_buffer.flush()              # and written to weight_data / user_stats
+    _ownership.release(devices)
+    for device_id in devices:
+        _grace_scheduler.cancel(device_id)
+        _carton_tracker.forget(device_id)
+        _deadband.forget(device_id)
+        _analytics.forget(device_id)
+        _metrics.forget_device(device_id)
+    print(f"[analysis] 🔀 Handed off {len(devices)} device(s) to other replicas")
+
+def ownership_loop():
+    """Renew this replica's leases and rebalance devices when replicas join or leave."""
+    while True:
+        try:
+            moved = _ownership.heartbeat()
+            if moved:
+                hand_off_devices(moved)
+        except Exception as e:
+            print(f"[analysis] Error in ownership heartbeat: {e}")
+        time.sleep(_ownership.heartbeat_s)
+
 # ======= Save flow =======
+def ensure_analytics(device_id: str):
+    """A device swept for being idle (or never seen) is reloaded from MySQL before its reading is folded in."""
+    if _analytics.idle_ttl_s <= 0 or device_id in _analytics:
+        return
+    try:
+        with _db_pool.connection() as conn:
+            rows = _analytics.reload_device(conn, device_id)
+        if rows:
+            print(f"[analysis] ♻️ Reloaded idle device {device_id} ({rows} readings from MySQL)")
+    except Exception as e:
+        print(f"[analysis] ERROR reloading analytics for {device_id} - {e}")
+
 def save_weight(device_id: str, weight: float, msg_num: int):
+    """
+    Fold the reading into the in-memory analytics state and queue it for the
+    batched weight_data insert; user_stats is refreshed after the flush.
+    Readings inside the write deadband are neither stored nor folded in.
+    """
     try:
-        # Create a fresh connection for each operation
-        conn = mysql.connector.connect(**MYSQL_CONFIG)
-        
-        current_amount_g = float(weight)
-        
-        # Insert weight data with precise timestamp
-        cur = conn.cursor()
         now = datetime.now()
-        
-        cur.execute(
-            "INSERT IGNORE INTO weight_data (device_id, weight, timestamp) VALUES (%s, %s, %s)",
-            (device_id, current_amount_g, now)
-        )
-        cur.close()
-        
-        # Calculate intelligent analytics
-        percent_full = min(100.0, (current_amount_g / 1000.0) * 100)  # Assume 1000g is full
-        
-        # Get learned cup size from recent weight drops
-        learned_cup_size = calculate_learned_cup_size(conn, device_id)
-        cups_left = math.floor(current_amount_g / learned_cup_size) if learned_cup_size > 0 else 0
-        
-        # Get learned daily consumption
-        learned_daily_consumption = calculate_learned_daily_consumption(conn, device_id)
-        
-        # Calculate days left until empty
-        expected_empty_date = None
-        if learned_daily_consumption > 0 and current_amount_g > 0:
-            days_left = current_amount_g / learned_daily_consumption
-            if days_left > 0:
-                expected_empty_date = datetime.now().date() + timedelta(days=int(days_left))
-        
-        # Update user_stats using device_id (container_id)
-        upsert_user_stats(conn, device_id, current_amount_g, learned_daily_consumption,
-                         cups_left, percent_full, expected_empty_date)
-        
-        print(f"[analysis] Message #{msg_num}: Analytics saved to MySQL - {cups_left} cups left, {percent_full:.1f}% full")
-        conn.close()
-        
+        stored = _deadband.filter(device_id, float(weight), now)
+        if stored is None:
+            _metrics.inc("readings_deadbanded_total", description="Steady readings not stored (write deadband)")
+            print(f"[analysis] Message #{msg_num}: Weight {weight}g within {WRITE_DEADBAND_G:g}g of the last stored reading - not stored")
+            return
+        drop_g = _analytics.add_reading(device_id, stored, now)
+        _weight_buffer.add(device_id, stored, now, msg_num, drop_g)
     except Exception as e:
-        print(f"[analysis] Message #{msg_num}: ERROR saving to MySQL - {e}")
+        print(f"[analysis] Message #{msg_num}: ERROR buffering weight - {e}")
+
+def save_weights(device_id: str, readings, msg_num: int):
+    """
+    save_weight() for a backlog [(weight, ts)], oldest first, queued for the
+    insert together. Returns how many readings were queued.
+    """
+    try:
+        rows = []
+        for weight, ts in readings:
+            stored = _deadband.filter(device_id, float(weight), ts)
+            if stored is None:
+                continue
+            drop_g = _analytics.add_reading(device_id, stored, ts)
+            rows.append(BufferedReading(device_id, stored, ts, msg_num, drop_g))
+        _weight_buffer.add_many(rows)
+        if len(rows) < len(readings):
+            _metrics.inc("readings_deadbanded_total", len(readings) - len(rows),
+                         description="Steady readings not stored (write deadband)")
+        return len(rows)
+    except Exception as e:
+        print(f"[analysis] Message #{msg_num}: ERROR buffering weights - {e}")
+        return 0
+
+def rollup_weights(conn, rows):
+    """
+    Called by the ingest buffer between the weight_data INSERT and its commit,
+    inside the batch's explicit transaction, with only the rows the INSERT
+    IGNORE stored: a batch that is rolled back and retried leaves no rollup
+    behind, and readings already in weight_data are not counted again.
+    """
+    with _metrics.time("rollup"):
+        update_daily_rollup(conn, rows, commit=False)
+
+def on_weights_flushed(conn, rows):
+    """
+    Called by the ingest buffer after a batch (and its rollup) has been committed.
+    Stats are derived once per device from the incremental state (no queries)
+    and written back with one multi-row upsert.
+    """
+    latest = {}
+    for row in rows:
+        latest[row.device_id] = row.msg_num
+    now = datetime.now()
+    stats_rows = []
+    for device_id, msg_num in latest.items():
         try:
-            conn.close()
-        except:
-            pass
+            with _metrics.time("analytics"):
+                stats_rows.append(compute_user_stats(device_id, now))
+        except Exception as e:
+            print(f"[analysis] Message #{msg_num}: ERROR computing analytics - {e}")
+    if not stats_rows:
+        return
+    try:
+        with _metrics.time("upsert_user_stats"):
+            upsert_user_stats_many(conn, stats_rows)
+    except Exception as e:
+        print(f"[analysis] ERROR saving analytics for {len(stats_rows)} device(s) to MySQL - {e}")
+        return
+    for row in stats_rows:
+        empty = f", empty around {row[6]:%Y-%m-%d %H:%M}" if row[6] else ""
+        print(f"[analysis] Message #{latest[row[0]]}: Analytics saved to MySQL - {row[3]} cups left, {row[4]:.1f}% full{empty}")
 
-def calculate_learned_cup_size(conn, device_id: str) -> float:
+def compute_user_stats(device_id: str, now: datetime):
+    """
+    Build one user_stats row from the incremental analytics state.
+    Returns (device_id, current_g, avg_daily_g, cups_left, percent_full,
+    expected_empty_date, expected_empty_at).
     """
-    Calculate average cup size by analyzing weight drops in the last 7 days.
-    A weight drop is detected when weight decreases significantly between readings.
+    return user_stats_row(_analytics, device_id, now)
+
+def log_runtime_stats():
+    w = _workers.stats()
+    print(
+        f"[analysis] 🧵 Workers: {w['workers']} shards, depth {w['depth']} (max {w['depth_max']}/{w['queue_depth_limit']}), "
+        f"processed {w['processed']}, failed {w['failed']}, policy {w['overload_policy']}: "
+        f"blocked {w['blocked']}, dropped {w['dropped_oldest']}, shed {w['shed']}"
+    )
+    p = _db_pool.stats()
+    print(
+        f"[analysis] 🔌 DB pool: {p['open']} open / {p['idle']} idle, {p['checkouts']} checkouts "
+        f"({p['checkouts_waited']} waited, avg {p['wait_time_avg_ms']:.2f}ms, max {p['wait_time_max_ms']:.1f}ms), "
+        f"timeouts {p['timeouts']}, created {p['created']}, recycled {p['recycled']}, "
+        f"failed health checks {p['health_check_failures']}"
+    )
+    d = _dedup.stats()
+    print(f"[analysis] ♻️ Dedup: {d['suppressed']} duplicates suppressed of {d['checked']} checked, "
+          f"{d['keys']} message ids remembered")
+
+_analytics = AnalyticsState(
+    window_days=WINDOW_DAYS,
+    cup_min_g=CUP_MIN_DROP_G,
+    cup_max_g=CUP_MAX_DROP_G,
+    cup_default_g=CUP_DEFAULT_G,
+    daily_default_g=DAILY_DEFAULT_G,
+    baseline_days=FULL_BASELINE_LOOKBACK_DAYS,
+    forecast_alpha=FORECAST_ALPHA,
+    forecast_horizon_days=FORECAST_HORIZON_DAYS,
+    idle_ttl_s=DEVICE_STATE_TTL_HOURS * 3600,
+)
+
+_db_pool = ConnectionPool(
+    MYSQL_CONFIG,
+    size=DB_POOL_SIZE,
+    max_overflow=DB_POOL_MAX_OVERFLOW,
+    recycle_s=DB_POOL_RECYCLE_SEC,
+    timeout_s=DB_POOL_TIMEOUT_SEC,
+    pre_ping_idle_s=DB_POOL_PRE_PING_IDLE_SEC,
+)
+
+_grace_scheduler = DeadlineScheduler(name="grace-scheduler", log_prefix="[analysis]")
+_housekeeping = DeadlineScheduler(name="housekeeping", log_prefix="[analysis]")   # periodic idle-device sweep
+
+_metrics = Metrics(prefix="analysis")
+
+_dedup = DuplicateFilter(DEDUP_WINDOW_SEC, DEDUP_MAX_KEYS)
+
+# Device leases between replicas (shared-subscription mode only)
+_ownership = DeviceOwnership(_db_pool.connection, REPLICA_ID, OWNERSHIP_LEASE_SEC) if MQTT_SHARED_GROUP else None
+_mqtt_client = None   # set on connect; the workers publish forwarded readings through it
+
+_workers = ShardedWorkerPool(
+    workers=WORKER_THREADS,
+    queue_depth=WORK_QUEUE_DEPTH,
+    overload_policy=OVERLOAD_POLICY,
+    block_timeout_s=OVERLOAD_BLOCK_TIMEOUT_MS / 1000.0,
+    name="analysis-worker",
+)
+
+_weight_buffer = WeightWriteBuffer(
+    connection=_db_pool.connection,
+    batch_size=WEIGHT_BATCH_SIZE,
+    max_latency_s=WEIGHT_BATCH_MAX_LATENCY_MS / 1000.0,
+    in_transaction=rollup_weights,
+    on_flush=on_weights_flushed,
+    stats_log_interval_s=INGEST_STATS_LOG_SEC,
+    on_stats=log_runtime_stats,
+    observe=_metrics.observe,
+    max_retries=WEIGHT_FLUSH_MAX_RETRIES,
+    retry_backoff_s=WEIGHT_FLUSH_RETRY_BACKOFF_MS / 1000.0,
+)
+
+def register_metrics():
+    """Expose the worker, buffer, pool and scheduler counters next to the stage histograms."""
+    m = _metrics
+    m.collect("messages_received_total", "MQTT messages received", lambda: message_counter, kind="counter")
+    for key, kind, description in (
+        ("submitted", "counter", "Readings handed to the worker pool"),
+        ("processed", "counter", "Readings processed by the workers"),
+        ("failed", "counter", "Readings whose processing raised"),
+        ("shed", "counter", "Readings rejected because a shard queue was full (or stayed full while blocking)"),
+        ("dropped_oldest", "counter", "Queued readings discarded to make room"),
+        ("blocked", "counter", "Submissions that waited for queue space"),
+    ):
+        m.collect(f"worker_{key}_total", description, lambda k=key: _workers.stats()[k], kind=kind)
+    m.collect("work_queue_depth", "Readings queued per worker shard",
+              lambda: [({"shard": str(i)}, d) for i, d in enumerate(_workers.shard_depths())])
+    m.collect("device_queue_depth", "Readings of a device waiting for its worker",
+              lambda: [({"device_id": d}, n) for d, n in sorted(_workers.depth_by_key().items())])
+    for key, kind, description in (
+        ("pending", "gauge", "Readings buffered for the next weight_data insert"),
+        ("rows_flushed", "counter", "Readings written to weight_data"),
+        ("rows_failed", "counter", "Readings lost to failed inserts"),
+        ("rows_skipped", "counter", "Readings already in weight_data (not inserted or rolled up again)"),
+        ("batches_flushed", "counter", "Multi-row weight_data inserts"),
+        ("flush_retries", "counter", "Failed weight_data inserts requeued for a retry"),
+    ):
+        suffix = "" if kind == "gauge" else "_total"
+        m.collect(f"ingest_{key}{suffix}", description, lambda k=key: _weight_buffer.stats()[k], kind=kind)
+    for key, kind, description in (
+        ("open", "gauge", "Open MySQL connections"),
+        ("idle", "gauge", "Idle MySQL connections in the pool"),
+        ("checkouts", "counter", "Connection checkouts"),
+        ("timeouts", "counter", "Checkouts that timed out"),
+        ("rolled_back", "counter", "Connections returned with an open transaction (rolled back)"),
+    ):
+        suffix = "" if kind == "gauge" else "_total"
+        m.collect(f"db_pool_{key}{suffix}", description, lambda k=key: _db_pool.stats()[k], kind=kind)
+    m.collect("duplicates_suppressed_total", "QoS 1 redeliveries dropped by message_id",
+              lambda: _dedup.suppressed, kind="counter")
+    m.collect("dedup_keys", "Message ids remembered for duplicate suppression", lambda: len(_dedup))
+    m.collect("deadband_devices", "Devices tracked by the write deadband", lambda: len(_deadband))
+    m.collect("grace_timers_pending", "Carton-removal grace periods running", _grace_scheduler.pending)
+    if _ownership is not None:
+        m.collect("owned_devices", "Devices this replica holds the lease for", _ownership.owned_count)
+        m.collect("replicas_live", "Live analysis-service replicas", lambda: len(_ownership.members))
+        m.collect("devices_acquired_total", "Devices taken over from other replicas",
+                  lambda: _ownership.acquired, kind="counter")
+        m.collect("devices_released_total", "Devices handed off to other replicas",
+                  lambda: _ownership.released, kind="counter")
+    if _snapshotter is not None:
+        m.collect("snapshots_written_total", "State snapshots written", lambda: _snapshotter.written, kind="counter")
+        m.collect("snapshots_failed_total", "State snapshots that failed to write", lambda: _snapshotter.failed, kind="counter")
+        m.collect("snapshot_bytes", "Size of the last state snapshot", lambda: _snapshotter.last_bytes)
+
+# ======= Snapshots =======
+def collect_snapshot() -> dict:
+    return {
+        "service": "analysis",
+        "config": _analytics.config(),
+        "analytics": _analytics.export(),
+        "carton": _carton_tracker.dump(),
+    }
+
+def restore_snapshot(conn) -> bool:
+    """
+    Restore the analytics state and pending carton removals from the last
+    snapshot, then fold in readings stored after it. Returns False when there
+    is no usable snapshot and the state has to be warmed from MySQL instead.
     """
+    if not SNAPSHOT_PATH:
+        return False
+    started = time.monotonic()
     try:
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT weight, timestamp 
-            FROM weight_data 
-            WHERE device_id = %s 
-            AND timestamp >= (NOW() - INTERVAL 7 DAY)
-            ORDER BY timestamp ASC
-        """, (device_id,))
-        weights = cur.fetchall()
-        cur.close()
-        
-        if len(weights) < 2:
-            return 60.0  # Default if not enough data
-        
-        # Calculate weight drops (when user pours coffee)
-        drops = []
-        for i in range(1, len(weights)):
-            current_weight = float(weights[i][0])
-            previous_weight = float(weights[i-1][0])
-            drop = previous_weight - current_weight
-            
-            # Filter for realistic coffee cup sizes (25g to 350g)
-            if 25 <= drop <= 350:
-                drops.append(drop)
-        
-        if not drops:
-            return 60.0  # Default if no valid drops found
-        
-        # Calculate average cup size from drops
-        avg_cup_size = sum(drops) / len(drops)
-        return avg_cup_size
-        
+        snap = read_snapshot(SNAPSHOT_PATH, SNAPSHOT_MAX_AGE_MIN * 60)
     except Exception as e:
-        print(f"[analysis] Error calculating cup size: {e}")
-        return 60.0  # Default fallback
+        print(f"[analysis] ⚠️ Ignoring state snapshot {SNAPSHOT_PATH}: {e}")
+        return False
+    if snap is None:
+        print(f"[analysis] No recent state snapshot at {SNAPSHOT_PATH} - warming from MySQL")
+        return False
+    created, sections = snap
+    if sections.get("service") != "analysis" or sections.get("config") != _analytics.config():
+        print("[analysis] ⚠️ State snapshot was taken with different analytics settings - warming from MySQL")
+        return False
+
+    devices = _analytics.restore(sections["analytics"])
+    pending = _carton_tracker.load(sections["carton"])
+    caught_up = _analytics.catch_up(conn, created - timedelta(seconds=SNAPSHOT_CATCH_UP_MARGIN_SEC))
+
+    # Re-arm grace periods that were running when the snapshot was taken (overdue ones fire right away)
+    now = datetime.now()
+    for device_id, zero_start in _carton_tracker.pending():
+        delay = (zero_start + _carton_tracker.grace - now).total_seconds()
+        _grace_scheduler.schedule(device_id, delay, on_grace_deadline, device_id, zero_start)
 
-def calculate_learned_daily_consumption(conn, device_id: str) -> float:
+    print(f"[analysis] ♻️ Restored state snapshot from {created:%Y-%m-%d %H:%M:%S}: {devices} devices, "
+          f"{pending} pending carton removals, {caught_up} newer readings caught up "
+          f"in {(time.monotonic() - started) * 1000:.0f}ms")
+    return True
+
+_snapshotter = (Snapshotter(SNAPSHOT_PATH, collect_snapshot, SNAPSHOT_INTERVAL_SEC, log_prefix="[analysis]")
+                if SNAPSHOT_PATH else None)
+
+def warm_analytics():
     """
-    Calculate average daily consumption by analyzing daily weight changes.
+    Make sure the tables exist (backfilling the daily rollup on first run), then
+    restore the last state snapshot or, without one, load the analytics state
+    for all devices; retried until MySQL is reachable.
     """
+    while True:
+        try:
+            started = time.monotonic()
+            with _db_pool.connection() as conn:
+                init_tables(conn)
+                if _ownership is not None:
+                    _ownership.init_tables(conn)
+                if rollup_is_empty(conn):
+                    print("[analysis] 🧮 weight_daily_rollup is empty - backfilling from weight_data")
+                    backfill_rollup(conn)
+                if restore_snapshot(conn):
+                    return
+                rows = _analytics.warm(conn)
+            print(f"[analysis] 🔥 Analytics state warmed: {len(_analytics)} devices, {rows} readings "
+                  f"in {time.monotonic() - started:.2f}s")
+            return
+        except Exception as e:
+            print(f"[analysis] Error warming analytics state: {e}; retrying in 5s…")
+            time.sleep(5)
+
+def sweep_device_state(analytics: bool = True):
+    """Evict idle devices from the per-device state, then re-arm on the housekeeping scheduler."""
     try:
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT DATE(timestamp) as date, 
-                   MAX(weight) as max_weight,
-                   MIN(weight) as min_weight
-            FROM weight_data 
-            WHERE device_id = %s 
-            AND timestamp >= (NOW() - INTERVAL 7 DAY)
-            GROUP BY DATE(timestamp)
-            HAVING COUNT(*) > 1
-        """, (device_id,))
-        daily_data = cur.fetchall()
-        cur.close()
-        
-        if not daily_data:
-            return 200.0  # Default if no data
-        
-        # Calculate daily consumption (max - min for each day)
-        daily_consumptions = []
-        for date, max_weight, min_weight in daily_data:
-            consumption = float(max_weight) - float(min_weight)
-            if consumption > 0:  # Only count positive consumption
-                daily_consumptions.append(consumption)
-        
-        if not daily_consumptions:
-            return 200.0  # Default if no valid consumption data
-        
-        avg_daily = sum(daily_consumptions) / len(daily_consumptions)
-        return avg_daily
-        
+        deadband = _deadband.sweep()
+        idle = _analytics.sweep() if analytics else 0
+        series = _metrics.sweep_devices(DEVICE_STATE_TTL_HOURS * 3600)
+        if deadband or idle or series:
+            print(f"[analysis] 🧹 Swept idle devices: {deadband} deadband, {idle} analytics, {series} metric series")
     except Exception as e:
-        print(f"[analysis] Error calculating daily consumption: {e}")
-        return 200.0  # Default fallback
+        print(f"[analysis] Error sweeping device state: {e}")
+    finally:
+        _housekeeping.schedule("sweep", DEVICE_STATE_SWEEP_MIN * 60, sweep_device_state, analytics)
 
-def main():
-    # Start a background thread to check expired grace periods
-    def grace_period_checker():
-        while True:
-            time.sleep(10)  # Check every 10 seconds
-            check_expired_grace_periods()
-    
-    grace_thread = threading.Thread(target=grace_period_checker, daemon=True)
-    grace_thread.start()
-    print("[analysis] 🔄 Started grace period checker thread")
+def retention_loop():
+    """
+    Keep weight_data partitions ahead of time and drop expired ones.
+    Never drops anything the live analytics still reads.
+    """
+    while True:
+        try:
+            with _db_pool.connection() as conn:
+                if not run_retention(conn, RETENTION_DAYS, RETENTION_PARTITION, RETENTION_PARTITIONS_AHEAD):
+                    print("[analysis] Retention already running elsewhere; skipping this round")
+        except Exception as e:
+            print(f"[analysis] Error in retention job: {e}")
+        time.sleep(RETENTION_INTERVAL_HOURS * 3600)
+
+def start_sweeps(analytics: bool = True):
+    """Sweep idle devices every DEVICE_STATE_SWEEP_MIN; analytics=False keeps the analytics state."""
+    if DEVICE_STATE_TTL_HOURS > 0 and DEVICE_STATE_SWEEP_MIN > 0:
+        _housekeeping.start()
+        _housekeeping.schedule("sweep", DEVICE_STATE_SWEEP_MIN * 60, sweep_device_state, analytics)
+        print(f"[analysis] 🗃️  Sweeping devices idle {DEVICE_STATE_TTL_HOURS:g}h every {DEVICE_STATE_SWEEP_MIN:g} min")
 
-    client = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION2)
+def main():
+    warm_analytics()
+    _weight_buffer.start()
+    _workers.start()
+    # atexit runs these last-registered-first: drain workers, flush the buffer, snapshot, drop leases, close the pool
+    atexit.register(_db_pool.close)
+    if _ownership is not None:
+        atexit.register(_ownership.leave)
+    if _snapshotter is not None:
+        atexit.register(_snapshotter.stop)
+    atexit.register(_weight_buffer.close)
+    atexit.register(_workers.stop)
+    # Kubernetes stops pods with SIGTERM; exit through atexit so the final snapshot is written
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(f"[analysis] 📦 Ingest buffer started (batch {WEIGHT_BATCH_SIZE}, max latency {WEIGHT_BATCH_MAX_LATENCY_MS}ms)")
+    print(f"[analysis] 🗜️ Write deadband {WRITE_DEADBAND_G:g}g, heartbeat {WRITE_HEARTBEAT_SEC:g}s, median of {WRITE_MEDIAN_WINDOW}")
+    print(f"[analysis] 🧵 Started {WORKER_THREADS} worker shards (queue depth {WORK_QUEUE_DEPTH}, overload policy {OVERLOAD_POLICY})")
+
+    # Grace-period deadlines fire from a heap-ordered timer thread (idle when nothing is pending)
+    _grace_scheduler.start()
+    print("[analysis] 🔄 Started grace period deadline scheduler")
+    start_sweeps()
+
+    if METRICS_PORT > 0:
+        register_metrics()
+        _metrics.serve(METRICS_PORT)
+        print(f"[analysis] 📈 Metrics on http://0.0.0.0:{METRICS_PORT}/metrics")
+
+    if _snapshotter is not None:
+        _snapshotter.start()
+        print(f"[analysis] 💾 Snapshotting state to {SNAPSHOT_PATH} every {SNAPSHOT_INTERVAL_SEC:g}s")
+
+    if RETENTION_INTERVAL_HOURS > 0:
+        threading.Thread(target=retention_loop, name="retention", daemon=True).start()
+        print(f"[analysis] 🧹 Started weight_data retention job (keep {RETENTION_DAYS} days, "
+              f"{RETENTION_PARTITION} partitions, every {RETENTION_INTERVAL_HOURS:g}h)")
+
+    if _ownership is not None:
+        _ownership.heartbeat()
+        threading.Thread(target=ownership_loop, name="ownership", daemon=True).start()
+        print(f"[analysis] 🔀 Replica {REPLICA_ID} in shared group '{MQTT_SHARED_GROUP}' "
+              f"({len(_ownership.members)} live replica(s), lease {OWNERSHIP_LEASE_SEC}s)")
+
+    client = make_client(MQTT_PROTOCOL, client_id=REPLICA_ID if MQTT_SHARED_GROUP else "")
     client.on_connect = on_connect
     client.on_message = on_message
 
@@ -496,5 +837,85 @@ def main():
             print(f"[analysis] Error: {e}; retrying in 5s…")
             time.sleep(5)
 
+def run_async():
+    """
+    MODE=async: the same pipeline on one asyncio event loop (see async_engine.py).
+    Startup and the retention job reuse the threaded pool above.
+    """
+    import asyncio
+    import async_engine
+
+    if MQTT_SHARED_GROUP:
+        sys.exit("[analysis] MODE=async does not support MQTT_SHARED_GROUP (device ownership); use MODE=sync")
+
+    warm_analytics()
+    engine = async_engine.AsyncAnalysisEngine(
+        mqtt_host=MQTT_HOST,
+        mqtt_port=MQTT_PORT,
+        filters=subscription_filters(MQTT_TOPIC, MQTT_PER_DEVICE_TOPICS),
+        base_topic=MQTT_TOPIC,
+        protocol=MQTT_PROTOCOL,
+        mysql_config=MYSQL_CONFIG,
+        analytics=_analytics,
+        tracker=_carton_tracker,
+        deadband=_deadband,
+        parse=parse_payload,
+        dedup=_dedup,
+        stats_sql=UPSERT_USER_STATS_SQL,
+        metrics=_metrics,
+        batch_size=WEIGHT_BATCH_SIZE,
+        max_latency_s=WEIGHT_BATCH_MAX_LATENCY_MS / 1000.0,
+        pool_size=DB_POOL_SIZE + DB_POOL_MAX_OVERFLOW,
+        max_inflight=ASYNC_MAX_INFLIGHT_BATCHES,
+        max_pending=ASYNC_MAX_PENDING,
+        pool_recycle_s=DB_POOL_RECYCLE_SEC,
+        stats_log_interval_s=INGEST_STATS_LOG_SEC,
+        max_retries=WEIGHT_FLUSH_MAX_RETRIES,
+        retry_backoff_s=WEIGHT_FLUSH_RETRY_BACKOFF_MS / 1000.0,
+    )
+    # atexit runs these after the engine has flushed and returned: snapshot, then close the pool
+    atexit.register(_db_pool.close)
+    if _snapshotter is not None:
+        atexit.register(_snapshotter.stop)
+
+    if METRICS_PORT > 0:
+        m = _metrics
+        m.collect("messages_received_total", "MQTT messages received", lambda: engine.received, kind="counter")
+        for key, kind, description in (
+            ("pending", "gauge", "Readings buffered for the next weight_data insert"),
+            ("in_flight", "gauge", "weight_data batches being written"),
+            ("rows_flushed", "counter", "Readings written to weight_data"),
+            ("rows_failed", "counter", "Readings lost to failed inserts"),
+            ("rows_skipped", "counter", "Readings already in weight_data (not inserted or rolled up again)"),
+            ("batches_flushed", "counter", "Multi-row weight_data inserts"),
+            ("flush_retries", "counter", "Failed weight_data inserts requeued for a retry"),
+            ("consumer_pauses", "counter", "Times MQTT reading paused for a full buffer"),
+        ):
+            suffix = "" if kind == "gauge" else "_total"
+            m.collect(f"ingest_{key}{suffix}", description, lambda k=key: engine.stats()[k], kind=kind)
+        m.collect("grace_timers_pending", "Carton-removal grace periods running", lambda: engine.stats()["grace_timers"])
+        if _snapshotter is not None:
+            m.collect("snapshots_written_total", "State snapshots written", lambda: _snapshotter.written, kind="counter")
+            m.collect("snapshot_bytes", "Size of the last state snapshot", lambda: _snapshotter.last_bytes)
+        m.serve(METRICS_PORT)
+        print(f"[analysis] 📈 Metrics on http://0.0.0.0:{METRICS_PORT}/metrics")
+
+    if _snapshotter is not None:
+        _snapshotter.start()
+        print(f"[analysis] 💾 Snapshotting state to {SNAPSHOT_PATH} every {SNAPSHOT_INTERVAL_SEC:g}s")
+
+    if RETENTION_INTERVAL_HOURS > 0:
+        threading.Thread(target=retention_loop, name="retention", daemon=True).start()
+        print(f"[analysis] 🧹 Started weight_data retention job (keep {RETENTION_DAYS} days, "
+              f"{RETENTION_PARTITION} partitions, every {RETENTION_INTERVAL_HOURS:g}h)")
+
+    # Analytics are not swept here: reloading an evicted device would block the event loop
+    start_sweeps(analytics=False)
+
+    asyncio.run(engine.run())
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if MODE == "async":
+        run_async()
+    else:
+        main()
\ No newline at end of file
@@ -0,0 +1,63 @@
+# mqtt_topics.py (shared by analysis-service and updates-service; keep both copies identical)
+"""
+MQTT topic layout and client setup.
+
+Devices publish either to the base topic (`milk/weight`, device_id in the
+payload) or to their own topic (`milk/weight/<device_id>`), and binary
+readings to `milk/weight/bin/<device_id>` (see payload_codec.py); consumers
+subscribe to all of them. With a shared-subscription group the filters become
+`$share/<group>/<filter>`, so the broker hands every message to one member
+of the group instead of to every replica.
+"""
+from __future__ import annotations
+import paho.mqtt.client as mqtt
+
+from payload_codec import BINARY_SEGMENT, CONTENT_TYPE
+
+PROTOCOLS = {"3.1": mqtt.MQTTv31, "3.1.1": mqtt.MQTTv311, "5": mqtt.MQTTv5}
+
+
+def subscription_filters(base: str, per_device: bool = True, shared_group: str = "") -> list:
+    filters = [base, f"{base}/+", f"{base}/{BINARY_SEGMENT}/+"] if per_device else [base]
+    if shared_group:
+        filters = [f"$share/{shared_group}/{f}" for f in filters]
+    return filters
+
+
+def device_from_topic(topic: str, base: str):
+    """`<base>/<device_id>` -> device_id; None for the base topic or anything deeper."""
+    if not topic.startswith(base + "/"):
+        return None
+    rest = topic[len(base) + 1:]
+    return rest if rest and "/" not in rest else None
+
+
+def parse_topic(topic: str, base: str, content_type: str | None = None):
+    """
+    (device_id, binary) for `<base>`, `<base>/<device_id>` and
+    `<base>/bin/<device_id>`; binary is also announced by the MQTT 5
+    content type. device_id is None when the topic does not name one.
+    """
+    device_id = device_from_topic(topic, f"{base}/{BINARY_SEGMENT}")
+    if device_id is not None:
+        return device_id, True
+    return device_from_topic(topic, base), content_type == CONTENT_TYPE
+
+
+def content_type(msg):
+    """A received message's MQTT 5 content type, or None."""
+    return getattr(getattr(msg, "properties", None), "ContentType", None)
+
+
+def make_client(protocol: str = "3.1.1", client_id: str = ""):
+    if protocol not in PROTOCOLS:
+        raise ValueError(f"MQTT protocol must be one of {sorted(PROTOCOLS)}, got {protocol!r}")
+    try:
+        return mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION2,
+                           client_id=client_id, protocol=PROTOCOLS[protocol])
+    except (TypeError, AttributeError):
+        return mqtt.Client(client_id=client_id, protocol=PROTOCOLS[protocol])  # older paho versions
+
+
+def subscribe_all(client, filters, qos: int = 0):
+    return client.subscribe([(f, qos) for f in filters])
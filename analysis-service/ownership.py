@@ -0,0 +1,258 @@
+# analysis-service/ownership.py
+"""
+Device ownership across analysis-service replicas.
+
+With a shared MQTT subscription the broker may hand a device's readings to
+any replica, but the incremental per-device state (analytics, carton timers)
+is only correct if one replica processes all of a device's readings in
+order. Each device is therefore owned by exactly one live replica, recorded
+as a lease in MySQL:
+
+    device_owner        device_id -> replica_id, lease_until
+    analysis_replicas   replica_id -> heartbeat_at   (live membership)
+
+A replica that receives a reading for a device it does not own forwards it
+to the owner's inbox topic. Unowned devices go to their rendezvous-hash
+owner among the live replicas, so adding a pod moves ~1/N of the devices to
+it. A replica taking over a device reloads its state from MySQL first.
+Leases are renewed in bulk by heartbeat(); a replica that stops
+heartbeating loses its devices after lease_s. When membership changes, a
+replica hands off the devices that now hash elsewhere: it stops processing
+them, flushes, then deletes their leases.
+
+Ownership is cached in memory, so the hot path only touches MySQL when a
+device changes hands or a foreign lease needs re-checking.
+"""
+from __future__ import annotations
+import time
+import hashlib
+import threading
+
+OWNER_DDL = """
+    CREATE TABLE IF NOT EXISTS device_owner (
+      device_id   VARCHAR(128) NOT NULL,
+      replica_id  VARCHAR(128) NOT NULL,
+      lease_until DATETIME(3)  NOT NULL,
+      PRIMARY KEY (device_id),
+      KEY idx_owner_replica (replica_id)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+"""
+
+REPLICAS_DDL = """
+    CREATE TABLE IF NOT EXISTS analysis_replicas (
+      replica_id   VARCHAR(128) NOT NULL,
+      heartbeat_at DATETIME(3)  NOT NULL,
+      PRIMARY KEY (replica_id)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+"""
+
+SELECT_OWNER_SQL = """
+    SELECT replica_id, TIMESTAMPDIFF(MICROSECOND, NOW(3), lease_until)
+    FROM device_owner WHERE device_id = %s
+"""
+
+# Take the lease if it is free, expired or already ours. MySQL applies the
+# assignments left to right, so lease_until sees the new replica_id.
+CLAIM_SQL = """
+    INSERT INTO device_owner (device_id, replica_id, lease_until)
+    VALUES (%s, %s, NOW(3) + INTERVAL %s SECOND)
+    ON DUPLICATE KEY UPDATE
+        replica_id  = IF(lease_until < NOW(3) OR replica_id = VALUES(replica_id), VALUES(replica_id), replica_id),
+        lease_until = IF(replica_id = VALUES(replica_id), VALUES(lease_until), lease_until)
+"""
+
+# claim() results besides the owning replica's id
+OWNED = "owned"        # this replica already owns the device
+ACQUIRED = "acquired"  # this replica just took the device over; reload its state first
+
+
+def rendezvous_owner(device_id: str, members) -> str:
+    """Highest-random-weight choice: stable, and only ~1/N devices move when a member joins or leaves."""
+    # crc32 is linear, so pod names sharing a prefix get correlated weights
+    # and a skewed split; a real hash spreads devices evenly
+    return max(members, key=lambda m: hashlib.blake2b(f"{m}/{device_id}".encode("utf-8"), digest_size=8).digest())
+
+
+class DeviceOwnership:
+    """
+    connection -> callable returning a context manager that yields a pooled
+                  connection (ConnectionPool.connection; the lookup uses its
+                  prepared cursors)
+    replica_id -> this replica's stable name (the pod name)
+    lease_s    -> how long a lease outlives its last renewal
+    """
+
+    def __init__(self, connection, replica_id: str, lease_s: int = 30):
+        self._connection = connection
+        self.replica_id = replica_id
+        self.lease_s = max(3, int(lease_s))
+        self.heartbeat_s = self.lease_s / 3.0
+        # Trust a cached lease for less than its DB lifetime, so clock and query delays never overlap owners
+        self._local_validity_s = self.lease_s * 0.8
+        self._lock = threading.Lock()
+        self._leases = {}            # device_id -> (owner replica_id, monotonic expiry of the cached answer)
+        self._releasing = set()      # devices being handed off: forwarded, no longer processed here
+        self.members = [replica_id]  # live replicas, refreshed by heartbeat()
+
+        # Counters (read via stats())
+        self.acquired = 0
+        self.released = 0
+        self.lookups = 0
+
+    def init_tables(self, conn):
+        cur = conn.cursor()
+        cur.execute(OWNER_DDL)
+        cur.execute(REPLICAS_DDL)
+        conn.commit()
+        cur.close()
+
+    # ---------- hot path ----------
+    def owns(self, device_id: str) -> bool:
+        """Cached answer only (no DB); False while the device is being handed off."""
+        with self._lock:
+            lease = self._leases.get(device_id)
+            return (lease is not None and lease[0] == self.replica_id and lease[1] > time.monotonic()
+                    and device_id not in self._releasing)
+
+    def desired_owner(self, device_id: str) -> str:
+        with self._lock:
+            members = list(self.members)
+        return rendezvous_owner(device_id, members)
+
+    def claim(self, device_id: str, refresh: bool = False) -> str:
+        """
+        Decide who processes device_id's next reading: OWNED, ACQUIRED, or the
+        replica_id of the replica to forward it to. refresh=True re-reads a
+        lease cached for another replica (e.g. while it hands the device off).
+        """
+        now = time.monotonic()
+        with self._lock:
+            if device_id in self._releasing:
+                return rendezvous_owner(device_id, [m for m in self.members if m != self.replica_id]
+                                        or [self.replica_id])
+            lease = self._leases.get(device_id)
+            if lease is not None and lease[1] > now:
+                if lease[0] == self.replica_id:
+                    return OWNED
+                if not refresh and lease[0] in self.members:
+                    return lease[0]
+
+        self.lookups += 1
+        with self._connection() as conn:
+            select = conn.prepared(SELECT_OWNER_SQL)
+            select.execute(SELECT_OWNER_SQL, (device_id,))
+            row = next(iter(select.fetchall()), None)   # read to the end, or the cursor can't run again
+            previous = None
+            if row is not None and row[1] is not None and row[1] > 0:
+                previous = row[0]
+                if previous != self.replica_id:
+                    return self._cache(device_id, previous, now, row[1] / 1e6)
+            elif self.desired_owner(device_id) != self.replica_id:
+                # Free (or expired): leave it for the replica it hashes to
+                return self.desired_owner(device_id)
+
+            conn.prepared(CLAIM_SQL).execute(CLAIM_SQL, (device_id, self.replica_id, self.lease_s))
+            select.execute(SELECT_OWNER_SQL, (device_id,))
+            owner, remaining_us = select.fetchall()[0]
+            conn.commit()
+
+        if owner != self.replica_id:   # lost a race with another replica
+            return self._cache(device_id, owner, now, (remaining_us or 0) / 1e6)
+        self._cache(device_id, owner, now, self._local_validity_s)
+        if previous == self.replica_id:
+            return OWNED               # our own lease, only the cached copy had run out
+        self.acquired += 1
+        return ACQUIRED
+
+    def _cache(self, device_id: str, owner: str, now: float, valid_s: float) -> str:
+        with self._lock:
+            self._leases[device_id] = (owner, now + min(valid_s, self._local_validity_s))
+        return owner
+
+    # ---------- background ----------
+    def heartbeat(self) -> list:
+        """
+        Renew this replica's membership and all its leases, refresh the member
+        list, and return the owned devices that now hash to another replica.
+        """
+        started = time.monotonic()
+        with self._connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                "INSERT INTO analysis_replicas (replica_id, heartbeat_at) VALUES (%s, NOW(3)) "
+                "ON DUPLICATE KEY UPDATE heartbeat_at = NOW(3)", (self.replica_id,))
+            cur.execute(
+                "UPDATE device_owner SET lease_until = NOW(3) + INTERVAL %s SECOND WHERE replica_id = %s",
+                (self.lease_s, self.replica_id))
+            cur.execute(
+                "SELECT replica_id FROM analysis_replicas WHERE heartbeat_at > NOW(3) - INTERVAL %s SECOND",
+                (self.lease_s,))
+            members = sorted({r[0] for r in cur.fetchall()} | {self.replica_id})
+            cur.execute("SELECT device_id FROM device_owner WHERE replica_id = %s", (self.replica_id,))
+            mine = [r[0] for r in cur.fetchall()]
+            cur.close()
+            conn.commit()
+
+        expiry = started + self._local_validity_s
+        with self._lock:
+            self.members = members
+            for device_id in mine:
+                self._leases[device_id] = (self.replica_id, expiry)
+            # Forget cached leases of replicas that left, so their devices are re-claimed right away
+            gone = [d for d, (owner, _) in self._leases.items() if owner not in members]
+            for device_id in gone:
+                del self._leases[device_id]
+            moved = [d for d in mine
+                     if d not in self._releasing and rendezvous_owner(d, members) != self.replica_id]
+        return moved
+
+    def start_handoff(self, devices):
+        """Stop processing these devices here; their readings are forwarded from now on."""
+        with self._lock:
+            self._releasing.update(devices)
+
+    def release(self, devices):
+        """Drop the leases of handed-off devices (after their buffered readings were flushed)."""
+        devices = list(devices)
+        if not devices:
+            return
+        with self._connection() as conn:
+            cur = conn.cursor()
+            for i in range(0, len(devices), 500):
+                chunk = devices[i:i + 500]
+                cur.execute(
+                    f"DELETE FROM device_owner WHERE replica_id = %s AND device_id IN ({', '.join(['%s'] * len(chunk))})",
+                    (self.replica_id, *chunk))
+            cur.close()
+            conn.commit()
+        with self._lock:
+            for device_id in devices:
+                self._leases.pop(device_id, None)
+                self._releasing.discard(device_id)
+        self.released += len(devices)
+
+    def leave(self):
+        """Graceful shutdown: give up every lease and the membership at once."""
+        with self._connection() as conn:
+            cur = conn.cursor()
+            cur.execute("DELETE FROM device_owner WHERE replica_id = %s", (self.replica_id,))
+            cur.execute("DELETE FROM analysis_replicas WHERE replica_id = %s", (self.replica_id,))
+            cur.close()
+            conn.commit()
+        with self._lock:
+            self._leases.clear()
+            self._releasing.clear()
+
+    # ---------- metrics ----------
+    def owned_count(self) -> int:
+        now = time.monotonic()
+        with self._lock:
+            return sum(1 for owner, expiry in self._leases.values() if owner == self.replica_id and expiry > now)
+
+    def stats(self) -> dict:
+        with self._lock:
+            members = len(self.members)
+            releasing = len(self._releasing)
+        return {"replica_id": self.replica_id, "members": members, "owned": self.owned_count(),
+                "releasing": releasing, "acquired": self.acquired, "released": self.released,
+                "lookups": self.lookups}
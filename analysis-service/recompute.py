@@ -0,0 +1,235 @@
+# analysis-service/recompute.py
+"""
+Fleet-wide user_stats recompute (batch mode).
+
+Daily consumption, the full baseline and each device's latest weight come
+from weight_daily_rollup in one grouped query. weight_data is only streamed
+for the cup-size window, in (device_id, timestamp) order, to measure cup
+size with NumPy array operations. Cups left, percent full and the expected
+empty date follow, and user_stats is written back with multi-row upserts. Use it after changing CUP_MIN_DROP_G,
+CUP_MAX_DROP_G, ANALYSIS_WINDOW_DAYS (or any other tunable) so silent
+devices do not keep stale stats.
+
+    python recompute.py [--dry-run] [--chunk-rows 200000] [--write-batch 1000]
+"""
+from __future__ import annotations
+import sys
+import time
+import argparse
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from main import (
+    MYSQL_CONFIG, WINDOW_DAYS, CUP_MIN_DROP_G, CUP_MAX_DROP_G, CUP_DEFAULT_G,
+    DAILY_DEFAULT_G, FULL_BASELINE_LOOKBACK_DAYS,
+)
+
+ASSUMED_FULL_G = 1000.0
+
+# Like main.UPSERT_USER_STATS_SQL, but an existing row keeps its forecast: expected_empty_at
+# is never overwritten, and expected_empty_date only for devices without an hourly forecast
+# (where the live path derives the date from expected_empty_at).
+RECOMPUTE_UPSERT_SQL = """
+    INSERT INTO user_stats (
+        container_id, current_amount_g, avg_daily_consumption_g,
+        cups_left, percent_full, expected_empty_date, expected_empty_at
+    ) VALUES (%s, %s, %s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+        current_amount_g=VALUES(current_amount_g),
+        avg_daily_consumption_g=VALUES(avg_daily_consumption_g),
+        cups_left=VALUES(cups_left),
+        percent_full=VALUES(percent_full),
+        expected_empty_date=IF(expected_empty_at IS NULL, VALUES(expected_empty_date), expected_empty_date)
+"""
+
+
+def load_device_rollup(conn, now: datetime):
+    """
+    {device_id: (baseline_g, last_weight, daily_g)} from weight_daily_rollup.
+    daily_g averages max - min over the window's days with more than one
+    reading (like AnalyticsState.snapshot); last_weight covers devices that
+    sent nothing inside the window.
+    """
+    first_day = (now - timedelta(days=WINDOW_DAYS)).date()
+    if FULL_BASELINE_LOOKBACK_DAYS > 0:
+        max_w = "MAX(IF(`day` >= %s, max_weight, NULL))"
+        params = [(now - timedelta(days=FULL_BASELINE_LOOKBACK_DAYS)).date()]
+    else:
+        max_w, params = "MAX(max_weight)", []
+    cur = conn.cursor()
+    cur.execute(f"""
+        SELECT r.device_id, b.max_w, r.last_weight, b.daily_sum, b.daily_days
+        FROM (
+            SELECT device_id, {max_w} AS max_w, MAX(`day`) AS last_day,
+                   SUM(IF(`day` >= %s AND reading_count > 1, GREATEST(max_weight - min_weight, 0), 0)) AS daily_sum,
+                   SUM(`day` >= %s AND reading_count > 1 AND max_weight > min_weight) AS daily_days
+            FROM weight_daily_rollup
+            GROUP BY device_id
+        ) b
+        JOIN weight_daily_rollup r ON r.device_id = b.device_id AND r.`day` = b.last_day
+    """, params + [first_day, first_day])
+    out = {}
+    for device_id, m, lw, daily_sum, daily_days in cur.fetchall():
+        daily = float(daily_sum) / int(daily_days) if daily_days else DAILY_DEFAULT_G
+        out[device_id] = (float(m) if m is not None else None, float(lw), daily)
+    cur.close()
+    return out
+
+
+def stream_segments(cur, chunk_rows: int):
+    """
+    Yield (device_ids, weights, timestamps) segments that only ever contain
+    complete devices: the trailing device of a chunk is carried into the next.
+    """
+    carry = []
+    while True:
+        rows = cur.fetchmany(chunk_rows)
+        if not rows:
+            break
+        rows = carry + rows
+        last_dev = rows[-1][0]
+        cut = len(rows)
+        while cut > 0 and rows[cut - 1][0] == last_dev:
+            cut -= 1
+        if cut == 0:
+            carry = rows          # one device bigger than a chunk; keep reading
+            continue
+        carry = rows[cut:]
+        yield _to_arrays(rows[:cut])
+    if carry:
+        yield _to_arrays(carry)
+
+
+def _to_arrays(rows):
+    devices, weights, stamps = zip(*rows)
+    return (
+        np.asarray(devices, dtype=object),
+        np.asarray(weights, dtype=np.float64),
+        np.asarray(stamps, dtype="datetime64[s]"),
+    )
+
+
+def compute_segment(devices, w, ts, now: datetime):
+    """
+    Vectorised analytics for a segment sorted by (device, timestamp).
+    Returns (device_ids, current_g, cup_g).
+    """
+    n = len(w)
+    dev_start = np.empty(n, dtype=bool)
+    dev_start[0] = True
+    dev_start[1:] = devices[1:] != devices[:-1]
+    dev_idx = np.cumsum(dev_start) - 1
+    n_dev = int(dev_idx[-1]) + 1
+    starts = np.flatnonzero(dev_start)
+    ends = np.append(starts[1:], n) - 1
+    device_ids = devices[starts]
+    current = w[ends]
+
+    window_start = np.datetime64(now - timedelta(days=WINDOW_DAYS), "s")
+
+    # Cup size: drops between consecutive readings of the same device, inside the window
+    drops = w[:-1] - w[1:]
+    ok = (~dev_start[1:]) & (drops >= CUP_MIN_DROP_G) & (drops <= CUP_MAX_DROP_G) & (ts[:-1] >= window_start)
+    drop_sum = np.bincount(dev_idx[1:][ok], weights=drops[ok], minlength=n_dev)
+    drop_cnt = np.bincount(dev_idx[1:][ok], minlength=n_dev)
+    cup = np.full(n_dev, CUP_DEFAULT_G)
+    np.divide(drop_sum, drop_cnt, out=cup, where=drop_cnt > 0)
+    return device_ids, current, cup
+
+
+def derive_rows(device_ids, current, cup, daily, baseline, today):
+    """
+    Vectorised equivalent of device_analytics.derive_stats; returns user_stats
+    upsert rows. expected_empty_at is None (the hourly forecast needs the live
+    per-device model); RECOMPUTE_UPSERT_SQL leaves a stored forecast in place.
+    """
+    full = np.where(baseline > 0, baseline, ASSUMED_FULL_G)
+    percent = np.minimum(100.0, current / full * 100)
+    cups_left = np.zeros_like(current)
+    np.floor_divide(current, cup, out=cups_left, where=cup > 0)
+    days_left = np.zeros_like(current)
+    has_date = (daily > 0) & (current > 0)
+    np.divide(current, daily, out=days_left, where=has_date)
+    has_date &= days_left > 0
+    offsets = days_left.astype(np.int64)
+
+    rows = []
+    for i, device_id in enumerate(device_ids):
+        empty = today + timedelta(days=int(offsets[i])) if has_date[i] else None
+        rows.append((device_id, float(current[i]), float(daily[i]), int(cups_left[i]),
+                     float(percent[i]), empty, None))
+    return rows
+
+
+def recompute(conn, now: datetime | None = None, chunk_rows: int = 200_000,
+              write_batch: int = 1000, dry_run: bool = False, log=print):
+    now = now or datetime.now()
+    today = now.date()
+    started = time.monotonic()
+
+    rollup = load_device_rollup(conn, now)
+    no_rollup = (None, 0.0, DAILY_DEFAULT_G)
+
+    read_cur = conn.cursor()   # unbuffered: rows are streamed with fetchmany
+    read_cur.execute("""
+        SELECT device_id, weight, timestamp
+        FROM weight_data
+        WHERE timestamp >= %s
+        ORDER BY device_id, timestamp
+    """, (now - timedelta(days=WINDOW_DAYS),))
+
+    pending, seen = [], set()
+    total_rows = total_devices = 0
+    for devices, w, ts in stream_segments(read_cur, chunk_rows):
+        total_rows += len(w)
+        device_ids, current, cup = compute_segment(devices, w, ts, now)
+        stored = [rollup.get(d, no_rollup) for d in device_ids]
+        baseline = np.array([b or 0.0 for b, _, _ in stored])
+        daily = np.array([daily for _, _, daily in stored])
+        pending.extend(derive_rows(device_ids, current, cup, daily, baseline, today))
+        seen.update(device_ids.tolist())
+        total_devices += len(device_ids)
+    read_cur.close()
+
+    # Devices with no readings inside the window: default cup, current from the rollup
+    silent = [d for d in rollup if d not in seen]
+    if silent:
+        current = np.array([rollup[d][1] for d in silent])
+        baseline = np.array([rollup[d][0] or 0.0 for d in silent])
+        daily = np.array([rollup[d][2] for d in silent])
+        pending.extend(derive_rows(np.asarray(silent, dtype=object), current,
+                                   np.full(len(silent), CUP_DEFAULT_G), daily, baseline, today))
+        total_devices += len(silent)
+
+    compute_s = time.monotonic() - started
+    if not dry_run:
+        cur = conn.cursor()
+        for i in range(0, len(pending), write_batch):
+            cur.executemany(RECOMPUTE_UPSERT_SQL, pending[i:i + write_batch])
+            conn.commit()
+        cur.close()
+    elapsed = time.monotonic() - started
+    log(f"[analysis] 🧮 Recompute: {total_devices} devices, {total_rows} readings, "
+        f"compute {compute_s:.2f}s, total {elapsed:.2f}s"
+        f"{' (dry run, nothing written)' if dry_run else ''}")
+    return pending
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recompute user_stats for every device from weight_data")
+    parser.add_argument("--dry-run", action="store_true", help="compute only, do not write user_stats")
+    parser.add_argument("--chunk-rows", type=int, default=200_000, help="rows fetched per round trip")
+    parser.add_argument("--write-batch", type=int, default=1000, help="user_stats rows per upsert")
+    args = parser.parse_args(argv)
+
+    import mysql.connector
+    conn = mysql.connector.connect(**MYSQL_CONFIG)
+    try:
+        recompute(conn, chunk_rows=args.chunk_rows, write_batch=args.write_batch, dry_run=args.dry_run)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,259 @@
+# analysis-service/replay.py
+"""
+Rebuild user_stats by replaying history.
+
+Every device's weight_data is replayed in timestamp order through the same
+carton-removal state machine (carton.py) and incremental analytics
+(device_analytics.py) the live path uses, with the reading timestamps as the
+clock. Devices are split into chunks across a process pool; each worker
+process keeps its own MySQL connection.
+
+    python replay.py [--dry-run] [--workers N] [--chunk 50] [--device ID]
+                     [--since YYYY-MM-DD] [--checkpoint FILE] [--fresh]
+
+--dry-run diffs the replayed rows against user_stats instead of writing.
+With --checkpoint, devices whose stats were written are appended to FILE and
+skipped when the command is run again (--fresh starts over).
+"""
+from __future__ import annotations
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+from datetime import datetime, timedelta
+
+from carton import CartonRemovalTracker, SAVE, RETURNED
+from device_analytics import AnalyticsState, DEVICE_ROLLUP_DAYS_SQL, DEVICE_ROLLUP_MAX_SQL, user_stats_row
+from main import (
+    MYSQL_CONFIG, WINDOW_DAYS, CUP_MIN_DROP_G, CUP_MAX_DROP_G, CUP_DEFAULT_G,
+    DAILY_DEFAULT_G, FULL_BASELINE_LOOKBACK_DAYS, CARTON_REMOVAL_GRACE_PERIOD_MIN,
+    UPSERT_USER_STATS_SQL,
+)
+
+STATS_COLUMNS = ("current_amount_g", "avg_daily_consumption_g", "cups_left", "percent_full", "expected_empty_date",
+                 "expected_empty_at")
+FLOAT_TOLERANCE = 0.01
+
+# Per-process state, created by _init_worker
+_conn = None
+_state = None
+
+
+def _new_state() -> AnalyticsState:
+    return AnalyticsState(
+        window_days=WINDOW_DAYS,
+        cup_min_g=CUP_MIN_DROP_G,
+        cup_max_g=CUP_MAX_DROP_G,
+        cup_default_g=CUP_DEFAULT_G,
+        daily_default_g=DAILY_DEFAULT_G,
+        baseline_days=FULL_BASELINE_LOOKBACK_DAYS,
+    )
+
+
+def _init_worker():
+    global _conn, _state
+    import mysql.connector
+    _conn = mysql.connector.connect(**MYSQL_CONFIG)
+    _state = _new_state()
+
+
+# ---------- replay of one device ----------
+def _expire_due(state: AnalyticsState, tracker: CartonRemovalTracker, device_id: str, now: datetime):
+    """Fire the grace-period deadline if the replay clock has passed it (live: on_grace_deadline)."""
+    deadline = tracker.deadline(device_id)
+    if deadline is not None and deadline <= now:
+        tracker.expire(device_id, tracker.zero_since(device_id))
+        state.add_reading(device_id, 0.0, deadline)
+
+
+def replay_device(conn, state: AnalyticsState, device_id: str, now: datetime, since: datetime):
+    """
+    Replay one device and return (user_stats row, readings replayed).
+    The live path stores a 0g reading only when its grace period expires, so
+    each stored 0g is replayed as a removal that started one grace period
+    earlier; positive readings go through the tracker at their own timestamp.
+    Daily consumption and the baseline come from weight_daily_rollup, like
+    the live warm-up, so they cover the readings before `since` too.
+    """
+    tracker = CartonRemovalTracker(CARTON_REMOVAL_GRACE_PERIOD_MIN * 60, stripes=1)
+    cur = conn.cursor()
+    cur.execute(DEVICE_ROLLUP_DAYS_SQL, (device_id, (now - timedelta(days=state.keep_days)).date()))
+    days = cur.fetchall()
+    cur.execute(DEVICE_ROLLUP_MAX_SQL, (device_id,))
+    (max_w,) = cur.fetchone()
+    cur.execute("""
+        SELECT weight, timestamp
+        FROM weight_data
+        WHERE device_id = %s AND timestamp >= %s
+        ORDER BY timestamp
+    """, (device_id, since))
+    rows = 0
+    for weight, ts in cur:
+        rows += 1
+        weight = float(weight)
+        observed_at = ts - tracker.grace if weight <= 0 else ts
+        _expire_due(state, tracker, device_id, observed_at)
+        if tracker.observe(device_id, weight, observed_at) in (SAVE, RETURNED):
+            state.add_reading(device_id, weight, ts)
+        _expire_due(state, tracker, device_id, ts)
+    cur.close()
+    _expire_due(state, tracker, device_id, now)
+
+    state.apply_rollup(device_id, days, max_w)
+    row = user_stats_row(state, device_id, now)
+    state.forget(device_id)
+    return row, rows
+
+
+# ---------- dry-run diff ----------
+def _differs(old, new) -> bool:
+    if old is None or new is None:
+        return old is not new
+    if isinstance(new, float) or isinstance(old, float):
+        return abs(float(old) - float(new)) > FLOAT_TOLERANCE
+    return old != new
+
+
+def diff_user_stats(conn, rows):
+    """[(device_id, column, stored, replayed)] for every column that would change."""
+    if not rows:
+        return []
+    cur = conn.cursor()
+    placeholders = ", ".join(["%s"] * len(rows))
+    cur.execute(f"SELECT container_id, {', '.join(STATS_COLUMNS)} FROM user_stats "
+                f"WHERE container_id IN ({placeholders})", [r[0] for r in rows])
+    stored = {r[0]: r[1:] for r in cur.fetchall()}
+    cur.close()
+    diffs = []
+    for row in rows:
+        old = stored.get(row[0])
+        if old is None:
+            diffs.append((row[0], "*", None, "new row"))
+            continue
+        for col, before, after in zip(STATS_COLUMNS, old, row[1:]):
+            if _differs(before, after):
+                diffs.append((row[0], col, before, after))
+    return diffs
+
+
+# ---------- worker entry point ----------
+def _replay_chunk(args):
+    devices, now, since, dry_run = args
+    results, rows, failed = [], 0, []
+    for device_id in devices:
+        try:
+            row, n = replay_device(_conn, _state, device_id, now, since)
+        except Exception as e:
+            failed.append((device_id, str(e)))
+            _state.forget(device_id)
+            continue
+        results.append(row)
+        rows += n
+    if dry_run:
+        diffs = diff_user_stats(_conn, results)
+    else:
+        diffs = []
+        if results:
+            cur = _conn.cursor()
+            cur.executemany(UPSERT_USER_STATS_SQL, results)
+            _conn.commit()
+            cur.close()
+    return [r[0] for r in results], rows, diffs, failed
+
+
+# ---------- checkpoints ----------
+def load_checkpoint(path: str) -> set:
+    if not path or not os.path.exists(path):
+        return set()
+    with open(path, encoding="utf-8") as f:
+        return {line.strip() for line in f if line.strip()}
+
+
+def list_devices(conn):
+    cur = conn.cursor()
+    cur.execute("SELECT device_id FROM weight_daily_rollup GROUP BY device_id ORDER BY device_id")
+    devices = [d for (d,) in cur.fetchall()]
+    cur.close()
+    return devices
+
+
+def replay(devices, workers: int, chunk: int, since: datetime, dry_run: bool = False,
+           checkpoint: str | None = None, max_diffs: int = 50, log=print):
+    now = datetime.now()
+    chunks = [devices[i:i + chunk] for i in range(0, len(devices), chunk)]
+    ckpt = open(checkpoint, "a", encoding="utf-8") if checkpoint and not dry_run else None
+    done = rows = changed = shown = 0
+    failures = []
+    started = last_log = time.monotonic()
+    try:
+        with multiprocessing.Pool(processes=workers, initializer=_init_worker) as pool:
+            work = ((c, now, since, dry_run) for c in chunks)
+            for finished, n, diffs, failed in pool.imap_unordered(_replay_chunk, work):
+                done += len(finished)
+                rows += n
+                failures.extend(failed)
+                changed += len({d[0] for d in diffs})
+                for device_id, col, before, after in diffs:
+                    if shown < max_diffs:
+                        log(f"[analysis] Δ {device_id} {col}: {before} -> {after}")
+                        shown += 1
+                if ckpt:
+                    ckpt.write("".join(f"{d}\n" for d in finished))
+                    ckpt.flush()
+                t = time.monotonic()
+                if t - last_log >= 5:
+                    last_log = t
+                    el = t - started
+                    log(f"[analysis] 🔁 Replay: {done}/{len(devices)} devices, {rows} readings "
+                        f"({done / el:.1f} devices/s, {rows / el:.0f} rows/s)")
+    finally:
+        if ckpt:
+            ckpt.close()
+
+    elapsed = max(time.monotonic() - started, 1e-9)
+    for device_id, err in failures:
+        log(f"[analysis] ❌ Replay failed for device {device_id}: {err}")
+    log(f"[analysis] ✅ Replay done: {done} devices, {rows} readings in {elapsed:.1f}s "
+        f"({done / elapsed:.1f} devices/s, {rows / elapsed:.0f} rows/s)"
+        + (f"; {changed} device(s) would change (dry run, nothing written)" if dry_run else ""))
+    return done, rows, failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rebuild user_stats by replaying weight_data history")
+    parser.add_argument("--dry-run", action="store_true", help="diff against user_stats, do not write")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2, help="worker processes")
+    parser.add_argument("--chunk", type=int, default=50, help="devices per task")
+    parser.add_argument("--device", action="append", help="only this device_id (repeatable)")
+    parser.add_argument("--since", help="replay readings from this date (YYYY-MM-DD); default: all")
+    parser.add_argument("--checkpoint", help="file recording finished devices, for resuming")
+    parser.add_argument("--fresh", action="store_true", help="ignore and truncate the checkpoint file")
+    parser.add_argument("--max-diffs", type=int, default=50, help="differences printed in dry-run mode")
+    args = parser.parse_args(argv)
+
+    since = datetime.strptime(args.since, "%Y-%m-%d") if args.since else datetime(1970, 1, 1)
+    if args.device:
+        devices = sorted(set(args.device))
+    else:
+        import mysql.connector
+        conn = mysql.connector.connect(**MYSQL_CONFIG)
+        try:
+            devices = list_devices(conn)
+        finally:
+            conn.close()
+
+    if args.checkpoint and args.fresh:
+        open(args.checkpoint, "w").close()
+    skip = load_checkpoint(args.checkpoint)
+    if skip:
+        print(f"[analysis] Resuming from {args.checkpoint}: {len(skip)} device(s) already done")
+        devices = [d for d in devices if d not in skip]
+
+    _, _, failures = replay(devices, max(1, args.workers), max(1, args.chunk), since,
+                            dry_run=args.dry_run, checkpoint=args.checkpoint, max_diffs=args.max_diffs)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,249 @@
+# analysis-service/retention.py
+"""
+Time partitioning and retention for weight_data.
+
+weight_data is RANGE COLUMNS-partitioned on `timestamp` (monthly by default,
+daily with RETENTION_PARTITION=day). The retention run:
+  1. keeps RETENTION_PARTITIONS_AHEAD future partitions split off `pmax`,
+  2. downsamples every partition that ends before the retention cutoff into
+     weight_hourly_history (first/last/min/max/avg/count per device-hour),
+  3. drops those partitions - an O(1) metadata operation instead of a DELETE.
+
+The daily view of old data stays available in weight_daily_rollup. An empty,
+unpartitioned weight_data is converted automatically on the first run; an
+existing table is rebuilt only on request (it copies every row).
+
+    python retention.py partition   # one-time conversion of an existing table
+    python retention.py run [--dry-run]
+"""
+from __future__ import annotations
+import sys
+import time
+import argparse
+from datetime import datetime, timedelta
+
+HOURLY_HISTORY_DDL = """
+    CREATE TABLE IF NOT EXISTS weight_hourly_history (
+      device_id     VARCHAR(128) NOT NULL,
+      `hour`        DATETIME     NOT NULL,
+      first_weight  FLOAT        NOT NULL,
+      last_weight   FLOAT        NOT NULL,
+      min_weight    FLOAT        NOT NULL,
+      max_weight    FLOAT        NOT NULL,
+      avg_weight    FLOAT        NOT NULL,
+      reading_count INT UNSIGNED NOT NULL,
+      PRIMARY KEY (device_id, `hour`)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+"""
+
+DOWNSAMPLE_PARTITION_SQL = """
+    INSERT INTO weight_hourly_history (
+        device_id, `hour`, first_weight, last_weight,
+        min_weight, max_weight, avg_weight, reading_count
+    )
+    SELECT device_id, h, MAX(first_w), MAX(last_w), MIN(weight), MAX(weight), AVG(weight), COUNT(*)
+    FROM (
+        SELECT device_id, weight,
+               DATE_FORMAT(timestamp, '%Y-%m-%d %H:00:00') AS h,
+               FIRST_VALUE(weight) OVER w_asc  AS first_w,
+               FIRST_VALUE(weight) OVER w_desc AS last_w
+        FROM weight_data PARTITION ({partition})
+        WINDOW w_asc  AS (PARTITION BY device_id, DATE_FORMAT(timestamp, '%Y-%m-%d %H') ORDER BY timestamp ASC),
+               w_desc AS (PARTITION BY device_id, DATE_FORMAT(timestamp, '%Y-%m-%d %H') ORDER BY timestamp DESC)
+    ) t
+    GROUP BY device_id, h
+    ON DUPLICATE KEY UPDATE
+        first_weight  = VALUES(first_weight),
+        last_weight   = VALUES(last_weight),
+        min_weight    = VALUES(min_weight),
+        max_weight    = VALUES(max_weight),
+        avg_weight    = VALUES(avg_weight),
+        reading_count = VALUES(reading_count)
+"""
+
+LOCK_NAME = "smartmilk_weight_retention"
+
+
+# ---------- partition naming ----------
+def _period_start(ts: datetime, granularity: str) -> datetime:
+    if granularity == "day":
+        return datetime(ts.year, ts.month, ts.day)
+    return datetime(ts.year, ts.month, 1)
+
+
+def _next_period(start: datetime, granularity: str) -> datetime:
+    if granularity == "day":
+        return start + timedelta(days=1)
+    return datetime(start.year + (start.month == 12), start.month % 12 + 1, 1)
+
+
+def _partition_name(start: datetime, granularity: str) -> str:
+    return start.strftime("p%Y%m%d" if granularity == "day" else "p%Y%m")
+
+
+def _partition_clause(start: datetime) -> str:
+    """VALUES LESS THAN bound for the partition covering the period *before* `start`."""
+    return f"VALUES LESS THAN ('{start:%Y-%m-%d %H:%M:%S}')"
+
+
+def list_partitions(conn):
+    """[(name, upper_bound datetime | None for MAXVALUE)] ordered by position; [] if not partitioned."""
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT PARTITION_NAME, PARTITION_DESCRIPTION
+        FROM INFORMATION_SCHEMA.PARTITIONS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'weight_data'
+          AND PARTITION_NAME IS NOT NULL
+        ORDER BY PARTITION_ORDINAL_POSITION
+    """)
+    out = []
+    for name, desc in cur.fetchall():
+        bound = None
+        if desc and desc.upper() != "MAXVALUE":
+            bound = datetime.strptime(desc.strip("'"), "%Y-%m-%d %H:%M:%S")
+        out.append((name, bound))
+    cur.close()
+    return out
+
+
+# ---------- one-time conversion ----------
+def partition_table(conn, granularity: str = "month", ahead: int = 2, log=print):
+    """
+    Convert an unpartitioned weight_data into RANGE COLUMNS(timestamp) partitions.
+    MySQL requires every unique key to contain the partitioning column, so the
+    primary key becomes (id, timestamp); uniq_device_time already qualifies.
+    """
+    if list_partitions(conn):
+        log("[analysis] weight_data is already partitioned")
+        return
+    cur = conn.cursor()
+    cur.execute("SELECT MIN(timestamp) FROM weight_data")
+    (oldest,) = cur.fetchone()
+    start = _period_start(oldest or datetime.now(), granularity)
+    end = _period_start(datetime.now(), granularity)
+    for _ in range(ahead + 1):
+        end = _next_period(end, granularity)
+
+    parts = []
+    p = start
+    while p < end:
+        nxt = _next_period(p, granularity)
+        parts.append(f"PARTITION {_partition_name(p, granularity)} {_partition_clause(nxt)}")
+        p = nxt
+    parts.append("PARTITION pmax VALUES LESS THAN (MAXVALUE)")
+
+    started = time.monotonic()
+    log(f"[analysis] 🗂️  Rebuilding weight_data with {len(parts)} partitions (this copies the table)")
+    cur.execute("ALTER TABLE weight_data DROP PRIMARY KEY, ADD PRIMARY KEY (id, `timestamp`)")
+    cur.execute("ALTER TABLE weight_data PARTITION BY RANGE COLUMNS(`timestamp`) (\n  "
+                + ",\n  ".join(parts) + "\n)")
+    cur.close()
+    log(f"[analysis] ✅ weight_data partitioned in {time.monotonic() - started:.1f}s")
+
+
+# ---------- recurring maintenance ----------
+def ensure_future_partitions(conn, granularity: str, ahead: int, log=print) -> int:
+    """Split new periods off pmax so inserts never land in the catch-all partition."""
+    parts = list_partitions(conn)
+    bounded = [b for _, b in parts if b is not None]
+    if not parts or not bounded or parts[-1][0] != "pmax":
+        return 0
+    target = _period_start(datetime.now(), granularity)
+    for _ in range(ahead + 1):
+        target = _next_period(target, granularity)
+
+    new_parts = []
+    p = max(bounded)        # the first period not yet covered
+    while p < target:
+        nxt = _next_period(p, granularity)
+        new_parts.append(f"PARTITION {_partition_name(p, granularity)} {_partition_clause(nxt)}")
+        p = nxt
+    if not new_parts:
+        return 0
+    cur = conn.cursor()
+    cur.execute("ALTER TABLE weight_data REORGANIZE PARTITION pmax INTO (\n  "
+                + ",\n  ".join(new_parts + ["PARTITION pmax VALUES LESS THAN (MAXVALUE)"]) + "\n)")
+    cur.close()
+    log(f"[analysis] 🗂️  Added {len(new_parts)} weight_data partition(s)")
+    return len(new_parts)
+
+
+def expire_partitions(conn, cutoff: datetime, dry_run: bool = False, log=print) -> int:
+    """Downsample, then drop, every partition whose whole range is older than cutoff."""
+    expired = [name for name, bound in list_partitions(conn) if bound is not None and bound <= cutoff]
+    cur = conn.cursor()
+    for name in expired:
+        if dry_run:
+            log(f"[analysis] (dry run) would downsample and drop partition {name}")
+            continue
+        started = time.monotonic()
+        cur.execute(DOWNSAMPLE_PARTITION_SQL.format(partition=name))
+        hours = cur.rowcount
+        conn.commit()
+        cur.execute(f"ALTER TABLE weight_data DROP PARTITION {name}")
+        log(f"[analysis] 🧹 Partition {name}: {hours} hourly rows kept, partition dropped "
+            f"({time.monotonic() - started:.1f}s)")
+    cur.close()
+    return len(expired)
+
+
+def run_retention(conn, retention_days: int, granularity: str = "month", ahead: int = 2,
+                  dry_run: bool = False, log=print):
+    """
+    One maintenance pass. Serialised across replicas with a MySQL named lock;
+    returns False if another process holds it.
+    """
+    cur = conn.cursor()
+    cur.execute("SELECT GET_LOCK(%s, 0)", (LOCK_NAME,))
+    (got,) = cur.fetchone()
+    if not got:
+        cur.close()
+        return False
+    try:
+        cur.execute(HOURLY_HISTORY_DDL)
+        if not list_partitions(conn):
+            cur.execute("SELECT 1 FROM weight_data LIMIT 1")
+            if cur.fetchone() is not None:
+                log("[analysis] ⚠️  weight_data is not partitioned - run 'python retention.py partition' "
+                    "once; skipping retention")
+                return True
+            if dry_run:
+                return True
+            partition_table(conn, granularity, ahead, log)   # fresh install: converting is instant
+        if not dry_run:
+            ensure_future_partitions(conn, granularity, ahead, log)
+        cutoff = datetime.now() - timedelta(days=retention_days)
+        expire_partitions(conn, cutoff, dry_run, log)
+        return True
+    finally:
+        cur.execute("SELECT RELEASE_LOCK(%s)", (LOCK_NAME,))
+        cur.fetchone()
+        cur.close()
+
+
+def main(argv=None):
+    from main import (MYSQL_CONFIG, RETENTION_DAYS, RETENTION_PARTITION,
+                      RETENTION_PARTITIONS_AHEAD)
+
+    parser = argparse.ArgumentParser(description="weight_data partitioning and retention")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("partition", help="convert weight_data to a time-partitioned table (one-time)")
+    run = sub.add_parser("run", help="add future partitions, downsample and drop expired ones")
+    run.add_argument("--dry-run", action="store_true", help="only report what would be dropped")
+    args = parser.parse_args(argv)
+
+    import mysql.connector
+    conn = mysql.connector.connect(**MYSQL_CONFIG)
+    try:
+        if args.command == "partition":
+            partition_table(conn, RETENTION_PARTITION, RETENTION_PARTITIONS_AHEAD)
+        else:
+            if not run_retention(conn, RETENTION_DAYS, RETENTION_PARTITION,
+                                 RETENTION_PARTITIONS_AHEAD, dry_run=args.dry_run):
+                print("[analysis] Another process is running retention; nothing done")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
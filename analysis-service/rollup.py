@@ -0,0 +1,191 @@
+# analysis-service/rollup.py
+"""
+weight_daily_rollup: one row per (device, day) maintained as readings arrive.
+
+Columns: first/last reading of the day (timestamp + weight), min/max weight,
+reading count and the sum of positive drops between consecutive readings.
+Daily-consumption analytics read this table instead of grouping raw
+weight_data rows: the live warm-up and reload (device_analytics.py) and
+replay.py take min/max/reading_count per day and MAX(max_weight) as the
+baseline; recompute.py also takes each device's latest last_weight.
+
+Backfill existing history:
+    python rollup.py backfill [--device DEVICE_ID] [--since YYYY-MM-DD]
+"""
+from __future__ import annotations
+import sys
+import time
+import argparse
+from datetime import datetime
+
+ROLLUP_DDL = """
+    CREATE TABLE IF NOT EXISTS weight_daily_rollup (
+      device_id     VARCHAR(128) NOT NULL,
+      `day`         DATE         NOT NULL,
+      first_ts      DATETIME     NOT NULL,
+      first_weight  FLOAT        NOT NULL,
+      last_ts       DATETIME     NOT NULL,
+      last_weight   FLOAT        NOT NULL,
+      min_weight    FLOAT        NOT NULL,
+      max_weight    FLOAT        NOT NULL,
+      reading_count INT UNSIGNED NOT NULL,
+      drop_sum_g    FLOAT        NOT NULL DEFAULT 0,   -- sum of positive drops between consecutive readings
+      PRIMARY KEY (device_id, `day`)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+"""
+
+# MySQL applies ON DUPLICATE KEY assignments left to right, so the *_weight
+# columns are decided before their *_ts columns move.
+UPSERT_ROLLUP_SQL = """
+    INSERT INTO weight_daily_rollup (
+        device_id, `day`, first_ts, first_weight, last_ts, last_weight,
+        min_weight, max_weight, reading_count, drop_sum_g
+    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+        first_weight  = IF(VALUES(first_ts) < first_ts, VALUES(first_weight), first_weight),
+        first_ts      = LEAST(first_ts, VALUES(first_ts)),
+        last_weight   = IF(VALUES(last_ts) >= last_ts, VALUES(last_weight), last_weight),
+        last_ts       = GREATEST(last_ts, VALUES(last_ts)),
+        min_weight    = LEAST(min_weight, VALUES(min_weight)),
+        max_weight    = GREATEST(max_weight, VALUES(max_weight)),
+        reading_count = reading_count + VALUES(reading_count),
+        drop_sum_g    = drop_sum_g + VALUES(drop_sum_g)
+"""
+
+# Rebuild rows from raw history. LAG() spans day boundaries on purpose: the
+# first reading of a day is compared with the last one of the previous day,
+# exactly like the live path does.
+BACKFILL_SQL = """
+    INSERT INTO weight_daily_rollup (
+        device_id, `day`, first_ts, first_weight, last_ts, last_weight,
+        min_weight, max_weight, reading_count, drop_sum_g
+    )
+    SELECT device_id, d,
+           MIN(timestamp), MAX(first_w), MAX(timestamp), MAX(last_w),
+           MIN(weight), MAX(weight), COUNT(*),
+           COALESCE(SUM(GREATEST(prev_w - weight, 0)), 0)
+    FROM (
+        SELECT device_id, DATE(timestamp) AS d, timestamp, weight,
+               LAG(weight) OVER (PARTITION BY device_id ORDER BY timestamp) AS prev_w,
+               FIRST_VALUE(weight) OVER (PARTITION BY device_id, DATE(timestamp) ORDER BY timestamp ASC) AS first_w,
+               FIRST_VALUE(weight) OVER (PARTITION BY device_id, DATE(timestamp) ORDER BY timestamp DESC) AS last_w
+        FROM weight_data
+        WHERE device_id = %s AND timestamp >= %s
+    ) t
+    GROUP BY device_id, d
+    ON DUPLICATE KEY UPDATE
+        first_ts      = VALUES(first_ts),
+        first_weight  = VALUES(first_weight),
+        last_ts       = VALUES(last_ts),
+        last_weight   = VALUES(last_weight),
+        min_weight    = VALUES(min_weight),
+        max_weight    = VALUES(max_weight),
+        reading_count = VALUES(reading_count),
+        drop_sum_g    = VALUES(drop_sum_g)
+"""
+
+
+def aggregate_batch(rows):
+    """
+    Fold buffered readings (device_id, weight, timestamp, drop_g, ...) into
+    one upsert row per (device, day), in arrival order.
+    """
+    groups = {}
+    for r in rows:
+        key = (r.device_id, r.timestamp.date())
+        g = groups.get(key)
+        if g is None:
+            groups[key] = [r.device_id, key[1], r.timestamp, r.weight, r.timestamp, r.weight,
+                           r.weight, r.weight, 1, r.drop_g]
+            continue
+        if r.timestamp < g[2]:
+            g[2], g[3] = r.timestamp, r.weight
+        if r.timestamp >= g[4]:
+            g[4], g[5] = r.timestamp, r.weight
+        g[6] = min(g[6], r.weight)
+        g[7] = max(g[7], r.weight)
+        g[8] += 1
+        g[9] += r.drop_g
+    return [tuple(g) for g in groups.values()]
+
+
+def update_daily_rollup(conn, rows, commit: bool = True):
+    """
+    Apply a flushed batch of readings to weight_daily_rollup (one multi-row upsert).
+    commit=False leaves the upsert in the caller's transaction.
+    """
+    upserts = aggregate_batch(rows)
+    if not upserts:
+        return 0
+    cur = conn.cursor()
+    cur.executemany(UPSERT_ROLLUP_SQL, upserts)
+    cur.close()
+    if commit:
+        conn.commit()
+    return len(upserts)
+
+
+def ensure_rollup_table(conn):
+    cur = conn.cursor()
+    cur.execute(ROLLUP_DDL)
+    cur.close()
+    conn.commit()
+
+
+def rollup_is_empty(conn) -> bool:
+    cur = conn.cursor()
+    cur.execute("SELECT 1 FROM weight_daily_rollup LIMIT 1")
+    empty = cur.fetchone() is None
+    cur.close()
+    return empty
+
+
+def backfill(conn, device_id: str | None = None, since: datetime | None = None, log=print):
+    """
+    Rebuild rollup rows from weight_data, one device at a time so each
+    statement stays short. Returns (devices, rollup_rows).
+    """
+    since = since or datetime(1970, 1, 1)
+    cur = conn.cursor()
+    if device_id:
+        devices = [device_id]
+    else:
+        cur.execute("SELECT DISTINCT device_id FROM weight_data")
+        devices = [d for (d,) in cur.fetchall()]
+
+    total_rows = 0
+    started = time.monotonic()
+    for i, dev in enumerate(devices, 1):
+        cur.execute(BACKFILL_SQL, (dev, since))
+        conn.commit()
+        total_rows += max(cur.rowcount, 0)
+        if i % 100 == 0 or i == len(devices):
+            log(f"[analysis] 🧮 Rollup backfill: {i}/{len(devices)} devices "
+                f"({time.monotonic() - started:.1f}s)")
+    cur.close()
+    return len(devices), total_rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="weight_daily_rollup maintenance")
+    sub = parser.add_subparsers(dest="command", required=True)
+    bf = sub.add_parser("backfill", help="rebuild rollup rows from raw weight_data")
+    bf.add_argument("--device", help="only this device_id")
+    bf.add_argument("--since", help="only days from this date (YYYY-MM-DD)")
+    args = parser.parse_args(argv)
+
+    import mysql.connector
+    from main import MYSQL_CONFIG
+
+    conn = mysql.connector.connect(**MYSQL_CONFIG)
+    try:
+        ensure_rollup_table(conn)
+        since = datetime.strptime(args.since, "%Y-%m-%d") if args.since else None
+        devices, rows = backfill(conn, args.device, since)
+        print(f"[analysis] ✅ Rollup backfill done: {devices} devices, {rows} rows affected")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,273 @@
+# snapshot.py (shared by analysis-service and updates-service; keep both copies identical)
+"""
+Versioned binary snapshots of in-memory state, for warm restarts.
+
+A snapshot is a dict of named sections. Values are encoded with a small
+msgpack-style tagged format (one tag byte, then a fixed-width or
+length-prefixed body):
+
+    N None   T True   F False
+    i int64  d float64
+    s str    (u32 length + utf-8)
+    t datetime (int64 microseconds since 1970-01-01, naive)
+    D date   (int32 proleptic ordinal)
+    l list   (u32 count + items; tuples come back as lists)
+    m dict   (u32 count + key/value pairs)
+
+File layout, little-endian:
+
+    header  magic "SMSNAP" | u16 version | s64 created (us) | u32 payload length
+    payload the encoded sections dict
+    footer  u32 crc32 of the payload
+
+Files are written to a temporary sibling, fsync'd and moved into place with
+os.replace(), so a reader only ever sees a complete snapshot; a torn or
+corrupt file fails the length/CRC check and is ignored. Loading decodes
+straight out of a memoryview of the file.
+"""
+from __future__ import annotations
+import os
+import time
+import zlib
+import struct
+import threading
+from datetime import datetime, date, timedelta
+
+MAGIC = b"SMSNAP"
+VERSION = 1
+
+_HEADER = struct.Struct("<6sHqI")
+_FOOTER = struct.Struct("<I")
+_I64 = struct.Struct("<q")
+_I32 = struct.Struct("<i")
+_U32 = struct.Struct("<I")
+_F64 = struct.Struct("<d")
+
+_EPOCH = datetime(1970, 1, 1)
+_US = timedelta(microseconds=1)
+
+
+class SnapshotError(Exception):
+    pass
+
+
+# =========================
+# Encoding
+# =========================
+def _encode(value, out: bytearray):
+    if value is None:
+        out += b"N"
+    elif value is True:
+        out += b"T"
+    elif value is False:
+        out += b"F"
+    elif isinstance(value, int):
+        out += b"i"
+        out += _I64.pack(value)
+    elif isinstance(value, float):
+        out += b"d"
+        out += _F64.pack(value)
+    elif isinstance(value, str):
+        raw = value.encode("utf-8")
+        out += b"s"
+        out += _U32.pack(len(raw))
+        out += raw
+    elif isinstance(value, datetime):   # before date: datetime is a date subclass
+        if value.tzinfo is not None:
+            raise SnapshotError("only naive datetimes can be snapshotted")
+        out += b"t"
+        out += _I64.pack((value - _EPOCH) // _US)
+    elif isinstance(value, date):
+        out += b"D"
+        out += _I32.pack(value.toordinal())
+    elif isinstance(value, (list, tuple)):
+        out += b"l"
+        out += _U32.pack(len(value))
+        for item in value:
+            _encode(item, out)
+    elif isinstance(value, dict):
+        out += b"m"
+        out += _U32.pack(len(value))
+        for k, v in value.items():
+            _encode(k, out)
+            _encode(v, out)
+    else:
+        raise SnapshotError(f"cannot snapshot {type(value).__name__}")
+
+
+def _decode(buf: memoryview, pos: int):
+    tag = buf[pos]
+    pos += 1
+    if tag == 0x4E:    # N
+        return None, pos
+    if tag == 0x54:    # T
+        return True, pos
+    if tag == 0x46:    # F
+        return False, pos
+    if tag == 0x69:    # i
+        return _I64.unpack_from(buf, pos)[0], pos + 8
+    if tag == 0x64:    # d
+        return _F64.unpack_from(buf, pos)[0], pos + 8
+    if tag == 0x73:    # s
+        n = _U32.unpack_from(buf, pos)[0]
+        pos += 4
+        return str(buf[pos:pos + n], "utf-8"), pos + n
+    if tag == 0x74:    # t
+        return _EPOCH + _US * _I64.unpack_from(buf, pos)[0], pos + 8
+    if tag == 0x44:    # D
+        return date.fromordinal(_I32.unpack_from(buf, pos)[0]), pos + 4
+    if tag == 0x6C:    # l
+        n = _U32.unpack_from(buf, pos)[0]
+        pos += 4
+        items = []
+        for _ in range(n):
+            item, pos = _decode(buf, pos)
+            items.append(item)
+        return items, pos
+    if tag == 0x6D:    # m
+        n = _U32.unpack_from(buf, pos)[0]
+        pos += 4
+        result = {}
+        for _ in range(n):
+            k, pos = _decode(buf, pos)
+            v, pos = _decode(buf, pos)
+            if isinstance(k, list):
+                k = tuple(k)
+            result[k] = v
+        return result, pos
+    raise SnapshotError(f"unknown tag 0x{tag:02x} at offset {pos - 1}")
+
+
+def dumps(sections: dict, created: datetime | None = None) -> bytes:
+    payload = bytearray()
+    _encode(sections, payload)
+    created_us = ((created or datetime.now()) - _EPOCH) // _US
+    return (_HEADER.pack(MAGIC, VERSION, created_us, len(payload))
+            + bytes(payload) + _FOOTER.pack(zlib.crc32(payload)))
+
+
+def loads(data) -> tuple[datetime, dict]:
+    """Returns (created, sections); raises SnapshotError if the file is not a valid snapshot."""
+    buf = memoryview(data)
+    if len(buf) < _HEADER.size + _FOOTER.size:
+        raise SnapshotError("file too short")
+    magic, version, created_us, length = _HEADER.unpack_from(buf, 0)
+    if magic != MAGIC:
+        raise SnapshotError("not a snapshot file")
+    if version != VERSION:
+        raise SnapshotError(f"unsupported snapshot version {version}")
+    end = _HEADER.size + length
+    if len(buf) != end + _FOOTER.size:
+        raise SnapshotError("truncated snapshot")
+    payload = buf[_HEADER.size:end]
+    if zlib.crc32(payload) != _FOOTER.unpack_from(buf, end)[0]:
+        raise SnapshotError("checksum mismatch")
+    sections, pos = _decode(payload, 0)
+    if pos != length or not isinstance(sections, dict):
+        raise SnapshotError("malformed payload")
+    return _EPOCH + _US * created_us, sections
+
+
+# =========================
+# Files
+# =========================
+def write_snapshot(path: str, sections: dict) -> int:
+    """Atomically replace path with a snapshot of sections; returns its size in bytes."""
+    data = dumps(sections)
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    tmp = f"{path}.tmp.{os.getpid()}"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+    try:   # make the rename itself durable
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    except OSError:
+        pass
+    return len(data)
+
+
+def read_snapshot(path: str, max_age_s: float = 0):
+    """
+    Returns (created, sections), or None if there is no usable snapshot at
+    path (missing, corrupt, wrong version, or older than max_age_s when > 0).
+    """
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    created, sections = loads(data)
+    if max_age_s > 0 and (datetime.now() - created).total_seconds() > max_age_s:
+        return None
+    return created, sections
+
+
+class Snapshotter:
+    """
+    Writes collect() to path every interval_s seconds from a daemon thread,
+    and once more on stop(). collect() returns the sections dict.
+    """
+
+    def __init__(self, path: str, collect, interval_s: float, log_prefix: str = "[snapshot]"):
+        self.path = path
+        self.collect = collect
+        self.interval_s = interval_s
+        self.log_prefix = log_prefix
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.written = 0
+        self.failed = 0
+        self.last_bytes = 0
+        self.last_duration_s = 0.0
+
+    def save(self) -> bool:
+        with self._lock:   # the periodic and the shutdown snapshot never interleave
+            started = time.perf_counter()
+            try:
+                self.last_bytes = write_snapshot(self.path, self.collect())
+            except Exception as e:
+                self.failed += 1
+                print(f"{self.log_prefix} ❌ Failed to write state snapshot to {self.path}: {e}")
+                return False
+            self.last_duration_s = time.perf_counter() - started
+            self.written += 1
+            return True
+
+    def start(self):
+        if self._thread is None and self.interval_s > 0:
+            self._thread = threading.Thread(target=self._run, name="state-snapshot", daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval_s):
+            self.save()
+
+    def stop(self):
+        """Stop the periodic thread and write a final snapshot."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval_s + 5)
+            self._thread = None
+        if self.save():
+            print(f"{self.log_prefix} 💾 Final state snapshot written to {self.path} "
+                  f"({self.last_bytes} bytes in {self.last_duration_s * 1000:.1f}ms)")
+
+    def stats(self) -> dict:
+        return {"written": self.written, "failed": self.failed,
+                "last_bytes": self.last_bytes, "last_duration_ms": round(self.last_duration_s * 1000, 2)}
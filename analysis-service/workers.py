@@ -0,0 +1,222 @@
+# analysis-service/workers.py
+"""
+Sharded worker pool that keeps DB work off the MQTT network thread.
+
+Each device_id is hashed onto one shard. A shard is a bounded FIFO drained by
+exactly one thread, so readings of the same device are processed strictly in
+order while different devices run in parallel.
+
+When a shard is full the overload policy decides what happens:
+  block       -> the producer waits for space, at most block_timeout_s, then
+                 the new item is shed (back-pressure onto the broker; the
+                 producer is paho's network thread, so the wait stays short)
+  drop-oldest -> the oldest queued item of that shard is discarded
+  shed        -> the new item is rejected and counted
+
+Control items (grace-period expiries, barrier markers) go in through
+submit_pinned(): they bypass the depth limit and are never evicted by
+drop-oldest, so a busy shard delays them but never loses them.
+"""
+from __future__ import annotations
+import time
+import zlib
+import threading
+from collections import deque
+
+OVERLOAD_POLICIES = ("block", "drop-oldest", "shed")
+
+
+def shard_for(key: str, shards: int) -> int:
+    """Stable shard index for a device id (same result in every process)."""
+    return zlib.crc32(key.encode("utf-8")) % shards
+
+
+class _Shard:
+    __slots__ = ("items", "cond", "depth_max")
+
+    def __init__(self):
+        self.items = deque()
+        self.cond = threading.Condition()
+        self.depth_max = 0
+
+
+class ShardedWorkerPool:
+    def __init__(self, workers: int = 4, queue_depth: int = 1000,
+                 overload_policy: str = "drop-oldest", name: str = "worker",
+                 block_timeout_s: float | None = 0.05):
+        if overload_policy not in OVERLOAD_POLICIES:
+            raise ValueError(f"overload_policy must be one of {OVERLOAD_POLICIES}, got {overload_policy!r}")
+        self.workers = max(1, int(workers))
+        self.queue_depth = max(1, int(queue_depth))
+        self.overload_policy = overload_policy
+        self.block_timeout_s = block_timeout_s   # None = wait for space indefinitely
+        self.name = name
+        self._shards = [_Shard() for _ in range(self.workers)]
+        self._threads = []
+        self._stopped = False
+        self._lock = threading.Lock()
+
+        # Counters (read via stats())
+        self.submitted = 0
+        self.processed = 0
+        self.failed = 0
+        self.dropped_oldest = 0
+        self.shed = 0
+        self.blocked = 0
+
+    # ---------- producer side ----------
+    def submit(self, key: str, fn, *args) -> bool:
+        """
+        Queue fn(*args) on the shard owning `key`.
+        Returns False if the item was shed because the shard is full (with
+        "block": still full after block_timeout_s).
+        """
+        shard = self._shards[shard_for(key, self.workers)]
+        with shard.cond:
+            if len(shard.items) >= self.queue_depth:
+                if self.overload_policy == "shed":
+                    with self._lock:
+                        self.shed += 1
+                    return False
+                if self.overload_policy == "drop-oldest":
+                    if self._evict_oldest(shard):
+                        with self._lock:
+                            self.dropped_oldest += 1
+                else:
+                    with self._lock:
+                        self.blocked += 1
+                    deadline = None if self.block_timeout_s is None else time.monotonic() + self.block_timeout_s
+                    while len(shard.items) >= self.queue_depth and not self._stopped:
+                        remaining = None if deadline is None else deadline - time.monotonic()
+                        if remaining is not None and remaining <= 0:
+                            with self._lock:
+                                self.shed += 1
+                            return False
+                        shard.cond.wait(remaining)
+            shard.items.append((key, fn, args, False))
+            if len(shard.items) > shard.depth_max:
+                shard.depth_max = len(shard.items)
+            shard.cond.notify_all()
+        with self._lock:
+            self.submitted += 1
+        return True
+
+    def submit_pinned(self, key: str, fn, *args) -> bool:
+        """
+        Queue fn(*args) on the shard owning `key`, past the depth limit: it is
+        never shed, blocked on or evicted. Returns False only once the pool is stopping.
+        """
+        if self._stopped:
+            return False
+        shard = self._shards[shard_for(key, self.workers)]
+        with shard.cond:
+            shard.items.append((key, fn, args, True))
+            shard.cond.notify_all()
+        with self._lock:
+            self.submitted += 1
+        return True
+
+    @staticmethod
+    def _evict_oldest(shard: _Shard) -> bool:
+        """Drop the oldest item that is not pinned (caller holds shard.cond)."""
+        for i, item in enumerate(shard.items):
+            if not item[3]:
+                del shard.items[i]
+                return True
+        return False
+
+    def depth(self) -> int:
+        return sum(len(s.items) for s in self._shards)
+
+    def depth_by_key(self) -> dict:
+        """Queued items per key (scans the queues; meant for metrics scrapes, not the hot path)."""
+        counts = {}
+        for shard in self._shards:
+            with shard.cond:
+                keys = [item[0] for item in shard.items if item[0] is not None]
+            for key in keys:
+                counts[key] = counts.get(key, 0) + 1
+        return counts
+
+    def shard_depths(self) -> list:
+        return [len(s.items) for s in self._shards]
+
+    def barrier(self, timeout: float = 10.0) -> bool:
+        """
+        Wait until every shard has finished the items queued before this call.
+        Returns False on timeout.
+        """
+        remaining = [len(self._shards)]
+        done = threading.Event()
+        lock = threading.Lock()
+
+        def arrive():
+            with lock:
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    done.set()
+
+        for shard in self._shards:
+            with shard.cond:
+                shard.items.append((None, arrive, (), True))   # pinned: never blocks, sheds or gets evicted
+                shard.cond.notify_all()
+        return done.wait(timeout)
+
+    # ---------- lifecycle ----------
+    def start(self):
+        for i, shard in enumerate(self._shards):
+            t = threading.Thread(target=self._run, args=(shard,), name=f"{self.name}-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        return self
+
+    def stop(self, timeout: float = 10.0):
+        """Let the workers drain their queues, then stop them."""
+        self._stopped = True
+        for shard in self._shards:
+            with shard.cond:
+                shard.cond.notify_all()
+        for t in self._threads:
+            t.join(timeout=timeout)
+        self._threads = []
+
+    def _run(self, shard: _Shard):
+        while True:
+            with shard.cond:
+                while not shard.items:
+                    if self._stopped:
+                        return
+                    shard.cond.wait()
+                key, fn, args, _ = shard.items.popleft()
+                shard.cond.notify_all()   # wake a producer blocked on a full shard
+            if key is None:               # barrier marker, not a reading
+                fn()
+                continue
+            try:
+                fn(*args)
+                ok = True
+            except Exception as e:
+                ok = False
+                print(f"[analysis] ERROR in {threading.current_thread().name}: {e}")
+            with self._lock:
+                if ok:
+                    self.processed += 1
+                else:
+                    self.failed += 1
+
+    # ---------- metrics ----------
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "queue_depth_limit": self.queue_depth,
+                "overload_policy": self.overload_policy,
+                "depth": self.depth(),
+                "depth_max": max(s.depth_max for s in self._shards),
+                "submitted": self.submitted,
+                "processed": self.processed,
+                "failed": self.failed,
+                "dropped_oldest": self.dropped_oldest,
+                "shed": self.shed,
+                "blocked": self.blocked,
+            }
@@ -0,0 +1,346 @@
+# benchmarks/ingest_bench.py
+"""
+End-to-end ingest benchmark for analysis-service and updates-service.
+
+Loads each service's main.py, connects its on_connect/on_message to an
+in-process broker and publishes synthetic readings shaped like
+weight-service/main.py:publish_weight from N simulated devices. The DB is an
+embedded stand-in by default (--db mysql uses the server from the MYSQL_*
+environment variables); SMTP is always a counting stand-in.
+
+Reported per service: msgs/s, p50/p95/p99 latency, DB round trips per message.
+analysis-service hands readings to its workers, so its latency is measured
+from publish until the reading's batch has been flushed and user_stats
+written; updates-service handles everything inside on_message.
+
+    python benchmarks/ingest_bench.py --devices 200 --messages 20000 [--rate 500]
+    python benchmarks/ingest_bench.py --save benchmarks/baseline.json
+    python benchmarks/ingest_bench.py --compare benchmarks/baseline.json
+"""
+from __future__ import annotations
+import io
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import smtplib
+import threading
+import subprocess
+import contextlib
+import importlib.util
+from datetime import datetime
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, HERE)
+
+from standins import FakeBroker, EmbeddedDB, RoundTrips, FakeSMTP, counting_connect  # noqa: E402
+
+SERVICES = {
+    "analysis": os.path.join(ROOT, "analysis-service"),
+    "updates": os.path.join(ROOT, "updates-service"),
+}
+
+# The publisher's copy of the payload encoder (--payload binary)
+_codec_spec = importlib.util.spec_from_file_location(
+    "weight_payload_codec", os.path.join(ROOT, "weight-service", "payload_codec.py"))
+payload_codec = importlib.util.module_from_spec(_codec_spec)
+_codec_spec.loader.exec_module(payload_codec)
+
+# metric -> True if higher is better
+METRICS = {
+    "msgs_per_s": True,
+    "latency_p50_ms": False,
+    "latency_p95_ms": False,
+    "latency_p99_ms": False,
+    "db_round_trips_per_msg": False,
+}
+
+
+# =========================
+# Service loading
+# =========================
+def load_service(name: str):
+    """
+    Import <service>/main.py as '<name>_main'. Sibling modules it imports are
+    removed from sys.modules afterwards so the other service gets its own copies.
+    """
+    path = SERVICES[name]
+    before = set(sys.modules)
+    sys.path.insert(0, path)
+    try:
+        spec = importlib.util.spec_from_file_location(f"{name}_main", os.path.join(path, "main.py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(path)
+        for mod_name in set(sys.modules) - before:
+            if (getattr(sys.modules[mod_name], "__file__", None) or "").startswith(path):
+                del sys.modules[mod_name]
+    return module
+
+
+@contextlib.contextmanager
+def patched(obj, **attrs):
+    saved = {k: getattr(obj, k) for k in attrs}
+    for k, v in attrs.items():
+        setattr(obj, k, v)
+    try:
+        yield
+    finally:
+        for k, v in saved.items():
+            setattr(obj, k, v)
+
+
+# =========================
+# Synthetic devices
+# =========================
+class SimulatedDevice:
+    """Same consumption pattern as weight-service simulate_weight()."""
+
+    def __init__(self, device_id: str, rng: random.Random, binary: bool = False):
+        self.device_id = device_id
+        self.rng = rng
+        self.binary = binary
+        self.weight = 1000
+        self.count = 0
+
+    def next_payload(self, topic: str):
+        """(weight, payload, topic it is published to)"""
+        if self.weight < 100:
+            self.weight = 1000
+        else:
+            self.weight = max(0, self.weight - self.rng.choice([60, 70, 80, 100, 120]))
+        self.count += 1
+        if self.binary:
+            return (self.weight, payload_codec.encode(self.device_id, self.weight, seq=self.count),
+                    payload_codec.binary_topic(topic, self.device_id))
+        payload = json.dumps({
+            "device_id": self.device_id,
+            "weight": self.weight,
+            "timestamp": datetime.now().isoformat(),
+            "message_id": f"weight-{self.count}-{int(time.time())}",
+        })
+        return self.weight, payload, topic
+
+
+def percentile(sorted_values, p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * p / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def summarize(latencies_s, messages: int, elapsed_s: float, db: dict, extra: dict) -> dict:
+    lat = sorted(x * 1000 for x in latencies_s)
+    return {
+        "messages": messages,
+        "completed": len(lat),
+        "elapsed_s": round(elapsed_s, 3),
+        "msgs_per_s": round(messages / elapsed_s, 1) if elapsed_s > 0 else 0.0,
+        "latency_p50_ms": round(percentile(lat, 50), 3),
+        "latency_p95_ms": round(percentile(lat, 95), 3),
+        "latency_p99_ms": round(percentile(lat, 99), 3),
+        "latency_max_ms": round(lat[-1], 3) if lat else 0.0,
+        "db_round_trips_per_msg": round(db["round_trips"] / messages, 3) if messages else 0.0,
+        "db": db,
+        **extra,
+    }
+
+
+# =========================
+# Runner
+# =========================
+def run_service(name: str, args, connect, counter: RoundTrips) -> dict:
+    rng = random.Random(args.seed)
+    devices = [SimulatedDevice(f"bench-{i:05d}", rng, args.payload == "binary") for i in range(args.devices)]
+    topic = "milk/weight"
+
+    with patched(smtplib, SMTP=FakeSMTP, SMTP_SSL=FakeSMTP):
+        import mysql.connector
+        with patched(mysql.connector, connect=connect):
+            svc = load_service(name)
+            broker = FakeBroker()
+            client = broker.client(svc.on_connect, svc.on_message)
+
+            publish_times = {}
+            done_times = {}
+            done_lock = threading.Lock()
+            if name == "analysis":
+                svc.warm_analytics()
+                flush = svc._weight_buffer._on_flush
+
+                def timed_flush(conn, rows):
+                    flush(conn, rows)
+                    t = time.perf_counter()
+                    with done_lock:
+                        for r in rows:
+                            done_times[r.msg_num] = t
+                svc._weight_buffer._on_flush = timed_flush
+                svc._weight_buffer.start()
+                svc._workers.start()
+            else:
+                svc._email_dispatch.start()
+                svc._alert_coalescer.start()
+            svc._grace_scheduler.start()
+            client.connect()
+            FakeSMTP.reset()
+            counter.reset()
+
+            held = 0
+            duplicates = 0
+            dup_rng = random.Random(args.seed + 1)
+            interval = 1.0 / args.rate if args.rate > 0 else 0.0
+            started = time.perf_counter()
+            for i in range(args.messages):
+                if interval:
+                    delay = started + i * interval - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                weight, payload, device_topic = devices[i % len(devices)].next_payload(topic)
+                held += weight <= 0       # 0g readings wait for the carton grace period
+                t0 = time.perf_counter()
+                publish_times[i + 1] = t0
+                broker.publish(device_topic, payload, qos=1)
+                if args.duplicate_rate and dup_rng.random() < args.duplicate_rate:
+                    broker.publish(device_topic, payload, qos=1)   # redelivery, suppressed by message_id
+                    duplicates += 1
+                if name == "updates":
+                    done_times[i + 1] = time.perf_counter()
+
+            if name == "analysis":
+                deadline = time.perf_counter() + args.drain_timeout
+                while time.perf_counter() < deadline:
+                    # steady readings inside the write deadband are never stored
+                    expected = args.messages - held - svc._deadband.suppressed
+                    with done_lock:
+                        if len(done_times) >= expected:
+                            break
+                    time.sleep(0.005)
+            elapsed = max(done_times.values(), default=started) - started
+            if name == "updates":
+                svc._alert_coalescer.stop()                              # send the held digests
+                svc._email_dispatch.stop(timeout_s=args.drain_timeout)   # emails go out in the background
+
+            extra = {"devices": args.devices, "held_zero_readings": held,
+                     "smtp_sessions": FakeSMTP.sessions, "emails": FakeSMTP.messages,
+                     "duplicates_sent": duplicates, "duplicates_suppressed": svc._dedup.suppressed}
+            if name == "analysis":
+                extra["ingest_buffer"] = svc._weight_buffer.stats()
+                extra["workers"] = svc._workers.stats()
+                extra["deadband"] = svc._deadband.stats()
+                svc._weight_buffer.close()
+                svc._workers.stop()
+            else:
+                extra["email"] = svc._email_dispatch.stats()
+                extra["coalescer"] = svc._alert_coalescer.stats()
+            svc._grace_scheduler.stop()
+            db = counter.snapshot()
+
+    latencies = [done_times[n] - publish_times[n] for n in done_times if n in publish_times]
+    return summarize(latencies, args.messages, elapsed, db, extra)
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+
+# =========================
+# Baselines
+# =========================
+def compare(baseline: dict, current: dict, tolerance: float) -> list:
+    """Print a metric table; returns [(service, metric, before, after)] regressions."""
+    regressions = []
+    for service, now in current["results"].items():
+        before = baseline.get("results", {}).get(service)
+        if not before:
+            print(f"[bench] {service}: no baseline entry")
+            continue
+        print(f"[bench] {service} (baseline {baseline.get('meta', {}).get('git') or '?'})")
+        for metric, higher_is_better in METRICS.items():
+            b, a = before.get(metric), now.get(metric)
+            if b is None or a is None:
+                continue
+            change = ((a - b) / b * 100) if b else 0.0
+            worse = change < -tolerance if higher_is_better else change > tolerance
+            flag = "  ❌ regression" if worse else ""
+            print(f"    {metric:<24} {b:>12.3f} -> {a:>12.3f}  ({change:+.1f}%){flag}")
+            if worse:
+                regressions.append((service, metric, b, a))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Ingest throughput benchmark for the Smart Milk services")
+    parser.add_argument("--service", choices=["analysis", "updates", "both"], default="both")
+    parser.add_argument("--devices", type=int, default=100, help="simulated devices")
+    parser.add_argument("--messages", type=int, default=10000, help="readings published per service")
+    parser.add_argument("--rate", type=float, default=0, help="target msgs/s across all devices (0 = unthrottled)")
+    parser.add_argument("--db", choices=["embedded", "mysql"], default="embedded",
+                        help="embedded stand-in, or the MySQL server from MYSQL_* env vars")
+    parser.add_argument("--users-per-device", type=int, default=1, help="users returned per device (embedded db)")
+    parser.add_argument("--payload", choices=["json", "binary"], default="json",
+                        help="reading encoding (binary = payload_codec layout on milk/weight/bin/<device_id>)")
+    parser.add_argument("--duplicate-rate", type=float, default=0,
+                        help="fraction of readings redelivered once, like a QoS 1 retry (0-1)")
+    parser.add_argument("--seed", type=int, default=1, help="random seed for the consumption pattern")
+    parser.add_argument("--drain-timeout", type=float, default=60, help="max seconds to wait for analysis flushes")
+    parser.add_argument("--save", help="write results to this JSON file")
+    parser.add_argument("--compare", help="compare with a saved baseline JSON")
+    parser.add_argument("--tolerance", type=float, default=10.0, help="allowed regression in percent")
+    parser.add_argument("--verbose", action="store_true", help="keep the services' own log output")
+    args = parser.parse_args(argv)
+
+    counter = RoundTrips()
+    if args.db == "embedded":
+        connect = counting_connect(EmbeddedDB(users_per_device=args.users_per_device).connect, counter)
+    else:
+        import mysql.connector
+        connect = counting_connect(mysql.connector.connect, counter)
+
+    services = ["analysis", "updates"] if args.service == "both" else [args.service]
+    results = {}
+    for name in services:
+        sink = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+        with sink as buf:
+            results[name] = run_service(name, args, connect, counter)
+            if buf is not None:
+                buf.truncate(0)
+        r = results[name]
+        print(f"[bench] {name}: {r['msgs_per_s']:.0f} msgs/s | latency p50 {r['latency_p50_ms']:.2f}ms "
+              f"p95 {r['latency_p95_ms']:.2f}ms p99 {r['latency_p99_ms']:.2f}ms | "
+              f"{r['db_round_trips_per_msg']:.2f} DB round trips/msg ({r['completed']}/{r['messages']} completed)")
+
+    report = {
+        "meta": {
+            "git": git_revision(),
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "db": args.db,
+            "args": {k: v for k, v in vars(args).items() if k not in ("save", "compare", "verbose")},
+        },
+        "results": results,
+    }
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, default=str)
+        print(f"[bench] Results saved to {args.save}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if compare(baseline, report, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,355 @@
+# benchmarks/standins.py
+"""
+In-process stand-ins used by the ingest benchmark.
+
+FakeBroker   -> delivers published messages synchronously to subscribed
+                clients, the way paho's network thread calls on_message;
+                $share/<group>/ subscriptions get each message round-robin
+EmbeddedDB   -> mysql.connector-compatible connections that answer the
+                handful of queries the services issue, without a server
+RoundTrips   -> counts DB round trips; wraps either the embedded stand-in
+                or a real mysql-connector connection
+FakeSMTP     -> smtplib.SMTP / SMTP_SSL replacement that only counts
+"""
+from __future__ import annotations
+import zlib
+import threading
+
+try:
+    import paho.mqtt.client as mqtt
+except ImportError:          # the broker still works with the plain message class below
+    mqtt = None
+
+
+# =========================
+# MQTT
+# =========================
+class _Message:
+    __slots__ = ("topic", "payload", "qos", "retain", "mid", "properties")
+
+    def __init__(self, topic: str, payload: bytes, qos: int, mid: int):
+        self.topic, self.payload, self.qos, self.mid = topic, payload, qos, mid
+        self.retain = False
+        self.properties = None
+
+
+def topic_matches(pattern: str, topic: str) -> bool:
+    """MQTT filter match with + and # wildcards and $share/<group>/ prefixes."""
+    if pattern.startswith("$share/"):
+        pattern = pattern.split("/", 2)[2]
+    p, t = pattern.split("/"), topic.split("/")
+    for i, part in enumerate(p):
+        if part == "#":
+            return True
+        if i >= len(t) or (part != "+" and part != t[i]):
+            return False
+    return len(p) == len(t)
+
+
+class FakeClient:
+    """The subset of paho.mqtt.client.Client the services use."""
+
+    def __init__(self, broker: "FakeBroker"):
+        self._broker = broker
+        self.on_connect = None
+        self.on_message = None
+        self.subscriptions = []
+
+    def subscribe(self, topic, qos=0, *args, **kwargs):
+        topics = topic if isinstance(topic, list) else [(topic, qos)]
+        for t in topics:
+            self.subscriptions.append(t[0] if isinstance(t, tuple) else t)
+        return 0, len(self.subscriptions)
+
+    def publish(self, topic, payload=None, qos=0, retain=False, **kwargs):
+        return self._broker.publish(topic, payload, qos)
+
+    def connect(self, *args, **kwargs):
+        return self._broker.attach(self)
+
+
+class FakeBroker:
+    def __init__(self):
+        self._clients = []
+        self._mid = 0
+        self._next_in_group = {}   # share group -> round-robin position
+
+    def client(self, on_connect=None, on_message=None) -> FakeClient:
+        c = FakeClient(self)
+        c.on_connect, c.on_message = on_connect, on_message
+        return c
+
+    def attach(self, client: FakeClient):
+        self._clients.append(client)
+        if client.on_connect is not None:
+            client.on_connect(client, None, {}, 0, None)
+        return 0
+
+    def publish(self, topic: str, payload, qos: int = 0):
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        self._mid += 1
+        targets, groups = [], {}
+        for c in self._clients:
+            if c.on_message is None:
+                continue
+            matched = [s for s in c.subscriptions if topic_matches(s, topic)]
+            if any(not s.startswith("$share/") for s in matched):
+                targets.append(c)
+            for s in matched:
+                if s.startswith("$share/"):
+                    groups.setdefault(s.split("/", 2)[1], []).append(c)
+        for group, members in groups.items():
+            i = self._next_in_group.get(group, 0)
+            self._next_in_group[group] = i + 1
+            member = members[i % len(members)]
+            if member not in targets:
+                targets.append(member)
+        for c in targets:
+            c.on_message(c, None, self._message(topic, payload, qos))
+        return self._mid
+
+    def _message(self, topic, payload, qos):
+        if mqtt is not None:
+            msg = mqtt.MQTTMessage(self._mid, topic.encode("utf-8"))
+            msg.payload, msg.qos = payload, qos
+            return msg
+        return _Message(topic, payload, qos, self._mid)
+
+
+# =========================
+# MySQL
+# =========================
+class RoundTrips:
+    """Thread-safe DB round-trip counters shared by every wrapped connection."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.round_trips = 0
+            self.connects = 0
+            self.statements = 0
+            self.rows_written = 0
+
+    def add(self, round_trips: int = 1, statements: int = 0, rows_written: int = 0, connects: int = 0):
+        with self._lock:
+            self.round_trips += round_trips
+            self.statements += statements
+            self.rows_written += rows_written
+            self.connects += connects
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"round_trips": self.round_trips, "connects": self.connects,
+                    "statements": self.statements, "rows_written": self.rows_written}
+
+
+def _is_batched_insert(sql: str) -> bool:
+    # mysql-connector rewrites executemany(INSERT ... VALUES) into one multi-row statement
+    head = sql.lstrip().upper()
+    return head.startswith("INSERT") or head.startswith("REPLACE")
+
+
+class _EmbeddedCursor:
+    def __init__(self, db: "EmbeddedDB", dictionary: bool = False):
+        self._db = db
+        self._dictionary = dictionary
+        self._rows = []
+        self.rowcount = -1
+        self.lastrowid = None
+
+    def execute(self, sql, params=()):
+        self._rows = self._db.answer(sql, params or (), self._dictionary)
+        self.rowcount = len(self._rows) if sql.lstrip().upper().startswith("SELECT") else 1
+
+    def executemany(self, sql, seq):
+        seq = list(seq)
+        self._rows = []
+        self.rowcount = len(seq)
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def fetchmany(self, size=1):
+        out, self._rows = self._rows[:size], self._rows[size:]
+        return out
+
+    def fetchall(self):
+        out, self._rows = self._rows, []
+        return out
+
+    def __iter__(self):
+        while self._rows:
+            yield self._rows.pop(0)
+
+    def close(self):
+        pass
+
+
+class _EmbeddedConnection:
+    def __init__(self, db: "EmbeddedDB"):
+        self._db = db
+        self.in_transaction = False
+
+    def cursor(self, dictionary=False, prepared=False, **kwargs):
+        return _EmbeddedCursor(self._db, dictionary)
+
+    def start_transaction(self, *args, **kwargs):
+        self.in_transaction = True
+
+    def commit(self):
+        self.in_transaction = False
+
+    def rollback(self):
+        self.in_transaction = False
+
+    def is_connected(self):
+        return True
+
+    def ping(self, *args, **kwargs):
+        pass
+
+    def close(self):
+        pass
+
+
+class EmbeddedDB:
+    """
+    Server-less stand-in: writes are accepted and dropped, and reads return
+    what a provisioned fleet would (one user per device, a non-empty rollup).
+    """
+
+    def __init__(self, users_per_device: int = 1, threshold_g: float = 200.0):
+        self.users_per_device = users_per_device
+        self.threshold_g = threshold_g
+
+    def connect(self, **config):
+        return _EmbeddedConnection(self)
+
+    def answer(self, sql: str, params, dictionary: bool):
+        s = " ".join(sql.split()).upper()
+        if not s.startswith("SELECT"):
+            return []
+        if "FROM USERS" in s and params:
+            device_id = params[0]
+            base = zlib.crc32(device_id.encode("utf-8")) * 10
+            users = [{"id": base + i, "full_name": f"Bench User {i}", "email": f"{device_id}-{i}@bench.invalid",
+                      "threshold_wanted": self.threshold_g} for i in range(self.users_per_device)]
+            if dictionary:
+                return users
+            return [(u["id"],) for u in users]
+        if s.startswith("SELECT 1 FROM WEIGHT_DAILY_ROLLUP"):
+            return [(1,)]
+        if "FROM INFORMATION_SCHEMA.COLUMNS" in s:   # schema is up to date
+            return [(1,)]
+        if "GET_LOCK" in s or "RELEASE_LOCK" in s:
+            return [(1,)]
+        return []
+
+
+class _CountingCursor:
+    def __init__(self, raw, counter: RoundTrips):
+        self._raw = raw
+        self._counter = counter
+
+    def execute(self, sql, params=None, *args, **kwargs):
+        self._counter.add(1, statements=1, rows_written=0 if sql.lstrip().upper().startswith("SELECT") else 1)
+        return self._raw.execute(sql, params, *args, **kwargs)
+
+    def executemany(self, sql, seq, *args, **kwargs):
+        seq = list(seq)
+        trips = 1 if _is_batched_insert(sql) else len(seq)
+        self._counter.add(trips, statements=len(seq), rows_written=len(seq))
+        return self._raw.executemany(sql, seq, *args, **kwargs)
+
+    def __iter__(self):
+        return iter(self._raw)
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+
+class _CountingConnection:
+    def __init__(self, raw, counter: RoundTrips):
+        self._raw = raw
+        self._counter = counter
+
+    def cursor(self, *args, **kwargs):
+        return _CountingCursor(self._raw.cursor(*args, **kwargs), self._counter)
+
+    def start_transaction(self, *args, **kwargs):
+        self._counter.add(1)
+        return self._raw.start_transaction(*args, **kwargs)
+
+    def commit(self):
+        self._counter.add(1)
+        return self._raw.commit()
+
+    def rollback(self):
+        self._counter.add(1)
+        return self._raw.rollback()
+
+    def is_connected(self):
+        self._counter.add(1)
+        return self._raw.is_connected()
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+
+def counting_connect(connect, counter: RoundTrips):
+    """Wrap a connect() function so every connection it opens counts its round trips."""
+    def _connect(*args, **kwargs):
+        counter.add(1, connects=1)
+        return _CountingConnection(connect(*args, **kwargs), counter)
+    return _connect
+
+
+# =========================
+# SMTP
+# =========================
+class FakeSMTP:
+    sessions = 0
+    messages = 0
+    _lock = threading.Lock()
+
+    def __init__(self, *args, **kwargs):
+        with FakeSMTP._lock:
+            FakeSMTP.sessions += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def ehlo(self, *args, **kwargs):
+        pass
+
+    def starttls(self, *args, **kwargs):
+        pass
+
+    def login(self, *args, **kwargs):
+        pass
+
+    def noop(self):
+        return 250, b"OK"
+
+    def send_message(self, *args, **kwargs):
+        with FakeSMTP._lock:
+            FakeSMTP.messages += 1
+        return {}
+
+    def quit(self):
+        pass
+
+    def close(self):
+        pass
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls.sessions = cls.messages = 0
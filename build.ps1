@@ -11,6 +11,22 @@ $DOCKER_REPO = "mika66"
 
 Write-Host "Building Smart Milk Docker images with version $VERSION..." -ForegroundColor Green
 
+# Shared modules are copied into each service (every image builds from its own directory):
+# refuse to build when the copies have drifted apart
+Write-Host "Checking shared module copies..." -ForegroundColor Yellow
+$shared = @{}
+foreach ($file in Get-ChildItem -Path analysis-service, updates-service, weight-service -Filter *.py) {
+    if ((Get-Content $file.FullName -TotalCount 1) -match "^# \S+\.py \(shared by .*; keep (both|all) copies identical\)$") {
+        $shared[$file.Name] += @((Get-FileHash $file.FullName -Algorithm MD5).Hash)
+    }
+}
+foreach ($name in $shared.Keys) {
+    if (($shared[$name] | Select-Object -Unique).Count -ne 1) {
+        Write-Host "Copies of $name differ between services; sync them before building." -ForegroundColor Red
+        exit 1
+    }
+}
+
 # Build frontend first
 Write-Host "Building frontend..." -ForegroundColor Yellow
 cd myapp 
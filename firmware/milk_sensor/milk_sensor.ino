@@ -1,6 +1,7 @@
 #include <WiFi.h>
 #include <PubSubClient.h>
 #include "HX711.h"
+#include <esp_system.h>
 
 // ===== USER CONFIG =====
 const char* ssid        = "Home";
@@ -11,6 +12,10 @@ const int   mqtt_port   = 1883;
 const char* mqtt_topic  = "milk/weight";   // or "milk/weight/device1"
 const char* device_id   = "device1";       // must exist in DB 'clients'
 
+// Compact binary readings (24 bytes instead of ~60 of JSON, layout in payload_codec.py)
+#define BINARY_PAYLOAD 0
+const char* mqtt_binary_topic = "milk/weight/bin/device1";   // milk/weight/bin/<device_id>
+
 // HX711 pins & calibration
 #define DOUT 21
 #define CLK  22
@@ -71,6 +76,38 @@ void publishWeight(float weight) {
   }
 }
 
+uint32_t crc32(const uint8_t* data, size_t len) {
+  uint32_t crc = 0xFFFFFFFF;
+  for (size_t i = 0; i < len; i++) {
+    crc ^= data[i];
+    for (int k = 0; k < 8; k++) crc = (crc >> 1) ^ (0xEDB88320 & -(crc & 1));
+  }
+  return ~crc;
+}
+
+void publishWeightBinary(float weight) {
+  // Without a wall clock the sequence number is all that tells readings apart
+  // in the consumers' dedup, so it must not restart at 1 after a reboot: the
+  // high 16 bits are a random boot nonce (WiFi is up, so esp_random() draws
+  // from the RF noise), the low 16 bits count readings
+  static uint32_t seq = esp_random() & 0xFFFF0000;
+  static uint32_t device_hash = crc32((const uint8_t*)device_id, strlen(device_id));
+  int64_t ts_ms = 0;            // no wall clock: the consumers use the arrival time
+  uint8_t payload[24] = {0xA7, 'M', 1, 0};
+  seq++;
+  // ESP32 is little-endian, like the wire format
+  memcpy(payload + 4, &device_hash, 4);
+  memcpy(payload + 8, &weight, 4);
+  memcpy(payload + 12, &ts_ms, 8);
+  memcpy(payload + 20, &seq, 4);
+
+  if (mqttClient.publish(mqtt_binary_topic, payload, sizeof(payload))) {
+    Serial.print("Published binary #"); Serial.print(seq); Serial.print(": "); Serial.println(weight);
+  } else {
+    Serial.println("Publish failed!");
+  }
+}
+
 // ---------- Arduino ----------
 void setup() {
   Serial.begin(115200);
@@ -84,7 +121,11 @@ void loop() {
   mqttClient.loop();
 
   float w = readWeight();
+#if BINARY_PAYLOAD
+  publishWeightBinary(w);
+#else
   publishWeight(w);
+#endif
 
   delay(10000); // every 10s
 }
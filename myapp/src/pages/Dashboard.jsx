@@ -11,6 +11,12 @@ function fmtDate(iso) {
   return isNaN(d) ? "-" : d.toLocaleDateString("he-IL", { day: "2-digit", month: "2-digit", year: "numeric" });
 }
 
+function fmtHour(iso) {
+  if (!iso) return "";
+  const d = new Date(iso);
+  return isNaN(d) ? "" : ` ~${d.toLocaleTimeString("he-IL", { hour: "2-digit", minute: "2-digit" })}`;
+}
+
 function fmtMl(n) {
   if (n == null) return "-";
   return n >= 1000 ? `${(n/1000).toFixed(1)} ליטר` : `${Math.round(n)} מ״ל`;
@@ -174,7 +180,7 @@ export default function Dashboard() {
 
           <div className="info-card calendar-card">
             <h3 className="card-title">תאריך ריק צפוי</h3>
-            <p className="card-value">{fmtDate(dashboardData.expectedMilkEndDay)}</p>
+            <p className="card-value">{fmtDate(dashboardData.expectedMilkEndDay)}{fmtHour(dashboardData.expectedMilkEndTime)}</p>
           </div>
 
           <div className="info-card sensor-card">
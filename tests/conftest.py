@@ -0,0 +1,46 @@
+# tests/conftest.py
+"""
+Services import their modules as top-level names (each runs from its own
+directory), so the service directories go on sys.path. Modules that exist in
+more than one service are identical copies (see test_shared_copies.py); a
+module that only one service has is found in that service's directory.
+"""
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+for service in ("weight-service", "updates-service", "analysis-service"):
+    sys.path.insert(0, str(ROOT / service))
+
+
+class FakeClock:
+    """
+    Stands in for the time module of the modules passed to install(), which
+    then see time.monotonic() / time.time() advance only through advance().
+    """
+
+    def __init__(self, monkeypatch, start: float = 1000.0):
+        self._monkeypatch = monkeypatch
+        self.now = start
+
+    def install(self, *modules):
+        for module in modules:
+            self._monkeypatch.setattr(module, "time", self)
+        return self
+
+    def monotonic(self) -> float:
+        return self.now
+
+    time = perf_counter = monotonic
+
+    def sleep(self, seconds: float):
+        self.now += seconds
+
+    advance = sleep
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    return FakeClock(monkeypatch)
@@ -0,0 +1,75 @@
+# tests/test_alert_coalescer.py
+import time
+import threading
+
+import pytest
+
+from alert_coalescer import AlertCoalescer
+
+
+class Outbox:
+    def __init__(self):
+        self.emails = []
+        self.sent = threading.Event()
+
+    def __call__(self, to_email, full_name, alerts):
+        self.emails.append((to_email, full_name, [(a.kind, a.device_id, a.weight) for a in alerts]))
+        self.sent.set()
+
+
+@pytest.fixture
+def outbox():
+    return Outbox()
+
+
+def test_no_coalescing(outbox):
+    c = AlertCoalescer(outbox, window_s=0)
+    c.add("a@x", "A", "warning", "d1", 300)
+    c.add("a@x", "A", "critical", "d1", 90)
+    assert [e[2] for e in outbox.emails] == [[("warning", "d1", 300)], [("critical", "d1", 90)]]
+
+
+def test_digest_per_recipient(outbox):
+    c = AlertCoalescer(outbox, window_s=60).start()
+    c.add("a@x", "A", "warning", "d1", 300)
+    c.add("a@x", "A", "warning", "d2", 250)
+    c.add("b@x", "B", "warning", "d1", 300)
+    assert outbox.emails == [] and c.held() == 3
+    c.stop()
+    assert sorted(outbox.emails) == [
+        ("a@x", "A", [("warning", "d1", 300), ("warning", "d2", 250)]),
+        ("b@x", "B", [("warning", "d1", 300)])]
+    assert c.stats() == {"held": 0, "alerts": 3, "merged": 1, "emails": 2}
+
+
+def test_most_severe_alert_per_device(outbox):
+    c = AlertCoalescer(outbox, window_s=60, critical_window_s=60).start()
+    c.add("a@x", "A", "warning", "d1", 300)
+    c.add("a@x", "A", "critical", "d1", 90)
+    c.add("a@x", "A", "warning", "d1", 280)    # less severe: dropped
+    c.add("a@x", "A", "critical", "d1", 80)    # tie: latest weight wins
+    c.stop()
+    assert outbox.emails == [("a@x", "A", [("critical", "d1", 80)])]
+
+
+def test_urgent_alert_shortens_hold(outbox):
+    c = AlertCoalescer(outbox, window_s=60, critical_window_s=0.05).start()
+    try:
+        c.add("a@x", "A", "warning", "d1", 300)
+        started = time.monotonic()
+        c.add("a@x", "A", "over", "d2")
+        assert outbox.sent.wait(2) and time.monotonic() - started < 1
+        assert outbox.emails == [("a@x", "A", [("warning", "d1", 300), ("over", "d2", None)])]
+    finally:
+        c.stop()
+
+
+def test_full_hold_sent_straight_away(outbox):
+    c = AlertCoalescer(outbox, window_s=60, max_alerts=2).start()
+    try:
+        c.add("a@x", "A", "warning", "d1", 300)
+        c.add("a@x", "A", "warning", "d2", 300)
+        assert outbox.sent.wait(2)
+        assert len(outbox.emails[0][2]) == 2 and c.held() == 0
+    finally:
+        c.stop()
@@ -0,0 +1,150 @@
+# tests/test_alert_state.py
+from datetime import datetime, timedelta
+
+import pytest
+
+import alert_state
+from alert_state import ALREADY_SENT, CLAIMED, UNAVAILABLE, AlertClaims
+from device_state import DeviceStateStore, StateRecord
+
+T0 = datetime(2025, 3, 1, 8, 0, 0)
+
+
+class UserFlags(StateRecord):
+    __slots__ = ("warning_sent", "critical_sent")
+
+    def __init__(self):
+        self.warning_sent = False
+        self.critical_sent = False
+
+
+class AlertTable:
+    """alert_state rows shared by every connection; `down` makes connect() and queries fail."""
+
+    def __init__(self):
+        self.rows = {}          # (user_id, alert_type) -> [sent_at, replica]
+        self.statements = 0
+        self.connections = []
+        self.down = False
+
+    def connect(self):
+        if self.down:
+            raise OSError("Can't connect to MySQL server")
+        conn = Connection(self)
+        self.connections.append(conn)
+        return conn
+
+
+class Connection:
+    def __init__(self, table):
+        self.table = table
+        self.pings = 0
+        self.closed = False
+
+    def ping(self):
+        self.pings += 1
+        if self.table.down:
+            raise OSError("MySQL server has gone away")
+
+    def cursor(self):
+        return Cursor(self.table)
+
+    def close(self):
+        self.closed = True
+
+
+class Cursor:
+    def __init__(self, table):
+        self.table = table
+        self.rowcount = 0
+
+    def execute(self, sql, params=()):
+        t = self.table
+        if t.down:
+            raise OSError("MySQL server has gone away")
+        t.statements += 1
+        if sql.startswith("INSERT IGNORE"):
+            user_id, alert_type, sent_at, replica = params
+            if (user_id, alert_type) not in t.rows:
+                t.rows[(user_id, alert_type)] = [sent_at, replica]
+                self.rowcount = 1
+        elif sql.startswith("UPDATE alert_state"):
+            sent_at, replica, user_id, alert_type, since = params
+            row = t.rows.get((user_id, alert_type))
+            if row is not None and row[0] < since:
+                row[:] = [sent_at, replica]
+                self.rowcount = 1
+        elif sql.startswith("DELETE FROM alert_state"):
+            for key in [k for k in t.rows if k[0] in params and k[1] in ("warning", "critical")]:
+                del t.rows[key]
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def table(clock):
+    clock.install(alert_state)
+    return AlertTable()
+
+
+def claims(table, replica="updates-0", ping_idle_s=30):
+    return AlertClaims(table.connect, DeviceStateStore(UserFlags), replica, ping_idle_s=ping_idle_s)
+
+
+def test_only_one_replica_claims_an_alert(table):
+    a, b = claims(table, "updates-0"), claims(table, "updates-1")
+    assert a.claim(1, "warning", T0) == CLAIMED
+    assert b.claim(1, "warning", T0) == ALREADY_SENT
+    assert table.rows[(1, "warning")] == [T0, "updates-0"]
+    assert (a.claimed, b.lost) == (1, 1)
+
+
+def test_cached_flag_answers_without_mysql(table):
+    a = claims(table)
+    assert not a.is_sent(1, "critical")
+    a.claim(1, "critical", T0)
+    assert a.is_sent(1, "critical") and not a.is_sent(1, "warning")
+
+
+def test_over_reclaimed_once_per_removal(table):
+    a, b = claims(table, "updates-0"), claims(table, "updates-1")
+    assert a.claim(1, "over", T0, since=T0) == CLAIMED
+    assert b.claim(1, "over", T0, since=T0) == ALREADY_SENT           # same removal
+    later = T0 + timedelta(hours=5)
+    assert b.claim(1, "over", later, since=later - timedelta(minutes=1)) == CLAIMED
+    assert a.claim(1, "over", later, since=later - timedelta(minutes=1)) == ALREADY_SENT
+    assert not a.is_sent(1, "over")                                     # never cached
+
+
+def test_refill_reset_lets_the_alert_go_out_again(table):
+    a, b = claims(table, "updates-0"), claims(table, "updates-1")
+    a.claim(1, "warning", T0)
+    a.claim(1, "over", T0, since=T0)
+    assert a.reset([1, 2]) == 1
+    assert (1, "over") in table.rows and (1, "warning") not in table.rows
+    assert b.claim(1, "warning", T0) == CLAIMED
+
+
+def test_fails_closed_while_mysql_is_down(table):
+    a = claims(table)
+    table.down = True
+    assert a.claim(1, "warning", T0) == UNAVAILABLE
+    assert not a.is_sent(1, "warning") and a.errors == 1 and a.claimed == 0
+    table.down = False
+    assert a.claim(1, "warning", T0) == CLAIMED                        # the next attempt reconnects
+
+
+def test_idle_connection_pinged_and_replaced(table, clock):
+    a = claims(table, ping_idle_s=30)
+    a.claim(1, "warning", T0)
+    clock.advance(10)
+    a.claim(2, "warning", T0)
+    assert table.connections[0].pings == 0
+    clock.advance(30)
+    table.down = True
+    assert a.claim(3, "warning", T0) == UNAVAILABLE
+    assert table.connections[0].pings == 1 and table.connections[0].closed
+    table.down = False
+    a.claim(3, "warning", T0)
+    assert len(table.connections) == 2
@@ -0,0 +1,210 @@
+# tests/test_async_engine.py
+import asyncio
+import json
+from datetime import datetime, timedelta
+
+from async_engine import AsyncAnalysisEngine, aiomysql_config
+from carton import CartonRemovalTracker
+from deadband import DeadbandFilter
+from dedup import DuplicateFilter
+from device_analytics import AnalyticsState
+from ingest_buffer import INSERT_WEIGHTS_SQL, BufferedReading, stored_key
+from main import parse_payload
+from metrics import Metrics
+from rollup import UPSERT_ROLLUP_SQL
+
+T0 = datetime(2025, 3, 1, 8, 0, 0)
+STATS_SQL = "UPSERT user_stats"
+
+
+class FakeMySQL:
+    """weight_data keys, rollup upserts and user_stats rows; only committed work is kept."""
+
+    def __init__(self, stored=()):
+        self.stored = set(stored)
+        self.rollup = []
+        self.stats = []
+        self.failures = 0
+        self.begins = 0
+
+    def acquire(self):
+        return FakeConnection(self)
+
+
+class FakeConnection:
+    def __init__(self, db):
+        self.db = db
+        self.pending = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def begin(self):
+        self.db.begins += 1
+        self.pending = ([], [], [])
+
+    async def commit(self):
+        weights, rollup, stats = self.pending or ([], [], [])
+        self.db.stored.update(weights)
+        self.db.rollup.extend(rollup)
+        self.db.stats.extend(stats)
+        self.pending = None
+
+    async def rollback(self):
+        self.pending = None
+
+    def cursor(self):
+        return FakeCursor(self)
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.rowcount = 0
+        self._rows = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def executemany(self, sql, seq):
+        db, seq = self.conn.db, list(seq)
+        if db.failures:
+            db.failures -= 1
+            raise OSError("MySQL server has gone away")
+        if self.conn.pending is None:   # autocommit
+            self.conn.pending = ([], [], [])
+        weights, rollup, stats = self.conn.pending
+        if sql == INSERT_WEIGHTS_SQL:
+            keys = [stored_key(d, ts) for d, _, ts in seq]
+            fresh = [k for i, k in enumerate(keys) if k not in db.stored and k not in keys[:i]]
+            weights.extend(fresh)
+            self.rowcount = len(fresh)
+        elif sql == UPSERT_ROLLUP_SQL:
+            rollup.extend(seq)
+        else:
+            assert sql == STATS_SQL
+            stats.extend(seq)
+
+    async def execute(self, sql, params=()):
+        assert sql.startswith("SELECT device_id, timestamp FROM weight_data")
+        keys = list(zip(params[::2], params[1::2]))
+        self._rows = [k for k in keys if k in self.conn.db.stored]
+
+    async def fetchall(self):
+        return self._rows
+
+
+def make_engine(db=None, **kw):
+    engine = AsyncAnalysisEngine(
+        mqtt_host="localhost", mqtt_port=1883, filters=["milk/weight"], base_topic="milk/weight",
+        protocol="3.1.1", mysql_config={"database": "milk"},
+        analytics=AnalyticsState(7, 5, 500, 200, 250), tracker=CartonRemovalTracker(60),
+        deadband=DeadbandFilter(deadband_g=0, heartbeat_s=0, median_window=1), parse=parse_payload,
+        stats_sql=STATS_SQL, metrics=Metrics(prefix="test"), dedup=DuplicateFilter(), **kw)
+    engine._pool = db or FakeMySQL()
+    return engine
+
+
+def run(engine, coro_fn):
+    """Run coro_fn() on a fresh loop with the events the engine creates in run()."""
+    async def main():
+        engine._loop = asyncio.get_running_loop()
+        engine._wake, engine._room, engine._stats_due = asyncio.Event(), asyncio.Event(), asyncio.Event()
+        engine._inflight = asyncio.Semaphore(engine.max_inflight)
+        return await coro_fn()
+    return asyncio.run(main())
+
+
+def rows(n, device_id="d", start=0):
+    return [BufferedReading(device_id, 1000.0 - i, T0 + timedelta(seconds=i), i, 1.0)
+            for i in range(start, start + n)]
+
+
+def test_aiomysql_config_renames_database():
+    assert aiomysql_config({"database": "milk", "user": "u"}) == {"db": "milk", "user": "u"}
+
+
+def test_batch_and_rollup_commit_in_one_transaction():
+    db = FakeMySQL()
+    engine = make_engine(db)
+    run(engine, lambda: engine._write(rows(3)))
+    assert len(db.stored) == 3 and db.begins == 1
+    (upsert,) = db.rollup
+    assert upsert[0] == "d" and upsert[8] == 3          # one (device, day) row covering three readings
+    assert engine.rows_flushed == 3 and engine.rows_skipped == 0
+    assert engine._dirty == {"d": 2}
+
+
+def test_already_stored_rows_stay_out_of_the_rollup():
+    batch = rows(3)
+    db = FakeMySQL(stored=[stored_key("d", batch[0].timestamp)])
+    engine = make_engine(db)
+    run(engine, lambda: engine._write(batch))
+    assert len(db.stored) == 3 and db.begins == 2       # rolled back and retried with the fresh rows
+    (upsert,) = db.rollup
+    assert upsert[8] == 2 and upsert[2] == batch[1].timestamp
+    assert engine.rows_skipped == 1
+
+
+def test_failed_batch_requeued_then_dropped():
+    db = FakeMySQL()
+    engine = make_engine(db, max_retries=1)
+    db.failures = 2
+    first, second = rows(2), rows(1, start=2)
+    engine._rows = list(second)
+
+    async def write_twice():
+        await engine._write(first)
+        assert engine._rows == first + second and engine.flush_retries == 1
+        assert engine._retry_at > 0
+        await engine._write(engine._take(2))
+    run(engine, write_twice)
+    assert engine.rows_failed == 2 and engine._rows == second
+    assert db.stored == set() and db.rollup == []
+
+
+def test_handle_buffers_readings_and_suppresses_duplicates():
+    engine = make_engine(batch_size=2)
+
+    async def body():
+        engine.handle("milk/weight/d1", json.dumps({"weight": 900, "message_id": "m1"}).encode())
+        engine.handle("milk/weight/d1", json.dumps({"weight": 900, "message_id": "m1"}).encode())
+        engine.handle("milk/weight/d1", b"not a reading")
+        assert len(engine._rows) == 1
+        engine._wake.clear()
+        engine.handle("milk/weight/d2", json.dumps({"weight": 500, "message_id": "m7"}).encode())
+        return engine._wake.is_set()
+    assert run(engine, body) is True                      # a full batch wakes the flusher
+    assert [(r.device_id, r.weight) for r in engine._rows] == [("d1", 900.0), ("d2", 500.0)]
+    assert engine.received == 4 and engine._dedup.suppressed == 1
+
+
+def test_carton_removal_held_by_a_grace_timer():
+    engine = make_engine()
+
+    async def body():
+        engine.handle("milk/weight/d", json.dumps({"weight": 800, "message_id": "m1"}).encode())
+        engine.handle("milk/weight/d", json.dumps({"weight": 0, "message_id": "m2"}).encode())
+        assert "d" in engine._timers and len(engine._rows) == 1
+        engine.handle("milk/weight/d", json.dumps({"weight": 790, "message_id": "m3"}).encode())
+        assert "d" not in engine._timers
+    run(engine, body)
+    assert [r.weight for r in engine._rows] == [800.0, 790.0]
+
+
+def test_stats_writer_upserts_dirty_devices():
+    db = FakeMySQL()
+    engine = make_engine(db)
+
+    async def body():
+        engine.save("d", 800.0, T0, 1)
+        await engine._write(engine._take(10))
+        await engine._write_stats()
+    run(engine, body)
+    assert [r[0] for r in db.stats] == ["d"] and engine._dirty == {}
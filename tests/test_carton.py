@@ -0,0 +1,63 @@
+# tests/test_carton.py
+from datetime import datetime, timedelta
+
+from carton import CartonRemovalTracker, PENDING, RETURNED, SAVE, STARTED
+
+T0 = datetime(2025, 3, 1, 8, 0)
+GRACE_S = 60
+
+
+def at(seconds: float) -> datetime:
+    return T0 + timedelta(seconds=seconds)
+
+
+def test_state_machine():
+    t = CartonRemovalTracker(GRACE_S, stripes=4)
+    assert t.observe("d", 950, at(0)) == SAVE
+    assert t.observe("d", 0, at(1)) == STARTED
+    assert t.observe("d", 0, at(2)) == PENDING
+    assert "d" in t and t.zero_since("d") == at(1) and t.deadline("d") == at(61)
+    assert t.observe("d", 940, at(3)) == RETURNED
+    assert "d" not in t and t.deadline("d") is None
+    assert t.observe("d", 940, at(4)) == SAVE
+
+
+def test_expire_only_the_running_removal():
+    t = CartonRemovalTracker(GRACE_S)
+    t.observe("d", 0, at(0))
+    assert not t.expire("d", at(-5))
+    assert t.expire("d", at(0))
+    assert not t.expire("d", at(0))              # already ended
+    t.observe("d", 0, at(10))
+    t.observe("d", 900, at(20))
+    assert not t.expire("d", at(10))             # carton came back
+
+
+def test_backlog_grace_boundary():
+    t = CartonRemovalTracker(GRACE_S)
+    stored = t.observe_backlog("d", [(950, at(0)), (0, at(10)), (0, at(70)), (900, at(80))], now=at(100))
+    # the 0g at exactly the deadline ends the grace period before it is observed
+    assert stored == [(950, at(0)), (0.0, at(70)), (900, at(80))]
+    assert len(t) == 0
+
+
+def test_backlog_removal_cancelled_inside_grace():
+    t = CartonRemovalTracker(GRACE_S)
+    stored = t.observe_backlog("d", [(0, at(0)), (0, at(59.9)), (900, at(59.95))], now=at(100))
+    assert stored == [(900, at(59.95))]
+
+
+def test_backlog_removal_still_running():
+    t = CartonRemovalTracker(GRACE_S)
+    assert t.observe_backlog("d", [(950, at(0)), (0, at(10))], now=at(69)) == [(950, at(0))]
+    assert t.pending() == [("d", at(10))]
+    assert t.observe_backlog("d", [], now=at(70)) == [(0.0, at(70))]
+
+
+def test_dump_load():
+    t = CartonRemovalTracker(GRACE_S)
+    t.observe("a", 0, at(0))
+    t.observe("b", 0, at(5))
+    restored = CartonRemovalTracker(GRACE_S, stripes=8)
+    assert restored.load(t.dump()) == 2
+    assert sorted(restored.pending()) == [("a", at(0)), ("b", at(5))]
@@ -0,0 +1,171 @@
+# tests/test_db_pool.py
+import threading
+import time
+
+import pytest
+
+import db_pool
+from db_pool import ConnectionPool, PoolTimeout
+
+
+class FakeRaw:
+    def __init__(self):
+        self.in_transaction = False
+        self.closed = False
+        self.connected = True
+        self.rollbacks = 0
+        self.fail_rollback = False
+        self.cursors = []
+
+    def cursor(self, prepared=False, **kwargs):
+        cur = FakeCursor(prepared)
+        self.cursors.append(cur)
+        return cur
+
+    def start_transaction(self):
+        self.in_transaction = True
+
+    def commit(self):
+        self.in_transaction = False
+
+    def rollback(self):
+        if self.fail_rollback:
+            raise OSError("connection lost")
+        self.rollbacks += 1
+        self.in_transaction = False
+
+    def is_connected(self):
+        return self.connected
+
+    def close(self):
+        self.closed = True
+
+
+class FakeCursor:
+    def __init__(self, prepared):
+        self.prepared = prepared
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def opened(monkeypatch):
+    raws = []
+
+    def connect(**config):
+        raws.append(FakeRaw())
+        return raws[-1]
+
+    monkeypatch.setattr(db_pool.mysql.connector, "connect", connect)
+    return raws
+
+
+def test_connections_are_reused(opened):
+    pool = ConnectionPool({}, size=2)
+    for _ in range(3):
+        with pool.connection():
+            pass
+    assert len(opened) == 1
+    assert pool.stats()["checkouts"] == 3
+
+
+def test_open_transaction_rolled_back_on_checkin(opened):
+    pool = ConnectionPool({}, size=1)
+    with pool.connection() as conn:
+        conn.start_transaction()
+    assert opened[0].rollbacks == 1 and not opened[0].in_transaction
+    assert pool.stats()["rolled_back"] == 1 and pool.stats()["idle"] == 1
+
+    with pool.connection() as conn:
+        conn.start_transaction()
+        conn.commit()
+    assert opened[0].rollbacks == 1
+
+
+def test_failed_rollback_discards_the_connection(opened):
+    pool = ConnectionPool({}, size=1)
+    with pool.connection() as conn:
+        conn.start_transaction()
+        opened[0].fail_rollback = True
+    assert opened[0].closed
+    assert pool.stats()["open"] == 0 and pool.stats()["discarded"] == 1
+    with pool.connection():
+        pass
+    assert len(opened) == 2
+
+
+def test_block_that_raises_discards(opened):
+    pool = ConnectionPool({}, size=1)
+    with pytest.raises(ValueError):
+        with pool.connection():
+            raise ValueError("boom")
+    assert opened[0].closed and pool.stats()["open"] == 0
+
+
+def test_prepared_cursor_cached_per_statement(opened):
+    pool = ConnectionPool({}, size=1)
+    with pool.connection() as conn:
+        first = conn.prepared("SELECT 1")
+        assert conn.prepared("SELECT 1") is first and first.prepared
+        other = conn.prepared("SELECT 2")
+    with pool.connection() as conn:
+        assert conn.prepared("SELECT 1") is first
+    pool.close()
+    assert first.closed and other.closed and opened[0].closed
+
+
+def test_overflow_closed_when_returned(opened):
+    pool = ConnectionPool({}, size=1, max_overflow=1)
+    with pool.connection():
+        with pool.connection():
+            assert pool.stats()["open"] == 2
+    assert pool.stats()["open"] == 1 and pool.stats()["idle"] == 1
+    assert sum(raw.closed for raw in opened) == 1
+
+
+def test_recycled_and_pinged_on_checkout(opened, clock):
+    clock.install(db_pool)
+    pool = ConnectionPool({}, size=1, recycle_s=100, pre_ping_idle_s=10)
+    with pool.connection():
+        pass
+    clock.advance(20)
+    opened[0].connected = False
+    with pool.connection():
+        pass
+    assert pool.stats()["health_check_failures"] == 1 and len(opened) == 2
+    clock.advance(100)
+    with pool.connection():
+        pass
+    assert pool.stats()["recycled"] == 1 and len(opened) == 3
+
+
+def test_exhausted_pool_times_out(opened):
+    pool = ConnectionPool({}, size=1, max_overflow=0, timeout_s=0)
+    with pool.connection():
+        with pytest.raises(PoolTimeout):
+            with pool.connection():
+                pass
+    assert pool.stats()["timeouts"] == 1
+
+
+def test_waiter_gets_slot_freed_by_discard(opened):
+    pool = ConnectionPool({}, size=1, max_overflow=0, timeout_s=5)
+    got = []
+    holding = threading.Event()
+
+    def waiter():
+        holding.wait()
+        with pool.connection():
+            got.append(True)
+
+    t = threading.Thread(target=waiter)
+    t.start()
+    with pytest.raises(RuntimeError):
+        with pool.connection():
+            holding.set()
+            time.sleep(0.05)   # let the waiter block on the exhausted pool
+            raise RuntimeError("broken connection")
+    t.join(5)
+    assert got == [True] and pool.stats()["timeouts"] == 0
@@ -0,0 +1,65 @@
+# tests/test_deadband.py
+from datetime import datetime, timedelta
+
+from deadband import DeadbandFilter
+
+T0 = datetime(2025, 3, 1, 8, 0)
+
+
+def at(seconds: float) -> datetime:
+    return T0 + timedelta(seconds=seconds)
+
+
+def test_deadband_is_exclusive():
+    f = DeadbandFilter(deadband_g=3.0, heartbeat_s=0, median_window=1)
+    assert f.filter("d", 950.0, at(0)) == 950.0
+    assert f.filter("d", 953.0, at(1)) is None        # moved exactly deadband_g
+    assert f.filter("d", 947.0, at(2)) is None
+    assert f.filter("d", 953.5, at(3)) == 953.5
+    assert f.stats() == {"devices": 1, "passed": 2, "suppressed": 2}
+
+
+def test_heartbeat_is_inclusive():
+    f = DeadbandFilter(deadband_g=3.0, heartbeat_s=600, median_window=1)
+    f.filter("d", 950.0, at(0))
+    assert f.filter("d", 950.0, at(599.9)) is None
+    assert f.filter("d", 950.0, at(600)) == 950.0
+    assert f.filter("d", 950.0, at(1199)) is None
+
+
+def test_zero_deadband_stores_every_change():
+    f = DeadbandFilter(deadband_g=0, heartbeat_s=0, median_window=1)
+    f.filter("d", 950.0, at(0))
+    assert f.filter("d", 950.0, at(1)) is None
+    assert f.filter("d", 950.01, at(2)) == 950.01
+
+
+def test_negative_deadband_disables():
+    f = DeadbandFilter(deadband_g=-1, median_window=3)
+    assert [f.filter("d", w, at(i)) for i, w in enumerate([950, 950, 5000])] == [950, 950, 5000]
+    assert len(f) == 0
+
+
+def test_median_drops_single_spike():
+    f = DeadbandFilter(deadband_g=3.0, heartbeat_s=0, median_window=3)
+    assert f.filter("d", 950.0, at(0)) == 950.0
+    assert f.filter("d", 5000.0, at(1)) is None        # lower median of [950, 5000] is 950
+    assert f.filter("d", 949.0, at(2)) is None         # median 950
+    assert f.filter("d", 700.0, at(3)) is None         # median of [5000, 949, 700] is 949
+    assert f.filter("d", 700.0, at(4)) == 700.0        # a real step shows up one reading later
+
+
+def test_zero_bypasses_filter_and_clears_window():
+    f = DeadbandFilter(deadband_g=3.0, heartbeat_s=0, median_window=3)
+    f.filter("d", 950.0, at(0))
+    assert f.filter("d", 0.0, at(1)) == 0.0
+    assert f.filter("d", 0.0, at(2)) == 0.0
+    assert f.filter("d", 1000.0, at(3)) == 1000.0       # carton back: stored straight away
+
+
+def test_devices_are_independent():
+    f = DeadbandFilter(deadband_g=3.0, heartbeat_s=0, median_window=1)
+    f.filter("a", 950.0, at(0))
+    assert f.filter("b", 950.0, at(0)) == 950.0
+    f.forget("a")
+    assert f.filter("a", 950.0, at(1)) == 950.0
@@ -0,0 +1,72 @@
+# tests/test_deadline_scheduler.py
+import time
+import threading
+
+import pytest
+
+from deadline_scheduler import DeadlineScheduler
+
+
+@pytest.fixture
+def scheduler():
+    s = DeadlineScheduler(name="test-scheduler").start()
+    yield s
+    s.stop()
+
+
+def test_fires_in_deadline_order(scheduler):
+    fired = []
+    done = threading.Event()
+    scheduler.schedule("c", 0.06, lambda: (fired.append("c"), done.set()))
+    scheduler.schedule("a", 0.02, fired.append, "a")
+    scheduler.schedule("b", 0.04, fired.append, "b")
+    assert done.wait(2)
+    assert fired == ["a", "b", "c"] and scheduler.fired == 3 and scheduler.pending() == 0
+
+
+def test_reschedule_replaces_timer(scheduler):
+    fired = []
+    done = threading.Event()
+    scheduler.schedule("k", 0.01, fired.append, "first")
+    scheduler.schedule("k", 0.05, lambda: (fired.append("second"), done.set()))
+    assert scheduler.pending() == 1
+    assert done.wait(2)
+    assert fired == ["second"]
+
+
+def test_cancel(scheduler):
+    fired = []
+    done = threading.Event()
+    scheduler.schedule("k", 0.02, fired.append, "k")
+    scheduler.schedule("last", 0.05, done.set)
+    assert 0 < scheduler.remaining("k") <= 0.02
+    assert scheduler.cancel("k")
+    assert not scheduler.cancel("k")
+    assert scheduler.remaining("k") is None
+    assert done.wait(2)
+    assert fired == [] and scheduler.cancelled == 1
+
+
+def test_callback_error_does_not_stop_the_thread(scheduler, capsys):
+    done = threading.Event()
+    scheduler.schedule("bad", 0, lambda: 1 / 0)
+    scheduler.schedule("good", 0.02, done.set)
+    assert done.wait(2)
+    assert "division by zero" in capsys.readouterr().out
+
+
+def test_heap_compacted_under_churn():
+    s = DeadlineScheduler()   # not started: nothing fires
+    for i in range(1000):
+        s.schedule(i, 60, print)
+        s.cancel(i)
+    assert s.pending() == 0 and len(s._heap) <= 64 + 1
+
+
+def test_stop_drops_pending():
+    s = DeadlineScheduler().start()
+    fired = []
+    s.schedule("k", 0.05, fired.append, "k")
+    s.stop()
+    time.sleep(0.1)
+    assert fired == []
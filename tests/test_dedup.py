@@ -0,0 +1,68 @@
+# tests/test_dedup.py
+import pytest
+
+import dedup
+from dedup import DuplicateFilter
+
+
+@pytest.fixture(autouse=True)
+def fake_time(clock):
+    clock.install(dedup)
+
+
+def test_redelivery_suppressed():
+    f = DuplicateFilter(window_s=10)
+    assert not f.seen("d", "m1", "2025-03-01T08:00:00")
+    assert f.seen("d", "m1", "2025-03-01T08:00:00")
+    assert f.stats() == {"keys": 1, "checked": 2, "suppressed": 1, "rotations": 0}
+
+
+def test_key_is_device_message_and_timestamp():
+    f = DuplicateFilter(window_s=10)
+    f.seen("d", "m1", 1)
+    assert not f.seen("d", "m1", 2)        # sequence restarted after a reboot
+    assert not f.seen("other", "m1", 1)
+    assert not f.seen("d", "m2", 1)
+
+
+def test_readings_without_message_id_never_suppressed():
+    f = DuplicateFilter(window_s=10)
+    for message_id in (None, "unknown", None, "unknown"):
+        assert not f.seen("d", message_id, 1)
+    assert len(f) == 0
+
+
+def test_disabled():
+    f = DuplicateFilter(window_s=0)
+    assert not f.seen("d", "m1", 1)
+    assert not f.seen("d", "m1", 1)
+
+
+def test_window(clock):
+    f = DuplicateFilter(window_s=10)
+    f.seen("d", "m1", 1)
+    clock.advance(10)                      # rotates: m1 moves to the previous generation
+    assert f.seen("d", "m1", 1)
+    clock.advance(9.9)
+    assert f.seen("d", "m1", 1)
+    clock.advance(0.1)                     # second rotation drops it
+    assert not f.seen("d", "m1", 1)
+    assert f.rotations == 2
+
+
+def test_stale_current_generation_dropped(clock):
+    f = DuplicateFilter(window_s=10)
+    f.seen("d", "m1", 1)
+    clock.advance(20)                      # a whole window with no traffic at all
+    assert not f.seen("d", "m1", 1)
+
+
+def test_full_generation_rotates_early():
+    f = DuplicateFilter(window_s=600, max_keys=4)
+    for m in ("m1", "m2", "m3"):
+        f.seen("d", m, 1)
+    assert f.rotations == 1 and f.seen("d", "m1", 1)
+    f.seen("d", "m4", 1)
+    f.seen("d", "m5", 1)
+    assert f.rotations == 2 and not f.seen("d", "m1", 1)
+    assert len(f) <= 4
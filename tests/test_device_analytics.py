@@ -0,0 +1,185 @@
+# tests/test_device_analytics.py
+from datetime import datetime, timedelta
+
+import pytest
+
+import device_analytics
+from device_analytics import (AnalyticsState, DEVICE_READINGS_SQL, DEVICE_ROLLUP_DAYS_SQL, DEVICE_ROLLUP_MAX_SQL,
+                              READINGS_SQL, ROLLUP_DAYS_SQL, ROLLUP_MAX_SQL, derive_stats, user_stats_row)
+
+NOW = datetime(2025, 3, 8, 12, 0, 0)
+TODAY = NOW.date()
+
+
+def state(**kwargs):
+    settings = dict(window_days=7, cup_min_g=100, cup_max_g=300, cup_default_g=250, daily_default_g=500)
+    settings.update(kwargs)
+    return AnalyticsState(**settings)
+
+
+class FakeConnection:
+    """Answers each fixed query with canned rows; records what was asked."""
+
+    def __init__(self, answers):
+        self.answers = answers
+        self.executed = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def prepared(self, sql):
+        return FakeCursor(self)
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self._rows = []
+
+    def execute(self, sql, params=()):
+        self.conn.executed.append((sql, params))
+        self._rows = list(self.conn.answers.get(sql, []))
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def close(self):
+        pass
+
+
+def test_cup_and_daily_from_readings():
+    st = state()
+    t = NOW - timedelta(days=1)
+    for i, w in enumerate([1000, 800, 600, 590]):
+        st.add_reading("d", w, t + timedelta(hours=i))
+    current, cup, daily, baseline = st.snapshot("d", NOW)
+    assert current == 590 and cup == 200   # the 10g wobble is below cup_min_g
+    assert daily == 410 and baseline == 1000
+
+
+def test_unknown_device_gets_defaults():
+    assert state().snapshot("nope", NOW) == (None, 250, 500, None)
+
+
+def test_old_drops_leave_the_window():
+    st = state()
+    st.add_reading("d", 1000, NOW - timedelta(days=9))
+    st.add_reading("d", 800, NOW - timedelta(days=8, hours=23))
+    st.add_reading("d", 800, NOW - timedelta(hours=1))
+    assert st.snapshot("d", NOW)[1] == 250
+
+
+def test_lookback_baseline_uses_recent_days_only():
+    st = state(baseline_days=3)
+    st.add_reading("d", 1200, NOW - timedelta(days=5))
+    st.add_reading("d", 900, NOW - timedelta(days=1))
+    assert st.snapshot("d", NOW)[3] == 900
+
+
+def test_warm_takes_daily_and_baseline_from_the_rollup():
+    days = [("d1", TODAY - timedelta(days=2), 400.0, 900.0, 12),
+            ("d1", TODAY - timedelta(days=1), 300.0, 600.0, 8),
+            ("d1", TODAY, 250.0, 250.0, 1),        # one reading: not a consumption day
+            ("d2", TODAY - timedelta(days=3), 100.0, 300.0, 4)]
+    conn = FakeConnection({
+        ROLLUP_DAYS_SQL: days,
+        ROLLUP_MAX_SQL: [("d1", 1100.0), ("d2", 300.0), ("d3", 950.0)],
+        READINGS_SQL: [("d1", 450.0, NOW - timedelta(hours=3)), ("d1", 250.0, NOW - timedelta(hours=1))],
+    })
+    st = state()
+    assert st.warm(conn, NOW) == 2
+    assert [sql for sql, _ in conn.executed] == [ROLLUP_DAYS_SQL, ROLLUP_MAX_SQL, READINGS_SQL]
+    assert conn.executed[0][1] == ((NOW - timedelta(days=7)).date(),)
+    assert conn.executed[2][1] == (NOW - timedelta(days=7),)
+
+    current, cup, daily, baseline = st.snapshot("d1", NOW)
+    assert (current, cup) == (250.0, 200.0)
+    assert daily == 400.0               # (500 + 300) / 2 from the rollup, not the two raw readings
+    assert baseline == 1100.0           # all-time maximum, older than the window
+    assert st.snapshot("d2", NOW)[2] == 200.0
+    assert st.snapshot("d3", NOW)[3] == 950.0 and "d3" in st
+
+
+def test_warm_with_lookback_reads_no_all_time_max():
+    conn = FakeConnection({ROLLUP_DAYS_SQL: [("d1", TODAY - timedelta(days=10), 100.0, 700.0, 3)]})
+    st = state(baseline_days=14)
+    st.warm(conn, NOW)
+    assert ROLLUP_MAX_SQL not in [sql for sql, _ in conn.executed]
+    assert conn.executed[0][1] == ((NOW - timedelta(days=14)).date(),)
+    assert st.snapshot("d1", NOW)[3] == 700.0
+
+
+def test_readings_after_warm_extend_the_rollup_days():
+    conn = FakeConnection({ROLLUP_DAYS_SQL: [("d1", TODAY, 600.0, 900.0, 5)]})
+    st = state()
+    st.warm(conn, NOW)
+    st.add_reading("d1", 400.0, NOW)
+    assert st.export()["d1"][4] == {TODAY: [400.0, 900.0, 6]}
+
+
+def test_reload_device_matches_warm():
+    days = [(TODAY - timedelta(days=1), 300.0, 700.0, 6)]
+    readings = [(700.0, NOW - timedelta(hours=5)), (500.0, NOW - timedelta(hours=2))]
+    conn = FakeConnection({
+        DEVICE_ROLLUP_DAYS_SQL: days,
+        DEVICE_ROLLUP_MAX_SQL: [(1000.0,)],
+        DEVICE_READINGS_SQL: readings,
+    })
+    st = state()
+    assert st.reload_device(conn, "d1", NOW) == 2
+    assert st.snapshot("d1", NOW) == (500.0, 200.0, 400.0, 1000.0)
+
+    warm = FakeConnection({
+        ROLLUP_DAYS_SQL: [("d1", *days[0])],
+        ROLLUP_MAX_SQL: [("d1", 1000.0)],
+        READINGS_SQL: [("d1", *r) for r in readings],
+    })
+    other = state()
+    other.warm(warm, NOW)
+    assert other.snapshot("d1", NOW) == st.snapshot("d1", NOW)
+
+
+def test_apply_rollup_replaces_days_and_raises_baseline():
+    st = state()
+    st.add_reading("d", 500.0, NOW)
+    st.apply_rollup("d", [(TODAY, 200.0, 800.0, 4)], 1200.0)
+    _, _, daily, baseline = st.snapshot("d", NOW)
+    assert (daily, baseline) == (600.0, 1200.0)
+    st.apply_rollup("d", [], 900.0)
+    assert st.snapshot("d", NOW)[3] == 1200.0
+
+
+def test_sweep_evicts_idle_devices(clock):
+    clock.install(device_analytics)
+    st = state(idle_ttl_s=60)
+    st.add_reading("old", 500, NOW)
+    clock.advance(30)
+    st.add_reading("new", 500, NOW)
+    clock.advance(31)
+    assert st.sweep() == 1
+    assert "old" not in st and "new" in st and st.evicted == 1
+
+
+@pytest.mark.parametrize("current, baseline, expected", [
+    (500.0, 1000.0, (2, 50.0, TODAY + timedelta(days=2))),
+    (500.0, None, (2, 50.0, TODAY + timedelta(days=2))),    # assumed 1000g full
+    (1500.0, 1000.0, (7, 100.0, TODAY + timedelta(days=7))),
+    (0.0, 1000.0, (0, 0.0, None)),
+])
+def test_derive_stats(current, baseline, expected):
+    assert derive_stats(current, 200.0, 200.0, baseline, TODAY) == expected
+
+
+def test_user_stats_row():
+    st = state()
+    st.add_reading("d", 1000, NOW - timedelta(hours=2))
+    st.add_reading("d", 800, NOW - timedelta(hours=1))
+    row = user_stats_row(st, "d", NOW)
+    assert row[:5] == ("d", 800.0, 200.0, 4, 80.0)
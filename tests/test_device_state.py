@@ -0,0 +1,104 @@
+# tests/test_device_state.py
+import pytest
+
+import device_state
+import snapshot
+from device_state import DeviceStateStore, StateRecord
+
+
+class Rec(StateRecord):
+    __slots__ = ("value", "pinned")
+
+    def __init__(self):
+        self.value = 0
+        self.pinned = False
+
+
+@pytest.fixture(autouse=True)
+def fake_time(clock):
+    clock.install(device_state)
+
+
+def put(store, key, value=0):
+    with store.locked(key) as rec:
+        rec.value = value
+
+
+def test_locked_creates_and_get_does_not():
+    store = DeviceStateStore(Rec, stripes=4)
+    assert store.get("a") is None
+    with store.locked("a", create=False) as rec:
+        assert rec is None
+    put(store, "a", 5)
+    assert store.get("a").value == 5 and "a" in store and len(store) == 1
+    assert store.pop("a").value == 5 and store.pop("a") is None
+
+
+def test_lru_cap():
+    store = DeviceStateStore(Rec, stripes=1, max_records=2)
+    put(store, "a")
+    put(store, "b")
+    put(store, "a")          # refreshes a
+    put(store, "c")          # evicts b, the least recently used
+    assert sorted(store.keys()) == ["a", "c"] and store.evicted_lru == 1
+
+
+def test_ttl_on_insert_and_sweep(clock):
+    store = DeviceStateStore(Rec, stripes=1, ttl_s=10)
+    put(store, "a")
+    clock.advance(5)
+    put(store, "b")
+    clock.advance(5)         # a is exactly ttl_s old: kept
+    put(store, "c")
+    assert len(store) == 3
+    clock.advance(0.1)
+    put(store, "d")          # insert evicts a
+    assert "a" not in store and store.evicted_ttl == 1
+    clock.advance(10)
+    assert store.sweep() == 2 and sorted(store.keys()) == ["d"]
+
+
+def test_get_does_not_refresh(clock):
+    store = DeviceStateStore(Rec, stripes=1, ttl_s=10)
+    put(store, "a")
+    clock.advance(8)
+    store.get("a")
+    clock.advance(8)
+    assert store.sweep() == 1
+
+
+def test_kept_records_are_not_evicted(clock):
+    store = DeviceStateStore(Rec, stripes=1, max_records=1, ttl_s=10, keep=lambda r: r.pinned)
+    with store.locked("a") as rec:
+        rec.pinned = True
+    put(store, "b")
+    clock.advance(60)
+    store.sweep()
+    assert store.keys() == ["a"]
+
+
+def test_dump_load_round_trip(clock):
+    store = DeviceStateStore(Rec, stripes=2)
+    put(store, "a", 1)
+    clock.advance(3)
+    put(store, ("b", 2), 2)
+    data = snapshot.loads(snapshot.dumps({"s": store.dump()}))[1]["s"]   # tuple keys come back as lists
+    restored = DeviceStateStore(Rec, stripes=1, max_records=1)
+    assert restored.load(data) == 2
+    # the cap keeps the most recently used record
+    assert restored.keys() == [("b", 2)] and restored.get(("b", 2)).value == 2
+
+
+def test_load_matches_fields_by_name():
+    data = {"fields": ["gone", "value"], "records": [["a", 0.0, ["old", 7]]]}
+    store = DeviceStateStore(Rec)
+    store.load(data)
+    rec = store.get("a")
+    assert rec.value == 7 and rec.pinned is False and not hasattr(rec, "gone")
+
+
+def test_loaded_idle_time_counts_toward_ttl():
+    store = DeviceStateStore(Rec, ttl_s=10)
+    assert store.load({"fields": ["value"], "records": [["old", 11.0, [1]], ["new", 1.0, [2]]]}) == 2
+    assert store.keys() == ["new"]
+
@@ -0,0 +1,123 @@
+# tests/test_email_dispatch.py
+import smtplib
+import time
+from email.message import EmailMessage
+
+from email_dispatch import EmailDispatcher
+
+
+class FakeSMTP:
+    """One session; `script` is shared by all sessions: exceptions to raise on the next sends."""
+
+    def __init__(self, server):
+        self.server = server
+        self.open = True
+
+    def send_message(self, msg):
+        if self.server.script:
+            raise self.server.script.pop(0)
+        self.server.delivered.append((id(self), msg["To"]))
+
+    def quit(self):
+        self.open = False
+        self.server.quits += 1
+
+
+class FakeServer:
+    def __init__(self, *script):
+        self.script = list(script)
+        self.delivered = []
+        self.sessions = []
+        self.quits = 0
+
+    def connect(self):
+        session = FakeSMTP(self)
+        self.sessions.append(session)
+        return session
+
+
+def message(to="alice@example.com"):
+    msg = EmailMessage()
+    msg["To"] = to
+    msg["Subject"] = "Milk is low"
+    return msg
+
+
+def wait_for(predicate, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.005)
+
+
+def test_messages_share_one_session():
+    server = FakeServer()
+    d = EmailDispatcher(server.connect, workers=1).start()
+    for i in range(3):
+        assert d.submit(message(f"u{i}@example.com"), "low alert")
+    d.stop()
+    assert len(server.delivered) == 3 and len({s for s, _ in server.delivered}) == 1
+    assert d.stats()["sessions_opened"] == 1 and server.quits == 1
+
+
+def test_session_recycled_after_max_messages():
+    server = FakeServer()
+    d = EmailDispatcher(server.connect, workers=1, session_max_messages=2).start()
+    for _ in range(5):
+        d.submit(message())
+    d.stop()
+    assert d.sent == 5 and d.sessions_opened == 3
+
+
+def test_dropped_reused_session_resent_on_a_fresh_one():
+    server = FakeServer()
+    d = EmailDispatcher(server.connect, workers=1).start()
+    d.submit(message())
+    wait_for(lambda: d.sent == 1)
+    server.script = [smtplib.SMTPServerDisconnected("idle timeout")]
+    d.submit(message())
+    d.stop()
+    assert d.sent == 2 and d.retried == 0 and d.sessions_opened == 2
+
+
+def test_transient_failure_retried_after_backoff():
+    server = FakeServer(smtplib.SMTPConnectError(421, b"try later"))
+    d = EmailDispatcher(server.connect, workers=1, backoff_s=0.01).start()
+    d.submit(message())
+    wait_for(lambda: d.sent == 1)
+    d.stop()
+    assert d.retried == 1 and d.failed == 0
+
+
+def test_permanent_failure_not_retried():
+    server = FakeServer(smtplib.SMTPResponseException(550, b"no such user"))
+    d = EmailDispatcher(server.connect, workers=1, backoff_s=0.01).start()
+    d.submit(message())
+    wait_for(lambda: d.failed == 1)
+    d.stop()
+    assert d.retried == 0 and server.delivered == []
+
+
+def test_gives_up_after_max_attempts():
+    server = FakeServer(*[OSError("connection refused")] * 2)
+    d = EmailDispatcher(server.connect, workers=1, max_attempts=2, backoff_s=0.01).start()
+    d.submit(message())
+    wait_for(lambda: d.failed == 1)
+    d.stop()
+    assert d.retried == 1 and d.sent == 0
+
+
+def test_full_queue_drops_new_messages():
+    d = EmailDispatcher(FakeServer().connect, queue_max=1)   # not started: nothing drains the queue
+    assert d.submit(message())
+    assert not d.submit(message())
+    assert d.stats()["dropped"] == 1 and d.depth() == 1
+
+
+def test_dry_run_opens_no_session():
+    server = FakeServer()
+    d = EmailDispatcher(server.connect, dry_run=True).start()
+    d.submit(message())
+    d.stop()
+    assert d.sent == 1 and server.sessions == []
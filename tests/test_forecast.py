@@ -0,0 +1,74 @@
+# tests/test_forecast.py
+from datetime import datetime
+
+import pytest
+
+from forecast import HOURS, UsageForecast, predict_empty_at
+
+FLAT = [1.0] * HOURS
+MIDNIGHT = datetime(2025, 3, 1)
+
+
+@pytest.mark.parametrize("daily_g, current_g", [(None, 100), (0, 100), (240, 0), (240, -5)])
+def test_no_forecast_without_usage_or_milk(daily_g, current_g):
+    assert predict_empty_at(FLAT, daily_g, current_g, MIDNIGHT, 30) is None
+
+
+def test_flat_profile():
+    # 240 g/day on a flat profile is 10 g/h
+    assert predict_empty_at(FLAT, 240, 25, datetime(2025, 3, 1, 10, 30), 30) == datetime(2025, 3, 1, 13, 0)
+    assert predict_empty_at(FLAT, 240, 240, MIDNIGHT, 30) == datetime(2025, 3, 2)   # a full day's worth
+    assert predict_empty_at(FLAT, 240, 241, MIDNIGHT, 30) == datetime(2025, 3, 2, 0, 6)
+
+
+def test_empty_profile_spreads_evenly():
+    assert predict_empty_at([0.0] * HOURS, 240, 25, datetime(2025, 3, 1, 10, 30), 30) == datetime(2025, 3, 1, 13, 0)
+
+
+def test_skips_hours_without_usage():
+    profile = [0.0] * HOURS
+    profile[8] = 1.0    # all 200 g/day go at 08:00-09:00
+    assert predict_empty_at(profile, 200, 100, datetime(2025, 3, 1, 12), 30) == datetime(2025, 3, 2, 8, 30)
+
+
+def test_horizon():
+    now = datetime(2025, 3, 1, 12)
+    assert predict_empty_at(FLAT, 240, 240 * 3, now, 3) is None
+    assert predict_empty_at(FLAT, 240, 240 * 3 - 120, now, 3) == datetime(2025, 3, 4)
+
+
+def test_first_day_is_not_learned():
+    fc = UsageForecast()
+    fc.observe(datetime(2025, 3, 1, 8), 200, alpha=0.5)
+    fc.observe(datetime(2025, 3, 2, 8), 100, alpha=0.5)   # closes the partial first day
+    assert fc.daily_g is None
+    fc.observe(datetime(2025, 3, 2, 20), 50, alpha=0.5)
+    fc.observe(datetime(2025, 3, 3, 8), 0, alpha=0.5)     # first whole day taken as is
+    assert fc.daily_g == 150 and fc.profile[8] == 100 and fc.profile[20] == 50
+    fc.observe(datetime(2025, 3, 4, 8), 0, alpha=0.5)     # then smoothed
+    assert fc.daily_g == 75 and fc.profile[8] == 50
+
+
+def test_older_day_ignored():
+    fc = UsageForecast()
+    fc.observe(datetime(2025, 3, 2, 8), 100, alpha=0.5)
+    fc.observe(datetime(2025, 3, 1, 9), 100, alpha=0.5)
+    assert fc.day == datetime(2025, 3, 2).date() and sum(fc.today) == 100
+
+
+def test_forecast_cached_until_model_changes():
+    fc = UsageForecast()
+    now = datetime(2025, 3, 1, 10, 30)
+    first = fc.forecast(25, 240, now, 30)
+    assert first == datetime(2025, 3, 1, 13, 0)
+    assert fc.forecast(25, 240, datetime(2025, 3, 1, 12), 30) == first      # cached
+    fc.observe(datetime(2025, 3, 1, 12), 0, alpha=0.5)
+    assert fc.forecast(25, 240, datetime(2025, 3, 1, 12), 30) == datetime(2025, 3, 1, 14, 30)
+
+
+def test_export_restore():
+    fc = UsageForecast()
+    for day in (1, 2, 3):
+        fc.observe(datetime(2025, 3, day, 8), 120, alpha=0.3)
+    restored = UsageForecast.restore(fc.export())
+    assert restored.export() == fc.export()
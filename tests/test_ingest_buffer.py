@@ -0,0 +1,160 @@
+# tests/test_ingest_buffer.py
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import ingest_buffer
+from ingest_buffer import INSERT_WEIGHTS_SQL, WeightWriteBuffer
+
+T0 = datetime(2025, 3, 1, 8, 0, 0)
+
+
+class Recorder:
+    """Connection factory that keeps committed batches; `failures` makes the next N writes raise."""
+
+    def __init__(self):
+        self.batches = []
+        self.failures = 0
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        yield self
+
+    def start_transaction(self):
+        self._pending = []
+
+    def cursor(self):
+        return self
+
+    def executemany(self, sql, seq):
+        assert sql == INSERT_WEIGHTS_SQL
+        with self.lock:
+            if self.failures:
+                self.failures -= 1
+                raise OSError("MySQL server has gone away")
+        self._pending = list(seq)
+        self.rowcount = len(self._pending)
+
+    def commit(self):
+        with self.lock:
+            self.batches.append(self._pending)
+
+    def rollback(self):
+        self._pending = []
+
+    def close(self):
+        pass
+
+    def stored(self):
+        return [row for batch in self.batches for row in batch]
+
+
+def add(buf, n, start=0, device_id="d"):
+    for i in range(start, start + n):
+        buf.add(device_id, 1000 - i, T0 + timedelta(seconds=i), msg_num=i)
+
+
+def wait_for(predicate, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+def test_flush_writes_one_ordered_batch():
+    db = Recorder()
+    flushed, observed = [], []
+    buf = WeightWriteBuffer(db.connection, on_flush=lambda conn, rows: flushed.append(rows),
+                            observe=lambda stage, s: observed.append(stage))
+    add(buf, 3)
+    assert db.batches == [] and buf.pending() == 3
+    buf.flush()
+    assert db.batches == [[("d", 1000.0, T0), ("d", 999.0, T0 + timedelta(seconds=1)),
+                           ("d", 998.0, T0 + timedelta(seconds=2))]]
+    assert [r.msg_num for r in flushed[0]] == [0, 1, 2]
+    assert observed == ["insert"] and buf.pending() == 0
+    assert buf.stats()["rows_flushed"] == 3 and buf.stats()["batches_flushed"] == 1
+
+
+def test_flusher_thread_flushes_by_size_and_deadline():
+    db = Recorder()
+    buf = WeightWriteBuffer(db.connection, batch_size=4, max_latency_s=0.05).start()
+    try:
+        add(buf, 4)
+        wait_for(lambda: len(db.stored()) == 4)
+        add(buf, 1, start=4)
+        wait_for(lambda: len(db.stored()) == 5)
+    finally:
+        buf.close()
+    s = buf.stats()
+    assert s["flushes_by_size"] == 1 and s["flushes_by_deadline"] == 1
+    assert [row[1] for row in db.stored()] == [1000.0, 999.0, 998.0, 997.0, 996.0]
+
+
+def test_batches_are_capped_at_batch_size():
+    db = Recorder()
+    buf = WeightWriteBuffer(db.connection, batch_size=3, max_latency_s=0.01).start()
+    try:
+        buf.add_many([ingest_buffer.BufferedReading("d", 1.0, T0 + timedelta(seconds=i), i, 0.0)
+                      for i in range(7)])
+        wait_for(lambda: len(db.stored()) == 7)
+    finally:
+        buf.close()
+    assert [len(b) for b in db.batches] == [3, 3, 1]
+
+
+def test_failed_batch_requeued_at_head_with_backoff(clock):
+    clock.install(ingest_buffer)
+    db = Recorder()
+    buf = WeightWriteBuffer(db.connection, retry_backoff_s=0.5, retry_backoff_max_s=1.5)
+    add(buf, 2)
+    db.failures = 3
+    for expected_delay in (0.5, 1.0, 1.5):
+        buf._flush(buf._take(10))
+        assert buf._retry_at == clock.now + expected_delay
+    add(buf, 1, start=2)
+    buf._flush(buf._take(10))
+    assert [row[1] for row in db.stored()] == [1000.0, 999.0, 998.0]   # order kept
+    s = buf.stats()
+    assert (s["flush_errors"], s["flush_retries"], s["rows_failed"]) == (3, 3, 0)
+    assert buf._retry_at == 0.0
+
+
+def test_batch_dropped_after_max_retries():
+    db = Recorder()
+    buf = WeightWriteBuffer(db.connection, max_retries=1)
+    add(buf, 2)
+    db.failures = 2
+    buf._flush(buf._take(10))
+    assert buf.pending() == 2
+    buf._flush(buf._take(10))
+    assert buf.pending() == 0 and buf.stats()["rows_failed"] == 2 and db.batches == []
+
+
+def test_close_writes_the_rest_without_requeue():
+    db = Recorder()
+    buf = WeightWriteBuffer(db.connection, max_latency_s=60).start()
+    add(buf, 2)
+    buf.close()
+    assert len(db.stored()) == 2
+
+    failing = Recorder()
+    failing.failures = 1
+    buf = WeightWriteBuffer(failing.connection)
+    add(buf, 2)
+    buf.close()
+    assert buf.pending() == 0 and buf.stats()["rows_failed"] == 2
+
+
+def test_post_flush_error_does_not_requeue():
+    db = Recorder()
+
+    def broken(conn, rows):
+        raise RuntimeError("stats upsert failed")
+
+    buf = WeightWriteBuffer(db.connection, on_flush=broken)
+    add(buf, 1)
+    buf.flush()
+    assert len(db.stored()) == 1 and buf.pending() == 0 and buf.stats()["flush_errors"] == 0
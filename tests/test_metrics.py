@@ -0,0 +1,72 @@
+# tests/test_metrics.py
+import urllib.request
+
+import pytest
+
+import metrics
+from metrics import Metrics
+
+
+@pytest.fixture
+def registry(clock):
+    clock.install(metrics)
+    return Metrics(prefix="test", buckets=(0.1, 1.0))
+
+
+def test_stage_histogram_and_errors(registry, clock):
+    with registry.time("parse"):
+        clock.advance(0.05)
+    with pytest.raises(ValueError):
+        with registry.time("parse"):
+            clock.advance(0.5)
+            raise ValueError
+    text = registry.render()
+    assert 'test_stage_duration_seconds_bucket{stage="parse",le="0.1"} 1' in text
+    assert 'test_stage_duration_seconds_bucket{stage="parse",le="+Inf"} 2' in text
+    assert 'test_stage_duration_seconds_count{stage="parse"} 2' in text
+    assert 'test_stage_errors_total{stage="parse"} 1' in text
+
+
+def test_counters_and_collected_values(registry):
+    registry.inc("alerts_total", description="Alerts sent", level="low")
+    registry.inc("alerts_total", 2, level="low")
+    registry.collect("queue_depth", "Queued items", lambda: 7)
+    registry.collect("shard_depth", "Per shard", lambda: [({"shard": "0"}, 3)])
+    registry.collect("broken", "Raises", lambda: 1 / 0)
+    text = registry.render()
+    assert "# HELP test_alerts_total Alerts sent" in text
+    assert 'test_alerts_total{level="low"} 3' in text
+    assert "test_queue_depth 7" in text and 'test_shard_depth{shard="0"} 3' in text
+    assert "test_broken" not in text
+
+
+def test_device_series_swept_when_idle(registry, clock):
+    registry.device_seen("old")
+    clock.advance(100)
+    registry.device_seen("new")
+    clock.advance(5)
+    text = registry.render()
+    assert 'test_device_last_message_age_seconds{device_id="old"} 105.000' in text
+    assert registry.sweep_devices(0) == 0
+    assert registry.sweep_devices(60) == 1
+    text = registry.render()
+    assert 'device_id="old"' not in text and 'device_id="new"' in text
+    registry.forget_device("new")
+    assert 'device_id="new"' not in registry.render()
+
+
+def test_labels_are_escaped(registry):
+    registry.device_seen('we"ird\n')
+    assert 'device_id="we\\"ird\\n"' in registry.render()
+
+
+def test_serves_metrics_over_http():
+    registry = Metrics(prefix="http")
+    registry.inc("hits_total")
+    server = registry.serve(0, host="127.0.0.1")
+    try:
+        port = server.server_address[1]
+        body = urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5).read().decode()
+        assert "http_hits_total 1" in body
+    finally:
+        server.shutdown()
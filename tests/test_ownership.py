@@ -0,0 +1,186 @@
+# tests/test_ownership.py
+from contextlib import contextmanager
+
+import pytest
+
+import ownership
+from mqtt_topics import device_from_topic, parse_topic, subscription_filters
+from payload_codec import CONTENT_TYPE
+from ownership import ACQUIRED, CLAIM_SQL, OWNED, SELECT_OWNER_SQL, DeviceOwnership, rendezvous_owner
+
+
+class LeaseTable:
+    """device_owner and analysis_replicas, with NOW(3) read from the test clock."""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.owners = {}     # device_id -> [replica_id, lease_until]
+        self.replicas = {}   # replica_id -> heartbeat_at
+
+    @contextmanager
+    def connection(self):
+        yield Connection(self)
+
+
+class Connection:
+    def __init__(self, table):
+        self.table = table
+
+    def prepared(self, sql):
+        assert sql in (SELECT_OWNER_SQL, CLAIM_SQL)
+        return Cursor(self.table)
+
+    def cursor(self):
+        return Cursor(self.table)
+
+    def commit(self):
+        pass
+
+
+class Cursor:
+    def __init__(self, table):
+        self.t = table
+        self._rows = []
+
+    def execute(self, sql, params=()):
+        now = self.t.clock.now
+        text = " ".join(sql.split())
+        if sql is SELECT_OWNER_SQL:
+            row = self.t.owners.get(params[0])
+            self._rows = [] if row is None else [(row[0], int((row[1] - now) * 1e6))]
+        elif sql is CLAIM_SQL:
+            device_id, replica_id, lease_s = params
+            row = self.t.owners.get(device_id)
+            if row is None or row[1] < now or row[0] == replica_id:
+                self.t.owners[device_id] = [replica_id, now + lease_s]
+        elif text.startswith("INSERT INTO analysis_replicas"):
+            self.t.replicas[params[0]] = now
+        elif text.startswith("UPDATE device_owner"):
+            lease_s, replica_id = params
+            for row in self.t.owners.values():
+                if row[0] == replica_id:
+                    row[1] = now + lease_s
+        elif text.startswith("SELECT replica_id FROM analysis_replicas"):
+            self._rows = [(r,) for r, at in self.t.replicas.items() if at > now - params[0]]
+        elif text.startswith("SELECT device_id FROM device_owner"):
+            self._rows = [(d,) for d, row in self.t.owners.items() if row[0] == params[0]]
+        elif text.startswith("DELETE FROM device_owner WHERE replica_id = %s AND device_id IN"):
+            for device_id in params[1:]:
+                if self.t.owners.get(device_id, [None])[0] == params[0]:
+                    del self.t.owners[device_id]
+        elif text.startswith("DELETE FROM device_owner"):
+            self.t.owners = {d: row for d, row in self.t.owners.items() if row[0] != params[0]}
+        elif text.startswith("DELETE FROM analysis_replicas"):
+            self.t.replicas.pop(params[0], None)
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def table(clock):
+    clock.install(ownership)
+    return LeaseTable(clock)
+
+
+def device_hashing_to(replica_id, members):
+    return next(d for d in (f"dev{i}" for i in range(1000)) if rendezvous_owner(d, members) == replica_id)
+
+
+def test_rendezvous_spreads_evenly_and_moves_few_devices():
+    members = ["analysis-0", "analysis-1", "analysis-2"]
+    counts = {m: 0 for m in members}
+    for i in range(3000):
+        counts[rendezvous_owner(f"dev{i}", members)] += 1
+    assert all(900 < n < 1100 for n in counts.values())
+
+
+def test_rendezvous_moves_few_devices():
+    devices = [f"dev{i}" for i in range(1000)]
+    before = {d: rendezvous_owner(d, ["a", "b", "c"]) for d in devices}
+    after = {d: rendezvous_owner(d, ["a", "b", "c", "d"]) for d in devices}
+    moved = [d for d in devices if before[d] != after[d]]
+    assert all(after[d] == "d" for d in moved) and 180 < len(moved) < 320
+
+
+def test_claim_free_device_then_cached(table):
+    a = DeviceOwnership(table.connection, "a", lease_s=30)
+    assert a.claim("dev1") == ACQUIRED
+    assert table.owners["dev1"][0] == "a" and a.owns("dev1")
+    lookups = a.lookups
+    assert a.claim("dev1") == OWNED and a.lookups == lookups   # answered from the cache
+
+
+def test_foreign_lease_is_forwarded_until_it_expires(table, clock):
+    a = DeviceOwnership(table.connection, "a", lease_s=30)
+    b = DeviceOwnership(table.connection, "b", lease_s=30)
+    for r in (a, b):
+        r.heartbeat()
+    a.heartbeat()                      # a now knows b is live
+    device = device_hashing_to("b", ["a", "b"])
+    assert b.claim(device) == ACQUIRED
+    assert a.claim(device) == "b" and not a.owns(device)
+
+    clock.advance(31)                  # b stopped heartbeating: its lease and membership lapse
+    a.heartbeat()
+    assert a.members == ["a"]
+    assert a.claim(device, refresh=True) == ACQUIRED and table.owners[device][0] == "a"
+
+
+def test_free_device_left_for_its_rendezvous_owner(table):
+    a = DeviceOwnership(table.connection, "a")
+    DeviceOwnership(table.connection, "b").heartbeat()
+    a.heartbeat()
+    device = device_hashing_to("b", ["a", "b"])
+    assert a.claim(device) == "b" and device not in table.owners
+
+
+def test_heartbeat_reports_devices_to_hand_off_and_release(table):
+    a = DeviceOwnership(table.connection, "a")
+    a.heartbeat()
+    devices = [f"dev{i}" for i in range(20)]
+    for d in devices:
+        assert a.claim(d) == ACQUIRED
+    DeviceOwnership(table.connection, "b").heartbeat()
+    moved = a.heartbeat()
+    assert moved and set(moved) == {d for d in devices if rendezvous_owner(d, ["a", "b"]) == "b"}
+
+    a.start_handoff(moved)
+    assert not a.owns(moved[0]) and a.claim(moved[0]) == "b"
+    a.release(moved)
+    assert all(d not in table.owners for d in moved) and a.released == len(moved)
+    assert a.heartbeat() == []
+
+
+def test_leave_drops_everything(table):
+    a = DeviceOwnership(table.connection, "a")
+    a.heartbeat()
+    a.claim("dev1")
+    a.leave()
+    assert table.owners == {} and table.replicas == {} and a.owned_count() == 0
+
+
+def test_subscription_filters():
+    assert subscription_filters("milk/weight") == ["milk/weight", "milk/weight/+", "milk/weight/bin/+"]
+    assert subscription_filters("milk/weight", per_device=False, shared_group="g") == ["$share/g/milk/weight"]
+
+
+@pytest.mark.parametrize("topic, expected", [
+    ("milk/weight", (None, False)),
+    ("milk/weight/dev1", ("dev1", False)),
+    ("milk/weight/bin/dev1", ("dev1", True)),
+    ("milk/weight/dev1/extra", (None, False)),
+    ("milk/weightx/dev1", (None, False)),
+])
+def test_parse_topic(topic, expected):
+    assert parse_topic(topic, "milk/weight") == expected
+
+
+def test_content_type_marks_binary():
+    assert parse_topic("milk/weight/dev1", "milk/weight", CONTENT_TYPE) == ("dev1", True)
+    assert parse_topic("milk/weight/dev1", "milk/weight", "application/json") == ("dev1", False)
+    assert device_from_topic("milk/weight/", "milk/weight") is None
@@ -0,0 +1,113 @@
+# tests/test_payload_codec.py
+import json
+from datetime import datetime
+
+import pytest
+
+from dedup import DuplicateFilter
+
+import payload_codec as codec
+
+TS = datetime(2025, 3, 1, 7, 30, 15, 250000)
+
+
+def test_binary_round_trip():
+    payload = codec.encode("device1", 950.25, TS, seq=42)
+    assert len(payload) == 24 and payload[:2] == codec.MAGIC
+    r = codec.decode(payload, topic_device="device1", binary=True)
+    assert r == codec.Reading("device1", 950.25, TS, "42", codec.BINARY)
+
+
+def test_binary_batch_round_trip():
+    readings = [(950.0, TS, 1), (720.5, TS.replace(minute=31), 2), (0.0, TS.replace(minute=32), 0xFFFFFFFF + 3)]
+    payload = codec.encode_batch("device1", readings, binary=True)
+    got = codec.decode_readings(payload, topic_device="device1", binary=True)
+    assert [(r.weight, r.timestamp, r.message_id) for r in got] == [
+        (950.0, TS, "1"), (720.5, TS.replace(minute=31), "2"), (0.0, TS.replace(minute=32), "2")]
+    assert {r.device_id for r in got} == {"device1"}
+
+
+def test_json_batch_round_trip():
+    readings = [(950, TS, 1), (720.5, TS.replace(minute=31), 2)]
+    got = codec.decode_readings(codec.encode_batch("device1", readings))
+    assert [(r.device_id, r.weight, r.timestamp, r.message_id, r.format) for r in got] == [
+        ("device1", 950.0, TS, codec.message_id(1, TS), codec.JSON),
+        ("device1", 720.5, TS.replace(minute=31), codec.message_id(2, TS.replace(minute=31)), codec.JSON)]
+
+
+def test_single_and_batch_message_ids_agree():
+    single = json.dumps({"device_id": "device1", "weight": 1, "timestamp": TS.isoformat(),
+                         "message_id": codec.message_id(7, TS)})
+    batch = codec.encode_batch("device1", [(1, TS, 7)])
+    assert codec.decode(single).message_id == codec.decode_readings(batch)[0].message_id
+
+
+def test_json_and_legacy():
+    r = codec.decode(b'{"device_id": "d", "weight": "950", "timestamp": "2025-03-01T07:30:15.250000"}')
+    assert r == codec.Reading("d", 950.0, TS, "unknown", codec.JSON)
+    assert codec.decode(b"950", topic_device="d2") == codec.Reading("d2", 950.0, None, None, codec.LEGACY)
+    assert codec.decode(b"950.5", default_device="d3").device_id == "d3"
+    assert codec.decode(b'{"weight": 1}', topic_device="t").device_id == "t"
+    assert codec.decode(b'{"weight": 1, "timestamp": 12345}').timestamp is None   # seconds since boot
+
+
+def test_aware_timestamp_becomes_local_naive():
+    aware = TS.astimezone()
+    r = codec.decode(json.dumps({"weight": 1, "timestamp": aware.isoformat()}).encode())
+    assert r.timestamp == TS and r.timestamp.tzinfo is None
+
+
+@pytest.mark.parametrize("payload", [b"not a number", b'{"weight": null}', b'{"device_id": "d"}'])
+def test_unreadable_json_rejected(payload):
+    with pytest.raises(ValueError):
+        codec.decode(payload)
+
+
+def test_empty_batch_rejected():
+    with pytest.raises(ValueError):
+        codec.decode_readings(b'{"device_id": "d", "readings": []}')
+    with pytest.raises(ValueError):
+        codec.decode_readings(codec.encode_batch("d", [], binary=True), topic_device="d", binary=True)
+
+
+def test_binary_device_checked():
+    payload = codec.encode("device1", 1.0, TS)
+    with pytest.raises(ValueError, match="does not belong"):
+        codec.decode(payload, topic_device="device2", binary=True)
+    with pytest.raises(ValueError, match="without a device topic"):
+        codec.decode(payload, binary=True)
+
+
+def test_binary_layout_checked():
+    payload = codec.encode("d", 1.0, TS)
+    with pytest.raises(ValueError, match="24 bytes"):
+        codec.decode(payload[:-1], topic_device="d", binary=True)
+    with pytest.raises(ValueError, match="version"):
+        codec.decode(payload[:2] + b"\x09" + payload[3:], topic_device="d", binary=True)
+    with pytest.raises(ValueError, match="not a binary"):
+        codec.decode(b'{"weight": 1}', topic_device="d", binary=True)
+    batch = codec.encode_batch("d", [(1.0, TS, 1)], binary=True)
+    with pytest.raises(ValueError, match="bytes"):
+        codec.decode_readings(batch + b"\x00", topic_device="d", binary=True)
+
+
+def test_batch_size_limit():
+    with pytest.raises(ValueError):
+        codec.encode_batch("d", [(1.0, TS, 0)] * (codec.MAX_BATCH + 1), binary=True)
+
+
+def test_zero_timestamp_means_arrival_time():
+    payload = bytearray(codec.encode("d", 1.0, TS))
+    payload[12:20] = bytes(8)
+    assert codec.decode(bytes(payload), topic_device="d", binary=True).timestamp is None
+
+
+def test_untimed_readings_from_two_boots_stay_distinct():
+    dedup = DuplicateFilter()
+    # firmware seq: random boot nonce in the high 16 bits, counter in the low 16
+    for nonce in (0x1A2B0000, 0x7F010000):
+        payload = bytearray(codec.encode("d", 1.0, TS, seq=nonce + 1))
+        payload[12:20] = bytes(8)
+        r = codec.decode(bytes(payload), topic_device="d", binary=True)
+        assert not dedup.seen(r.device_id, r.message_id, r.timestamp)
+    assert r.message_id == str(0x7F010001)
@@ -0,0 +1,112 @@
+# tests/test_recompute.py
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import recompute
+from recompute import RECOMPUTE_UPSERT_SQL, compute_segment, derive_rows, stream_segments
+
+NOW = datetime(2025, 3, 8, 12, 0, 0)
+TODAY = NOW.date()
+
+
+class FakeConnection:
+    """Rollup query -> `rollup` rows, weight_data scan -> `readings` (streamed); upserts are kept."""
+
+    def __init__(self, rollup, readings):
+        self.rollup = rollup
+        self.readings = readings
+        self.queries = []
+        self.written = []
+        self.commits = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self._rows = []
+
+    def execute(self, sql, params=()):
+        self.conn.queries.append((sql, list(params)))
+        self._rows = list(self.conn.rollup if "weight_daily_rollup" in sql else self.conn.readings)
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def fetchmany(self, size):
+        rows, self._rows = self._rows[:size], self._rows[size:]
+        return rows
+
+    def executemany(self, sql, seq):
+        assert sql == RECOMPUTE_UPSERT_SQL
+        self.conn.written.extend(seq)
+
+    def close(self):
+        pass
+
+
+def segment(rows):
+    devices, weights, stamps = zip(*rows)
+    return (np.asarray(devices, dtype=object), np.asarray(weights, dtype=np.float64),
+            np.asarray(stamps, dtype="datetime64[s]"))
+
+
+def test_stream_segments_never_splits_a_device():
+    rows = [("a", 1.0, NOW)] * 3 + [("b", 2.0, NOW)] * 4 + [("c", 3.0, NOW)]
+    cur = FakeCursor(FakeConnection([], rows))
+    cur.execute("SELECT weight_data")
+    segments = [list(devices) for devices, _, _ in stream_segments(cur, 2)]
+    assert segments == [["a"] * 3, ["b"] * 4, ["c"]]
+
+
+def test_compute_segment_cup_and_current():
+    t = NOW - timedelta(hours=5)
+    rows = [("a", 1000.0, t), ("a", 800.0, t + timedelta(hours=1)), ("a", 790.0, t + timedelta(hours=2)),
+            ("a", 600.0, t + timedelta(hours=3)),
+            ("b", 500.0, NOW - timedelta(days=10)), ("b", 300.0, NOW - timedelta(days=9))]  # before the window
+    device_ids, current, cup = compute_segment(*segment(rows), NOW)
+    assert list(device_ids) == ["a", "b"]
+    assert list(current) == [600.0, 300.0]
+    assert cup[0] == 195.0 and cup[1] == recompute.CUP_DEFAULT_G
+
+
+def test_derive_rows_matches_derive_stats():
+    rows = derive_rows(np.asarray(["a", "b"], dtype=object), np.array([500.0, 0.0]), np.array([200.0, 200.0]),
+                       np.array([250.0, 250.0]), np.array([1000.0, 0.0]), TODAY)
+    assert rows[0] == ("a", 500.0, 250.0, 2, 50.0, TODAY + timedelta(days=2), None)
+    assert rows[1] == ("b", 0.0, 250.0, 0, 0.0, None, None)
+
+
+def test_recompute_takes_daily_and_baseline_from_the_rollup():
+    t = NOW - timedelta(hours=3)
+    conn = FakeConnection(
+        # device_id, baseline, last_weight, sum of daily (max - min), consumption days
+        rollup=[("a", 1200.0, 600.0, 900.0, 3), ("silent", 1000.0, 400.0, 0, 0)],
+        readings=[("a", 800.0, t), ("a", 600.0, t + timedelta(hours=1))],
+    )
+    rows = recompute.recompute(conn, now=NOW, log=lambda *a: None)
+    by_device = {r[0]: r for r in rows}
+    assert by_device["a"][:5] == ("a", 600.0, 300.0, 3, 50.0)       # daily 900/3, cup 200, full 1200
+    assert by_device["silent"][:5] == ("silent", 400.0, recompute.DAILY_DEFAULT_G, 6, 40.0)
+    assert conn.written == rows and conn.commits == 1
+
+    (rollup_sql, rollup_params), (_, scan_params) = conn.queries
+    first_day = (NOW - timedelta(days=recompute.WINDOW_DAYS)).date()
+    assert rollup_params == [first_day, first_day]
+    assert scan_params == [NOW - timedelta(days=recompute.WINDOW_DAYS)]   # only the cup-size window
+
+
+def test_recompute_with_baseline_lookback(monkeypatch):
+    monkeypatch.setattr(recompute, "FULL_BASELINE_LOOKBACK_DAYS", 14)
+    conn = FakeConnection(rollup=[("a", None, 500.0, 0, 0)], readings=[])
+    rows = recompute.recompute(conn, now=NOW, dry_run=True, log=lambda *a: None)
+    assert rows[0][4] == 50.0                                        # no max in the lookback: assumed 1000g
+    assert conn.queries[0][1][0] == (NOW - timedelta(days=14)).date()
+    assert conn.written == []
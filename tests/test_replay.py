@@ -0,0 +1,95 @@
+# tests/test_replay.py
+from datetime import datetime, timedelta
+
+import replay
+from device_analytics import DEVICE_ROLLUP_DAYS_SQL, DEVICE_ROLLUP_MAX_SQL
+from replay import diff_user_stats, load_checkpoint, replay_device
+
+NOW = datetime(2025, 3, 8, 12, 0, 0)
+TODAY = NOW.date()
+
+
+class FakeConnection:
+    def __init__(self, answers):
+        self.answers = answers   # sql -> rows; anything else -> the raw readings
+        self.executed = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self._rows = []
+
+    def execute(self, sql, params=()):
+        self.conn.executed.append((sql, params))
+        self._rows = list(self.conn.answers.get(sql, self.conn.answers.get("*", [])))
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def close(self):
+        pass
+
+
+def replayed(readings, days=(), max_w=None):
+    conn = FakeConnection({DEVICE_ROLLUP_DAYS_SQL: list(days), DEVICE_ROLLUP_MAX_SQL: [(max_w,)], "*": readings})
+    state = replay._new_state()
+    row, n = replay_device(conn, state, "d", NOW, datetime(1970, 1, 1))
+    assert "d" not in state   # forgotten after its row is built
+    return row, n
+
+
+def test_replay_row_takes_daily_and_baseline_from_the_rollup():
+    t = NOW - timedelta(hours=4)
+    readings = [(1000.0, t), (800.0, t + timedelta(hours=1)), (600.0, t + timedelta(hours=2))]
+    days = [(TODAY - timedelta(days=1), 200.0, 800.0, 9), (TODAY, 600.0, 1000.0, 3)]
+    row, n = replayed(readings, days, max_w=1250.0)
+    assert n == 3
+    device_id, current, daily, cups_left, percent = row[:5]
+    assert (device_id, current) == ("d", 600.0)
+    assert daily == 500.0                       # (600 + 400) / 2 rollup days
+    assert percent == 600.0 / 1250.0 * 100      # all-time rollup maximum
+
+
+def test_stored_zero_replayed_as_an_expired_removal():
+    grace = replay.CARTON_REMOVAL_GRACE_PERIOD_MIN * 60
+    t = NOW - timedelta(hours=2)
+    # 0g is only stored once a removal outlasted its grace period; a stored 0g
+    # is therefore replayed as having started one grace period earlier
+    readings = [(900.0, t), (0.0, t + timedelta(seconds=grace + 30)), (880.0, t + timedelta(seconds=grace + 60))]
+    row, _ = replayed(readings)
+    assert row[1] == 880.0
+
+
+def test_without_rollup_rows_defaults_apply():
+    row, n = replayed([(700.0, NOW - timedelta(hours=1))])
+    assert n == 1 and row[2] == replay.DAILY_DEFAULT_G
+
+
+def test_diff_user_stats_reports_changed_columns():
+    stored = [("d", 600.0, 500.0, 2, 60.0, TODAY, None), ("same", 1.0, 2.0, 0, 0.1, None, None)]
+    conn = FakeConnection({"*": stored})
+    rows = [("d", 600.004, 450.0, 2, 60.0, TODAY + timedelta(days=1), None),
+            ("same", 1.0, 2.0, 0, 0.1, None, None),
+            ("new", 1.0, 2.0, 0, 0.1, None, None)]
+    diffs = diff_user_stats(conn, rows)
+    assert diffs == [("d", "avg_daily_consumption_g", 500.0, 450.0),
+                     ("d", "expected_empty_date", TODAY, TODAY + timedelta(days=1)),
+                     ("new", "*", None, "new row")]
+
+
+def test_checkpoint_lists_finished_devices(tmp_path):
+    path = tmp_path / "replay.ckpt"
+    assert load_checkpoint(str(path)) == set()
+    path.write_text("d1\n\nd2\n", encoding="utf-8")
+    assert load_checkpoint(str(path)) == {"d1", "d2"}
@@ -0,0 +1,135 @@
+# tests/test_retention.py
+from datetime import datetime
+
+import pytest
+
+import retention
+from retention import HOURLY_HISTORY_DDL, ensure_future_partitions, expire_partitions, run_retention
+
+NOW = datetime(2025, 3, 15, 10, 0, 0)
+
+
+class FixedDatetime(datetime):
+    @classmethod
+    def now(cls, tz=None):
+        return NOW
+
+
+@pytest.fixture(autouse=True)
+def fixed_now(monkeypatch):
+    monkeypatch.setattr(retention, "datetime", FixedDatetime)
+
+
+class FakeMySQL:
+    """weight_data partitions as INFORMATION_SCHEMA lists them; every other statement is recorded."""
+
+    def __init__(self, partitions=(), rows=True, lock=True):
+        self.partitions = list(partitions)   # [(name, 'YYYY-MM-DD HH:MM:SS' | 'MAXVALUE')]
+        self.rows = rows
+        self.lock = lock
+        self.statements = []
+        self.commits = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+
+class FakeCursor:
+    def __init__(self, db):
+        self.db = db
+        self._rows = []
+        self.rowcount = 0
+
+    def execute(self, sql, params=()):
+        text = " ".join(sql.split())
+        if "INFORMATION_SCHEMA.PARTITIONS" in text:
+            self._rows = [(n, d if d == "MAXVALUE" else f"'{d}'") for n, d in self.db.partitions]
+            return
+        self.db.statements.append(text)
+        if text.startswith("SELECT GET_LOCK"):
+            self._rows = [(1 if self.db.lock else 0,)]
+        elif text.startswith("SELECT RELEASE_LOCK"):
+            self._rows = [(1,)]
+        elif text.startswith("SELECT 1 FROM weight_data"):
+            self._rows = [(1,)] if self.db.rows else []
+        elif text.startswith("SELECT MIN(timestamp)"):
+            self._rows = [(datetime(2025, 1, 20),)]
+        elif text.startswith("INSERT INTO weight_hourly_history"):
+            self.rowcount = 24
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def close(self):
+        pass
+
+
+MONTHLY = [("p202412", "2025-01-01 00:00:00"), ("p202501", "2025-02-01 00:00:00"),
+           ("p202502", "2025-03-01 00:00:00"), ("p202503", "2025-04-01 00:00:00"), ("pmax", "MAXVALUE")]
+
+
+def test_partition_names_and_periods():
+    assert retention._partition_name(datetime(2025, 3, 1), "month") == "p202503"
+    assert retention._partition_name(datetime(2025, 3, 7), "day") == "p20250307"
+    assert retention._next_period(datetime(2025, 12, 1), "month") == datetime(2026, 1, 1)
+    assert retention._next_period(datetime(2025, 2, 28), "day") == datetime(2025, 3, 1)
+    assert retention._period_start(NOW, "month") == datetime(2025, 3, 1)
+
+
+def test_future_partitions_split_off_pmax():
+    db = FakeMySQL(MONTHLY)
+    assert ensure_future_partitions(db, "month", ahead=2, log=lambda *a: None) == 2
+    (stmt,) = db.statements
+    assert stmt.startswith("ALTER TABLE weight_data REORGANIZE PARTITION pmax INTO")
+    assert "PARTITION p202504 VALUES LESS THAN ('2025-05-01 00:00:00')" in stmt
+    assert "PARTITION p202505 VALUES LESS THAN ('2025-06-01 00:00:00')" in stmt
+    assert stmt.endswith("PARTITION pmax VALUES LESS THAN (MAXVALUE) )")
+    assert ensure_future_partitions(FakeMySQL(MONTHLY), "month", ahead=0, log=lambda *a: None) == 0
+
+
+def test_expired_partitions_downsampled_then_dropped():
+    db = FakeMySQL(MONTHLY)
+    logged = []
+    assert expire_partitions(db, datetime(2025, 1, 15), log=logged.append) == 1
+    downsample, drop = db.statements
+    assert "FROM weight_data PARTITION (p202412)" in downsample
+    assert drop == "ALTER TABLE weight_data DROP PARTITION p202412"
+    assert db.commits == 1 and "24 hourly rows kept" in logged[0]
+
+
+def test_dry_run_changes_nothing():
+    db = FakeMySQL(MONTHLY)
+    assert expire_partitions(db, datetime(2025, 3, 1), dry_run=True, log=lambda *a: None) == 3
+    assert db.statements == []
+
+
+def test_run_skips_when_another_replica_holds_the_lock():
+    db = FakeMySQL(MONTHLY, lock=False)
+    assert run_retention(db, 30, log=lambda *a: None) is False
+    assert db.statements == ["SELECT GET_LOCK(%s, 0)"]
+
+
+def test_run_leaves_an_unpartitioned_table_with_rows_alone():
+    db = FakeMySQL(rows=True)
+    logged = []
+    assert run_retention(db, 30, log=logged.append) is True
+    assert not any(s.startswith("ALTER") for s in db.statements)
+    assert "retention.py partition" in logged[0]
+    assert db.statements[-1] == "SELECT RELEASE_LOCK(%s)"
+
+
+def test_run_partitions_an_empty_table():
+    db = FakeMySQL(rows=False)
+    assert run_retention(db, 30, log=lambda *a: None) is True
+    assert " ".join(HOURLY_HISTORY_DDL.split()) in db.statements
+    alters = [s for s in db.statements if s.startswith("ALTER")]
+    assert alters[0] == "ALTER TABLE weight_data DROP PRIMARY KEY, ADD PRIMARY KEY (id, `timestamp`)"
+    assert "PARTITION p202501 VALUES LESS THAN ('2025-02-01 00:00:00')" in alters[1]
+    assert db.statements[-1] == "SELECT RELEASE_LOCK(%s)"
@@ -0,0 +1,155 @@
+# tests/test_rollup.py
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import pytest
+
+from ingest_buffer import BufferedReading, WeightWriteBuffer, new_rows, stored_key
+from rollup import UPSERT_ROLLUP_SQL, aggregate_batch, update_daily_rollup
+
+T0 = datetime(2025, 3, 1, 23, 59, 0)
+
+
+def reading(device_id, weight, seconds, drop_g=0.0):
+    return BufferedReading(device_id, weight, T0 + timedelta(seconds=seconds), 0, drop_g)
+
+
+class FakeMySQL:
+    """
+    weight_data keys and rollup counts, with autocommit-off transactions:
+    writes made after start_transaction() only land on commit().
+    """
+
+    def __init__(self):
+        self.weights = set()
+        self.rollup = {}              # (device_id, day) -> reading_count
+        self.fail_rollup = False
+
+    @contextmanager
+    def connection(self):
+        yield FakeConnection(self)
+
+
+class FakeConnection:
+    def __init__(self, db: FakeMySQL):
+        self.db = db
+        self.in_transaction = False
+        self._weights, self._rollup = set(), []
+
+    def start_transaction(self):
+        assert not self.in_transaction
+        self.in_transaction = True
+
+    def commit(self):
+        assert self.in_transaction
+        self.db.weights |= self._weights
+        for key, count in self._rollup:
+            self.db.rollup[key] = self.db.rollup.get(key, 0) + count
+        self.rollback()
+
+    def rollback(self):
+        self.in_transaction = False
+        self._weights, self._rollup = set(), []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+
+class FakeCursor:
+    def __init__(self, conn: FakeConnection):
+        self.conn = conn
+        self.rowcount = -1
+        self._rows = []
+
+    def executemany(self, sql, seq):
+        assert self.conn.in_transaction, "write outside an explicit transaction"
+        seq = list(seq)
+        if sql is UPSERT_ROLLUP_SQL:
+            if self.conn.db.fail_rollup:
+                raise RuntimeError("lock wait timeout")
+            self.conn._rollup += [((r[0], r[1]), r[8]) for r in seq]
+            self.rowcount = len(seq)
+            return
+        self.rowcount = 0
+        for device_id, _, ts in seq:
+            key = stored_key(device_id, ts)
+            if key not in self.conn.db.weights and key not in self.conn._weights:
+                self.conn._weights.add(key)
+                self.rowcount += 1
+
+    def execute(self, sql, params):
+        assert "FOR UPDATE" in sql
+        keys = set(zip(params[::2], params[1::2]))
+        self._rows = sorted(keys & self.conn.db.weights)
+
+    def fetchall(self):
+        return self._rows
+
+    def close(self):
+        pass
+
+
+def flush(db, rows):
+    buf = WeightWriteBuffer(db.connection,
+                            in_transaction=lambda conn, inserted: update_daily_rollup(conn, inserted, commit=False))
+    buf._flush(rows)
+    return buf
+
+
+def test_aggregate_batch_per_device_day():
+    rows = [reading("d1", 900, 10, 0), reading("d1", 950, 0), reading("d1", 700, 30, 200),
+            reading("d1", 690, 90, 10), reading("d2", 500, 5)]
+    got = {(r[0], r[1]): r for r in aggregate_batch(rows)}
+    assert set(got) == {("d1", T0.date()), ("d1", T0.date() + timedelta(days=1)), ("d2", T0.date())}
+    d1 = got["d1", T0.date()]
+    assert d1[2:6] == (T0, 950, T0 + timedelta(seconds=30), 700)   # first/last by timestamp, not arrival
+    assert d1[6:] == (700, 950, 3, 200)
+    assert got["d1", T0.date() + timedelta(days=1)][8] == 1
+
+
+def test_batch_and_rollup_commit_together():
+    db = FakeMySQL()
+    buf = flush(db, [reading("d1", 900, 0), reading("d1", 880, 1)])
+    assert len(db.weights) == 2 and db.rollup == {("d1", T0.date()): 2}
+    assert buf.stats()["rows_skipped"] == 0
+
+
+def test_failed_rollup_leaves_nothing_and_retry_counts_once():
+    db = FakeMySQL()
+    rows = [reading("d1", 900, 0), reading("d1", 880, 1)]
+    db.fail_rollup = True
+    buf = flush(db, rows)
+    assert db.weights == set() and db.rollup == {}
+    assert buf.pending() == 2
+
+    db.fail_rollup = False
+    buf._flush(buf._take(10))
+    assert len(db.weights) == 2 and db.rollup == {("d1", T0.date()): 2}
+
+
+def test_already_stored_rows_not_counted_again():
+    db = FakeMySQL()
+    flush(db, [reading("d1", 900, 0)])
+    # a redelivered reading, one repeated within the batch (same stored second) and a new one
+    buf = flush(db, [reading("d1", 900, 0), reading("d1", 890, 5), reading("d1", 889, 5.2),
+                     reading("d1", 880, 10)])
+    assert db.rollup == {("d1", T0.date()): 3}
+    assert len(db.weights) == 3
+    assert buf.stats()["rows_skipped"] == 2
+
+
+def test_batch_of_duplicates_skips_the_rollup():
+    db = FakeMySQL()
+    flush(db, [reading("d1", 900, 0)])
+    flush(db, [reading("d1", 900, 0)])
+    assert db.rollup == {("d1", T0.date()): 1}
+
+
+@pytest.mark.parametrize("micro, second", [(499999, 0), (500000, 1)])
+def test_stored_key_rounds_like_datetime(micro, second):
+    assert stored_key("d", T0.replace(microsecond=micro)) == ("d", T0 + timedelta(seconds=second))
+
+
+def test_new_rows_keeps_first_of_each_key():
+    rows = [reading("d1", 1, 0), reading("d1", 2, 0.2), reading("d2", 3, 0), reading("d1", 4, 3)]
+    assert new_rows(rows, [("d1", T0 + timedelta(seconds=3))]) == rows[:1] + rows[2:3]
@@ -0,0 +1,50 @@
+# tests/test_shared_copies.py
+"""
+Modules shared between services are copied into each service directory (every
+image is built from its own directory). Their first line names the services
+and says to keep the copies identical; this checks that they are.
+"""
+import hashlib
+import re
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+SERVICES = ("analysis-service", "updates-service", "weight-service")
+HEADER = re.compile(r"^# (?P<name>\w+\.py) \(shared by (?P<services>[\w\-, ]+); keep (both|all) copies identical\)$")
+
+
+def _shared_modules() -> dict:
+    """module name -> services named in its header, from every copy found."""
+    shared = {}
+    for service in SERVICES:
+        for path in sorted((ROOT / service).glob("*.py")):
+            m = HEADER.match(path.read_text(encoding="utf-8").split("\n", 1)[0])
+            if m:
+                assert m.group("name") == path.name, f"{service}/{path.name} header names {m.group('name')}"
+                shared[path.name] = tuple(s.strip() for s in re.split(r",| and ", m.group("services")) if s.strip())
+    return shared
+
+
+SHARED = _shared_modules()
+
+
+def test_shared_modules_found():
+    assert "payload_codec.py" in SHARED and "device_state.py" in SHARED
+
+
+@pytest.mark.parametrize("name", sorted(SHARED))
+def test_copies_identical(name):
+    digests = {}
+    for service in SHARED[name]:
+        path = ROOT / service / name
+        assert path.exists(), f"{name} is shared with {service} but {service}/{name} is missing"
+        digests[service] = hashlib.md5(path.read_bytes()).hexdigest()
+    assert len(set(digests.values())) == 1, f"copies of {name} differ: {digests}"
+
+
+@pytest.mark.parametrize("name", sorted(SHARED))
+def test_no_unlisted_copies(name):
+    holders = {s for s in SERVICES if (ROOT / s / name).exists()}
+    assert holders == set(SHARED[name]), f"{name} exists in {sorted(holders)} but its header lists {SHARED[name]}"
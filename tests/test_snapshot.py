@@ -0,0 +1,117 @@
+# tests/test_snapshot.py
+import os
+import time
+from datetime import datetime, date, timedelta
+
+import pytest
+
+import snapshot
+from device_analytics import AnalyticsState
+from snapshot import SnapshotError, Snapshotter, dumps, loads, read_snapshot, write_snapshot
+
+SECTIONS = {
+    "service": "analysis",
+    "devices": {
+        "fields": ["zero_start", "window"],
+        "records": [["device1", 1.5, [datetime(2025, 3, 1, 7, 30, 0, 123456), [950.0, 948.5]]],
+                    [["device2", 3], 0.0, [None, []]]],
+    },
+    "flags": [True, False, None],
+    "numbers": [0, -1, 2 ** 62, 0.1, -273.15],
+    "day": date(2025, 2, 28),
+    "text": "חלב 🥛",
+    (1, "tuple-key"): "value",
+}
+
+
+def test_round_trip():
+    created = datetime(2025, 3, 1, 8, 0, 0)
+    got_created, got = loads(dumps(SECTIONS, created=created))
+    assert got_created == created
+    assert got["devices"]["records"][0] == ["device1", 1.5, [datetime(2025, 3, 1, 7, 30, 0, 123456), [950.0, 948.5]]]
+    assert got["devices"]["records"][1][0] == ["device2", 3]   # tuples come back as lists...
+    assert got[(1, "tuple-key")] == "value"                    # ...except as dict keys
+    assert {k: v for k, v in got.items() if k != "devices"} == {k: v for k, v in SECTIONS.items() if k != "devices"}
+
+
+def test_bool_is_not_int():
+    _, got = loads(dumps({"b": True, "i": 1}))
+    assert got["b"] is True and type(got["i"]) is int
+
+
+@pytest.mark.parametrize("value", [{1, 2}, b"bytes", datetime(2025, 1, 1).astimezone()])
+def test_unsupported_values_rejected(value):
+    with pytest.raises(SnapshotError):
+        dumps({"x": value})
+
+
+def test_corruption_detected():
+    data = bytearray(dumps(SECTIONS))
+    with pytest.raises(SnapshotError, match="checksum"):
+        flipped = bytearray(data)
+        flipped[snapshot._HEADER.size + 3] ^= 0xFF
+        loads(bytes(flipped))
+    with pytest.raises(SnapshotError, match="truncated"):
+        loads(bytes(data[:-1]))
+    with pytest.raises(SnapshotError, match="not a snapshot"):
+        loads(b"XXXXXX" + bytes(data[6:]))
+    with pytest.raises(SnapshotError, match="too short"):
+        loads(b"SMSNAP")
+
+
+def test_version_checked(monkeypatch):
+    data = dumps(SECTIONS)
+    monkeypatch.setattr(snapshot, "VERSION", snapshot.VERSION + 1)
+    with pytest.raises(SnapshotError, match="version"):
+        loads(data)
+
+
+def test_files(tmp_path):
+    path = str(tmp_path / "state" / "snap.bin")
+    assert read_snapshot(path) is None
+    size = write_snapshot(path, {"a": [1, 2]})
+    assert (tmp_path / "state" / "snap.bin").stat().st_size == size
+    assert [p.name for p in (tmp_path / "state").iterdir()] == ["snap.bin"]   # no temp file left behind
+    created, sections = read_snapshot(path, max_age_s=60)
+    assert sections == {"a": [1, 2]}
+
+
+def test_max_age(tmp_path):
+    path = tmp_path / "snap.bin"
+    path.write_bytes(dumps({"a": 1}, created=datetime(2000, 1, 1)))
+    assert read_snapshot(str(path), max_age_s=3600) is None
+    assert read_snapshot(str(path))[1] == {"a": 1}
+
+
+def test_snapshotter_writes_periodically_and_on_stop(tmp_path):
+    path = str(tmp_path / "snap.bin")
+    state = {"n": 0}
+    snapper = Snapshotter(path, lambda: dict(state), interval_s=0.02).start()
+    deadline = time.monotonic() + 2
+    while snapper.written == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert snapper.written >= 1
+    state["n"] = 42
+    snapper.stop()
+    assert read_snapshot(path)[1] == {"n": 42}
+    assert snapper.stats()["last_bytes"] == os.path.getsize(path)
+
+
+def test_snapshotter_counts_failures(tmp_path, capsys):
+    snapper = Snapshotter(str(tmp_path / "snap.bin"), lambda: {"x": object()}, interval_s=0)
+    assert not snapper.save()
+    assert snapper.failed == 1 and "Failed to write state snapshot" in capsys.readouterr().out
+
+
+def test_analytics_state_survives_a_snapshot():
+    state = AnalyticsState(window_days=7, cup_min_g=25, cup_max_g=350, cup_default_g=60, daily_default_g=200)
+    t0 = datetime(2025, 3, 1, 8)
+    for i, w in enumerate([1000, 940, 880, 1000, 930]):
+        state.add_reading("d1", w, t0 + timedelta(hours=i * 7))
+    _, sections = loads(dumps({"analytics": state.export()}))
+    restored = AnalyticsState(window_days=7, cup_min_g=25, cup_max_g=350, cup_default_g=60, daily_default_g=200)
+    assert restored.restore(sections["analytics"]) == 1
+    now = t0 + timedelta(days=2)
+    assert restored.snapshot("d1", now) == state.snapshot("d1", now)
+    assert restored.empty_at("d1", 200, now) == state.empty_at("d1", 200, now)
+    assert restored.add_reading("d1", 870, now) == state.add_reading("d1", 870, now) == 60
@@ -0,0 +1,81 @@
+# tests/test_store_forward.py
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import paho.mqtt.client as mqtt
+
+import payload_codec as codec
+from store_forward import ReadingBacklog, handed_over
+
+T0 = datetime(2025, 3, 1, 8, 0, 0)
+
+
+class FakeClient:
+    """Takes publishes until `room` runs out, then answers MQTT_ERR_QUEUE_SIZE."""
+
+    def __init__(self, room=None):
+        self.room = room
+        self.published = []
+
+    def publish(self, topic, payload=None, qos=0):
+        if self.room is not None:
+            if self.room == 0:
+                return SimpleNamespace(rc=mqtt.MQTT_ERR_QUEUE_SIZE)
+            self.room -= 1
+        self.published.append((topic, payload, qos))
+        return SimpleNamespace(rc=mqtt.MQTT_ERR_SUCCESS)
+
+
+def fill(backlog, n):
+    for i in range(n):
+        backlog.add(1000 - i, T0 + timedelta(seconds=10 * i), i)
+
+
+def test_only_a_full_paho_queue_counts_as_not_handed_over():
+    assert handed_over(SimpleNamespace(rc=mqtt.MQTT_ERR_SUCCESS))
+    assert handed_over(SimpleNamespace(rc=mqtt.MQTT_ERR_NO_CONN))      # queued, sent on reconnect
+    assert not handed_over(SimpleNamespace(rc=mqtt.MQTT_ERR_QUEUE_SIZE))
+
+
+def test_backlog_drops_the_oldest_beyond_its_size():
+    backlog = ReadingBacklog("d", max_readings=3)
+    fill(backlog, 5)
+    assert len(backlog) == 3 and backlog.dropped == 2
+    client = FakeClient()
+    backlog.flush(client, "milk/weight")
+    (_, payload, _), = client.published
+    assert [r.weight for r in codec.decode_readings(payload, "d")] == [998.0, 997.0, 996.0]
+
+
+def test_flush_sends_batches_oldest_first_and_keeps_message_ids():
+    backlog = ReadingBacklog("d", batch_max=2)
+    fill(backlog, 5)
+    client = FakeClient()
+    assert backlog.flush(client, "milk/weight") == 5
+    assert len(backlog) == 0 and backlog.forwarded == 5
+    batches = [codec.decode_readings(p, "d") for _, p, qos in client.published if qos == 1]
+    assert [len(b) for b in batches] == [2, 2, 1]
+    readings = [r for b in batches for r in b]
+    assert [r.timestamp for r in readings] == [T0 + timedelta(seconds=10 * i) for i in range(5)]
+    assert readings[3].message_id == codec.message_id(3, T0 + timedelta(seconds=30))
+
+
+def test_binary_batches_name_the_device_by_hash():
+    backlog = ReadingBacklog("d", binary=True)
+    fill(backlog, 2)
+    client = FakeClient()
+    backlog.flush(client, codec.binary_topic("milk/weight", "d"))
+    (topic, payload, _), = client.published
+    assert topic == "milk/weight/bin/d"
+    assert [r.message_id for r in codec.decode_readings(payload, "d", binary=True)] == ["0", "1"]
+
+
+def test_flush_stops_at_a_full_queue_and_keeps_the_rest():
+    backlog = ReadingBacklog("d", batch_max=2)
+    fill(backlog, 5)
+    client = FakeClient(room=1)
+    assert backlog.flush(client, "milk/weight") == 2
+    assert len(backlog) == 3
+    client.room = None
+    assert backlog.flush(client, "milk/weight") == 3
+    assert backlog.forwarded == 5
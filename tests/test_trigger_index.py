@@ -0,0 +1,96 @@
+# tests/test_trigger_index.py
+import pytest
+
+from trigger_index import TriggerIndex
+
+CRITICAL_G = 100.0
+DEFAULT_G = 300.0
+
+
+@pytest.fixture
+def sent():
+    return set()   # (user_id, kind) already sent
+
+
+@pytest.fixture
+def index(sent):
+    return TriggerIndex(CRITICAL_G, DEFAULT_G, lambda user_id, kind: (user_id, kind) in sent, stripes=4)
+
+
+def kinds(due):
+    return sorted((user["id"], kind) for user, kind in due)
+
+
+def test_threshold_is_inclusive(index):
+    users = [{"id": 1, "threshold_wanted": 500}]
+    assert index.due("d", users, 500.01) == ([], 500.0)
+    due, next_trigger = index.due("d", users, 500.0)
+    assert kinds(due) == [(1, "warning")] and next_trigger == 500.0
+
+
+def test_critical_is_inclusive(index):
+    users = [{"id": 1, "threshold_wanted": 500}]
+    assert kinds(index.due("d", users, 100.01)[0]) == [(1, "warning")]
+    assert kinds(index.due("d", users, 100.0)[0]) == [(1, "critical")]   # critical replaces the warning
+
+
+def test_default_threshold(index):
+    users = [{"id": 1, "threshold_wanted": None}, {"id": 2}]
+    assert index.due("d", users, DEFAULT_G + 0.5)[0] == []
+    assert kinds(index.due("d", users, DEFAULT_G)[0]) == [(1, "warning"), (2, "warning")]
+
+
+def test_zero_waits_for_grace_period(index):
+    users = [{"id": 1, "threshold_wanted": 500}]
+    assert index.due("d", users, 0) == ([], 500.0)
+    assert index.due("d", users, -3) == ([], 500.0)
+
+
+def test_only_crossed_users(index):
+    users = [{"id": 1, "threshold_wanted": 500}, {"id": 2, "threshold_wanted": 200}]
+    assert kinds(index.due("d", users, 350)[0]) == [(1, "warning")]
+    assert kinds(index.due("d", users, 200)[0]) == [(1, "warning"), (2, "warning")]
+    assert index.stats()["builds"] == 1
+
+
+def test_fired_entries_stop_matching(index):
+    users = [{"id": 1, "threshold_wanted": 500}, {"id": 2, "threshold_wanted": 200}]
+    index.due("d", users, 600)
+    index.fired("d", users[0], "warning")
+    due, next_trigger = index.due("d", users, 400)
+    assert due == [] and next_trigger == 200.0
+    index.fired("d", users[1], "warning")
+    index.fired("d", users[0], "critical")
+    index.fired("d", users[1], "critical")
+    assert index.due("d", users, 50) == ([], None)
+
+
+def test_unfired_alert_due_again(index):
+    # a claim alert_state could not take is not fired, so the next reading retries it
+    users = [{"id": 1, "threshold_wanted": 500}]
+    assert kinds(index.due("d", users, 450)[0]) == [(1, "warning")]
+    assert kinds(index.due("d", users, 440)[0]) == [(1, "warning")]
+
+
+def test_sent_flags_read_on_build(index, sent):
+    users = [{"id": 1, "threshold_wanted": 500}]
+    sent.add((1, "critical"))
+    assert index.due("d", users, 50)[0] == []                     # critical already out, warning not due below it
+    assert kinds(index.due("d", users, 150)[0]) == [(1, "warning")]   # back above critical_g without a refill
+
+
+def test_rebuilt_for_new_user_list_or_invalidate(index, sent):
+    users = [{"id": 1, "threshold_wanted": 500}]
+    index.due("d", users, 600)
+    sent.add((1, "warning"))
+    assert kinds(index.due("d", users, 400)[0]) == [(1, "warning")]   # flags only read on a build
+    index.invalidate("d")
+    assert index.due("d", users, 400)[0] == []
+    sent.clear()
+    assert index.due("d", users, 400)[0] == []                        # same list object: no rebuild
+    assert kinds(index.due("d", list(users), 400)[0]) == [(1, "warning")]
+    assert index.stats()["builds"] == 3
+
+
+def test_no_users(index):
+    assert index.due("d", [], 50) == ([], None)
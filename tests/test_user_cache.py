@@ -0,0 +1,91 @@
+# tests/test_user_cache.py
+import pytest
+
+import device_state
+import user_cache
+from user_cache import DeviceUsersCache
+
+ALICE = {"id": 1, "email": "alice@example.com", "threshold": 20}
+
+
+class Loader:
+    """device_id -> users from `users`; `fail` makes the next lookup raise, `during` runs mid-lookup."""
+
+    def __init__(self, users):
+        self.users = users
+        self.calls = 0
+        self.fail = False
+        self.during = None
+
+    def __call__(self, device_id):
+        self.calls += 1
+        if self.during is not None:
+            self.during()
+        if self.fail:
+            self.fail = False
+            raise OSError("MySQL server has gone away")
+        return self.users.get(device_id, [])
+
+
+@pytest.fixture
+def loader(clock):
+    clock.install(user_cache, device_state)
+    return Loader({"d": [ALICE]})
+
+
+def test_cached_until_the_ttl(loader, clock):
+    cache = DeviceUsersCache(loader, ttl_s=300, negative_ttl_s=60)
+    assert cache.get("d") == [ALICE] and cache.get("d") == [ALICE]
+    assert loader.calls == 1 and cache.stats()["hits"] == 1
+    clock.advance(300)
+    cache.get("d")
+    assert loader.calls == 2
+
+
+def test_devices_without_users_use_the_negative_ttl(loader, clock):
+    cache = DeviceUsersCache(loader, ttl_s=300, negative_ttl_s=60)
+    assert cache.get("empty") == []
+    clock.advance(59)
+    cache.get("empty")
+    assert loader.calls == 1
+    clock.advance(1)
+    loader.users["empty"] = [ALICE]
+    assert cache.get("empty") == [ALICE]
+
+
+def test_db_errors_are_not_cached(loader):
+    cache = DeviceUsersCache(loader)
+    loader.fail = True
+    assert cache.get("d") == [] and cache.errors == 1
+    assert cache.get("d") == [ALICE] and loader.calls == 2
+
+
+def test_invalidate_one_device_or_all(loader):
+    cache = DeviceUsersCache(loader)
+    loader.users["e"] = [ALICE]
+    cache.get("d")
+    cache.get("e")
+    cache.invalidate("d")
+    cache.get("d")
+    cache.get("e")
+    assert loader.calls == 3
+    cache.invalidate()
+    cache.get("e")
+    assert loader.calls == 4 and cache.invalidations == 2
+
+
+@pytest.mark.parametrize("device_id", ["d", None])
+def test_lookup_racing_an_invalidation_is_not_cached(loader, device_id):
+    cache = DeviceUsersCache(loader)
+    loader.during = lambda: cache.invalidate(device_id)
+    assert cache.get("d") == [ALICE]          # the caller still gets the rows...
+    loader.during = None
+    cache.get("d")
+    assert loader.calls == 2                  # ...but they were not kept
+
+
+def test_zero_ttl_disables_the_cache(loader):
+    cache = DeviceUsersCache(loader, ttl_s=0)
+    cache.get("d")
+    cache.get("d")
+    assert loader.calls == 2 and len(cache) == 0
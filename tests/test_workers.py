@@ -0,0 +1,86 @@
+# tests/test_workers.py
+import threading
+import time
+
+import pytest
+
+from workers import ShardedWorkerPool, shard_for
+
+
+def test_shard_for_is_stable():
+    assert shard_for("device-42", 8) == shard_for("device-42", 8)
+    assert {shard_for(f"d{i}", 4) for i in range(100)} == {0, 1, 2, 3}
+
+
+def test_unknown_policy_rejected():
+    with pytest.raises(ValueError):
+        ShardedWorkerPool(overload_policy="wait-forever")
+
+
+def test_device_order_kept_across_shards():
+    seen = {}
+    pool = ShardedWorkerPool(workers=3).start()
+    for i in range(200):
+        device_id = f"d{i % 5}"
+        pool.submit(device_id, lambda d, n: seen.setdefault(d, []).append(n), device_id, i)
+    assert pool.barrier(5)
+    pool.stop()
+    assert all(seen[d] == sorted(seen[d]) for d in seen) and sum(map(len, seen.values())) == 200
+    assert pool.stats()["processed"] == 200
+
+
+def test_failures_counted_and_worker_survives():
+    pool = ShardedWorkerPool(workers=1).start()
+    pool.submit("d", lambda: 1 / 0)
+    pool.submit("d", lambda: None)
+    assert pool.barrier(5)
+    pool.stop()
+    assert pool.stats()["failed"] == 1 and pool.stats()["processed"] == 1
+
+
+def test_shed_rejects_new_items():
+    pool = ShardedWorkerPool(workers=1, queue_depth=2, overload_policy="shed")
+    assert pool.submit("d", print, 1) and pool.submit("d", print, 2)
+    assert not pool.submit("d", print, 3)
+    assert pool.stats()["shed"] == 1 and pool.depth() == 2
+
+
+def test_drop_oldest_is_the_default_and_keeps_pinned_items():
+    pool = ShardedWorkerPool(workers=1, queue_depth=2)
+    assert pool.overload_policy == "drop-oldest"
+    pool.submit_pinned("d", print, "pinned")
+    pool.submit("d", print, 1)
+    pool.submit("d", print, 2)
+    pool.submit("d", print, 3)
+    args = [item[2][0] for item in pool._shards[0].items]
+    assert args == ["pinned", 3] and pool.stats()["dropped_oldest"] == 2
+
+
+def test_block_waits_only_block_timeout_then_sheds():
+    pool = ShardedWorkerPool(workers=1, queue_depth=1, overload_policy="block", block_timeout_s=0.05)
+    pool.submit("d", print, 1)
+    started = time.monotonic()
+    assert not pool.submit("d", print, 2)
+    assert 0.04 <= time.monotonic() - started < 1.0
+    assert pool.stats()["blocked"] == 1 and pool.stats()["shed"] == 1
+
+
+def test_block_gets_space_freed_by_a_worker():
+    release = threading.Event()
+    pool = ShardedWorkerPool(workers=1, queue_depth=1, overload_policy="block", block_timeout_s=5).start()
+    pool.submit("d", release.wait)     # taken by the worker, which then waits
+    pool.submit("d", print, "queued")  # fills the shard
+    threading.Timer(0.05, release.set).start()
+    assert pool.submit("d", print, "after")
+    pool.stop()
+    assert pool.stats()["shed"] == 0 and pool.stats()["processed"] == 3
+
+
+def test_barrier_waits_for_earlier_items():
+    done = []
+    pool = ShardedWorkerPool(workers=2).start()
+    for i in range(4):
+        pool.submit(f"d{i}", lambda i=i: (time.sleep(0.01), done.append(i)))
+    assert pool.barrier(5)
+    assert sorted(done) == [0, 1, 2, 3]
+    pool.stop()
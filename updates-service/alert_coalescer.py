@@ -0,0 +1,136 @@
+# updates-service/alert_coalescer.py
+"""
+Per-recipient alert coalescing.
+
+Alerts are not mailed one by one: the first alert for a recipient opens a
+hold window (window_s), and everything else for that recipient arriving
+within it goes out together as one email when the window closes. A
+household with several devices, or a device bouncing around a threshold,
+then gets a single digest instead of a burst of emails.
+
+Urgent alerts ("critical", "over") shorten the hold to critical_window_s,
+also for alerts already held. Within a digest each device keeps only its
+most severe alert (latest weight on ties), so a device that went warning ->
+critical inside the window is reported once, as critical. A hold that
+reaches max_alerts is sent straight away.
+
+Windows run on a DeadlineScheduler; flush() is called with the recipient and
+the held alerts (oldest first) and builds and queues the email. stop() sends
+whatever is still held. window_s <= 0 disables coalescing.
+"""
+from __future__ import annotations
+import time
+import threading
+
+from deadline_scheduler import DeadlineScheduler
+
+SEVERITY = {"warning": 1, "critical": 2, "over": 3}
+URGENT = ("critical", "over")
+
+
+class HeldAlert:
+    __slots__ = ("kind", "device_id", "weight", "at")
+
+    def __init__(self, kind: str, device_id, weight, at):
+        self.kind = kind            # "warning" | "critical" | "over"
+        self.device_id = device_id
+        self.weight = weight        # grams (None for "over")
+        self.at = at                # datetime the alert was raised
+
+
+class _Hold:
+    __slots__ = ("full_name", "alerts", "deadline")
+
+    def __init__(self, full_name):
+        self.full_name = full_name
+        self.alerts = []
+        self.deadline = None        # monotonic time the hold is flushed
+
+
+class AlertCoalescer:
+    """
+    flush             -> callback(to_email, full_name, alerts) that sends one email
+    window_s          -> how long alerts for a recipient are held (0 = no coalescing)
+    critical_window_s -> the hold once a critical / 'milk is over' alert is in it
+    max_alerts        -> flush early when a hold reaches this many alerts
+    """
+
+    def __init__(self, flush, window_s: float = 60, critical_window_s: float = 5, max_alerts: int = 20,
+                 log_prefix: str = "[updates]"):
+        self.flush = flush
+        self.window_s = float(window_s)
+        self.critical_window_s = min(float(critical_window_s), self.window_s)
+        self.max_alerts = max(1, int(max_alerts))
+        self.log_prefix = log_prefix
+        self._holds = {}                # to_email -> _Hold
+        self._lock = threading.Lock()
+        self._scheduler = DeadlineScheduler(name="alert-coalescer", log_prefix=log_prefix)
+
+        # Counters (read via stats())
+        self.alerts = 0
+        self.merged = 0
+        self.emails = 0
+
+    def start(self):
+        self._scheduler.start()
+        return self
+
+    def stop(self):
+        """Send every held digest now."""
+        self._scheduler.stop()
+        with self._lock:
+            recipients = list(self._holds)
+        for to in recipients:
+            self._flush(to)
+
+    def held(self) -> int:
+        with self._lock:
+            return sum(len(h.alerts) for h in self._holds.values())
+
+    def add(self, to_email: str, full_name, kind: str, device_id=None, weight=None, at=None):
+        """Hold an alert for to_email; it goes out with anything else raised for them within the window."""
+        alert = HeldAlert(kind, device_id, weight, at)
+        with self._lock:
+            self.alerts += 1
+        if self.window_s <= 0:
+            self._send(to_email, full_name, [alert])
+            return
+        window = self.critical_window_s if kind in URGENT else self.window_s
+        now = time.monotonic()
+        with self._lock:
+            hold = self._holds.get(to_email)
+            if hold is None:
+                hold = self._holds[to_email] = _Hold(full_name)
+            else:
+                self.merged += 1
+            self._merge(hold, alert)
+            full = len(hold.alerts) >= self.max_alerts
+            deadline = now if full else now + window
+            if hold.deadline is None or deadline < hold.deadline:
+                hold.deadline = deadline
+                self._scheduler.schedule(to_email, deadline - now, self._flush, to_email)
+
+    @staticmethod
+    def _merge(hold: _Hold, alert: HeldAlert):
+        for i, held in enumerate(hold.alerts):
+            if held.device_id == alert.device_id:
+                if SEVERITY.get(alert.kind, 0) >= SEVERITY.get(held.kind, 0):
+                    hold.alerts[i] = alert
+                return
+        hold.alerts.append(alert)
+
+    def _flush(self, to_email: str):
+        with self._lock:
+            hold = self._holds.pop(to_email, None)
+        if hold is not None and hold.alerts:
+            self._send(to_email, hold.full_name, hold.alerts)
+
+    def _send(self, to_email: str, full_name, alerts: list):
+        with self._lock:
+            self.emails += 1
+        if len(alerts) > 1:
+            print(f"{self.log_prefix} 📬 Sending {len(alerts)} alerts to {to_email} as one digest")
+        self.flush(to_email, full_name, alerts)
+
+    def stats(self) -> dict:
+        return {"held": self.held(), "alerts": self.alerts, "merged": self.merged, "emails": self.emails}
@@ -0,0 +1,179 @@
+# updates-service/alert_state.py
+"""
+Durable alert flags shared by every updates-service replica.
+
+alert_state holds one row per (user, alert type) that went out. Sending is
+claim-then-send: a replica first inserts the row with INSERT IGNORE, and only
+the one whose insert affected a row sends the email. The others (another
+replica, or this one after a restart) see 0 rows and skip it. A refill
+deletes the user's warning / critical rows so the next low level alerts
+again.
+
+'over' (milk is over) is sent once per carton removal: its row is claimed
+again by a conditional UPDATE that only matches when the stored sent_at is
+older than the removal. Both statements are single-row and atomic, so
+exactly one replica wins. (ON DUPLICATE KEY UPDATE is avoided because
+mysql-connector reports found rows, so its rowcount cannot tell an insert
+from a no-op.)
+
+Claims are written through the caller's per-user cache (the `cache` store
+with warning_sent / critical_sent flags): a flag that is already set never
+touches MySQL, so the DB is only written when an alert would go out. The
+statements share one long-lived autocommit connection, pinged before use
+after ping_idle_s without traffic.
+
+If MySQL is unreachable the claim fails closed: claim() returns UNAVAILABLE,
+nothing is cached, and the caller sends nothing and tries again later (the
+next reading, or a retry timer). Sending anyway would email the user once
+per replica for as long as the outage lasts; waiting only delays the alert.
+
+The cached flags are never snapshotted: a refill handled by another replica
+while this one was down would otherwise come back as "already sent". After
+a restart the cache starts empty and fills from the claims.
+"""
+from __future__ import annotations
+import time
+import threading
+from datetime import datetime
+
+ALERT_STATE_DDL = """
+    CREATE TABLE IF NOT EXISTS alert_state (
+      user_id    INT UNSIGNED NOT NULL,
+      alert_type VARCHAR(16)  NOT NULL,   -- 'warning' | 'critical' | 'over'
+      sent_at    DATETIME     NOT NULL,   -- UTC
+      replica    VARCHAR(64)  NOT NULL,   -- replica that sent it
+      PRIMARY KEY (user_id, alert_type)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+"""
+
+CACHED_TYPES = ("warning", "critical")   # flags mirrored in the cache records
+
+# claim() outcomes
+CLAIMED = "claimed"            # this replica sends the alert
+ALREADY_SENT = "already sent"  # claimed elsewhere, or before a restart
+UNAVAILABLE = "unavailable"    # MySQL unreachable: send nothing, claim again later
+
+
+class AlertClaims:
+    """
+    connect     -> returns a new autocommit MySQL connection (kept open and reused)
+    cache       -> DeviceStateStore of per-user records with <type>_sent flags
+    ping_idle_s -> ping the connection before use when it was idle this long
+    """
+
+    def __init__(self, connect, cache, replica_id: str, ping_idle_s: float = 30,
+                 log_prefix: str = "[updates]"):
+        self.connect = connect
+        self.cache = cache
+        self.replica_id = replica_id
+        self.ping_idle_s = ping_idle_s
+        self.log_prefix = log_prefix
+        self._lock = threading.Lock()
+        self._conn = None
+        self._last_used = 0.0
+
+        # Counters (read via stats())
+        self.claimed = 0
+        self.lost = 0        # already claimed elsewhere (or before a restart)
+        self.errors = 0      # claims (and resets) that could not reach MySQL
+
+    def ensure_table(self):
+        self._execute(ALERT_STATE_DDL)
+
+    def _execute(self, sql: str, params=()) -> int:
+        """Run one statement on the shared connection; returns its rowcount."""
+        with self._lock:
+            now = time.monotonic()
+            if self._conn is not None and now - self._last_used >= self.ping_idle_s:
+                try:
+                    self._conn.ping()
+                except Exception:
+                    self._close()
+            if self._conn is None:
+                self._conn = self.connect()
+            try:
+                cur = self._conn.cursor()
+                cur.execute(sql, params)
+                rowcount = cur.rowcount
+                cur.close()
+            except Exception:
+                self._close()   # reconnect on the next call
+                raise
+            self._last_used = now
+            return rowcount
+
+    def _close(self):
+        try:
+            self._conn.close()
+        except Exception:
+            pass
+        self._conn = None
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._close()
+
+    def is_sent(self, user_id, alert_type: str) -> bool:
+        """Cached flag only (no DB read); claim() is the authoritative check."""
+        st = self.cache.get(user_id)
+        return st is not None and getattr(st, f"{alert_type}_sent")
+
+    def claim(self, user_id, alert_type: str, now: datetime, since: datetime = None) -> str:
+        """
+        CLAIMED if this replica should send the alert, ALREADY_SENT if not,
+        UNAVAILABLE if MySQL could not be asked (send nothing, nothing is
+        cached). For 'over' pass since=the removal time: an earlier 'over'
+        row for the user is re-claimed.
+        """
+        try:
+            claimed = self._claim(user_id, alert_type, now, since)
+        except Exception as e:
+            self.errors += 1
+            print(f"{self.log_prefix} ⚠️ Could not claim {alert_type} alert for user {user_id} ({e}); not sending it yet")
+            return UNAVAILABLE
+        if alert_type in CACHED_TYPES:
+            with self.cache.locked(user_id) as st:
+                setattr(st, f"{alert_type}_sent", True)
+        if claimed:
+            self.claimed += 1
+            return CLAIMED
+        self.lost += 1
+        return ALREADY_SENT
+
+    def _claim(self, user_id, alert_type: str, now: datetime, since) -> bool:
+        inserted = self._execute(
+            "INSERT IGNORE INTO alert_state (user_id, alert_type, sent_at, replica) VALUES (%s, %s, %s, %s)",
+            (user_id, alert_type, now, self.replica_id),
+        )
+        if inserted == 1 or since is None:
+            return inserted == 1
+        return self._execute(
+            "UPDATE alert_state SET sent_at = %s, replica = %s "
+            "WHERE user_id = %s AND alert_type = %s AND sent_at < %s",
+            (now, self.replica_id, user_id, alert_type, since),
+        ) == 1
+
+    def reset(self, user_ids) -> int:
+        """Refill: forget the users' warning / critical alerts, here and in MySQL. Returns cached records dropped."""
+        user_ids = list(user_ids)
+        dropped = sum(self.cache.pop(u) is not None for u in user_ids)
+        if not user_ids:
+            return dropped
+        marks = ", ".join(["%s"] * len(user_ids))
+        try:
+            self._execute(
+                f"DELETE FROM alert_state WHERE user_id IN ({marks}) AND alert_type IN ('warning', 'critical')",
+                tuple(user_ids),
+            )
+        except Exception as e:
+            self.errors += 1
+            print(f"{self.log_prefix} ⚠️ Could not reset alert state for users {user_ids}: {e}")
+        return dropped
+
+    def forget_cached(self, user_ids) -> int:
+        """Drop cached flags only (another replica already reset MySQL)."""
+        return sum(self.cache.pop(u) is not None for u in user_ids)
+
+    def stats(self) -> dict:
+        return {"cached": len(self.cache), "claimed": self.claimed, "lost": self.lost, "errors": self.errors}
@@ -0,0 +1,188 @@
+# device_state.py (shared by analysis-service and updates-service; keep both copies identical)
+"""
+Bounded, thread-safe per-device state store.
+
+Records are small `__slots__` objects (subclasses of StateRecord) kept in
+lock-striped LRU maps: a key hashes onto one of `stripes` shards, each with its
+own re-entrant lock and an OrderedDict in least-recently-used order. Threads
+working on different devices rarely contend, and the same device is always
+serialised on the same lock.
+
+Eviction keeps memory flat however many devices have ever reported:
+  ttl_s        -> records idle for longer than this are dropped
+  max_records  -> hard cap; the least recently used record goes first
+Both are applied to a shard when a new key is inserted into it (the LRU end
+of an OrderedDict is O(1) to inspect), and sweep() applies the TTL to every
+shard. Records for which `keep(record)` is true (e.g. a pending timer) are
+never evicted.
+
+dump()/load() turn the store into plain lists (field names plus values) for
+snapshot.py, so a restarted service resumes with the same records.
+"""
+from __future__ import annotations
+import time
+import zlib
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class StateRecord:
+    """Base class for stored records; subclasses add their own __slots__."""
+    __slots__ = ("touched",)
+
+
+class _Stripe:
+    __slots__ = ("lock", "records")
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.records = OrderedDict()
+
+
+class DeviceStateStore:
+    def __init__(self, record_type, stripes: int = 64, max_records: int = 0, ttl_s: float = 0,
+                 keep=None):
+        self.record_type = record_type
+        self._stripes = [_Stripe() for _ in range(max(1, int(stripes)))]
+        self.max_records = max(0, int(max_records))
+        # Per-stripe share of the cap, so eviction never needs a global lock
+        self._stripe_cap = -(-self.max_records // len(self._stripes)) if self.max_records else 0
+        self.ttl_s = ttl_s
+        self._keep = keep
+        self.evicted_ttl = 0
+        self.evicted_lru = 0
+
+    def _stripe(self, key) -> _Stripe:
+        k = key if isinstance(key, bytes) else str(key).encode("utf-8")
+        return self._stripes[zlib.crc32(k) % len(self._stripes)]
+
+    # ---------- access ----------
+    @contextmanager
+    def locked(self, key, create: bool = True):
+        """
+        Hold the key's stripe lock and yield its record (created if missing
+        and create=True, otherwise possibly None). Mutate the record only
+        inside the block.
+        """
+        stripe = self._stripe(key)
+        with stripe.lock:
+            rec = stripe.records.get(key)
+            now = time.monotonic()
+            if rec is None and create:
+                rec = self.record_type()
+                rec.touched = now
+                stripe.records[key] = rec
+                self._evict(stripe, now, protect=key)
+            elif rec is not None:
+                rec.touched = now
+                stripe.records.move_to_end(key)
+            yield rec
+
+    def get(self, key):
+        """Current record or None; does not refresh its LRU position."""
+        stripe = self._stripe(key)
+        with stripe.lock:
+            return stripe.records.get(key)
+
+    def pop(self, key):
+        stripe = self._stripe(key)
+        with stripe.lock:
+            return stripe.records.pop(key, None)
+
+    def __contains__(self, key) -> bool:
+        stripe = self._stripe(key)
+        with stripe.lock:
+            return key in stripe.records
+
+    def __len__(self) -> int:
+        return sum(len(s.records) for s in self._stripes)
+
+    def keys(self):
+        out = []
+        for stripe in self._stripes:
+            with stripe.lock:
+                out.extend(stripe.records.keys())
+        return out
+
+    # ---------- eviction ----------
+    def _evictable(self, rec) -> bool:
+        return self._keep is None or not self._keep(rec)
+
+    def _evict(self, stripe: _Stripe, now: float, protect=None):
+        records = stripe.records
+        cutoff = now - self.ttl_s if self.ttl_s > 0 else None
+        skipped = 0
+        while records and skipped < len(records):
+            key = next(iter(records))          # least recently used
+            rec = records[key]
+            expired = cutoff is not None and rec.touched < cutoff
+            over_cap = self._stripe_cap and len(records) > self._stripe_cap
+            if not (expired or over_cap):
+                break                          # everything after it is newer
+            if key == protect or not self._evictable(rec):
+                records.move_to_end(key)       # pinned: look past it
+                skipped += 1
+                continue
+            del records[key]
+            if expired:
+                self.evicted_ttl += 1
+            else:
+                self.evicted_lru += 1
+
+    def sweep(self) -> int:
+        """Apply TTL and cap to every stripe; returns how many records were dropped."""
+        before = self.evicted_ttl + self.evicted_lru
+        now = time.monotonic()
+        for stripe in self._stripes:
+            with stripe.lock:
+                self._evict(stripe, now)
+        return self.evicted_ttl + self.evicted_lru - before
+
+    # ---------- snapshots ----------
+    def _fields(self) -> list:
+        names = []
+        for cls in reversed(self.record_type.__mro__):
+            names.extend(n for n in getattr(cls, "__slots__", ()) if n != "touched")
+        return names
+
+    def dump(self) -> dict:
+        """Field names and [key, idle seconds, values] per record."""
+        fields = self._fields()
+        now = time.monotonic()
+        records = []
+        for stripe in self._stripes:
+            with stripe.lock:
+                for key, rec in stripe.records.items():
+                    records.append([key, now - rec.touched, [getattr(rec, f) for f in fields]])
+        return {"fields": fields, "records": records}
+
+    def load(self, data: dict) -> int:
+        """
+        Insert records from dump(). Fields are matched by name, so records
+        dumped before a field was added or removed still load. Returns the
+        number of records loaded.
+        """
+        known = set(self._fields())
+        fields = data["fields"]
+        now = time.monotonic()
+        loaded = 0
+        # Longest-idle first, so each stripe's LRU order survives a change in stripe count
+        for key, idle_s, values in sorted(data["records"], key=lambda r: -r[1]):
+            if isinstance(key, list):
+                key = tuple(key)
+            rec = self.record_type()
+            for name, value in zip(fields, values):
+                if name in known:
+                    setattr(rec, name, value)
+            rec.touched = now - max(0.0, idle_s)
+            stripe = self._stripe(key)
+            with stripe.lock:
+                stripe.records[key] = rec
+                stripe.records.move_to_end(key)
+            loaded += 1
+        self.sweep()
+        return loaded
+
+    def stats(self) -> dict:
+        return {"records": len(self), "evicted_ttl": self.evicted_ttl, "evicted_lru": self.evicted_lru}
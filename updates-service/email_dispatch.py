@@ -0,0 +1,232 @@
+# updates-service/email_dispatch.py
+"""
+Background email dispatch over long-lived SMTP sessions.
+
+Callers (the MQTT callback, the grace-period scheduler) only build the
+message and submit() it; a bounded queue is drained by `workers` threads, so
+at most that many SMTP connections are open and a slow or unreachable mail
+server never holds up MQTT processing.
+
+Each worker keeps its session open between messages: connect, STARTTLS and
+login happen once per session instead of once per email. A session is closed
+after `session_max_messages` messages, after `session_idle_s` without work,
+and after any error. A message that fails on a reused session because the
+server dropped it is resent once on a fresh session straight away; other
+failures are retried after an exponential backoff with jitter (on a
+DeadlineScheduler, so no worker sleeps) until `max_attempts`. 5xx replies
+are permanent and not retried.
+
+With dry_run nothing is sent; messages are logged instead.
+"""
+from __future__ import annotations
+import time
+import queue
+import random
+import smtplib
+import itertools
+import threading
+
+from deadline_scheduler import DeadlineScheduler
+
+
+class EmailJob:
+    __slots__ = ("msg", "label", "attempts", "queued_at")
+
+    def __init__(self, msg, label: str):
+        self.msg = msg              # email.message.EmailMessage
+        self.label = label          # what the email is, for the log ("critical alert", ...)
+        self.attempts = 0
+        self.queued_at = time.monotonic()
+
+
+def _permanent(e: Exception) -> bool:
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        return True
+    return isinstance(e, smtplib.SMTPResponseException) and 500 <= e.smtp_code < 600
+
+
+class EmailDispatcher:
+    """
+    connect              -> returns a logged-in smtplib.SMTP / SMTP_SSL session
+    workers              -> sending threads, i.e. the most SMTP sessions open at once
+    queue_max            -> messages waiting to be sent; submit() drops new ones beyond this
+    max_attempts         -> sends per message before giving up (1 = no retries)
+    backoff_s            -> delay before the first retry, doubled per attempt up to backoff_max_s
+    session_max_messages -> messages per session before it is recycled
+    session_idle_s       -> an idle session is closed after this long
+    observe              -> optional callback(stage, seconds) for latency metrics
+    """
+
+    def __init__(self, connect, workers: int = 2, queue_max: int = 1000, max_attempts: int = 5,
+                 backoff_s: float = 5.0, backoff_max_s: float = 300.0, session_max_messages: int = 100,
+                 session_idle_s: float = 60.0, dry_run: bool = False, observe=None,
+                 log_prefix: str = "[updates]"):
+        self.connect = connect
+        self.workers = max(1, int(workers))
+        self.max_attempts = max(1, int(max_attempts))
+        self.backoff_s = float(backoff_s)
+        self.backoff_max_s = float(backoff_max_s)
+        self.session_max_messages = max(1, int(session_max_messages))
+        self.session_idle_s = float(session_idle_s)
+        self.dry_run = dry_run
+        self.observe = observe
+        self.log_prefix = log_prefix
+        self._queue = queue.Queue(maxsize=max(1, int(queue_max)))
+        self._retries = DeadlineScheduler(name="email-retry", log_prefix=log_prefix)
+        self._retry_keys = itertools.count()
+        self._threads = []
+        self._lock = threading.Lock()
+
+        # Counters (read via stats())
+        self.submitted = 0
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.dropped = 0
+        self.sessions_opened = 0
+
+    # ---------- producer side ----------
+    def submit(self, msg, label: str = "email") -> bool:
+        """Queue msg for sending; False if the queue is full and it was dropped."""
+        with self._lock:
+            self.submitted += 1
+        return self._enqueue(EmailJob(msg, label))
+
+    def _enqueue(self, job: EmailJob) -> bool:
+        try:
+            self._queue.put_nowait(job)
+            return True
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            print(f"{self.log_prefix} ❌ Email queue full ({self._queue.maxsize}), dropping {job.label} email "
+                  f"to {job.msg['To']}")
+            return False
+
+    def depth(self) -> int:
+        """Messages waiting for a worker (retries waiting out their backoff not included)."""
+        return self._queue.qsize()
+
+    def retries_pending(self) -> int:
+        return self._retries.pending()
+
+    # ---------- lifecycle ----------
+    def start(self):
+        if not self._threads:
+            self._retries.start()
+            for i in range(self.workers):
+                t = threading.Thread(target=self._run, name=f"email-sender-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+        return self
+
+    def stop(self, timeout_s: float = 10.0):
+        """Send what is queued (within timeout_s) and close the sessions; pending retries are abandoned."""
+        self._retries.stop()
+        abandoned = self._retries.pending()
+        deadline = time.monotonic() + timeout_s
+        for _ in self._threads:
+            try:
+                self._queue.put(None, timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Full:
+                break
+        for t in self._threads:
+            t.join(timeout=max(0.0, deadline - time.monotonic()))
+        self._threads = []
+        left = self._queue.qsize() + abandoned
+        if left:
+            print(f"{self.log_prefix} ⚠️ Email dispatcher stopped with {left} email(s) unsent")
+
+    # ---------- workers ----------
+    def _run(self):
+        session = None
+        sent_in_session = 0
+        while True:
+            try:
+                job = self._queue.get(timeout=self.session_idle_s if session is not None else None)
+            except queue.Empty:
+                session = self._close(session)   # idle: don't hold the server's connection slot
+                continue
+            if job is None:
+                self._close(session)
+                return
+            if session is not None and sent_in_session >= self.session_max_messages:
+                session = self._close(session)
+            try:
+                session, sent_in_session = self._send(job, session, sent_in_session)
+            except Exception as e:
+                session = None   # _send closed it
+                self._failed(job, e)
+
+    def _send(self, job: EmailJob, session, sent_in_session: int):
+        job.attempts += 1
+        if self.observe is not None:
+            self.observe("email_queue_wait", time.monotonic() - job.queued_at)
+        if self.dry_run:
+            print(f"{self.log_prefix} 📧 DRY RUN: would send {job.label} email to {job.msg['To']}: {job.msg['Subject']}")
+            with self._lock:
+                self.sent += 1
+            return session, sent_in_session
+        started = time.perf_counter()
+        try:
+            if session is None:
+                session, sent_in_session = self._open(), 0
+            try:
+                session.send_message(job.msg)
+            except smtplib.SMTPServerDisconnected:
+                if sent_in_session == 0:
+                    raise
+                # The server closed a session we kept open between messages: resend on a fresh one
+                session = self._close(session)
+                session, sent_in_session = self._open(), 0
+                session.send_message(job.msg)
+        except Exception:
+            self._close(session)
+            raise
+        sent_in_session += 1
+        if self.observe is not None:
+            self.observe("email_send", time.perf_counter() - started)
+        with self._lock:
+            self.sent += 1
+        print(f"{self.log_prefix} ✅ {job.label} email sent to {job.msg['To']}")
+        return session, sent_in_session
+
+    def _open(self):
+        session = self.connect()
+        with self._lock:
+            self.sessions_opened += 1
+        return session
+
+    def _close(self, session):
+        if session is not None:
+            try:
+                session.quit()
+            except Exception:
+                try:
+                    session.close()
+                except Exception:
+                    pass
+        return None
+
+    def _failed(self, job: EmailJob, e: Exception):
+        to = job.msg["To"]
+        if _permanent(e) or job.attempts >= self.max_attempts:
+            with self._lock:
+                self.failed += 1
+            print(f"{self.log_prefix} ❌ Failed to send {job.label} email to {to} "
+                  f"(attempt {job.attempts}/{self.max_attempts}, giving up): {e}")
+            return
+        delay = min(self.backoff_max_s, self.backoff_s * 2 ** (job.attempts - 1))
+        delay *= 0.5 + random.random() / 2   # jitter: retries after an outage don't all land at once
+        with self._lock:
+            self.retried += 1
+        print(f"{self.log_prefix} ⚠️ Failed to send {job.label} email to {to} "
+              f"(attempt {job.attempts}/{self.max_attempts}): {e}; retrying in {delay:.0f}s")
+        job.queued_at = time.monotonic() + delay
+        self._retries.schedule(next(self._retry_keys), delay, self._enqueue, job)
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = {"submitted": self.submitted, "sent": self.sent, "retried": self.retried,
+                        "failed": self.failed, "dropped": self.dropped, "sessions_opened": self.sessions_opened}
+        return {"queued": self._queue.qsize(), "retries_pending": self._retries.pending(), **counters}
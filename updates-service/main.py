@@ -1,11 +1,25 @@
-import paho.mqtt.client as mqtt
-import os, time, json
+import os, sys, time
+import json
+import atexit
+import signal
 from datetime import datetime, timedelta
 from email.message import EmailMessage
 import mysql.connector
 import smtplib
 import ssl
-import threading
+
+from alert_coalescer import SEVERITY, AlertCoalescer
+from alert_state import CLAIMED, UNAVAILABLE, AlertClaims
+from deadline_scheduler import DeadlineScheduler
+from dedup import DuplicateFilter
+from device_state import DeviceStateStore, StateRecord
+from email_dispatch import EmailDispatcher
+from metrics import Metrics
+from mqtt_topics import content_type, make_client, parse_topic, subscribe_all, subscription_filters
+import payload_codec
+from snapshot import Snapshotter, read_snapshot
+from trigger_index import TriggerIndex
+from user_cache import DeviceUsersCache
 
 # =========================
 # Config (env with defaults)
@@ -13,6 +27,14 @@ import threading
 MQTT_HOST  = os.getenv("MQTT_HOST", "mqtt")
 MQTT_PORT  = int(os.getenv("MQTT_PORT", "1883"))
 MQTT_TOPIC = os.getenv("MQTT_TOPIC", "milk/weight")
+MQTT_PER_DEVICE_TOPICS = os.getenv("MQTT_PER_DEVICE_TOPICS", "true").lower() == "true"  # also subscribe to <MQTT_TOPIC>/+
+# Sent alerts are claimed in alert_state, shared by every replica. Carton-removal grace timers and refill
+# detection are per replica, so a shared group needs each device's readings to stay on one replica
+MQTT_SHARED_GROUP = os.getenv("MQTT_SHARED_GROUP", "")
+MQTT_PROTOCOL = os.getenv("MQTT_PROTOCOL", "5" if MQTT_SHARED_GROUP else "3.1.1")   # 3.1.1 | 5
+# users-service publishes here after it changes users; never shared, every replica drops its cached users
+MQTT_CONTROL_TOPIC = os.getenv("MQTT_CONTROL_TOPIC", "milk/control/users")           # empty disables
+REPLICA_ID = os.getenv("REPLICA_ID", os.getenv("HOSTNAME", "updates-0"))              # recorded with each alert sent
 
 MYSQL_CONFIG = {
     "host":     os.getenv("MYSQL_HOST", "mysql"),
@@ -33,31 +55,106 @@ SMTP_USER   = os.getenv("SMTP_USER")             # e.g., gmail address
 SMTP_PASS   = os.getenv("SMTP_PASS")             # app password / smtp key
 FROM_EMAIL  = os.getenv("FROM_EMAIL", SMTP_USER) # sender identity
 DRY_RUN     = os.getenv("DRY_RUN_EMAIL", "false").lower() == "true"
+SMTP_TIMEOUT_SEC = float(os.getenv("SMTP_TIMEOUT_SEC", "30"))    # connect / command timeout
+
+# Emails are sent from a background queue over a few long-lived SMTP sessions
+EMAIL_WORKERS = int(os.getenv("EMAIL_WORKERS", "2"))                          # concurrent SMTP sessions
+EMAIL_QUEUE_MAX = int(os.getenv("EMAIL_QUEUE_MAX", "1000"))                   # queued emails beyond this are dropped
+EMAIL_MAX_ATTEMPTS = int(os.getenv("EMAIL_MAX_ATTEMPTS", "5"))                # sends per email before giving up
+EMAIL_RETRY_BACKOFF_SEC = float(os.getenv("EMAIL_RETRY_BACKOFF_SEC", "5"))    # first retry delay, doubled per attempt
+EMAIL_RETRY_BACKOFF_MAX_SEC = float(os.getenv("EMAIL_RETRY_BACKOFF_MAX_SEC", "300"))
+EMAIL_SESSION_MAX_MESSAGES = int(os.getenv("EMAIL_SESSION_MAX_MESSAGES", "100"))  # recycle a session after this many
+EMAIL_SESSION_IDLE_SEC = float(os.getenv("EMAIL_SESSION_IDLE_SEC", "60"))         # close idle sessions
 
-# Throttle (avoid spamming): minutes between emails per user
-ALERT_COOLDOWN_MIN = int(os.getenv("ALERT_COOLDOWN_MIN", "60"))
+# Alerts for the same recipient are held briefly and sent as one email
+ALERT_DIGEST_WINDOW_SEC = float(os.getenv("ALERT_DIGEST_WINDOW_SEC", "60"))     # hold window (0 sends every alert on its own)
+ALERT_DIGEST_CRITICAL_SEC = float(os.getenv("ALERT_DIGEST_CRITICAL_SEC", "5"))  # shorter hold once a critical / 'milk is over' alert is in it
+ALERT_DIGEST_MAX_ALERTS = int(os.getenv("ALERT_DIGEST_MAX_ALERTS", "20"))       # send early when this many are held
+
+# Prometheus text metrics served on http://<pod>:METRICS_PORT/metrics (0 disables the endpoint)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
 
 # Update the configuration and tracking
 ALERT_THRESHOLD_LOW = float(os.getenv("ALERT_THRESHOLD_LOW", "200"))    # First alert at 200g
 ALERT_THRESHOLD_CRITICAL = float(os.getenv("ALERT_THRESHOLD_CRITICAL", "100"))  # Second alert at 100g
+ALERT_CLAIM_RETRY_SEC = float(os.getenv("ALERT_CLAIM_RETRY_SEC", "60"))  # retry of a 'milk is over' claim while MySQL is down
 
 # Carton removal detection configuration
 CARTON_REMOVAL_GRACE_PERIOD_MIN = int(os.getenv("CARTON_REMOVAL_GRACE_PERIOD_MIN", "1"))  # Wait 1 minute before alerting on 0g
 
-# Track which alerts have been sent for each device
-_device_alerts_sent = {}  # {device_id: {"200": True, "100": True}}
-
-# In-memory cooldown tracker per device
-_device_cooldown_utc = {}  # {device_id: datetime}
-
-# Carton removal tracking per device - tracks previous weight before 0g
-_device_carton_removal_tracking = {}  # {device_id: {"previous_weight": float, "zero_time": datetime, "grace_period_active": bool}}
-
-# User-based alert tracking per user - NEW: Track alerts per user instead of per device
-_user_alerts_sent = {}  # {user_id: {"200": True, "100": True}}
-
-# Add this global variable at the top with other tracking variables
-_last_weight_by_device = {}  # device_id -> weight
+# Per-device / per-user state store: idle records are evicted so memory stays flat
+DEVICE_STATE_TTL_HOURS = float(os.getenv("DEVICE_STATE_TTL_HOURS", "168"))   # drop devices idle this long
+DEVICE_STATE_MAX = int(os.getenv("DEVICE_STATE_MAX", "200000"))              # LRU cap per store
+DEVICE_STATE_STRIPES = int(os.getenv("DEVICE_STATE_STRIPES", "64"))          # lock stripes
+DEVICE_STATE_SWEEP_MIN = float(os.getenv("DEVICE_STATE_SWEEP_MIN", "15"))    # how often idle records are swept
+
+# Warm restarts: carton tracking and grace periods are snapshotted to a local file and restored on startup
+# (sent-alert flags are not: alert_state in MySQL is their source of truth)
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", "/var/lib/smart-milk/updates-state.snap")   # empty disables snapshots
+SNAPSHOT_INTERVAL_SEC = float(os.getenv("SNAPSHOT_INTERVAL_SEC", "30"))               # periodic snapshot (plus one on shutdown)
+SNAPSHOT_MAX_AGE_MIN = float(os.getenv("SNAPSHOT_MAX_AGE_MIN", "1440"))               # older snapshots are ignored
+
+# QoS 1 redeliveries are dropped by (device_id, message_id) before any DB or SMTP work
+DEDUP_WINDOW_SEC = float(os.getenv("DEDUP_WINDOW_SEC", "600"))   # remember message ids this long (0 disables)
+DEDUP_MAX_KEYS = int(os.getenv("DEDUP_MAX_KEYS", "200000"))      # memory bound; the window shrinks when it is hit
+
+# Device -> users lookups are cached; MQTT_CONTROL_TOPIC messages invalidate them early
+USER_CACHE_TTL_SEC = float(os.getenv("USER_CACHE_TTL_SEC", "300"))                  # 0 queries MySQL for every reading
+USER_CACHE_NEGATIVE_TTL_SEC = float(os.getenv("USER_CACHE_NEGATIVE_TTL_SEC", "60"))  # devices without users
+
+class DeviceAlertState(StateRecord):
+    """Everything updates-service remembers about one device."""
+    __slots__ = ("previous_weight", "zero_time", "grace_period_active", "last_weight")
+
+    def __init__(self):
+        self.previous_weight = None        # carton tracking: last positive weight (None = not tracked)
+        self.zero_time = None              # carton tracking: when the current 0g period started
+        self.grace_period_active = False
+        self.last_weight = None            # last weight seen, for refill detection
+
+class UserAlertState(StateRecord):
+    """Alerts already sent to one user since the last refill."""
+    __slots__ = ("warning_sent", "critical_sent")
+
+    def __init__(self):
+        self.warning_sent = False
+        self.critical_sent = False
+
+# Devices with a running grace period are never evicted (their deadline still needs them)
+_device_state = DeviceStateStore(
+    DeviceAlertState,
+    stripes=DEVICE_STATE_STRIPES,
+    max_records=DEVICE_STATE_MAX,
+    ttl_s=DEVICE_STATE_TTL_HOURS * 3600,
+    keep=lambda st: st.grace_period_active,
+)
+_user_state = DeviceStateStore(
+    UserAlertState,
+    stripes=DEVICE_STATE_STRIPES,
+    max_records=DEVICE_STATE_MAX,
+    ttl_s=DEVICE_STATE_TTL_HOURS * 3600,
+)
+
+# Sent alerts are claimed in MySQL (alert_state) before sending; _user_state caches the flags
+_alert_claims = AlertClaims(lambda: mysql.connector.connect(**MYSQL_CONFIG, autocommit=True), _user_state, REPLICA_ID)
+
+# Sorted pending alert thresholds per device; readings above the highest one skip the per-user checks
+_trigger_index = TriggerIndex(
+    ALERT_THRESHOLD_CRITICAL,
+    ALERT_THRESHOLD_LOW,
+    _alert_claims.is_sent,
+    stripes=DEVICE_STATE_STRIPES,
+    max_devices=DEVICE_STATE_MAX,
+    ttl_s=DEVICE_STATE_TTL_HOURS * 3600,
+)
+
+# Grace-period deadlines ("milk is over" fires exactly when a removal grace period ends)
+_grace_scheduler = DeadlineScheduler(name="grace-scheduler", log_prefix="[updates]")
+_housekeeping = DeadlineScheduler(name="housekeeping", log_prefix="[updates]")   # periodic idle-record sweep
+
+_dedup = DuplicateFilter(DEDUP_WINDOW_SEC, DEDUP_MAX_KEYS)
+
+_metrics = Metrics(prefix="updates")
 
 # Add this configuration at the top with other constants
 REFILL_THRESHOLD_G = float(os.getenv("REFILL_THRESHOLD_G", "1000"))  # Only consider refill above 1000g
@@ -69,77 +166,33 @@ REFILL_THRESHOLD_G = float(os.getenv("REFILL_THRESHOLD_G", "1000"))  # Only cons
 def _now_utc():
     return datetime.utcnow()
 
-def _cooldown_ok(device_id: str) -> bool:
-    t = _device_cooldown_utc.get(device_id)
-    return t is None or _now_utc() >= t
-
-def _mark_sent(device_id: str):
-    _device_cooldown_utc[device_id] = _now_utc() + timedelta(minutes=ALERT_COOLDOWN_MIN)
-
-def reset_alerts_for_device(device_id: str):
-    """Reset alert tracking when milk is refilled (weight goes back up)"""
-    if device_id in _device_alerts_sent:
-        del _device_alerts_sent[device_id]
-    
-    # Also reset carton removal tracking when weight goes back up significantly
-    if device_id in _device_carton_removal_tracking:
-        del _device_carton_removal_tracking[device_id]
-    
-    print(f"[updates] 🔄 Alert tracking reset for device {device_id} (milk refilled)")
+def _clear_carton_tracking(st: DeviceAlertState):
+    st.previous_weight = None
+    st.zero_time = None
+    st.grace_period_active = False
 
 def reset_user_alerts_for_device(device_id: str):
-    """Reset user alert tracking when milk is refilled (weight goes back up)"""
+    """Reset user alert tracking when milk is refilled (weight goes back up), in alert_state and on every replica"""
     users = find_all_users_by_device(device_id)
-    for user in users:
-        user_id = user.get("id")
-        if user_id in _user_alerts_sent:
-            del _user_alerts_sent[user_id]
-            print(f"[updates] 🔄 User alert tracking reset for user {user_id} (milk refilled)")
-
-def should_send_user_alert(user_id: int, user_threshold: int, weight: float) -> tuple[bool, str]:
+    user_ids = [user.get("id") for user in users]
+    _alert_claims.reset(user_ids)
+    _trigger_index.invalidate(device_id)
+    print(f"[updates] 🔄 User alert tracking reset for users {user_ids} (milk refilled)")
+    if MQTT_CONTROL_TOPIC and _mqtt_client is not None:
+        _mqtt_client.publish(MQTT_CONTROL_TOPIC, json.dumps(
+            {"device_id": device_id, "reason": "refill", "alerts_reset": True}), qos=1)
+
+def claim_user_alert(user_id: int, alert_type: str, since: datetime = None) -> str:
     """
-    Check if we should send an alert to a specific user based on their threshold.
-    Returns (should_send_alert, alert_type)
+    Claim this alert in alert_state before sending it (see alert_state.claim): CLAIMED to send it,
+    ALREADY_SENT if it went out already (another replica, or before a restart), UNAVAILABLE to try later
     """
-    # If weight is 0g, don't send immediate alert - wait for 1-minute timer
-    if weight == 0:
-        return False, "none"
-    
-    # Always send critical alert at 100g regardless of user threshold
-    if weight <= ALERT_THRESHOLD_CRITICAL:
-        # Check if we already sent critical alert to this user
-        if user_id not in _user_alerts_sent:
-            _user_alerts_sent[user_id] = {}
-        
-        if not _user_alerts_sent[user_id].get("critical"):
-            return True, "critical"
-        else:
-            return False, "none"  # Already sent critical alert
-    
-    # If user has no threshold set, use default 200g
-    if user_threshold is None:
-        user_threshold = ALERT_THRESHOLD_LOW
-    
-    # Check if weight is below user's threshold
-    if weight <= user_threshold:
-        # Check if we already sent threshold alert to this user
-        if user_id not in _user_alerts_sent:
-            _user_alerts_sent[user_id] = {}
-        
-        # Use "warning" as the alert type for all threshold alerts
-        if not _user_alerts_sent[user_id].get("warning"):
-            return True, "warning"
-        else:
-            return False, "none"  # Already sent warning alert
-    
-    return False, "none"
-
-def mark_user_alert_sent(user_id: int, alert_type: str):
-    """Mark that we've sent this type of alert to this user"""
-    if user_id not in _user_alerts_sent:
-        _user_alerts_sent[user_id] = {}
-    _user_alerts_sent[user_id][alert_type] = True
-    print(f"[updates] 📝 Marked {alert_type}g alert as sent for user {user_id}")
+    outcome = _alert_claims.claim(user_id, alert_type, _now_utc(), since)
+    if outcome == CLAIMED:
+        print(f"[updates] 📝 Claimed {alert_type} alert for user {user_id}")
+    elif outcome != UNAVAILABLE:
+        print(f"[updates] ⏭️ {alert_type} alert for user {user_id} was already sent - skipping")
+    return outcome
 
 def handle_carton_removal_logic(device_id: str, weight: float) -> tuple[bool, str]:
     """
@@ -147,234 +200,172 @@ def handle_carton_removal_logic(device_id: str, weight: float) -> tuple[bool, st
     Returns (should_send_alert, alert_type)
     """
     now = _now_utc()
-    
-    # If weight is not 0g, handle carton return
-    if weight > 0:
-        if device_id in _device_carton_removal_tracking:
-            tracking = _device_carton_removal_tracking[device_id]
-            previous_weight = tracking.get("previous_weight", 0)
-            
+
+    with _device_state.locked(device_id) as st:
+        # If weight is not 0g, handle carton return
+        if weight > 0:
             # If we were in a grace period, carton was returned
-            if tracking.get("grace_period_active", False):
-                print(f"[updates] 🥛 Carton returned at {weight}g (was {previous_weight}g) - clearing grace period")
+            if st.grace_period_active:
+                print(f"[updates] 🥛 Carton returned at {weight}g (was {st.previous_weight or 0}g) - clearing grace period")
                 # Clear the grace period and update tracking
-                tracking["grace_period_active"] = False
-                tracking["zero_time"] = None
-                tracking["previous_weight"] = weight
+                _grace_scheduler.cancel(device_id)
+                st.grace_period_active = False
+                st.zero_time = None
+                st.previous_weight = weight
                 return False, None  # No alert needed, carton was just temporarily removed
-            
-            else:
-                # Not in grace period, just update previous weight
-                tracking["previous_weight"] = weight
-        else:
-            # No tracking exists, create it
-            _device_carton_removal_tracking[device_id] = {
-                "previous_weight": weight,
-                "zero_time": None,
-                "grace_period_active": False
-            }
-        
-        return False, None  # Normal weight processing
-    
-    # Weight is 0g - handle carton removal
-    if device_id not in _device_carton_removal_tracking:
-        # First time seeing 0g, start tracking
-        _device_carton_removal_tracking[device_id] = {
-            "previous_weight": 0,  # Will be updated from previous readings
-            "zero_time": now,
-            "grace_period_active": True
-        }
-        print(f"[updates] 🥛 Carton removal detected for device {device_id} - starting 1 minute grace period")
-        return False, None
-    
-    tracking = _device_carton_removal_tracking[device_id]
-    
-    # If grace period is not active, start it
-    if not tracking.get("grace_period_active", False):
-        tracking["zero_time"] = now
-        tracking["grace_period_active"] = True
-        print(f"[updates] 🥛 Carton removal detected for device {device_id} - starting 1 minute grace period")
-        return False, None
-    
-    # Grace period is active, check if expired
-    grace_period_expired = now >= tracking["zero_time"] + timedelta(minutes=CARTON_REMOVAL_GRACE_PERIOD_MIN)
-    
-    if grace_period_expired:
-        print(f"[updates] ⏰ Grace period expired for device {device_id} - carton appears to be empty, sending critical alert")
-        del _device_carton_removal_tracking[device_id]
-        return True, "critical"  # Critical alert for empty carton
-    else:
-        remaining_time = (tracking["zero_time"] + timedelta(minutes=CARTON_REMOVAL_GRACE_PERIOD_MIN) - now).total_seconds()
-        print(f"[updates] ⏳ Carton removal grace period active for device {device_id}, {remaining_time:.0f} seconds remaining")
-        return False, None
 
-def check_expired_grace_periods():
-    """Check if any grace periods have expired and send 'milk is over' alerts"""
-    now = _now_utc()
-    expired_devices = []
-    
-    #print(f"[updates] 🔍 Background thread: Checking grace periods at {now} - tracking {len(_device_carton_removal_tracking)} devices")
-    
-    # Check the correct tracking dictionary
-    for device_id, tracking in _device_carton_removal_tracking.items():
-        #print(f"[updates] 🔍 Background thread: Found device {device_id} with tracking: {tracking}")
-        
-        if tracking.get("grace_period_active", False):
-            grace_period_expired = now >= tracking["zero_time"] + timedelta(minutes=CARTON_REMOVAL_GRACE_PERIOD_MIN)
-            
-            #print(f"[updates] 🔍 Background thread: Device {device_id}: grace_period_active={tracking.get('grace_period_active')}, zero_time={tracking['zero_time']}, expired={grace_period_expired}")
-            
-            if grace_period_expired:
-                expired_devices.append(device_id)
-                print(f"[updates] ⏰ Background thread: Grace period expired for device {device_id} - milk is over, sending 'milk is over' alert")
-    
-    # Send "milk is over" alerts for expired devices
-    for device_id in expired_devices:
-        del _device_carton_removal_tracking[device_id]
-        
-        # Send "milk is over" alert
-        users = find_all_users_by_device(device_id)
-        if not users:
-            print(f"[updates] ❌ Background thread: No users found for device_id='{device_id}', skipping alert")
-            continue
-
-        print(f"[updates] 🚨 Background thread: MILK IS OVER ALERT! Sending 'milk is over' email")
-        print(f"[updates]  Found {len(users)} user(s) connected to device {device_id}")
-
-        # Send "milk is over" alerts to all users connected to this device
-        for user in users:
-            user_email = user.get("email")
-            full_name = user.get("full_name")
-            
-            print(f"[updates] 👤 Background thread: Sending 'milk is over' alert to: {full_name} ({user_email})")
-            try:
-                send_milk_is_over_email(user_email, full_name)
-                print(f"[updates] ✅ Background thread: 'Milk is over' email sent to {user_email}")
-            except Exception as e:
-                print(f"[updates] ❌ Background thread: Failed to send 'milk is over' email to {user_email}: {e}")
-
-def send_milk_is_over_email(to_email: str, full_name: str):
-    """Send 'milk is over' email alert"""
-    subject = "🥛 Smart Milk: Milk Carton is Empty!"
-    body = (
-        f"Hi {full_name or 'there'},\n\n"
-        f"🥛 Your milk carton appears to be empty!\n\n"
-        f"The weight sensor detected that your milk carton has been removed for more than 1 minute.\n"
-        f"This usually means the milk is finished and you need to buy a new carton.\n\n"
-        f"Please check your milk and consider buying a new carton.\n\n"
-        f"— Smart Milk System"
-    )
+            # Not in grace period, just update previous weight
+            st.previous_weight = weight
+            return False, None  # Normal weight processing
+
+        # Weight is 0g - start the grace period unless one is already running
+        if not st.grace_period_active:
+            if st.previous_weight is None:
+                st.previous_weight = 0  # Will be updated from previous readings
+            st.zero_time = now
+            st.grace_period_active = True
+            start_grace_period(device_id, now)
+            print(f"[updates] 🥛 Carton removal detected for device {device_id} - starting 1 minute grace period")
+            return False, None
+
+    # Grace period is active; the deadline scheduler sends the alert when it ends
+    remaining_time = _grace_scheduler.remaining(device_id) or 0
+    print(f"[updates] ⏳ Carton removal grace period active for device {device_id}, {remaining_time:.0f} seconds remaining")
+    return False, None
 
-    # Send actual email
-    msg = EmailMessage()
-    msg["Subject"] = subject
-    msg["From"] = FROM_EMAIL or SMTP_USER
-    msg["To"] = to_email
-    msg.set_content(body)
+def start_grace_period(device_id: str, zero_time: datetime):
+    """Arm the 'milk is over' deadline for this removal (replaces any earlier one)."""
+    _grace_scheduler.schedule(device_id, CARTON_REMOVAL_GRACE_PERIOD_MIN * 60,
+                              on_grace_deadline, device_id, zero_time)
+
+def on_grace_deadline(device_id: str, zero_time: datetime):
+    """Fired by the deadline scheduler when a grace period ends: send 'milk is over' alerts"""
+    with _device_state.locked(device_id, create=False) as st:
+        if st is None or not st.grace_period_active or st.zero_time != zero_time:
+            return  # carton came back, or a newer removal re-armed the timer
+        _clear_carton_tracking(st)
+    print(f"[updates] ⏰ Grace period expired for device {device_id} - milk is over, sending 'milk is over' alert")
+    
+    # Send "milk is over" alert
+    users = find_all_users_by_device(device_id)
+    if not users:
+        print(f"[updates] ❌ Scheduler: No users found for device_id='{device_id}', skipping alert")
+        return
 
-    try:
-        if SMTP_PORT == 465:
-            ctx = ssl.create_default_context()
-            with smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, context=ctx) as server:
-                server.login(SMTP_USER, SMTP_PASS)
-                server.send_message(msg)
-        else:
-            with smtplib.SMTP(SMTP_HOST, SMTP_PORT) as server:
-                server.ehlo()
-                server.starttls(context=ssl.create_default_context())
-                server.login(SMTP_USER, SMTP_PASS)
-                server.send_message(msg)
-        
-        print(f"[updates] ✅ 'Milk is over' email sent to {to_email}")
-    except Exception as e:
-        print(f"[updates] ❌ Failed to send 'milk is over' email: {e}")
+    print(f"[updates] 🚨 Scheduler: MILK IS OVER ALERT! Sending 'milk is over' email")
+    print(f"[updates]  Found {len(users)} user(s) connected to device {device_id}")
+    send_milk_is_over_alerts(device_id, zero_time, users)
 
-def should_send_alert(device_id: str, weight: float) -> tuple[bool, str]:
-    """
-    Returns (should_send, alert_type)
-    alert_type: "200" or "100" or None
-    """
-    # Check carton removal logic for all weights (including 0g)
-    should_send, alert_type = handle_carton_removal_logic(device_id, weight)
-    if should_send:
-        return should_send, alert_type
-    
-    # Normal alert logic for non-zero weights
-    if weight > 0:
-        if device_id not in _device_alerts_sent:
-            _device_alerts_sent[device_id] = {}
-        
-        device_alerts = _device_alerts_sent[device_id]
-        
-        # Check for critical alert (100g)
-        if weight < ALERT_THRESHOLD_CRITICAL:
-            if not device_alerts.get("critical"):
-                return True, "critical"
-        
-        # Check for low alert (200g)  
-        elif weight < ALERT_THRESHOLD_LOW:
-            if not device_alerts.get("warning"):
-                return True, "warning"
+def send_milk_is_over_alerts(device_id: str, zero_time: datetime, users: list):
+    """Claim and send 'milk is over' to each user; claims alert_state could not take are retried later"""
+    retry = []
+    for user in users:
+        user_email = user.get("email")
+        full_name = user.get("full_name")
+        outcome = claim_user_alert(user.get("id"), "over", since=zero_time)
+        if outcome == UNAVAILABLE:
+            retry.append(user)
+        if outcome != CLAIMED:
+            continue
         
-        # Weight is above 200g - reset alerts for refill detection
-        elif weight >= 1000:
-            if device_alerts:  # Only reset if we had sent alerts
-                reset_alerts_for_device(device_id)
-    
-    return False, None
-
-def mark_alert_sent(device_id: str, alert_type: str):
-    """Mark that we've sent this type of alert for this device"""
-    if device_id not in _device_alerts_sent:
-        _device_alerts_sent[device_id] = {}
-    _device_alerts_sent[device_id][alert_type] = True
-    print(f"[updates] 📝 Marked {alert_type}g alert as sent for device {device_id}")
+        print(f"[updates] 👤 Scheduler: Sending 'milk is over' alert to: {full_name} ({user_email})")
+        send_milk_is_over_email(user_email, full_name, device_id)
+    if retry:
+        print(f"[updates] ⏳ 'milk is over' for {len(retry)} user(s) of device {device_id} not claimed yet - "
+              f"retrying in {ALERT_CLAIM_RETRY_SEC:g}s")
+        _grace_scheduler.schedule(("over", device_id), ALERT_CLAIM_RETRY_SEC,
+                                  send_milk_is_over_alerts, device_id, zero_time, retry)
+
+def send_milk_is_over_email(to_email: str, full_name: str, device_id: str = None):
+    """Queue a 'milk is over' alert (held briefly so it can share an email with other alerts)"""
+    _alert_coalescer.add(to_email, full_name, "over", device_id, None, _now_utc())
 
 # =========================
 # DB access
 # =========================
-def find_all_users_by_device(device_id: str):
-    """Return list of dicts [{id, full_name, email, threshold_wanted}, ...] for ALL users with this device_id."""
+def query_users_by_device(device_id: str):
+    """Return list of dicts [{id, full_name, email, threshold_wanted}, ...] for ALL users with this device_id (raises on errors)."""
+    conn = mysql.connector.connect(**MYSQL_CONFIG)
     try:
-        conn = mysql.connector.connect(**MYSQL_CONFIG)
-        cur  = conn.cursor(dictionary=True)
+        cur = conn.cursor(dictionary=True)
         cur.execute(
             "SELECT id, full_name, email, threshold_wanted FROM users WHERE device_id=%s",
             (device_id,)
         )
         rows = cur.fetchall()
+        cur.close()
         return rows
-    except Exception as e:
-        print(f"[updates] MySQL error while finding users: {e}")
-        return []
     finally:
-        try:
-            cur.close(); conn.close()
-        except Exception:
-            pass
+        conn.close()
+
+_mqtt_client = None   # set on connect; refill resets are published through it
+
+_users_cache = DeviceUsersCache(query_users_by_device, USER_CACHE_TTL_SEC, USER_CACHE_NEGATIVE_TTL_SEC,
+                                max_devices=DEVICE_STATE_MAX, stripes=DEVICE_STATE_STRIPES)
+
+def find_all_users_by_device(device_id: str):
+    """Users of this device, from the cache when fresh; [] on MySQL errors."""
+    return _users_cache.get(device_id)
+
+def handle_control_message(payload: bytes):
+    """
+    users-service control message: {"device_id": "device1"} after that device's users
+    changed, or {} (or an empty payload) to drop every cached device.
+    {"device_id": ..., "alerts_reset": true} comes from a replica that handled a refill.
+    """
+    text = payload.decode("utf-8", errors="replace").strip()
+    data = json.loads(text) if text else {}
+    if not isinstance(data, dict):
+        raise ValueError(f"control message must be a JSON object, got {text!r}")
+    device_id = data.get("device_id")
+    if data.get("alerts_reset") and device_id:
+        # A replica saw this device refilled and already reset alert_state: drop our cached flags
+        user_ids = [user.get("id") for user in find_all_users_by_device(str(device_id))]
+        _trigger_index.invalidate(str(device_id))
+        if _alert_claims.forget_cached(user_ids):
+            print(f"[updates] 🔄 Cached alert flags dropped for device {device_id} ({data.get('reason', 'alerts reset')})")
+        return
+    _users_cache.invalidate(str(device_id) if device_id else None)
+    _trigger_index.invalidate(str(device_id) if device_id else None)
+    target = f"device {device_id}" if device_id else "all devices"
+    print(f"[updates] 👥 Cached users dropped for {target} ({data.get('reason', 'users changed')})")
 
 # =========================
 # MQTT payload parsing
 # =========================
-def parse_payload(msg_bytes: bytes):
+def parse_payload(msg_bytes: bytes, topic_device: str = None, binary: bool = False):
     """
-    Supports:
+    Supports (see payload_codec.py):
       JSON   -> {"device_id":"device1","weight":950,"ts":"..."}
-      Number -> "950"  (falls back to DEFAULT_DEVICE_ID)
-    Returns (device_id, weight)
+      Number -> "950"  (device from the per-device topic, else DEFAULT_DEVICE_ID)
+      Binary -> packed 24-byte reading on milk/weight/bin/<device_id>
+      Batch  -> {"device_id":"device1","readings":[...]} (or binary): a publisher's offline backlog
+    Returns the readings (payload_codec.Reading), oldest first
     """
-    text = msg_bytes.decode(errors="ignore").strip()
-    # Try JSON first
-    try:
-        data = json.loads(text)
-        weight = float(data.get("weight"))
-        device_id = data.get("device_id") or DEFAULT_DEVICE_ID
-        return device_id, weight
-    except Exception:
-        pass
-    # Plain numeric
-    weight = float(text)  # raises ValueError if not numeric
-    return DEFAULT_DEVICE_ID, weight
+    readings = payload_codec.decode_readings(msg_bytes, topic_device, binary, default_device=DEFAULT_DEVICE_ID)
+    if len(readings) > 1:
+        readings.sort(key=lambda r: r.timestamp or datetime.max)
+    return readings
+
+
+def apply_backlog(device_id: str, weights):
+    """
+    Readings a device buffered while offline, oldest first, minus the latest
+    one. Alerts and carton timers only depend on the latest reading, so the
+    backlog just moves last_weight along; a refill inside it still resets the
+    users' alerts (same rule as in on_message, 0g readings never count).
+    """
+    refilled = None
+    with _device_state.locked(device_id) as st:
+        previous = st.last_weight or 0
+        for weight in weights:
+            if weight > previous and weight >= REFILL_THRESHOLD_G and previous > 0:
+                refilled = (previous, weight)
+            previous = weight
+        st.last_weight = previous
+    if refilled:
+        print(f"[updates] 🔄 Milk refilled while {device_id} was offline: {refilled[0]}g → {refilled[1]}g, resetting user alerts")
+        reset_user_alerts_for_device(device_id)
 
 
 # =========================
@@ -382,51 +373,88 @@ def parse_payload(msg_bytes: bytes):
 # =========================
 from typing import Optional
 
-def send_email_alert(to_email: str, full_name: str, weight_g: float, alert_type: str):
-    """Send email alert with appropriate message based on alert type"""
-    if alert_type == "critical":
-        subject = "🚨 Smart Milk: CRITICAL - Milk Almost Empty!"
-        body = (
-            f"Hi {full_name or 'there'},\n\n"
-            f"🚨 CRITICAL ALERT: Your milk is almost empty!\n"
-            f"Current weight: {weight_g:.0f}g\n\n"
-            f"Please buy milk immediately - you're running very low!\n\n"
-            f"— Smart Milk System"
+def send_email_alert(to_email: str, full_name: str, weight_g: float, alert_type: str, device_id: str = None):
+    """Queue a low / critical alert; alerts for the same recipient within ALERT_DIGEST_WINDOW_SEC share one email"""
+    _alert_coalescer.add(to_email, full_name, alert_type, device_id, weight_g, _now_utc())
+
+def alert_text(alert) -> tuple[str, str]:
+    """(subject, message) for one alert"""
+    if alert.kind == "over":
+        return "🥛 Smart Milk: Milk Carton is Empty!", (
+            f"🥛 Your milk carton appears to be empty!\n\n"
+            f"The weight sensor detected that your milk carton has been removed for more than 1 minute.\n"
+            f"This usually means the milk is finished and you need to buy a new carton.\n\n"
+            f"Please check your milk and consider buying a new carton."
         )
-    else:  # alert_type == "warning"
-        subject = "⚠️ Smart Milk: Low Milk Alert"
-        body = (
-            f"Hi {full_name or 'there'},\n\n"
-            f"⚠️ Your milk level is getting low.\n"
-            f"Current weight: {weight_g:.0f}g\n\n"
-            f"Consider buying a new carton soon.\n\n"
-            f"— Smart Milk System"
+    if alert.kind == "critical":
+        return "🚨 Smart Milk: CRITICAL - Milk Almost Empty!", (
+            f"🚨 CRITICAL ALERT: Your milk is almost empty!\n"
+            f"Current weight: {alert.weight:.0f}g\n\n"
+            f"Please buy milk immediately - you're running very low!"
         )
+    return "⚠️ Smart Milk: Low Milk Alert", (   # alert.kind == "warning"
+        f"⚠️ Your milk level is getting low.\n"
+        f"Current weight: {alert.weight:.0f}g\n\n"
+        f"Consider buying a new carton soon."
+    )
+
+def send_alert_email(to_email: str, full_name: str, alerts: list):
+    """Called by the coalescer: one email for everything held for this recipient (oldest first)"""
+    if len(alerts) == 1:
+        subject, text = alert_text(alerts[0])
+        label = "'Milk is over'" if alerts[0].kind == "over" else f"{alerts[0].kind} alert"
+    else:
+        worst = max(alerts, key=lambda a: SEVERITY.get(a.kind, 0))
+        subject = f"{alert_text(worst)[0]} (+{len(alerts) - 1} more)"
+        sections = []
+        for alert in alerts:
+            when = f" at {alert.at:%H:%M} UTC" if alert.at is not None else ""
+            sections.append(f"Device {alert.device_id}{when}:\n{alert_text(alert)[1]}")
+        text = f"You have {len(alerts)} milk alerts:\n\n" + "\n\n".join(sections)
+        label = f"digest of {len(alerts)} alerts"
 
-    
-    # Send actual email (existing email sending code)
     msg = EmailMessage()
     msg["Subject"] = subject
     msg["From"] = FROM_EMAIL or SMTP_USER
     msg["To"] = to_email
-    msg.set_content(body)
+    msg.set_content(f"Hi {full_name or 'there'},\n\n{text}\n\n— Smart Milk System")
+    _email_dispatch.submit(msg, label)
 
+def open_smtp_session():
+    """A connected, logged-in SMTP session (SSL on 465, STARTTLS otherwise); the dispatcher reuses it."""
+    if SMTP_PORT == 465:
+        server = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, context=ssl.create_default_context(), timeout=SMTP_TIMEOUT_SEC)
+    else:
+        server = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT_SEC)
     try:
-        if SMTP_PORT == 465:
-            ctx = ssl.create_default_context()
-            with smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, context=ctx) as server:
-                server.login(SMTP_USER, SMTP_PASS)
-                server.send_message(msg)
-        else:
-            with smtplib.SMTP(SMTP_HOST, SMTP_PORT) as server:
-                server.ehlo()
-                server.starttls(context=ssl.create_default_context())
-                server.login(SMTP_USER, SMTP_PASS)
-                server.send_message(msg)
-        
-        print(f"[updates] ✅ {alert_type}g alert email sent to {to_email}")
-    except Exception as e:
-        print(f"[updates] ❌ Failed to send email: {e}")
+        if SMTP_PORT != 465:
+            server.ehlo()
+            server.starttls(context=ssl.create_default_context())
+        server.login(SMTP_USER, SMTP_PASS)
+    except Exception:
+        server.close()
+        raise
+    return server
+
+_email_dispatch = EmailDispatcher(
+    open_smtp_session,
+    workers=EMAIL_WORKERS,
+    queue_max=EMAIL_QUEUE_MAX,
+    max_attempts=EMAIL_MAX_ATTEMPTS,
+    backoff_s=EMAIL_RETRY_BACKOFF_SEC,
+    backoff_max_s=EMAIL_RETRY_BACKOFF_MAX_SEC,
+    session_max_messages=EMAIL_SESSION_MAX_MESSAGES,
+    session_idle_s=EMAIL_SESSION_IDLE_SEC,
+    dry_run=DRY_RUN,
+    observe=_metrics.observe,
+)
+
+_alert_coalescer = AlertCoalescer(
+    send_alert_email,
+    window_s=ALERT_DIGEST_WINDOW_SEC,
+    critical_window_s=ALERT_DIGEST_CRITICAL_SEC,
+    max_alerts=ALERT_DIGEST_MAX_ALERTS,
+)
 
 
 def print_alert(user_id: int, weight: float):
@@ -437,32 +465,54 @@ def print_alert(user_id: int, weight: float):
 # MQTT callbacks
 # =========================
 def on_connect(client, userdata, flags, rc, properties=None):
+    global _mqtt_client
     if rc == 0:
-        client.subscribe(MQTT_TOPIC)
-        print("[updates] ✅ Connected to MQTT broker and subscribing to topic: {MQTT_TOPIC} successfully!")
+        _mqtt_client = client
+        filters = subscription_filters(MQTT_TOPIC, MQTT_PER_DEVICE_TOPICS, MQTT_SHARED_GROUP)
+        subscribe_all(client, filters)
+        if MQTT_CONTROL_TOPIC:
+            client.subscribe(MQTT_CONTROL_TOPIC, qos=1)
+            filters = filters + [MQTT_CONTROL_TOPIC]
+        print(f"[updates] ✅ Connected to MQTT broker and subscribing to topic(s): {', '.join(filters)} successfully!")
     else:
         print(f"[updates] ❌ MQTT connection failed with code: {rc}")
 
 def on_message(client, userdata, msg):
     try:
-        device_id, weight = parse_payload(msg.payload)
-        print(f"[updates] ⚖️  Received weight: {weight}g from device: {device_id}")
+        if MQTT_CONTROL_TOPIC and msg.topic == MQTT_CONTROL_TOPIC:
+            handle_control_message(msg.payload)
+            return
+        readings = parse_payload(msg.payload, *parse_topic(msg.topic, MQTT_TOPIC, content_type(msg)))
+        latest = readings[-1]
+        device_id, weight = latest.device_id, latest.weight
+        if _dedup.seen(device_id, latest.message_id, latest.timestamp):
+            print(f"[updates] ♻️ Duplicate msg_id {latest.message_id} from device {device_id} suppressed "
+                  f"({_dedup.suppressed} so far)")
+            return
+        if len(readings) > 1:
+            print(f"[updates] 📦 Received batch of {len(readings)} buffered readings from device: {device_id}, latest {weight}g")
+        else:
+            print(f"[updates] ⚖️  Received weight: {weight}g from device: {device_id}")
         
-        # Get all users for this device
+        # Get all users for this device (once per message, also for a batch)
         users = find_all_users_by_device(device_id)
         if not users:
             print(f"[updates] ❌ No users found for device_id='{device_id}', skipping")
             return
         
         print(f"[updates]  Found {len(users)} user(s) connected to device {device_id}")
+        if len(readings) > 1:
+            apply_backlog(device_id, [r.weight for r in readings[:-1]])
         
         # FIRST: Handle carton removal logic (this will set/clear grace periods)
         should_alert, alert_type = handle_carton_removal_logic(device_id, weight)
         
         # SECOND: Check for refill AFTER carton removal logic
-        previous_weight = _last_weight_by_device.get(device_id, 0)
-        is_coming_from_grace_period = (device_id in _device_carton_removal_tracking and 
-                                      _device_carton_removal_tracking[device_id].get("grace_period_active", False))
+        with _device_state.locked(device_id) as st:
+            previous_weight = st.last_weight or 0
+            is_coming_from_grace_period = st.grace_period_active
+            # Update last weight
+            st.last_weight = weight
         
         # Only consider it a refill if:
         # 1. Weight increased significantly
@@ -478,30 +528,132 @@ def on_message(client, userdata, msg):
             print(f"[updates] 🔄 Milk refilled: {previous_weight}g → {weight}g, resetting user alerts")
             reset_user_alerts_for_device(device_id)
         
-        # Update last weight
-        _last_weight_by_device[device_id] = weight
-        
-        # Process alerts for each user
-        for user in users:
-            user_id = user.get("id")
-            user_threshold = user.get("threshold_wanted")
+        # Process alerts: only the users whose pending thresholds this reading crossed
+        due, next_trigger = _trigger_index.due(device_id, users, weight)
+        if not due:
+            pending = f"next alert at {next_trigger:g}g" if next_trigger is not None else "no alerts pending"
+            print(f"[updates] ✅ Weight {weight}g: no alerts needed ({pending})")
+        for user, alert_type in due:
             user_email = user.get("email")
             user_name = user.get("full_name")
-            
-            # Check if we should send an alert to this specific user
-            should_alert, alert_type = should_send_user_alert(user_id, user_threshold, weight)
-            
-            if should_alert:
-                print(f"[updates] 👤 Sending {alert_type}g alert to user {user_name} ({user_email}) for weight: {weight}g")
-                send_email_alert(user_email, user_name, weight, alert_type)
-                mark_user_alert_sent(user_id, alert_type)
-            else:
-                print(f"[updates] ✅ Weight {weight}g >= {user_threshold}g (user threshold); no alerts needed for {user_name}")
+            outcome = claim_user_alert(user.get("id"), alert_type)
+            if outcome == UNAVAILABLE:
+                continue   # still pending in the trigger index: claimed again on the next reading
+            if outcome == CLAIMED:
+                print(f"[updates] 👤 Sending {alert_type} alert to user {user_name} ({user_email}) for weight: {weight}g")
+                send_email_alert(user_email, user_name, weight, alert_type, device_id)
+            _trigger_index.fired(device_id, user, alert_type)
 
     except Exception as e:
         print(f"[updates] ❌ Error processing MQTT message: {e}")
 
 
+# =========================
+# Snapshots
+# =========================
+def collect_snapshot() -> dict:
+    """
+    Per-device carton tracking. The per-user sent flags are left
+    out: another replica may have reset them (refill) while this one was down,
+    so they are re-read from alert_state on the next claim instead.
+    """
+    return {"service": "updates", "devices": _device_state.dump()}
+
+def restore_snapshot():
+    """Load carton tracking from the last snapshot and re-arm grace periods."""
+    started = time.monotonic()
+    try:
+        snap = read_snapshot(SNAPSHOT_PATH, SNAPSHOT_MAX_AGE_MIN * 60)
+    except Exception as e:
+        print(f"[updates] ⚠️ Ignoring state snapshot {SNAPSHOT_PATH}: {e}")
+        return
+    if snap is None:
+        print(f"[updates] No recent state snapshot at {SNAPSHOT_PATH} - starting with empty alert state")
+        return
+    created, sections = snap
+    if sections.get("service") != "updates":
+        print(f"[updates] ⚠️ {SNAPSHOT_PATH} is not an updates-service snapshot - ignoring it")
+        return
+
+    devices = _device_state.load(sections["devices"])   # a "users" section from older snapshots is ignored
+
+    # Re-arm grace periods that were running (overdue ones fire as soon as the scheduler starts)
+    rearmed = 0
+    now = _now_utc()
+    for device_id in _device_state.keys():
+        st = _device_state.get(device_id)
+        if st is not None and st.grace_period_active and st.zero_time is not None:
+            delay = (st.zero_time + timedelta(minutes=CARTON_REMOVAL_GRACE_PERIOD_MIN) - now).total_seconds()
+            _grace_scheduler.schedule(device_id, delay, on_grace_deadline, device_id, st.zero_time)
+            rearmed += 1
+
+    print(f"[updates] ♻️ Restored state snapshot from {created:%Y-%m-%d %H:%M:%S}: {devices} devices, "
+          f"{rearmed} grace periods re-armed in {(time.monotonic() - started) * 1000:.0f}ms")
+
+_snapshotter = (Snapshotter(SNAPSHOT_PATH, collect_snapshot, SNAPSHOT_INTERVAL_SEC, log_prefix="[updates]")
+                if SNAPSHOT_PATH else None)
+
+
+# =========================
+# Metrics
+# =========================
+def register_metrics():
+    """Expose the email queue, user cache and dedup counters next to the email latency histograms."""
+    m = _metrics
+    m.collect("alerts_held", "Alerts held for a per-recipient digest", _alert_coalescer.held)
+    for key, description in (
+        ("alerts", "Alerts raised"),
+        ("merged", "Alerts that joined an email already being held"),
+    ):
+        m.collect(f"coalescer_{key}_total", description, lambda k=key: _alert_coalescer.stats()[k], kind="counter")
+    m.collect("email_queue_depth", "Emails waiting for an SMTP session", _email_dispatch.depth)
+    m.collect("email_retries_pending", "Emails waiting out a retry backoff", _email_dispatch.retries_pending)
+    for key, description in (
+        ("submitted", "Emails queued for sending"),
+        ("sent", "Emails sent"),
+        ("retried", "Failed sends scheduled for a retry"),
+        ("failed", "Emails given up on"),
+        ("dropped", "Emails dropped because the queue was full"),
+        ("sessions_opened", "SMTP sessions opened"),
+    ):
+        m.collect(f"emails_{key}_total", description, lambda k=key: _email_dispatch.stats()[k], kind="counter")
+    for key, description in (
+        ("hits", "Device -> users lookups answered from the cache"),
+        ("misses", "Device -> users lookups that queried MySQL"),
+        ("invalidations", "Cache invalidations received on the control topic"),
+    ):
+        m.collect(f"user_cache_{key}_total", description, lambda k=key: _users_cache.stats()[k], kind="counter")
+    m.collect("user_cache_devices", "Devices with cached users", lambda: len(_users_cache))
+    for key, description in (
+        ("claimed", "Alerts claimed in alert_state for sending"),
+        ("lost", "Alerts skipped because alert_state showed them sent"),
+        ("errors", "alert_state queries that failed"),
+    ):
+        m.collect(f"alert_claims_{key}_total", description, lambda k=key: _alert_claims.stats()[k], kind="counter")
+    for key, description in (
+        ("skipped", "Readings above every pending alert threshold (one comparison)"),
+        ("evaluated", "Readings that crossed a pending alert threshold"),
+        ("builds", "Per-device alert trigger index (re)builds"),
+    ):
+        m.collect(f"trigger_index_{key}_total", description, lambda k=key: _trigger_index.stats()[k], kind="counter")
+    m.collect("duplicates_suppressed_total", "QoS 1 redeliveries dropped by message_id",
+              lambda: _dedup.suppressed, kind="counter")
+    m.collect("grace_timers_pending", "Carton-removal grace periods running", _grace_scheduler.pending)
+
+
+def sweep_device_state():
+    """Evict idle records from every per-device store, then re-arm on the housekeeping scheduler."""
+    try:
+        swept = {"devices": _device_state.sweep(), "users": _user_state.sweep(),
+                 "trigger index": _trigger_index.sweep(), "user cache": _users_cache.sweep()}
+        if any(swept.values()):
+            print("[updates] 🧹 Swept idle records: " + ", ".join(f"{n} {name}" for name, n in swept.items()))
+    except Exception as e:
+        print(f"[updates] Error sweeping device state: {e}")
+    finally:
+        _housekeeping.schedule("sweep", DEVICE_STATE_SWEEP_MIN * 60, sweep_device_state)
+
+
 # =========================
 # Main
 # =========================
@@ -509,33 +661,54 @@ def main():
     print("[updates] 🚀 Smart Milk Updates Service Starting...")
     print(f"[updates] 📡 MQTT Config: {MQTT_HOST}:{MQTT_PORT}, Topic: {MQTT_TOPIC}")
     print(f"[updates] 🚨 Alert Thresholds: {ALERT_THRESHOLD_LOW}g (Low), {ALERT_THRESHOLD_CRITICAL}g (Critical)")
-    print(f"[updates] 📧 Email Config: {SMTP_HOST}:{SMTP_PORT}")
-    print(f"[updates] ⏰ Alert Cooldown: {ALERT_COOLDOWN_MIN} minutes")
+    print(f"[updates] 📧 Email Config: {SMTP_HOST}:{SMTP_PORT}{' (dry run)' if DRY_RUN else ''}, "
+          f"{EMAIL_WORKERS} session(s), {EMAIL_SESSION_MAX_MESSAGES} emails/session, up to {EMAIL_MAX_ATTEMPTS} attempts")
+    print(f"[updates] 📬 Alert digests: {ALERT_DIGEST_WINDOW_SEC:g}s per recipient ({ALERT_DIGEST_CRITICAL_SEC:g}s once critical), "
+          f"up to {ALERT_DIGEST_MAX_ALERTS} alerts")
     print(f"[updates] 🥛 Carton Removal Detection: {CARTON_REMOVAL_GRACE_PERIOD_MIN} minute grace period for 0g readings")
+    print(f"[updates] ♻️ Duplicate suppression: {DEDUP_WINDOW_SEC:g}s window, up to {DEDUP_MAX_KEYS} message ids")
+    print(f"[updates] 👥 User cache: {USER_CACHE_TTL_SEC:g}s TTL ({USER_CACHE_NEGATIVE_TTL_SEC:g}s for devices without users), "
+          f"invalidated via {MQTT_CONTROL_TOPIC or 'TTL only'}")
+    print(f"[updates] 🗃️  Device state: {DEVICE_STATE_STRIPES} lock stripes, idle TTL {DEVICE_STATE_TTL_HOURS:g}h "
+          f"(swept every {DEVICE_STATE_SWEEP_MIN:g} min), cap {DEVICE_STATE_MAX} records")
     
     try:
-        client = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION2)
-    except TypeError:
-        client = mqtt.Client()  # older paho versions
+        _alert_claims.ensure_table()
+        print(f"[updates] 🗄️ Alert state table ready (replica {REPLICA_ID})")
+        atexit.register(_alert_claims.close)
+    except Exception as e:
+        print(f"[updates] ⚠️ Could not create alert_state table: {e}")
+
+    client = make_client(MQTT_PROTOCOL)
 
     client.on_connect = on_connect
     client.on_message = on_message
 
-    # Start a background thread to check expired grace periods
-    def grace_period_checker():
-        print("[updates] 🔄 Grace period checker thread started")
-        while True:
-            try:
-                time.sleep(10)  # Check every 10 seconds
-                #print("[updates]  Background thread: Checking grace periods...")
-                check_expired_grace_periods()
-            except Exception as e:
-                print(f"[updates] ❌ Error in grace period checker: {e}")
-                time.sleep(10)  # Wait before retrying
-    
-    grace_thread = threading.Thread(target=grace_period_checker, daemon=True)
-    grace_thread.start()
-    print("[updates] 🔄 Started grace period checker thread")
+    if _snapshotter is not None:
+        restore_snapshot()
+        _snapshotter.start()
+        atexit.register(_snapshotter.stop)
+        print(f"[updates] 💾 Snapshotting state to {SNAPSHOT_PATH} every {SNAPSHOT_INTERVAL_SEC:g}s")
+    # Kubernetes stops pods with SIGTERM; exit through atexit so the final snapshot is written
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    # Emails go out from background senders; queued ones get a chance to go out on shutdown
+    _email_dispatch.start()
+    atexit.register(_email_dispatch.stop)
+    _alert_coalescer.start()
+    atexit.register(_alert_coalescer.stop)   # runs first: held digests are queued before the dispatcher drains
+
+    register_metrics()
+    if METRICS_PORT:
+        _metrics.serve(METRICS_PORT)
+        print(f"[updates] 📈 Metrics on http://0.0.0.0:{METRICS_PORT}/metrics")
+
+    # Grace-period deadlines fire from a heap-ordered timer thread (idle when nothing is pending)
+    _grace_scheduler.start()
+    print("[updates] 🔄 Started grace period deadline scheduler")
+    if DEVICE_STATE_SWEEP_MIN > 0:
+        _housekeeping.start()
+        _housekeeping.schedule("sweep", DEVICE_STATE_SWEEP_MIN * 60, sweep_device_state)
 
     while True:
         try:
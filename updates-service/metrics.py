@@ -0,0 +1,200 @@
+# metrics.py (shared by analysis-service and updates-service; keep both copies identical)
+"""
+Minimal Prometheus metrics (no client library needed).
+
+    registry = Metrics(prefix="analysis")
+    with registry.time("parse"):
+        ...
+    registry.inc("messages_received_total")
+    registry.serve(9100)          # GET /metrics from a background thread
+
+Stage latencies go into one histogram family labelled by stage; gauges (and
+counters kept elsewhere, e.g. worker pool stats) are callables sampled on
+every scrape, so the hot path never updates them. Per-device last-message
+ages are kept until forget_device() or sweep_devices() drops them, so the
+series set follows the live fleet instead of every device ever seen.
+"""
+from __future__ import annotations
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Seconds; covers in-memory steps (sub-ms) up to slow DB round trips
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+
+def _num(v) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)   # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    def __init__(self, prefix: str, buckets=DEFAULT_BUCKETS):
+        self.prefix = prefix
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._stages = {}          # stage -> Histogram
+        self._stage_errors = {}    # stage -> count
+        self._counters = {}        # (name, labels tuple) -> value
+        self._help = {}            # name -> help text
+        self._collected = []       # (name, help, kind, fn() -> number | [(labels dict, number)])
+        self._last_seen = {}       # device_id -> unix time of its last message
+        self._server = None
+
+    # ---------- recording ----------
+    def observe(self, stage: str, seconds: float):
+        with self._lock:
+            h = self._stages.get(stage)
+            if h is None:
+                h = self._stages[stage] = Histogram(self.buckets)
+            h.observe(seconds)
+
+    @contextmanager
+    def time(self, stage: str):
+        """Time the block into the stage histogram; exceptions are counted per stage and re-raised."""
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            with self._lock:
+                self._stage_errors[stage] = self._stage_errors.get(stage, 0) + 1
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def inc(self, name: str, amount: float = 1, description: str = "", **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+            if description:
+                self._help.setdefault(name, description)
+
+    def collect(self, name: str, description: str, fn, kind: str = "gauge"):
+        """
+        Sample fn() on every scrape. It returns a number, or a list of
+        (labels dict, number) for a labelled family; kind is "gauge" or "counter".
+        """
+        self._collected.append((name, description, kind, fn))
+
+    def device_seen(self, device_id: str):
+        self._last_seen[device_id] = time.time()   # single dict store, atomic under the GIL
+
+    def forget_device(self, device_id: str):
+        self._last_seen.pop(device_id, None)
+
+    def sweep_devices(self, max_age_s: float) -> int:
+        """Drop the last-message series of devices silent for max_age_s (0 = keep all); returns how many."""
+        if max_age_s <= 0:
+            return 0
+        cutoff = time.time() - max_age_s
+        idle = [d for d, t in list(self._last_seen.items()) if t < cutoff]
+        for device_id in idle:
+            self.forget_device(device_id)
+        return len(idle)
+
+    # ---------- exposition ----------
+    def render(self) -> str:
+        p = self.prefix
+        out = []
+        now = time.time()
+        with self._lock:
+            stages = {s: (list(h.counts), h.sum, h.count) for s, h in self._stages.items()}
+            errors = dict(self._stage_errors)
+            counters = dict(self._counters)
+            last_seen = dict(self._last_seen)
+
+        out.append(f"# HELP {p}_stage_duration_seconds Time spent per processing stage")
+        out.append(f"# TYPE {p}_stage_duration_seconds histogram")
+        for stage, (counts, total, count) in sorted(stages.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                out.append(f"{p}_stage_duration_seconds_bucket{_labels({'stage': stage, 'le': _num(bound)})} {cumulative}")
+            out.append(f"{p}_stage_duration_seconds_sum{_labels({'stage': stage})} {total!r}")
+            out.append(f"{p}_stage_duration_seconds_count{_labels({'stage': stage})} {count}")
+
+        out.append(f"# HELP {p}_stage_errors_total Exceptions raised per processing stage")
+        out.append(f"# TYPE {p}_stage_errors_total counter")
+        for stage, n in sorted(errors.items()):
+            out.append(f"{p}_stage_errors_total{_labels({'stage': stage})} {n}")
+
+        seen = set()
+        for (name, labels), value in sorted(counters.items()):
+            if name not in seen:
+                seen.add(name)
+                out.append(f"# HELP {p}_{name} {self._help.get(name, name)}")
+                out.append(f"# TYPE {p}_{name} counter")
+            out.append(f"{p}_{name}{_labels(dict(labels))} {_num(value)}")
+
+        for name, description, kind, fn in self._collected:
+            try:
+                value = fn()
+            except Exception:
+                continue
+            out.append(f"# HELP {p}_{name} {description}")
+            out.append(f"# TYPE {p}_{name} {kind}")
+            if isinstance(value, list):
+                for labels, v in value:
+                    out.append(f"{p}_{name}{_labels(labels)} {_num(v)}")
+            else:
+                out.append(f"{p}_{name} {_num(value)}")
+
+        out.append(f"# HELP {p}_device_last_message_age_seconds Seconds since the device's last message")
+        out.append(f"# TYPE {p}_device_last_message_age_seconds gauge")
+        for device_id, t in sorted(last_seen.items()):
+            out.append(f"{p}_device_last_message_age_seconds{_labels({'device_id': device_id})} {now - t:.3f}")
+        return "\n".join(out) + "\n"
+
+    # ---------- HTTP ----------
+    def serve(self, port: int, host: str = "0.0.0.0"):
+        """Serve GET /metrics from a daemon thread."""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass   # keep scrapes out of the service log
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="metrics-http", daemon=True).start()
+        return self._server
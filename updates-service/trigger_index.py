@@ -0,0 +1,130 @@
+# updates-service/trigger_index.py
+"""
+Per-device index of the alerts that can still fire.
+
+Every user of a device has up to two pending triggers: "warning" at their
+threshold_wanted (default_g when unset) and "critical" at critical_g. A
+device's pending triggers are kept sorted by weight, and the highest one is
+its next trigger: a reading above it (the normal case, a carton with milk in
+it) is settled with one comparison, whatever the number of users. A reading
+at or below it bisects the sorted weights, and the entries from there up are
+exactly the triggers it crossed.
+
+Per user the rules are those of the original per-user check: at or below
+critical_g a user gets "critical" (nothing if that was already sent), above
+it "warning" once the weight is at or below their threshold. Once a user's
+alert went out (or another replica sent it) its entry is dropped with
+fired(). A user whose critical alert went out keeps a pending warning entry
+(the weight can come back above critical_g without a refill), so readings
+below their threshold keep bisecting until the next refill.
+
+The index is built from the device's user list and the sent flags
+(is_sent), and rebuilt only when something changes: a refill resets the
+flags, a settings change gives the device a new user list (a different list
+object from the users cache), or invalidate() is called.
+"""
+from __future__ import annotations
+from bisect import bisect_left
+
+from device_state import DeviceStateStore, StateRecord
+
+
+class DeviceTriggers(StateRecord):
+    __slots__ = ("users", "weights", "entries", "next_trigger")
+
+    def __init__(self):
+        self.users = None                 # user list the index was built from
+        self.weights = []                 # trigger weights, ascending
+        self.entries = []                 # (weight, kind, user) in the same order
+        self.next_trigger = float("-inf")  # highest pending trigger (-inf = nothing pending)
+
+
+class TriggerIndex:
+    """
+    critical_g -> weight at or below which every user gets the critical alert
+    default_g  -> warning threshold for users without threshold_wanted
+    is_sent    -> is_sent(user_id, kind): True if that alert already went out
+    """
+
+    def __init__(self, critical_g: float, default_g: float, is_sent, stripes: int = 64,
+                 max_devices: int = 0, ttl_s: float = 0):
+        self.critical_g = float(critical_g)
+        self.default_g = float(default_g)
+        self.is_sent = is_sent
+        self._devices = DeviceStateStore(DeviceTriggers, stripes=stripes, max_records=max_devices, ttl_s=ttl_s)
+        self.builds = 0
+        self.skipped = 0      # readings settled by the next-trigger comparison
+        self.evaluated = 0    # readings that bisected the index
+
+    def __len__(self) -> int:
+        return len(self._devices)
+
+    def due(self, device_id: str, users: list, weight: float):
+        """
+        ([(user, kind), ...], next_trigger) for this reading: the alerts to
+        send now, and the highest pending trigger weight (None if none).
+        """
+        with self._devices.locked(device_id) as ix:
+            if ix.users is not users:
+                self._build(ix, users)
+            next_trigger = ix.next_trigger if ix.entries else None
+            if weight <= 0 or weight > ix.next_trigger:   # 0g waits for the carton grace period
+                self.skipped += 1
+                return [], next_trigger
+            crossed = ix.entries[bisect_left(ix.weights, weight):]
+        self.evaluated += 1
+
+        kinds = {}   # id(user) -> (user, kinds crossed), in index order
+        for _, kind, user in crossed:
+            kinds.setdefault(id(user), (user, set()))[1].add(kind)
+        due = []
+        for user, crossed_kinds in kinds.values():
+            if weight <= self.critical_g:
+                if "critical" in crossed_kinds:
+                    due.append((user, "critical"))
+            elif "warning" in crossed_kinds:
+                due.append((user, "warning"))
+        return due, next_trigger
+
+    def _build(self, ix: DeviceTriggers, users: list):
+        entries = []
+        for user in users:
+            user_id = user.get("id")
+            if not self.is_sent(user_id, "critical"):
+                entries.append((self.critical_g, "critical", user))
+            if not self.is_sent(user_id, "warning"):
+                threshold = user.get("threshold_wanted")
+                entries.append((float(threshold if threshold is not None else self.default_g), "warning", user))
+        entries.sort(key=lambda e: e[0])
+        ix.users = users
+        ix.entries = entries
+        ix.weights = [e[0] for e in entries]
+        ix.next_trigger = ix.weights[-1] if entries else float("-inf")
+        self.builds += 1
+
+    def fired(self, device_id: str, user, kind: str):
+        """The user's `kind` alert was handled (sent, or found already sent): stop matching it."""
+        with self._devices.locked(device_id, create=False) as ix:
+            if ix is None:
+                return
+            keep = [e for e in ix.entries if not (e[2] is user and e[1] == kind)]
+            if len(keep) != len(ix.entries):
+                ix.entries = keep
+                ix.weights = [e[0] for e in keep]
+                ix.next_trigger = ix.weights[-1] if keep else float("-inf")
+
+    def invalidate(self, device_id: str = None):
+        """Rebuild on the next reading: one device, or every device when device_id is None."""
+        if device_id is None:
+            for key in self._devices.keys():
+                self._devices.pop(key)
+        else:
+            self._devices.pop(device_id)
+
+    def sweep(self) -> int:
+        """Drop idle devices (see DeviceStateStore.sweep); returns how many."""
+        return self._devices.sweep()
+
+    def stats(self) -> dict:
+        return {"devices": len(self._devices), "builds": self.builds,
+                "skipped": self.skipped, "evaluated": self.evaluated}
@@ -0,0 +1,111 @@
+# updates-service/user_cache.py
+"""
+Read-through cache for device -> users lookups.
+
+Every reading needs the users registered on its device (email, name,
+threshold), which change rarely. Lookups are kept per device in a
+DeviceStateStore for ttl_s; a device with no users is cached as well
+(negative_ttl_s, usually shorter, so a freshly registered user is picked up
+soon even if the invalidation was missed). A failed DB query is never
+cached: the caller gets [] and the next reading tries again.
+
+invalidate(device_id) drops one device, invalidate() drops everything; the
+users-service publishes on a control topic after it changes users (see
+main.py). A lookup that was already running when an invalidation came in
+returns its rows but does not cache them, so stale rows never outlive the
+invalidation.
+"""
+from __future__ import annotations
+import time
+import threading
+
+from device_state import DeviceStateStore, StateRecord
+
+
+class CachedUsers(StateRecord):
+    __slots__ = ("users", "expires", "version")
+
+    def __init__(self):
+        self.users = None    # list of user rows (None = not loaded)
+        self.expires = 0.0   # monotonic time the rows go stale
+        self.version = 0     # bumped by invalidate(device_id)
+
+
+class DeviceUsersCache:
+    """
+    loader         -> device_id -> list of user rows; raises on DB errors
+    ttl_s          -> how long a device's users are reused (0 disables the cache)
+    negative_ttl_s -> the same for devices without users
+    """
+
+    def __init__(self, loader, ttl_s: float = 300, negative_ttl_s: float = 60,
+                 max_devices: int = 200000, stripes: int = 64, log_prefix: str = "[updates]"):
+        self.loader = loader
+        self.ttl_s = float(ttl_s)
+        self.negative_ttl_s = float(negative_ttl_s)
+        self.log_prefix = log_prefix
+        self._entries = DeviceStateStore(CachedUsers, stripes=stripes, max_records=max_devices,
+                                         ttl_s=max(self.ttl_s, self.negative_ttl_s))
+        self._epoch = 0                 # bumped by invalidate() (all devices)
+        self._epoch_lock = threading.Lock()
+
+        # Counters (read via stats())
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.invalidations = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, device_id: str) -> list:
+        """The device's users (possibly cached), or [] if there are none or the DB failed."""
+        if self.ttl_s <= 0:
+            return self._load(device_id) or []
+        now = time.monotonic()
+        with self._entries.locked(device_id) as entry:
+            if entry.users is not None and now < entry.expires:
+                self.hits += 1
+                return entry.users
+            version, epoch = entry.version, self._epoch
+        self.misses += 1
+
+        # Query outside the stripe lock so other devices on the stripe are not held up
+        users = self._load(device_id)
+        if users is None:
+            return []
+        ttl = self.ttl_s if users else self.negative_ttl_s
+        with self._entries.locked(device_id) as entry:
+            if entry.version == version and self._epoch == epoch:
+                entry.users = users
+                entry.expires = time.monotonic() + ttl
+        return users
+
+    def _load(self, device_id: str):
+        try:
+            return list(self.loader(device_id))
+        except Exception as e:
+            self.errors += 1
+            print(f"{self.log_prefix} MySQL error while finding users: {e}")
+            return None
+
+    def invalidate(self, device_id: str = None):
+        """Forget one device's users, or every device's when device_id is None."""
+        self.invalidations += 1
+        if device_id is None:
+            with self._epoch_lock:
+                self._epoch += 1
+            for key in self._entries.keys():
+                self._entries.pop(key)
+            return
+        with self._entries.locked(device_id) as entry:
+            entry.users = None
+            entry.version += 1
+
+    def sweep(self) -> int:
+        """Drop devices not looked up for the TTL (see DeviceStateStore.sweep); returns how many."""
+        return self._entries.sweep()
+
+    def stats(self) -> dict:
+        return {"devices": len(self._entries), "hits": self.hits, "misses": self.misses,
+                "errors": self.errors, "invalidations": self.invalidations}
@@ -29,5 +29,11 @@ module.exports = {
   },
   bcrypt: {
     rounds: parseInt(process.env.BCRYPT_ROUNDS) || 12
+  },
+  mqtt: {
+    host: process.env.MQTT_HOST || 'mqtt',
+    port: Number(process.env.MQTT_PORT || 1883),
+    // updates-service drops its cached users for a device when a message arrives here (empty disables)
+    controlTopic: process.env.MQTT_CONTROL_TOPIC ?? 'milk/control/users',
   }
 };
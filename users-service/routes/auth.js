@@ -4,6 +4,7 @@ const AuthService = require('../services/AuthService');
 const { authenticate } = require('../middleware/auth');
 const { validateRegistration, validateLogin, validatePasswordChange, handleValidationErrors } = require('../middleware/validation');
 const db = require('../database/connection');
+const ControlPublisher = require('../services/ControlPublisher');
 
 // User registration
 router.post('/register', async (req, res) => {
@@ -57,6 +58,7 @@ router.post('/register', async (req, res) => {
     );
 
     console.log(`[users] ✅ User registered and saved to DB - ID: ${result.insertId}, Username: ${uname}, Device: ${deviceId}`);
+    ControlPublisher.usersChanged(deviceId, 'user registered');
     return res.status(201).json({ 
       success: true, 
       user_id: result.insertId, 
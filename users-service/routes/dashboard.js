@@ -1,6 +1,7 @@
 const express = require('express');
 const router = express.Router();
 const db = require('../database/connection');
+const ControlPublisher = require('../services/ControlPublisher');
 
 router.post('/status', async (req, res) => {
   try {
@@ -57,6 +58,7 @@ router.post('/status', async (req, res) => {
       coffeeCupsLeft: deviceStat.cups_left || 0,
       averageDailyConsumption: deviceStat.avg_daily_consumption_g || 0,
       expectedMilkEndDay: deviceStat.expected_empty_date || null,
+      expectedMilkEndTime: deviceStat.expected_empty_at || null,
       percentFull: deviceStat.percent_full || 0,
       isWeightSensorActive: (deviceStat.current_amount_g || 0) > 0,
       lastUpdated: weightData[0]?.timestamp || null
@@ -142,6 +144,10 @@ router.put('/MilkSettings', async (req, res) => {
         SET threshold_wanted = ? 
         WHERE id = ?
       `, [threshold_wanted, userId]);
+      const userDevice = await db.query(`
+        SELECT device_id FROM users WHERE id = ?
+      `, [userId]);
+      ControlPublisher.usersChanged(userDevice[0]?.device_id, 'threshold changed');
     }
     
     // Update device's expiry_date in user_stats
@@ -2,6 +2,7 @@ const express = require('express');
 const router = express.Router();
 const db = require('../database/connection');
 const User = require('../models/User');
+const ControlPublisher = require('../services/ControlPublisher');
 const { 
   authenticate, 
   requireAdmin, 
@@ -153,6 +154,14 @@ router.put('/UserSettings', async (req, res) => {
       WHERE id = ?
     `, values);
     
+    // Alert emails use the name and address, which updates-service caches per device
+    if (full_name !== undefined || email !== undefined) {
+      const userDevice = await db.query(`
+        SELECT device_id FROM users WHERE id = ?
+      `, [userId]);
+      ControlPublisher.usersChanged(userDevice[0]?.device_id, 'user details changed');
+    }
+    
     res.json({
       success: true,
       message: 'User settings updated successfully'
@@ -7,6 +7,7 @@ const cookieParser = require('cookie-parser');
 const crypto = require('crypto');
 require('dotenv').config();
 const db = require('./database/connection');
+const ControlPublisher = require('./services/ControlPublisher');
 const app = express();
 
 // --- Security & middleware ---
@@ -154,12 +155,14 @@ const PORT = parseInt(process.env.PORT || '3000', 10);
 // Graceful shutdown
 process.on('SIGTERM', async () => { 
   console.log(`[server] 🛑 SIGTERM received - shutting down gracefully`);
+  await ControlPublisher.close();
   await db.close(); 
   process.exit(0); 
 });
 
 process.on('SIGINT', async () => { 
   console.log(`[server] 🛑 SIGINT received - shutting down gracefully`);
+  await ControlPublisher.close();
   await db.close(); 
   process.exit(0); 
 });
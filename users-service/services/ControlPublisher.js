@@ -0,0 +1,49 @@
+const mqtt = require('mqtt');
+const config = require('../config');
+
+// Tells updates-service that the users of a device changed, so it drops its cached
+// device -> users lookup instead of waiting for the TTL. One persistent MQTT connection,
+// opened on the first change; notices go out at QoS 1, and the client queues them while
+// it is (re)connecting, so a broker restart does not lose them.
+class ControlPublisher {
+  static client = null;
+
+  static connect() {
+    if (!ControlPublisher.client) {
+      const { host, port } = config.mqtt;
+      const client = mqtt.connect({
+        host,
+        port,
+        protocol: 'mqtt',
+        clientId: `users-service-${process.pid}-${Date.now()}`,
+        connectTimeout: 3000,
+        reconnectPeriod: 5000,
+      });
+      client.on('connect', () => console.log(`[users] ✅ Connected to MQTT for users change notices`));
+      client.on('error', (err) => console.log(`[users] ⚠️ MQTT control connection error: ${err.message}`));
+      ControlPublisher.client = client;
+    }
+    return ControlPublisher.client;
+  }
+
+  static usersChanged(deviceId, reason) {
+    const { controlTopic } = config.mqtt;
+    if (!controlTopic) return;
+    const payload = JSON.stringify(deviceId ? { device_id: String(deviceId), reason } : { reason });
+    ControlPublisher.connect().publish(controlTopic, payload, { qos: 1 }, (err) => {
+      if (err) {
+        console.log(`[users] ⚠️ Could not publish users change for device ${deviceId || '*'}: ${err.message}`);
+      }
+    });
+  }
+
+  // Waits for notices still in flight, then disconnects
+  static close() {
+    const client = ControlPublisher.client;
+    ControlPublisher.client = null;
+    if (!client) return Promise.resolve();
+    return new Promise((resolve) => client.end(false, {}, () => resolve()));
+  }
+}
+
+module.exports = ControlPublisher;
@@ -5,14 +5,33 @@ import json
 import os
 from datetime import datetime
 
+import payload_codec
+from store_forward import ReadingBacklog, handed_over
+
 # MQTT Configuration
 MQTT_HOST = "smart-milk-mosquitto-service"
 MQTT_PORT = 1883
-MQTT_TOPIC = "milk/weight"
+MQTT_TOPIC = os.getenv("MQTT_TOPIC", "milk/weight")
 
 # Device Configuration
 DEVICE_ID = os.getenv("DEVICE_ID", "device1")
 
+# Publish to milk/weight/<device_id> instead of the shared topic (consumers subscribe to both)
+MQTT_PER_DEVICE_TOPIC = os.getenv("MQTT_PER_DEVICE_TOPIC", "false").lower() == "true"
+PUBLISH_TOPIC = f"{MQTT_TOPIC}/{DEVICE_ID}" if MQTT_PER_DEVICE_TOPIC else MQTT_TOPIC
+
+# json | binary (24-byte packed reading, see payload_codec.py; always on milk/weight/bin/<device_id>)
+PAYLOAD_FORMAT = os.getenv("PAYLOAD_FORMAT", "json").lower()
+if PAYLOAD_FORMAT == "binary":
+    PUBLISH_TOPIC = payload_codec.binary_topic(MQTT_TOPIC, DEVICE_ID)
+
+# Store-and-forward: readings taken while the broker is unreachable are buffered and
+# sent as batch payloads once the client reconnects (see store_forward.py)
+STORE_FORWARD_MAX_READINGS = int(os.getenv("STORE_FORWARD_MAX_READINGS", "8640"))  # ~24h at one reading per 10s
+STORE_FORWARD_BATCH_SIZE = int(os.getenv("STORE_FORWARD_BATCH_SIZE", "500"))       # readings per batch payload
+backlog = ReadingBacklog(DEVICE_ID, STORE_FORWARD_MAX_READINGS, STORE_FORWARD_BATCH_SIZE,
+                         binary=PAYLOAD_FORMAT == "binary", log_prefix="[weight]")
+
 client = mqtt.Client()
 
 # Global state for milk carton simulation
@@ -21,6 +40,8 @@ current_milk_weight = 1000  # Start with a full carton
 def on_connect(client, userdata, flags, rc):
     if rc == 0:
         print("[weight] Connected to MQTT broker successfully", flush=True)
+        if len(backlog):
+            backlog.flush(client, PUBLISH_TOPIC)
     else:
         print(f"[weight] ERROR - Connection failed (rc: {rc})", flush=True)
 
@@ -77,22 +98,38 @@ def publish_weight():
             weight = simulate_weight()
             message_count += 1
             
+            now = datetime.now()
+            
+            # Broker unreachable: keep the reading and forward it with the backlog on reconnect
+            if not client.is_connected():
+                backlog.add(weight, now, message_count)
+                print(f"[weight] Message #{message_count}: Broker unreachable - buffered weight {weight}g ({len(backlog)} readings waiting)", flush=True)
+                time.sleep(10)
+                continue
+            if len(backlog):
+                backlog.flush(client, PUBLISH_TOPIC)
+            
             # Create JSON payload with device_id, weight, and unique message ID
             payload_data = {
                 "device_id": DEVICE_ID,
                 "weight": weight,
-                "timestamp": datetime.now().isoformat(),
-                "message_id": f"weight-{message_count}-{int(time.time())}"
+                "timestamp": now.isoformat(),
+                "message_id": payload_codec.message_id(message_count, now)
             }
-            payload_json = json.dumps(payload_data)
+            if PAYLOAD_FORMAT == "binary":
+                payload = payload_codec.encode(DEVICE_ID, weight, now, seq=message_count)
+            else:
+                payload = json.dumps(payload_data)
             
             # Enhanced log to show consumption pattern
             print(f"[weight] Message #{message_count}: Sent device {DEVICE_ID}, weight {weight}g, msg_id: {payload_data['message_id']}", flush=True)
             
-            result = client.publish(MQTT_TOPIC, payload=payload_json, qos=1)
+            result = client.publish(PUBLISH_TOPIC, payload=payload, qos=1)
             
-            if result.rc != 0:
-                print(f"[weight] Message #{message_count}: ERROR - Failed to queue message (rc: {result.rc})", flush=True)
+            # rc NO_CONN still means queued: paho sends QoS 1 messages on reconnect, so only a full paho queue is buffered
+            if not handed_over(result):
+                backlog.add(weight, now, message_count)
+                print(f"[weight] Message #{message_count}: ERROR - Failed to queue message (rc: {result.rc}), buffered for retry", flush=True)
                 
             time.sleep(10)
             
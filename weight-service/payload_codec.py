@@ -0,0 +1,207 @@
+# payload_codec.py (shared by analysis-service, updates-service and weight-service; keep all copies identical)
+"""
+Weight reading payloads.
+
+    JSON    {"device_id": "device1", "weight": 950, "timestamp": "<iso>", "message_id": "..."}
+    legacy  a bare number, e.g. "950" (device from the topic)
+    binary  24 bytes, little-endian:
+
+        offset size
+        0      2    magic b"\\xa7M" (can never start a JSON document or a number)
+        2      1    version (1)
+        3      1    flags (bit 0: batch)
+        4      4    u32 crc32 of the utf-8 device_id
+        8      4    f32 weight in grams
+        12     8    s64 timestamp, ms since the Unix epoch (0 = unknown, use the arrival time)
+        20     4    u32 sequence number (the message_id); with no timestamp it alone
+                    identifies the reading, so it must not repeat after a reboot
+
+Batches carry the readings a publisher buffered while it was offline, oldest
+first, for one device:
+
+    JSON    {"device_id": "device1", "readings": [{"weight": 950, "timestamp": "<iso>",
+                                                  "message_id": "..."}, ...]}
+    binary  flags bit 0 set; the 10-byte header (magic, version, flags,
+            device hash, u16 count) is followed by count 16-byte records
+            (f32 weight, s64 timestamp ms, u32 sequence number)
+
+A binary reading does not carry its device_id. It is announced by its topic,
+`<base>/bin/<device_id>`, or over MQTT 5 by the content type CONTENT_TYPE on
+`<base>/<device_id>`; the hash is checked against the device the topic names.
+The fields are unpacked straight out of a memoryview of the payload, and
+JSON is parsed from the payload bytes without decoding them to str first.
+"""
+from __future__ import annotations
+import json
+import time
+import zlib
+import struct
+from collections import namedtuple
+from datetime import datetime
+
+MAGIC = b"\xa7M"
+VERSION = 1
+BINARY_SEGMENT = "bin"                              # <base>/bin/<device_id>
+CONTENT_TYPE = "application/vnd.smartmilk.reading"  # MQTT 5 alternative to the topic
+
+# Reading.format values
+JSON = "json"
+LEGACY = "legacy"
+BINARY = "binary"
+
+FLAG_BATCH = 0x01
+MAX_BATCH = 0xFFFF   # readings per batch payload
+
+_READING = struct.Struct("<2sBBIfqI")
+_BATCH_HEADER = struct.Struct("<2sBBIH")
+_BATCH_ITEM = struct.Struct("<fqI")
+
+# timestamp: naive local datetime, or None when the payload has none (use the arrival time)
+Reading = namedtuple("Reading", "device_id weight timestamp message_id format")
+
+
+def device_hash(device_id: str) -> int:
+    return zlib.crc32(device_id.encode("utf-8"))
+
+
+def binary_topic(base: str, device_id: str) -> str:
+    return f"{base}/{BINARY_SEGMENT}/{device_id}"
+
+
+def encode(device_id: str, weight: float, timestamp: datetime | None = None, seq: int = 0) -> bytes:
+    """Pack one reading in the binary layout (timestamp defaults to now)."""
+    ts_ms = int((timestamp.timestamp() if timestamp is not None else time.time()) * 1000)
+    return _READING.pack(MAGIC, VERSION, 0, device_hash(device_id), float(weight), ts_ms, seq & 0xFFFFFFFF)
+
+
+def message_id(seq: int, timestamp: datetime) -> str:
+    """JSON message_id of a reading; the same whether it goes out alone or in a batch."""
+    return f"weight-{seq}-{int(timestamp.timestamp())}"
+
+
+def encode_batch(device_id: str, readings, binary: bool = False):
+    """
+    Pack buffered readings [(weight, timestamp, seq)], oldest first, into one
+    batch payload: bytes in the binary layout, else a JSON string.
+    """
+    readings = list(readings)
+    if len(readings) > MAX_BATCH:
+        raise ValueError(f"a batch holds at most {MAX_BATCH} readings")
+    if not binary:
+        return json.dumps({"device_id": device_id, "readings": [
+            {"weight": weight, "timestamp": ts.isoformat(), "message_id": message_id(seq, ts)}
+            for weight, ts, seq in readings]})
+    out = bytearray(_BATCH_HEADER.size + _BATCH_ITEM.size * len(readings))
+    _BATCH_HEADER.pack_into(out, 0, MAGIC, VERSION, FLAG_BATCH, device_hash(device_id), len(readings))
+    for i, (weight, ts, seq) in enumerate(readings):
+        _BATCH_ITEM.pack_into(out, _BATCH_HEADER.size + i * _BATCH_ITEM.size,
+                              float(weight), int(ts.timestamp() * 1000), seq & 0xFFFFFFFF)
+    return bytes(out)
+
+
+def decode_readings(payload, topic_device: str | None = None, binary: bool = False,
+                    default_device: str | None = None) -> list:
+    """Like decode(), but also accepts batches; returns the readings in the order they were sent."""
+    if binary:
+        buf = memoryview(payload)
+        if len(buf) > 3 and buf[:2] == MAGIC and buf[2] == VERSION and buf[3] & FLAG_BATCH:
+            return _decode_binary_batch(buf, topic_device)
+        return [_decode_binary(buf, topic_device)]
+
+    data = _loads(payload)
+    if isinstance(data, dict):
+        device_id = data.get("device_id") or topic_device or default_device
+        if "readings" not in data:
+            return [_json_reading(data, device_id)]
+        items = data["readings"]
+        if not isinstance(items, list) or not items:
+            raise ValueError("batch has no readings")
+        return [_json_reading(item, device_id) for item in items]
+    return [_legacy_reading(data, payload, topic_device or default_device)]
+
+
+def decode(payload, topic_device: str | None = None, binary: bool = False,
+           default_device: str | None = None) -> Reading:
+    """
+    Parse one MQTT payload. binary=True when the topic or content type
+    announced the binary layout; topic_device is the device named by a
+    per-device topic, default_device the fallback for legacy payloads
+    published to the base topic. Raises ValueError for unreadable payloads.
+    """
+    if binary:
+        return _decode_binary(memoryview(payload), topic_device)
+
+    data = _loads(payload)
+    if isinstance(data, dict):
+        return _json_reading(data, data.get("device_id") or topic_device or default_device)
+    return _legacy_reading(data, payload, topic_device or default_device)
+
+
+def _loads(payload):
+    try:
+        return json.loads(payload)
+    except ValueError:   # JSONDecodeError and UnicodeDecodeError
+        return None
+
+
+def _legacy_reading(data, payload, device_id: str | None) -> Reading:
+    # A plain number ("950" is valid JSON too, and comes back as a number)
+    weight = float(data) if isinstance(data, (int, float)) and not isinstance(data, bool) else float(payload)
+    return Reading(device_id, weight, None, None, LEGACY)
+
+
+def _json_reading(item, device_id: str | None) -> Reading:
+    try:
+        weight = float(item.get("weight"))
+    except (TypeError, AttributeError):
+        raise ValueError("reading has no numeric weight") from None
+    return Reading(device_id, weight, _parse_timestamp(item.get("timestamp")), item.get("message_id", "unknown"), JSON)
+
+
+def _decode_binary(buf: memoryview, topic_device: str | None) -> Reading:
+    if len(buf) < 3 or buf[:2] != MAGIC:
+        raise ValueError("not a binary reading")
+    if buf[2] != VERSION:
+        raise ValueError(f"unsupported binary reading version {buf[2]}")
+    if len(buf) != _READING.size:
+        raise ValueError(f"binary reading must be {_READING.size} bytes, got {len(buf)}")
+    _, _, _, hashed, weight, ts_ms, seq = _READING.unpack_from(buf)
+    _check_device(hashed, topic_device)
+    return _binary_reading(topic_device, weight, ts_ms, seq)
+
+
+def _decode_binary_batch(buf: memoryview, topic_device: str | None) -> list:
+    if len(buf) < _BATCH_HEADER.size:
+        raise ValueError("truncated binary batch")
+    _, _, _, hashed, count = _BATCH_HEADER.unpack_from(buf)
+    if len(buf) != _BATCH_HEADER.size + count * _BATCH_ITEM.size:
+        raise ValueError(f"binary batch of {count} readings must be "
+                         f"{_BATCH_HEADER.size + count * _BATCH_ITEM.size} bytes, got {len(buf)}")
+    if count == 0:
+        raise ValueError("batch has no readings")
+    _check_device(hashed, topic_device)
+    return [_binary_reading(topic_device, weight, ts_ms, seq)
+            for weight, ts_ms, seq in _BATCH_ITEM.iter_unpack(buf[_BATCH_HEADER.size:])]
+
+
+def _check_device(hashed: int, topic_device: str | None):
+    if not topic_device:
+        raise ValueError("binary reading published without a device topic")
+    if hashed != device_hash(topic_device):
+        raise ValueError(f"binary reading does not belong to device {topic_device}")
+
+
+def _binary_reading(device_id: str, weight: float, ts_ms: int, seq: int) -> Reading:
+    timestamp = datetime.fromtimestamp(ts_ms / 1000.0) if ts_ms > 0 else None
+    return Reading(device_id, round(weight, 2), timestamp, str(seq), BINARY)
+
+
+def _parse_timestamp(value):
+    """ISO-8601 string -> naive local datetime; anything else (e.g. seconds since boot) -> None."""
+    if not isinstance(value, str):
+        return None
+    try:
+        ts = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    return ts.astimezone().replace(tzinfo=None) if ts.tzinfo is not None else ts
@@ -0,0 +1,83 @@
+# weight-service/store_forward.py
+"""
+Store-and-forward for readings taken while the MQTT broker is unreachable.
+
+Readings the client cannot publish are kept in a bounded in-memory backlog
+(the oldest are dropped once it is full). As soon as the client is connected
+again the backlog goes out as batch payloads (payload_codec.encode_batch),
+oldest first and before any new reading, so consumers get the device's
+history in order with its original timestamps.
+
+Only readings paho did not take go into the backlog. A QoS 1 publish while
+the connection is down returns MQTT_ERR_NO_CONN but stays queued in paho and
+is sent on reconnect, so buffering it as well would send it twice; only
+MQTT_ERR_QUEUE_SIZE (paho's own queue is full) means the message was not
+queued. A reading keeps its message_id (payload_codec.message_id) whether it
+goes out alone or in a batch, so a duplicate still gets deduplicated.
+"""
+from __future__ import annotations
+import threading
+from collections import deque
+from itertools import islice
+
+import paho.mqtt.client as mqtt
+
+import payload_codec
+
+
+def handed_over(result) -> bool:
+    """True if paho sent or queued the publish (it must not be buffered again)."""
+    return result.rc != mqtt.MQTT_ERR_QUEUE_SIZE
+
+
+class ReadingBacklog:
+    """
+    device_id    -> device the readings belong to
+    max_readings -> backlog size; the oldest readings are dropped beyond it
+    batch_max    -> readings per batch payload (at most payload_codec.MAX_BATCH)
+    binary       -> send batches in the binary layout instead of JSON
+    """
+
+    def __init__(self, device_id: str, max_readings: int = 8640, batch_max: int = 500,
+                 binary: bool = False, log_prefix: str = "[weight]"):
+        self.device_id = device_id
+        self.batch_max = max(1, min(int(batch_max), payload_codec.MAX_BATCH))
+        self.binary = binary
+        self.log_prefix = log_prefix
+        self._readings = deque(maxlen=max(1, int(max_readings)))   # (weight, timestamp, seq)
+        self._lock = threading.Lock()
+        self.dropped = 0
+        self.forwarded = 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._readings)
+
+    def add(self, weight: float, timestamp, seq: int):
+        with self._lock:
+            if len(self._readings) == self._readings.maxlen:
+                self.dropped += 1
+            self._readings.append((float(weight), timestamp, seq))
+
+    def flush(self, client, topic: str) -> int:
+        """
+        Publish the backlog in batches of batch_max readings. Stops at the first
+        batch paho does not take (it stays buffered). Returns readings handed over.
+        """
+        sent = 0
+        with self._lock:   # one flush at a time, and no add() between encoding and popping a batch
+            while self._readings:
+                batch = list(islice(self._readings, self.batch_max))
+                payload = payload_codec.encode_batch(self.device_id, batch, self.binary)
+                result = client.publish(topic, payload=payload, qos=1)
+                if not handed_over(result):
+                    print(f"{self.log_prefix} ERROR - Failed to queue backlog batch (rc: {result.rc}), "
+                          f"{len(self._readings)} readings still buffered", flush=True)
+                    break
+                for _ in batch:
+                    self._readings.popleft()
+                sent += len(batch)
+        if sent:
+            self.forwarded += sent
+            print(f"{self.log_prefix} 📦 Forwarded {sent} buffered readings after reconnecting", flush=True)
+        return sent
@@ -7,6 +7,9 @@ from datetime import datetime
 from flask import Flask, render_template, request, jsonify
 from flask_cors import CORS
 
+import payload_codec
+from store_forward import ReadingBacklog, handed_over
+
 app = Flask(__name__)
 CORS(app)
 
@@ -18,6 +21,22 @@ MQTT_TOPIC = os.getenv("MQTT_TOPIC", "milk/weight")
 # Device Configuration
 DEVICE_ID = os.getenv("DEVICE_ID", "device1")
 
+# Publish to milk/weight/<device_id> instead of the shared topic (consumers subscribe to both)
+MQTT_PER_DEVICE_TOPIC = os.getenv("MQTT_PER_DEVICE_TOPIC", "false").lower() == "true"
+PUBLISH_TOPIC = f"{MQTT_TOPIC}/{DEVICE_ID}" if MQTT_PER_DEVICE_TOPIC else MQTT_TOPIC
+
+# json | binary (24-byte packed reading, see payload_codec.py; always on milk/weight/bin/<device_id>)
+PAYLOAD_FORMAT = os.getenv("PAYLOAD_FORMAT", "json").lower()
+if PAYLOAD_FORMAT == "binary":
+    PUBLISH_TOPIC = payload_codec.binary_topic(MQTT_TOPIC, DEVICE_ID)
+
+# Store-and-forward: readings taken while the broker is unreachable are buffered and
+# sent as batch payloads once the client reconnects (see store_forward.py)
+STORE_FORWARD_MAX_READINGS = int(os.getenv("STORE_FORWARD_MAX_READINGS", "8640"))  # ~24h at one reading per 10s
+STORE_FORWARD_BATCH_SIZE = int(os.getenv("STORE_FORWARD_BATCH_SIZE", "500"))       # readings per batch payload
+backlog = ReadingBacklog(DEVICE_ID, STORE_FORWARD_MAX_READINGS, STORE_FORWARD_BATCH_SIZE,
+                         binary=PAYLOAD_FORMAT == "binary", log_prefix="[weight-web]")
+
 # Global MQTT client
 client = mqtt.Client()
 message_count = 0
@@ -25,6 +44,8 @@ message_count = 0
 def on_connect(client, userdata, flags, rc):
     if rc == 0:
         print(f"[weight-web] Connected to MQTT broker at {MQTT_HOST}:{MQTT_PORT} successfully", flush=True)
+        if len(backlog):
+            backlog.flush(client, PUBLISH_TOPIC)
     else:
         print(f"[weight-web] ERROR - Connection failed (rc: {rc})", flush=True)
 
@@ -56,23 +77,38 @@ def publish_weight_to_mqtt(weight):
     message_count += 1
     
     try:
+        now = datetime.now()
+        
+        # Broker unreachable: keep the reading and forward it with the backlog on reconnect
+        if not client.is_connected():
+            backlog.add(weight, now, message_count)
+            print(f"[weight-web] Manual input #{message_count}: Broker unreachable - buffered weight {weight}g ({len(backlog)} readings waiting)", flush=True)
+            return {"success": True, "queued": True, "message": f"Broker unreachable - weight {weight}g buffered, it will be sent on reconnect"}
+        if len(backlog):
+            backlog.flush(client, PUBLISH_TOPIC)
+        
         # Create JSON payload with device_id, weight, and unique message ID
         payload_data = {
             "device_id": DEVICE_ID,
             "weight": float(weight),
-            "timestamp": datetime.now().isoformat(),
-            "message_id": f"weight-manual-{message_count}-{int(time.time())}"
+            "timestamp": now.isoformat(),
+            "message_id": payload_codec.message_id(message_count, now)
         }
-        payload_json = json.dumps(payload_data)
+        if PAYLOAD_FORMAT == "binary":
+            payload = payload_codec.encode(DEVICE_ID, weight, now, seq=message_count)
+        else:
+            payload = json.dumps(payload_data)
         
         print(f"[weight-web] Manual input #{message_count}: Sending device {DEVICE_ID}, weight {weight}g, msg_id: {payload_data['message_id']}", flush=True)
         
-        result = client.publish(MQTT_TOPIC, payload=payload_json, qos=1)
+        result = client.publish(PUBLISH_TOPIC, payload=payload, qos=1)
         
-        if result.rc == 0:
+        # rc NO_CONN still means queued: paho sends QoS 1 messages on reconnect, so only a full paho queue is buffered
+        if handed_over(result):
             return {"success": True, "message": f"Weight {weight}g sent successfully", "message_id": payload_data['message_id']}
         else:
-            return {"success": False, "message": f"Failed to send weight data (rc: {result.rc})"}
+            backlog.add(weight, now, message_count)
+            return {"success": True, "queued": True, "message": f"Failed to send weight data (rc: {result.rc}) - buffered, it will be retried"}
             
     except Exception as e:
         print(f"[weight-web] Error publishing weight: {e}", flush=True)
@@ -115,9 +151,12 @@ def status():
     return jsonify({
         "service": "weight-web-interface",
         "mqtt_host": MQTT_HOST,
-        "mqtt_topic": MQTT_TOPIC,
+        "mqtt_topic": PUBLISH_TOPIC,
+        "payload_format": PAYLOAD_FORMAT,
         "device_id": DEVICE_ID,
-        "messages_sent": message_count
+        "messages_sent": message_count,
+        "buffered_readings": len(backlog),
+        "buffer_dropped": backlog.dropped
     })
 
 if __name__ == '__main__':